@@ -22,14 +22,18 @@ from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials
 
 from app.services.apphttpbearer import AppHttpBearer
-from app.models.user import Status, User
+from app.models.user import Status, User, UpdateConflictError, BreachedPasswordError
+from app.services.email_filter import EMAIL_FILTER
 from app.services.send_mail import send_recovery_mail
 from app.pydantic.models import BodyRequest
 from app.resources.dependencies import oauth2_scheme_session
+from app.resources.required_packages import set_read_scope
 
 INVALID_EMAIL_OR_PASSWORD_MESSAGE = "Invalid Email or password."
 PASSWORD_ALREADY_USED_MESSAGE = "Password already used."
 INVALID_EMAIL_MESSAGE = "Invalid email."
+CONFLICT_MESSAGE = "User was modified meanwhile, read it again."
+BREACHED_PASSWORD_MESSAGE = "Password found in a data breach, choose another one."
 
 AUTH = APIRouter(
     prefix="/user",
@@ -52,10 +56,12 @@ def register(data: BodyRequest):
         400: An error occurred.
     """
     user_data = data.data
+    set_read_scope(user_data["email"])
     new_user = User(email=user_data["email"])
 
-    # Check if email already exists
-    if not new_user.select():
+    # Check if email already exists. New emails are mostly answered by the
+    # filter, the unique constraint refuses those registered meanwhile.
+    if not EMAIL_FILTER.exists(user_data["email"], new_user.select):
         # Insert user in db
         new_user.host = user_data["host"]
         new_user.first_name = user_data["first_name"]
@@ -103,15 +109,18 @@ def oauth2_login(form_data: OAuth2PasswordRequestForm = Depends()):
         username: The email address of the user, this is required.
         password: The password of the user, this is required.
         scope: The scope of the access token, this is optional.
-        client_id: The client id, this is optional.
+        client_id: The client id, this is optional. It identifies the device
+                   so each device keeps its own session.
         client_secret: The client secret, this is optional.
 
     Returns:
         200 Token: The access token and token type.
         400: Invalid Email or password.
     """
+    # The requests of the new token read the session from the primary
+    set_read_scope(form_data.username)
     user = User(email=form_data.username, password=form_data.password)
-    user_data = user.authenticate_user()
+    user_data = user.authenticate_user(device=form_data.client_id)
     if not user_data:
         raise HTTPException(
             status_code=400,
@@ -121,14 +130,19 @@ def oauth2_login(form_data: OAuth2PasswordRequestForm = Depends()):
     return JSONResponse(content=user_data, status_code=200)
 
 
-@AUTH.post("/logout", dependencies=[Depends(oauth2_sheme)], description="Logout a user")
-def logout(data: BodyRequest) -> JSONResponse:
-
+@AUTH.post("/logout", description="Logout a user")
+def logout(
+    data: BodyRequest,
+    decode_token: HTTPAuthorizationCredentials = Depends(oauth2_sheme),
+) -> JSONResponse:
     """
     Log out a user.
 
     - email (BodyRequest): Email of the user to log out (required)
 
+    Only the session of the token is ended. Tokens without session end
+    every session of the user.
+
     Returns:
         200: User logged out successfully.
     """
@@ -137,7 +151,8 @@ def logout(data: BodyRequest) -> JSONResponse:
     if not user.select():
         raise HTTPException(status_code=404, detail=INVALID_EMAIL_MESSAGE)
 
-    user.end_session()
+    sid = decode_token.get("sid") if decode_token["sub"] == user.email else None
+    user.end_session(sid)
     return JSONResponse(
         content={"message": "User logged out successfully."},
         status_code=200,
@@ -225,7 +240,12 @@ def reset_password(
         "password": str(new_login["password"]),
         "status": Status.ACTIVE.value,
     }
-    original = user_to_reset.update(updated_user_data)
+    try:
+        original = user_to_reset.update(updated_user_data)
+    except UpdateConflictError as exception:
+        raise HTTPException(status_code=409, detail=CONFLICT_MESSAGE) from exception
+    except BreachedPasswordError as exception:
+        raise HTTPException(status_code=400, detail=BREACHED_PASSWORD_MESSAGE) from exception
     if original is None:
         raise HTTPException(status_code=400, detail=INVALID_EMAIL_MESSAGE)
 
@@ -246,6 +266,7 @@ def update_profile(
     Returns:
         200: User information is successfully updated.
         400: An error occurred.
+        409: The user was modified meanwhile, or "version" is not current.
     """
     update_data = user_data.data
     if not update_data:
@@ -255,7 +276,12 @@ def update_profile(
     current_user = User(email=email)
 
     # Update user information in the database based on user_data
-    updated_user = current_user.update(update_data)
+    try:
+        updated_user = current_user.update(update_data)
+    except UpdateConflictError as exception:
+        raise HTTPException(status_code=409, detail=CONFLICT_MESSAGE) from exception
+    except BreachedPasswordError as exception:
+        raise HTTPException(status_code=400, detail=BREACHED_PASSWORD_MESSAGE) from exception
 
 
     if updated_user is None:
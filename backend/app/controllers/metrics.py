@@ -0,0 +1,24 @@
+"""
+This file contains the route of the metrics of the API.
+
+Attributes:
+    - METRICS (APIRouter): The router for the metrics.
+    - metrics (function): The function returning the metrics of the worker.
+"""
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.services.metrics import REGISTRY
+
+METRICS = APIRouter(tags=["metrics"])
+
+
+@METRICS.get("/metrics", description="Metrics of the worker, Prometheus text format.")
+def metrics() -> PlainTextResponse:
+    """
+    Return the metrics of the worker answering.
+
+    Returns:
+        200: The metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
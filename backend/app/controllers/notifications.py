@@ -0,0 +1,62 @@
+"""
+This file contains the routes for the notification preferences.
+
+Attributes:
+    - NOTIFICATIONS (APIRouter): The router for the notification preferences.
+    - get_notifications (function): The function to read the preferences of the user.
+    - update_notifications (function): The function to change preferences of the user.
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
+from fastapi.security import HTTPAuthorizationCredentials
+
+from app.models.notification import get_preferences, update_preferences, to_dict
+from app.pydantic.models import BodyRequest
+from app.resources.dependencies import oauth2_scheme_session
+
+INVALID_PREFERENCES_MESSAGE = "Send preference names with true or false."
+
+NOTIFICATIONS = APIRouter(
+    prefix="/user",
+    tags=["notifications"],
+    responses={401: {"description": "Token expired"}},
+)
+
+
+@NOTIFICATIONS.get("/notifications", description="Read the notification preferences.")
+def get_notifications(
+    login_decode_token: HTTPAuthorizationCredentials = Depends(oauth2_scheme_session),
+) -> JSONResponse:
+    """
+    Read the notification preferences of the connected user.
+
+    Returns:
+        200: {name: bool} of every notification.
+    """
+    preferences = get_preferences(login_decode_token["sub"])
+    return JSONResponse(content=to_dict(preferences), status_code=200)
+
+
+@NOTIFICATIONS.patch("/notifications", description="Change notification preferences.")
+def update_notifications(
+    data: BodyRequest,
+    login_decode_token: HTTPAuthorizationCredentials = Depends(oauth2_scheme_session),
+) -> JSONResponse:
+    """
+    Change notification preferences of the connected user.
+
+    - data (BodyRequest): {name: bool} of the notifications to change, the
+                          others are kept.
+
+    Returns:
+        200: {name: bool} of every notification, once changed.
+        400: No data sent, an unknown name or a value other than a boolean.
+    """
+    changes = data.data
+    if not changes or not isinstance(changes, dict):
+        raise HTTPException(status_code=400, detail="No data sent.")
+    try:
+        preferences = update_preferences(login_decode_token["sub"], changes)
+    except ValueError as exception:
+        raise HTTPException(status_code=400, detail=INVALID_PREFERENCES_MESSAGE) from exception
+    return JSONResponse(content=to_dict(preferences), status_code=200)
@@ -0,0 +1,364 @@
+"""
+This file contains the routes for the waste sightings.
+
+Attributes:
+    - SIGHTINGS (APIRouter): The router for the waste sightings.
+    - report_sighting (function): The function to report a sighting.
+    - list_sightings (function): The function to list the sightings of a box.
+    - nearby_sightings (function): The function to list the sightings around a point.
+    - cluster_sightings (function): The function to cluster the sightings of a map viewport.
+    - read_sighting (function): The function to read a sighting.
+    - resolve (function): The function to mark a sighting cleaned up.
+    - upload_report_photos (function): The function to store photos before a report.
+    - upload_photos (function): The function to attach photos to a sighting.
+    - list_photos (function): The function to list the photos of a sighting.
+    - read_photo (function): The function to read a photo.
+    - read_thumbnail (function): The function to read the thumbnail of a photo.
+"""
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.security import HTTPAuthorizationCredentials
+
+from app.models.sighting import (
+    add_photos, create_sighting, get_sighting, resolve_sighting, sighting_clusters,
+    sighting_photos, sightings_in_bbox, sightings_nearby)
+from app.pydantic.models import BodyRequest
+from app.resources.dependencies import oauth2_scheme_session
+from app.resources.required_packages import PHOTO_MAX_BYTES
+from app.services.photos import (
+    DIGEST, PHOTO_MAX_FILES, UploadError, perceptual_hash, photo_path, receive_photos)
+
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 1000
+MAX_RADIUS_KM = 100
+MAX_DESCRIPTION_LENGTH = 2000
+MAX_ZOOM = 22
+# A map viewport covers a few tiles of its zoom, of 64 cells each
+MAX_CLUSTER_CELLS = 4096
+INVALID_SIGHTING_MESSAGE = ("Send a latitude in [-90, 90], a longitude in [-180, 180] "
+                            f"and a description of at most {MAX_DESCRIPTION_LENGTH} characters.")
+INVALID_PHOTOS_MESSAGE = f"Send the digests of at most {PHOTO_MAX_FILES} uploaded photos."
+INVALID_BBOX_MESSAGE = "Send bbox as west,south,east,north in degrees."
+LARGE_VIEWPORT_MESSAGE = "The bbox is too large for this zoom."
+SIGHTING_NOT_FOUND_MESSAGE = "Sighting not found."
+PHOTO_NOT_FOUND_MESSAGE = "Photo not found."
+# Room for the headers and boundaries of the parts
+MULTIPART_OVERHEAD = 64 * 1024
+# A digest names a single content
+PHOTO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+SIGHTINGS = APIRouter(
+    prefix="/sightings",
+    tags=["sightings"],
+    responses={401: {"description": "Token expired"}},
+)
+
+
+def _coordinate(value):
+    """
+    Return value as a float, raise 400 if it is not a number
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise HTTPException(status_code=400, detail=INVALID_SIGHTING_MESSAGE)
+    return float(value)
+
+
+def parse_bbox(bbox: str) -> tuple:
+    """
+    Return (south, west, north, east) of "west,south,east,north", raise
+    400 if it is invalid. A west edge east of the east edge crosses the
+    antimeridian.
+    """
+    try:
+        west, south, east, north = (float(edge) for edge in bbox.split(","))
+    except ValueError as exception:
+        raise HTTPException(status_code=400, detail=INVALID_BBOX_MESSAGE) from exception
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise HTTPException(status_code=400, detail=INVALID_BBOX_MESSAGE)
+    return south, west, north, east
+
+
+@SIGHTINGS.post("", description="Report a waste sighting.")
+def report_sighting(
+    data: BodyRequest,
+    login_decode_token: HTTPAuthorizationCredentials = Depends(oauth2_scheme_session),
+) -> JSONResponse:
+    """
+    Report a waste sighting at a point. A report close in space and time
+    to an open one, with a similar photo if both have photos, is linked to
+    it as a duplicate.
+
+    - data (BodyRequest): {"latitude", "longitude"} in degrees, an optional
+                          "description", and the optional "photos" digests
+                          returned by POST /sightings/photos.
+
+    Returns:
+        201: The sighting, with its id, and the id of the report it
+             duplicates in duplicate_of.
+        400: The position, the description or the photos are invalid.
+    """
+    report = data.data
+    if not isinstance(report, dict):
+        raise HTTPException(status_code=400, detail="No data sent.")
+    description = report.get("description", "")
+    if not isinstance(description, str) or len(description) > MAX_DESCRIPTION_LENGTH:
+        raise HTTPException(status_code=400, detail=INVALID_SIGHTING_MESSAGE)
+    digests = report.get("photos", [])
+    if (not isinstance(digests, list) or len(digests) > PHOTO_MAX_FILES
+            or not all(isinstance(digest, str) and DIGEST.match(digest) for digest in digests)):
+        raise HTTPException(status_code=400, detail=INVALID_PHOTOS_MESSAGE)
+    digests = list(dict.fromkeys(digests))
+    try:
+        hashes = tuple(perceptual_hash(digest) for digest in digests)
+    except FileNotFoundError as exception:
+        raise HTTPException(status_code=400, detail=INVALID_PHOTOS_MESSAGE) from exception
+    try:
+        sighting = create_sighting(login_decode_token["sub"],
+                                   _coordinate(report.get("latitude")),
+                                   _coordinate(report.get("longitude")), description,
+                                   digests, hashes)
+    except ValueError as exception:
+        raise HTTPException(status_code=400, detail=INVALID_SIGHTING_MESSAGE) from exception
+    return JSONResponse(content=sighting, status_code=201)
+
+
+@SIGHTINGS.get(
+    "",
+    dependencies=[Depends(oauth2_scheme_session)],
+    description="List the sightings of a bounding box.",
+)
+def list_sightings(
+    bbox: str,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+) -> JSONResponse:
+    """
+    List the sightings of a bounding box, by id.
+
+    - bbox (str): west,south,east,north in degrees.
+    - limit (int): The maximum number of sightings.
+
+    Returns:
+        200: The sightings of the box.
+        400: The box is invalid.
+    """
+    return JSONResponse(content={"sightings": sightings_in_bbox(*parse_bbox(bbox), limit)},
+                        status_code=200)
+
+
+@SIGHTINGS.get(
+    "/nearby",
+    dependencies=[Depends(oauth2_scheme_session)],
+    description="List the sightings around a point.",
+)
+def nearby_sightings(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(1.0, gt=0, le=MAX_RADIUS_KM),
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+) -> JSONResponse:
+    """
+    List the sightings within radius_km of a point, nearest first.
+
+    - lat (float): The latitude of the point.
+    - lon (float): The longitude of the point.
+    - radius_km (float): The radius of the search.
+    - limit (int): The maximum number of sightings.
+
+    Returns:
+        200: The sightings, with their distance_km.
+    """
+    return JSONResponse(content={"sightings": sightings_nearby(lat, lon, radius_km, limit)},
+                        status_code=200)
+
+
+@SIGHTINGS.get(
+    "/clusters",
+    dependencies=[Depends(oauth2_scheme_session)],
+    description="Cluster the open sightings of a map viewport.",
+)
+def cluster_sightings(
+    bbox: str,
+    zoom: int = Query(..., ge=0, le=MAX_ZOOM),
+) -> JSONResponse:
+    """
+    Return the clusters of the open sightings of a map viewport, from the
+    aggregates of its zoom level.
+
+    - bbox (str): west,south,east,north of the viewport in degrees.
+    - zoom (int): The zoom level of the map.
+
+    Returns:
+        200: The clusters {"count", "latitude", "longitude"}, with the "id"
+             of the clusters of one sighting.
+        400: The box is invalid, or covers too many cells at this zoom.
+    """
+    try:
+        clusters = sighting_clusters(*parse_bbox(bbox), zoom, MAX_CLUSTER_CELLS)
+    except ValueError as exception:
+        raise HTTPException(status_code=400, detail=LARGE_VIEWPORT_MESSAGE) from exception
+    return JSONResponse(content={"clusters": clusters}, status_code=200)
+
+
+def _photo_urls(digest: str) -> dict:
+    return {"digest": digest, "url": f"{SIGHTINGS.prefix}/photos/{digest}",
+            "thumbnail_url": f"{SIGHTINGS.prefix}/photos/{digest}/thumbnail"}
+
+
+def _photo_file(digest: str, thumbnail: bool) -> FileResponse:
+    if not DIGEST.match(digest):
+        raise HTTPException(status_code=404, detail=PHOTO_NOT_FOUND_MESSAGE)
+    path = photo_path(digest, thumbnail=thumbnail)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=PHOTO_NOT_FOUND_MESSAGE)
+    return FileResponse(path, media_type="image/jpeg",
+                        headers={"Cache-Control": PHOTO_CACHE_CONTROL})
+
+
+@SIGHTINGS.get("/photos/{digest}", description="Read a sighting photo.")
+def read_photo(digest: str) -> FileResponse:
+    """
+    Read a photo by digest, stripped of its metadata. Photos are not
+    protected so that maps can show them, their digest is their secret.
+
+    Returns:
+        200: The JPEG photo.
+        404: No photo has this digest.
+    """
+    return _photo_file(digest, thumbnail=False)
+
+
+@SIGHTINGS.get("/photos/{digest}/thumbnail", description="Read a sighting photo thumbnail.")
+def read_thumbnail(digest: str) -> FileResponse:
+    """
+    Read the thumbnail of a photo by digest.
+
+    Returns:
+        200: The JPEG thumbnail.
+        404: No photo has this digest.
+    """
+    return _photo_file(digest, thumbnail=True)
+
+
+@SIGHTINGS.get(
+    "/{sighting_id}",
+    dependencies=[Depends(oauth2_scheme_session)],
+    description="Read a sighting.",
+)
+def read_sighting(sighting_id: int) -> JSONResponse:
+    """
+    Read a sighting, with its reporter and description.
+
+    Returns:
+        200: The sighting, with the id of the report it duplicates and the
+             count of its duplicates.
+        404: No sighting has this id.
+    """
+    sighting = get_sighting(sighting_id)
+    if sighting is None:
+        raise HTTPException(status_code=404, detail=SIGHTING_NOT_FOUND_MESSAGE)
+    return JSONResponse(content=sighting, status_code=200)
+
+
+@SIGHTINGS.post("/{sighting_id}/resolve", description="Mark a sighting cleaned up.")
+def resolve(
+    sighting_id: int,
+    login_decode_token: HTTPAuthorizationCredentials = Depends(oauth2_scheme_session),
+) -> JSONResponse:
+    """
+    Mark a sighting cleaned up by the connected user. It leaves the clusters
+    of the map, and stays listed as RESOLVED.
+
+    Returns:
+        200: The sighting, RESOLVED.
+        404: No sighting has this id.
+    """
+    sighting = resolve_sighting(login_decode_token["sub"], sighting_id)
+    if sighting is None:
+        raise HTTPException(status_code=404, detail=SIGHTING_NOT_FOUND_MESSAGE)
+    return JSONResponse(content=sighting, status_code=200)
+
+
+async def _receive(request: Request) -> list:
+    """
+    Store the photos of an upload and return their digests, raise the
+    status of a refused upload
+    """
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > PHOTO_MAX_FILES * PHOTO_MAX_BYTES + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail="The photos are too large.")
+    try:
+        photos = await receive_photos(request.headers.get("content-type"), request.stream())
+    except UploadError as exception:
+        raise HTTPException(status_code=exception.status_code,
+                            detail=exception.message) from exception
+    return list(dict.fromkeys(photo.digest for photo in photos))
+
+
+@SIGHTINGS.post(
+    "/photos",
+    dependencies=[Depends(oauth2_scheme_session)],
+    description="Store photos to send with a report.",
+)
+async def upload_report_photos(request: Request) -> JSONResponse:
+    """
+    Store photos before reporting a sighting: their digests go in the
+    "photos" of the report, and help telling apart its duplicates.
+
+    - body: multipart/form-data, with one file part per photo.
+
+    Returns:
+        201: The photos, with their digest and urls.
+        400: No photo, or too many.
+        413: A photo is too large.
+        415: The body is not multipart, or a photo is not an image.
+    """
+    digests = await _receive(request)
+    return JSONResponse(content={"photos": [_photo_urls(digest) for digest in digests]},
+                        status_code=201)
+
+
+@SIGHTINGS.post("/{sighting_id}/photos", description="Attach photos to a sighting.")
+async def upload_photos(
+    sighting_id: int,
+    request: Request,
+    login_decode_token: HTTPAuthorizationCredentials = Depends(oauth2_scheme_session),
+) -> JSONResponse:
+    """
+    Attach photos to a sighting. The body is stored as it is received, the
+    photos are stripped of their metadata and thumbnailed.
+
+    - body: multipart/form-data, with one file part per photo.
+
+    Returns:
+        201: The photos, with their digest and urls.
+        400: No photo, or too many.
+        404: No sighting has this id.
+        413: A photo is too large.
+        415: The body is not multipart, or a photo is not an image.
+    """
+    if await run_in_threadpool(get_sighting, sighting_id) is None:
+        raise HTTPException(status_code=404, detail=SIGHTING_NOT_FOUND_MESSAGE)
+    digests = await _receive(request)
+    await run_in_threadpool(add_photos, login_decode_token["sub"], sighting_id, digests)
+    return JSONResponse(content={"photos": [_photo_urls(digest) for digest in digests]},
+                        status_code=201)
+
+
+@SIGHTINGS.get(
+    "/{sighting_id}/photos",
+    dependencies=[Depends(oauth2_scheme_session)],
+    description="List the photos of a sighting.",
+)
+def list_photos(sighting_id: int) -> JSONResponse:
+    """
+    List the photos of a sighting, oldest first.
+
+    Returns:
+        200: The photos, with their digest, urls, reporter and date.
+    """
+    return JSONResponse(content={"photos": [{**photo, **_photo_urls(photo["digest"])}
+                                            for photo in sighting_photos(sighting_id)]},
+                        status_code=200)
@@ -0,0 +1,158 @@
+"""
+This file contains the routes for the administration of users.
+
+Attributes:
+    - USERS (APIRouter): The router for the administration of users.
+    - bulk_import (function): The function to import users from CSV or NDJSON.
+    - list_users (function): The function to list users page by page.
+"""
+import base64
+import binascii
+from datetime import datetime
+import json
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+
+from app.models.user import Status, list_users as list_users_page, estimate_user_count
+from app.resources.dependencies import oauth2_scheme_admin
+from app.resources.required_packages import BULK_IMPORT_BATCH_SIZE
+from app.services.bulk_import import (
+    iter_records, validate_record, import_batch, send_invites)
+
+USERS = APIRouter(
+    prefix="/user",
+    tags=["users"],
+    responses={403: {"description": "Admin rights required"}},
+)
+
+BODY_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+}
+
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 200
+INVALID_CURSOR_MESSAGE = "Invalid cursor."
+
+
+@USERS.post(
+    "/bulk-import",
+    dependencies=[Depends(oauth2_scheme_admin)],
+    description="Import users from a CSV or NDJSON body.",
+)
+async def bulk_import(request: Request, background_tasks: BackgroundTasks) -> JSONResponse:
+    """
+    Import users, one record per line.
+
+    - body: CSV with a header line (Content-Type text/csv) or NDJSON
+            (Content-Type application/x-ndjson). Records need email, host,
+            first_name, last_name and lang, password is optional.
+
+    Returns:
+        200: The number of users created and the errors of the other lines.
+        415: The body format is not supported.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    body_format = BODY_FORMATS.get(content_type)
+    if body_format is None:
+        raise HTTPException(status_code=415, detail="Send text/csv or application/x-ndjson.")
+
+    created, errors, batch, seen = 0, [], [], set()
+
+    async def flush():
+        nonlocal created
+        batch_created, batch_errors = await run_in_threadpool(import_batch, list(batch))
+        batch.clear()
+        created += len(batch_created)
+        errors.extend(batch_errors)
+        if batch_created:
+            background_tasks.add_task(send_invites, batch_created)
+
+    async for line, record, error in iter_records(request.stream(), body_format):
+        if error is None:
+            row, error = validate_record(record, seen)
+        if error is not None:
+            errors.append({"line": line, "email": (record or {}).get("email"), "error": error})
+            continue
+        batch.append((line, row))
+        if len(batch) >= BULK_IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+
+    errors.sort(key=lambda error: error["line"])
+    return JSONResponse(content={"created": created, "errors": errors}, status_code=200)
+
+
+def encode_cursor(after: tuple) -> str:
+    """
+    Return the opaque cursor of (created_date, id, email)
+    """
+    created_date, user_id, email = after
+    raw = json.dumps([created_date.isoformat(), user_id, email]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Return (created_date, id, email) of a cursor, raise 400 if it is invalid
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_date, user_id, email = json.loads(raw)
+        if not isinstance(email, str):
+            raise TypeError("The email of the cursor is not a string")
+        return datetime.fromisoformat(created_date), int(user_id), email
+    except (binascii.Error, ValueError, TypeError) as exception:
+        raise HTTPException(status_code=400, detail=INVALID_CURSOR_MESSAGE) from exception
+
+
+@USERS.get(
+    "/list",
+    dependencies=[Depends(oauth2_scheme_admin)],
+    description="List users, newest first.",
+)
+def list_users(
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    cursor: str = None,
+    status: str = None,
+    lang: str = None,
+    host: str = None,
+) -> JSONResponse:
+    """
+    List users page by page.
+
+    - limit (int): The number of users per page.
+    - cursor (str): The next_cursor of the previous page.
+    - status (str): Only the users of this status, e.g. ACTIVE.
+    - lang (str): Only the users of this language.
+    - host (str): Only the users of this host.
+
+    Returns:
+        200: The users of the page, the cursor of the next page (null on the
+             last page) and the estimated number of users matching the filters.
+        400: The cursor or the status is invalid.
+    """
+    filters = {"lang": lang, "host": host}
+    if status is not None:
+        if status.upper() not in Status.__members__:
+            raise HTTPException(status_code=400, detail="Invalid status.")
+        filters["status"] = Status[status.upper()].value
+    after = decode_cursor(cursor) if cursor else None
+
+    users, next_after = list_users_page(limit, after, **filters)
+    for user in users:
+        user["created_date"] = str(user["created_date"])
+        user["updated_date"] = str(user["updated_date"])
+
+    return JSONResponse(
+        content={
+            "users": users,
+            "next_cursor": encode_cursor(next_after) if next_after else None,
+            "estimated_total": estimate_user_count(**filters),
+        },
+        status_code=200,
+    )
@@ -0,0 +1,105 @@
+"""
+This file contains the WebSocket routes.
+
+Attributes:
+    - WEBSOCKET (APIRouter): The router for the WebSocket connections.
+    - notifications_socket (function): The function pushing the messages of the user.
+"""
+import asyncio
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+
+from app.resources.dependencies import oauth2_scheme_session
+from app.services.push import BROKER, EVICTED
+
+# Browsers cannot set headers: they offer the subprotocols ["bearer", token]
+TOKEN_SUBPROTOCOL = "bearer"
+SLOW_CONSUMER_MESSAGE = "Too many messages behind, reconnect."
+SESSION_ENDED_MESSAGE = "Session ended."
+
+WEBSOCKET = APIRouter(
+    prefix="/ws",
+    tags=["websocket"],
+)
+
+
+def _token(websocket: WebSocket) -> tuple:
+    """
+    Return the bearer token of the Authorization header, or of the
+    Sec-WebSocket-Protocol header for the browsers, and the subprotocol to
+    accept. The token is never read from the URL, which is logged.
+    """
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return token, None
+    subprotocols = websocket.scope.get("subprotocols", [])
+    if len(subprotocols) == 2 and subprotocols[0] == TOKEN_SUBPROTOCOL:
+        return subprotocols[1], TOKEN_SUBPROTOCOL
+    return None, None
+
+
+async def _send(websocket: WebSocket, subscription):
+    """
+    Send the messages of subscription until it is evicted, its session
+    ends or the client leaves
+    """
+    try:
+        while True:
+            message = await subscription.get()
+            if message is EVICTED:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER,
+                                      reason=SLOW_CONSUMER_MESSAGE)
+                return
+            await websocket.send_json(message)
+            if (message["event"] == "session.ended" and subscription.sid
+                    and message["payload"].get("sid") == subscription.sid):
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION,
+                                      reason=SESSION_ENDED_MESSAGE)
+                return
+    except (WebSocketDisconnect, RuntimeError):
+        # The client left while a message was sent
+        return
+
+
+@WEBSOCKET.websocket("/notifications")
+async def notifications_socket(websocket: WebSocket):
+    """
+    Push the notifications of the connected user as JSON messages
+    {"event", "payload"}, with the "id" of the change events.
+
+    - token: The bearer token, in the Authorization header, or offered by
+             browsers as the subprotocols ["bearer", token].
+
+    Closes with:
+        1008: The token or its session is not valid, or the session ended.
+        1013: The client read too slowly, it may reconnect.
+    """
+    token, subprotocol = _token(websocket)
+    try:
+        if not token:
+            raise HTTPException(403, "Not authenticated")
+        claims = await run_in_threadpool(oauth2_scheme_session.verify, token)
+    except HTTPException as exception:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=exception.detail)
+        return
+
+    # Subscribed before the handshake ends: no message sent after it is lost
+    subscription = BROKER.subscribe(claims["sub"], claims.get("sid"))
+    sender = None
+    try:
+        await websocket.accept(subprotocol=subprotocol)
+        sender = asyncio.create_task(_send(websocket, subscription))
+        # The client only closes; its messages are ignored
+        while True:
+            received = asyncio.create_task(websocket.receive())
+            done, _ = await asyncio.wait({received, sender}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done:
+                received.cancel()
+                break
+            if received.result()["type"] == "websocket.disconnect":
+                break
+    finally:
+        BROKER.unsubscribe(subscription)
+        if sender is not None:
+            sender.cancel()
@@ -0,0 +1,35 @@
+"""
+This file contains the well-known routes of the API.
+
+Attributes:
+    - WELL_KNOWN (APIRouter): The router for the well-known routes.
+    - jwks (function): The function returning the public keys of the API.
+"""
+from fastapi import APIRouter, Request, Response
+
+from app.resources.required_packages import JWKS_MAX_AGE
+from app.services.jwt_keys import KEYRING
+
+WELL_KNOWN = APIRouter(
+    prefix="/.well-known",
+    tags=["well-known"],
+)
+
+
+@WELL_KNOWN.get("/jwks.json", description="Public keys used to sign the tokens.")
+def jwks(request: Request) -> Response:
+    """
+    Return the JSON Web Key Set so other services can verify tokens locally.
+
+    Returns:
+        200: The key set, cacheable for JWKS_MAX_AGE seconds.
+        304: The key set did not change since the given ETag.
+    """
+    headers = {
+        "Cache-Control": f"public, max-age={JWKS_MAX_AGE}",
+        "ETag": KEYRING.jwks_etag,
+    }
+    if request.headers.get("if-none-match") == KEYRING.jwks_etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=KEYRING.jwks_json, media_type="application/json",
+                    headers=headers)
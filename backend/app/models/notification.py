@@ -0,0 +1,129 @@
+"""
+This file contains the notification preferences of the users.
+
+The preferences of a user are one bitmask, a bit per NotificationPreference,
+in the preferences column of its notification row. Users without row
+subscribe to nothing. Reads are served from PREFERENCES_CACHE for
+NOTIF_CACHE_TTL seconds, refreshed by the writes of the worker: other
+workers see a change once their entry expires.
+
+Attributes:
+    - PREFERENCE_NAMES (dict): The flag of each preference name of the API.
+    - PREFERENCES_CACHE (TTLCache): The bitmasks read recently, by email.
+    - to_mask (function): The bits set and cleared by {name: bool}.
+    - to_dict (function): The {name: bool} of a bitmask.
+    - get_preferences (function): The bitmask of a user.
+    - update_preferences (function): Set and clear preferences of a user.
+    - iter_subscribers (function): The emails of the users wanting a notification.
+"""
+import time
+
+from psycopg2 import sql
+
+from app.models.user import db_for, all_databases
+from app.resources.cache import TTLCache
+from app.resources.required_packages import NOTIF_CACHE_SIZE, NOTIF_CACHE_TTL
+from app.resources.shards import normalize_email
+from app.resources.type.notification import NotificationPreference
+from app.resources.db_utils.user_queries import (NOTIF_SELECT_QUERY, NOTIF_INSERT_QUERY,
+                                                 NOTIF_UPDATE_QUERY, NOTIF_SUBSCRIBERS_QUERY)
+from app.services.outbox import record
+
+NOTIF_SUBSCRIBERS_BATCH_SIZE = 1000
+
+PREFERENCE_NAMES = {preference.name.lower(): preference
+                    for preference in NotificationPreference}
+
+PREFERENCES_CACHE = TTLCache(maxsize=NOTIF_CACHE_SIZE)
+
+
+def to_mask(changes: dict) -> tuple:
+    """
+    Return the bits to set and the bits to clear of {name: bool}
+
+    Raises:
+        ValueError: A name is not a preference, or a value not a boolean.
+    """
+    set_bits, clear_bits = 0, 0
+    for name, wanted in changes.items():
+        if name not in PREFERENCE_NAMES or not isinstance(wanted, bool):
+            raise ValueError(f"Invalid preference '{name}'")
+        if wanted:
+            set_bits |= PREFERENCE_NAMES[name]
+        else:
+            clear_bits |= PREFERENCE_NAMES[name]
+    return set_bits, clear_bits
+
+
+def to_dict(mask: int) -> dict:
+    """
+    Return {name: bool} of every preference of mask
+    """
+    return {name: bool(mask & preference) for name, preference in PREFERENCE_NAMES.items()}
+
+
+def _cache(email: str, mask: int):
+    PREFERENCES_CACHE.set(normalize_email(email), mask, time.time() + NOTIF_CACHE_TTL)
+
+
+def get_preferences(email: str) -> NotificationPreference:
+    """
+    Return the preferences of the user email, none if it has no row
+    """
+    mask = PREFERENCES_CACHE.get(normalize_email(email))
+    if mask is None:
+        database = db_for(email)
+        database.execute(sql.SQL(NOTIF_SELECT_QUERY), (email,))
+        row = database.fetch_one()
+        mask = row[0] if row else 0
+        _cache(email, mask)
+    return NotificationPreference(mask)
+
+
+def update_preferences(email: str, changes: dict) -> NotificationPreference:
+    """
+    Set and clear the preferences of the user email given as {name: bool},
+    the others are kept, and return its new preferences. The row of the
+    user is created on its first change.
+
+    Raises:
+        ValueError: A name is not a preference, or a value not a boolean.
+    """
+    set_bits, clear_bits = to_mask(changes)
+    database = db_for(email)
+    query = sql.SQL(NOTIF_UPDATE_QUERY)
+    try:
+        database.execute(query, (set_bits | clear_bits, set_bits, email))
+        row = database.fetch_one()
+        if row is None:
+            database.execute(sql.SQL(NOTIF_INSERT_QUERY), (email, set_bits))
+            # Inserted meanwhile by another change: update its row
+            database.execute(query, (set_bits | clear_bits, set_bits, email))
+            row = database.fetch_one()
+        record(database, "notification.updated", email,
+               {"preferences": row[0], "changed": sorted(changes)})
+        database.commit()
+    except Exception:
+        database.rollback()
+        raise
+    _cache(email, row[0])
+    return NotificationPreference(row[0])
+
+
+def iter_subscribers(preference: NotificationPreference,
+                     batch_size: int = NOTIF_SUBSCRIBERS_BATCH_SIZE):
+    """
+    Yield the emails of the users wanting the notification preference,
+    every shard in turn, reading batch_size emails at a time
+    """
+    query = sql.SQL(NOTIF_SUBSCRIBERS_QUERY).format(bit=sql.Literal(int(preference)))
+    for database in all_databases():
+        last_email = ""
+        while True:
+            database.execute(query, (last_email, batch_size))
+            rows = database.fetch_all()
+            for (email,) in rows:
+                yield email
+            if len(rows) < batch_size:
+                break
+            last_email = rows[-1][0]
@@ -0,0 +1,383 @@
+"""
+This file contains the waste sightings reported by the users.
+
+Sightings are rows of the sightings table of the main database. Nearby and
+bounding box queries are served by SIGHTING_INDEX, the GeoIndex of the
+worker: it is built by reading the table by id pages, at startup or on
+the first query, and gets the sightings created by the worker. Creating a
+sighting records a sighting.created event in the outbox, in its
+transaction: the push listener of every other worker adds it to its index
+once the relay publishes the event. The listener starts listening before
+the index is built, so no event is lost in between, and every time it
+connects again it calls sync_index for the events it missed: the
+sightings above the last id indexed, and those updated meanwhile.
+
+The index keeps the id, position, status and date of each sighting. The
+description and reporter are read from the table by get_sighting.
+
+SIGHTING_CLUSTERS counts the open sightings in the map cells of every zoom
+level, updated with the index when a sighting is created or resolved, so
+the clusters of a viewport cost the same whatever the number of
+sightings. A sighting is resolved once: a late created event does not
+open it again.
+
+A report within SIGHTING_DUPLICATE_METERS and SIGHTING_DUPLICATE_MINUTES
+of an open one is a duplicate of it, unless both have photos and none of
+them look alike: SIGHTING_DUPLICATES finds it in the buckets of the report,
+without reading the recent reports. Duplicates are stored and listed with
+the id of their canonical report, but are not counted in the clusters, and
+are resolved with it. The perceptual hashes of the report photos are
+stored with them, and read back with the sightings when the index is
+built. Reports created by one worker are checked and stored one at a
+time; two reports created at the same time by two workers may both stay
+canonical.
+
+Attributes:
+    - SIGHTING_INDEX (GeoIndex): The sightings of the worker, by id.
+    - SIGHTING_CLUSTERS (GridAggregates): The open sightings, per map cell and zoom.
+    - SIGHTING_DUPLICATES (SpaceTimeBuckets): The recent sightings, by cell and window.
+    - build_index (function): Load the sightings in SIGHTING_INDEX.
+    - sync_index (function): Index the sightings changed while the events were missed.
+    - apply_event (function): Index the sighting of a published event.
+    - create_sighting (function): Report a sighting.
+    - resolve_sighting (function): Mark a sighting cleaned up.
+    - get_sighting (function): A sighting and its description.
+    - sightings_nearby (function): The sightings around a point, nearest first.
+    - sightings_in_bbox (function): The sightings of a box.
+    - sighting_clusters (function): The clusters of the open sightings of a box.
+    - add_photos (function): Attach stored photos to a sighting.
+    - sighting_photos (function): The photos of a sighting.
+"""
+from datetime import datetime, timedelta
+import threading
+
+from psycopg2 import sql
+
+from app.resources.required_packages import (
+    PostgresDB, SIGHTINGS_CELL_DEGREES, SIGHTINGS_MAX_ZOOM, SIGHTING_DUPLICATE_METERS,
+    SIGHTING_DUPLICATE_MINUTES, SIGHTING_DUPLICATE_HAMMING)
+from app.resources.type.sighting import SightingStatus
+from app.resources.db_utils.sighting_queries import (
+    SIGHTING_INSERT_QUERY, SIGHTING_SELECT_QUERY, SIGHTING_RESOLVE_QUERY,
+    SIGHTINGS_BATCH_QUERY, SIGHTINGS_UPDATED_QUERY, SIGHTING_PHOTO_INSERT_QUERY,
+    SIGHTING_PHOTO_HASHES_QUERY, SIGHTING_PHOTOS_SELECT_QUERY)
+from app.services.geo_index import GeoIndex, GridAggregates, SpaceTimeBuckets
+from app.services.outbox import outbox_row, record, record_many
+
+SIGHTINGS_BATCH_SIZE = 10_000
+SIGHTING_FIELDS = ("id", "email", "latitude", "longitude", "description", "status",
+                   "created_date", "updated_date", "duplicate_of", "duplicates")
+EPOCH = datetime(1970, 1, 1)
+# Changes committed after their updated_date, or dated by a clock behind
+SYNC_MARGIN = timedelta(minutes=1)
+
+SIGHTING_INDEX = GeoIndex(SIGHTINGS_CELL_DEGREES)
+SIGHTING_CLUSTERS = GridAggregates(SIGHTINGS_MAX_ZOOM)
+SIGHTING_DUPLICATES = SpaceTimeBuckets(SIGHTING_DUPLICATE_METERS / 1000,
+                                       SIGHTING_DUPLICATE_MINUTES * 60,
+                                       SIGHTING_DUPLICATE_HAMMING)
+_BUILD_LOCK = threading.Lock()
+# Keeps SIGHTING_INDEX and SIGHTING_CLUSTERS in step
+_INDEX_LOCK = threading.Lock()
+# Held from the duplicate lookup of a report until it is indexed
+_CREATE_LOCK = threading.Lock()
+_built = False
+# The highest id indexed
+_last_id = 0
+
+OPEN = SightingStatus.OPEN.name
+
+
+def _seconds(created_date) -> float:
+    """
+    Return the seconds since the epoch of a UTC date, or of its text
+    """
+    return (datetime.fromisoformat(str(created_date)) - EPOCH).total_seconds()
+
+
+def _signed(phash: int) -> int:
+    """
+    Return a 64 bit hash as the signed value of a BIGINT column
+    """
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+def _hashes(first_id: int, last_id: int) -> dict:
+    """
+    Return the perceptual hashes of the report photos of the sightings from
+    first_id to last_id, by sighting id
+    """
+    PostgresDB.execute(sql.SQL(SIGHTING_PHOTO_HASHES_QUERY), (first_id, last_id))
+    hashes = {}
+    for sighting_id, phash in PostgresDB.fetch_all():
+        hashes.setdefault(sighting_id, []).append(phash & ((1 << 64) - 1))
+    return hashes
+
+
+def _index_rows(rows: list):
+    """
+    Index rows of SIGHTINGS_BATCH_QUERY, by id, with their hashes
+    """
+    hashes = _hashes(rows[0][0], rows[-1][0])
+    for row in rows:
+        _index(*row, tuple(hashes.get(row[0], ())))
+
+
+def _index(sighting_id: int, latitude: float, longitude: float, status: int,
+           created_date, duplicate_of: int = None, hashes: tuple = ()):
+    global _last_id  # pylint: disable=global-statement
+    status = SightingStatus(status).name
+    with _INDEX_LOCK:
+        _last_id = max(_last_id, sighting_id)
+        previous = SIGHTING_INDEX.get(sighting_id)
+        if previous is not None:
+            if previous[2]["status"] != OPEN:
+                return
+            if previous[2]["duplicate_of"] is None:
+                SIGHTING_CLUSTERS.remove(sighting_id, previous[0], previous[1])
+        SIGHTING_INDEX.add(sighting_id, latitude, longitude, {
+            "status": status,
+            "created_date": str(created_date),
+            "duplicate_of": duplicate_of,
+        })
+        if status == OPEN and duplicate_of is None:
+            SIGHTING_CLUSTERS.add(sighting_id, latitude, longitude)
+        if previous is None and status == OPEN:
+            SIGHTING_DUPLICATES.add(sighting_id, latitude, longitude, _seconds(created_date),
+                                    hashes, duplicate_of or sighting_id)
+        elif status != OPEN:
+            SIGHTING_DUPLICATES.remove(sighting_id)
+
+
+def _load(last_id: int = 0) -> int:
+    """
+    Read the sightings above last_id by id pages into SIGHTING_INDEX, with
+    _BUILD_LOCK held
+    """
+    global _built  # pylint: disable=global-statement
+    read = 0
+    while True:
+        PostgresDB.execute(sql.SQL(SIGHTINGS_BATCH_QUERY), (last_id, SIGHTINGS_BATCH_SIZE))
+        rows = PostgresDB.fetch_all()
+        if not rows:
+            break
+        _index_rows(rows)
+        read += len(rows)
+        last_id = rows[-1][0]
+    _built = True
+    return read
+
+
+def build_index() -> int:
+    """
+    Load every sighting in SIGHTING_INDEX and return how many were read
+    """
+    with _BUILD_LOCK:
+        return _load()
+
+
+def sync_index(since: datetime) -> int:
+    """
+    Index the sightings created above the last id indexed, or updated since
+    since, SYNC_MARGIN included, and return how many were read. Does nothing
+    before the index is built: the build reads them all.
+    """
+    with _BUILD_LOCK:
+        if not _built:
+            return 0
+        read = _load(_last_id)
+        PostgresDB.execute(sql.SQL(SIGHTINGS_UPDATED_QUERY), (since - SYNC_MARGIN,))
+        rows = PostgresDB.fetch_all()
+        if rows:
+            _index_rows(rows)
+    return read + len(rows)
+
+
+def _ensure_index():
+    """
+    Build SIGHTING_INDEX on the first query if the startup did not
+    """
+    if not _built:
+        with _BUILD_LOCK:
+            if not _built:
+                _load()
+
+
+def apply_event(event: str, payload: dict):
+    """
+    Index the sighting of a sighting event published by another worker
+    """
+    if event in ("sighting.created", "sighting.resolved"):
+        _index(payload["id"], payload["latitude"], payload["longitude"],
+               payload["status"], payload["created_date"], payload.get("duplicate_of"),
+               tuple(payload.get("hashes", ())))
+
+
+def _canonical(latitude: float, longitude: float, seconds: float, hashes: tuple):
+    """
+    Return the id of the open report a new report duplicates, None if it
+    is a new sighting
+    """
+    found = SIGHTING_DUPLICATES.find(latitude, longitude, seconds, hashes)
+    if found is None:
+        return None
+    canonical = SIGHTING_INDEX.get(found[1])
+    return found[1] if canonical is not None and canonical[2]["status"] == OPEN else None
+
+
+def create_sighting(email: str, latitude: float, longitude: float,
+                    description: str = "", photos: list = (), hashes: tuple = ()) -> dict:
+    """
+    Report a sighting at a point, with the digests of its stored photos and
+    their perceptual hashes, in the same order, and return it as in the
+    index. A duplicate has the id of its canonical report in duplicate_of.
+
+    Raises:
+        ValueError: The point is not on the globe, or a photo has no hash.
+    """
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("Latitude must be in [-90, 90] and longitude in [-180, 180].")
+    if len(photos) != len(hashes):
+        raise ValueError("Every photo needs its perceptual hash.")
+    now = datetime.utcnow()
+    status = SightingStatus.OPEN.value
+    hashes = tuple(hashes)
+    _ensure_index()
+    # Two reports of the worker may not both miss each other
+    with _CREATE_LOCK:
+        duplicate_of = _canonical(latitude, longitude, _seconds(now), hashes)
+        try:
+            PostgresDB.execute(sql.SQL(SIGHTING_INSERT_QUERY),
+                               (email, latitude, longitude, description, status, now, now,
+                                duplicate_of))
+            sighting_id = PostgresDB.fetch_one()[0]
+            if photos:
+                PostgresDB.execute_values(sql.SQL(SIGHTING_PHOTO_INSERT_QUERY), [
+                    (sighting_id, digest, email, now, _signed(phash))
+                    for digest, phash in zip(photos, hashes)])
+            record(PostgresDB, "sighting.created", email, {
+                "id": sighting_id, "latitude": latitude, "longitude": longitude,
+                "status": status, "created_date": now, "duplicate_of": duplicate_of,
+                "hashes": list(hashes)})
+            PostgresDB.commit()
+        except Exception:
+            PostgresDB.rollback()
+            raise
+        _index(sighting_id, latitude, longitude, status, now, duplicate_of, hashes)
+    return _to_dict(sighting_id, *SIGHTING_INDEX.get(sighting_id))
+
+
+def resolve_sighting(email: str, sighting_id: int):
+    """
+    Mark an open sighting and its open duplicates resolved by the user
+    email and return it as in the index, None if no sighting has this id.
+    A resolved sighting is returned unchanged.
+    """
+    now = datetime.utcnow()
+    resolved = SightingStatus.RESOLVED.value
+    try:
+        PostgresDB.execute(sql.SQL(SIGHTING_RESOLVE_QUERY),
+                           (resolved, now, sighting_id, sighting_id, SightingStatus.OPEN.value))
+        rows = PostgresDB.fetch_all()
+        if not any(row[0] == sighting_id for row in rows):
+            PostgresDB.rollback()
+            sighting = get_sighting(sighting_id)
+            return None if sighting is None else {
+                field: sighting[field] for field in (
+                    "id", "latitude", "longitude", "status", "created_date", "duplicate_of")}
+        record_many(PostgresDB, [outbox_row("sighting.resolved", email, {
+            "id": resolved_id, "latitude": latitude, "longitude": longitude,
+            "status": resolved, "created_date": created_date, "duplicate_of": duplicate_of})
+            for resolved_id, latitude, longitude, created_date, duplicate_of in rows])
+        PostgresDB.commit()
+    except Exception:
+        PostgresDB.rollback()
+        raise
+    for resolved_id, latitude, longitude, created_date, duplicate_of in rows:
+        _index(resolved_id, latitude, longitude, resolved, created_date, duplicate_of)
+    return _to_dict(sighting_id, *SIGHTING_INDEX.get(sighting_id))
+
+
+def get_sighting(sighting_id: int):
+    """
+    Return a sighting with its reporter and description, None if unknown
+    """
+    PostgresDB.execute(sql.SQL(SIGHTING_SELECT_QUERY), (sighting_id,))
+    row = PostgresDB.fetch_one()
+    if row is None:
+        return None
+    sighting = dict(zip(SIGHTING_FIELDS, row))
+    sighting["status"] = SightingStatus(sighting["status"]).name
+    sighting["created_date"] = str(sighting["created_date"])
+    sighting["updated_date"] = str(sighting["updated_date"])
+    return sighting
+
+
+def _to_dict(sighting_id: int, latitude: float, longitude: float, value: dict) -> dict:
+    return {"id": sighting_id, "latitude": latitude, "longitude": longitude, **value}
+
+
+def sightings_nearby(latitude: float, longitude: float, radius_km: float,
+                     limit: int) -> list:
+    """
+    Return up to limit sightings within radius_km of a point, nearest
+    first, with their distance_km
+    """
+    _ensure_index()
+    return [{**_to_dict(*point), "distance_km": round(distance, 3)}
+            for distance, *point in SIGHTING_INDEX.nearby(latitude, longitude, radius_km)[:limit]]
+
+
+def sightings_in_bbox(south: float, west: float, north: float, east: float,
+                      limit: int) -> list:
+    """
+    Return up to limit sightings of a box, by id
+    """
+    _ensure_index()
+    return [_to_dict(*point) for point in SIGHTING_INDEX.in_bbox(south, west, north, east)[:limit]]
+
+
+def sighting_clusters(south: float, west: float, north: float, east: float,
+                      zoom: int, max_cells: int) -> list:
+    """
+    Return the clusters of the open sightings of a box at a map zoom level,
+    deeper levels served by SIGHTINGS_MAX_ZOOM. A cluster of one sighting
+    has its id.
+
+    Raises:
+        ValueError: The box covers more than max_cells cells at this zoom.
+    """
+    zoom = min(zoom, SIGHTING_CLUSTERS.max_zoom)
+    if SIGHTING_CLUSTERS.cells(south, west, north, east, zoom) > max_cells:
+        raise ValueError("The box covers too many cells")
+    _ensure_index()
+    clusters = SIGHTING_CLUSTERS.clusters(south, west, north, east, zoom)
+    for cluster in clusters:
+        if "key" in cluster:
+            cluster["id"] = cluster.pop("key")
+    return clusters
+
+
+def add_photos(email: str, sighting_id: int, digests: list):
+    """
+    Attach the photos of digests, stored by the user email, to a sighting.
+    They are not hashed: duplicates are found by the photos of the report.
+    """
+    now = datetime.utcnow()
+    try:
+        PostgresDB.execute_values(sql.SQL(SIGHTING_PHOTO_INSERT_QUERY),
+                                  [(sighting_id, digest, email, now, None) for digest in digests])
+        PostgresDB.commit()
+    except Exception:
+        PostgresDB.rollback()
+        raise
+
+
+def sighting_photos(sighting_id: int) -> list:
+    """
+    Return the photos {"digest", "email", "created_date"} of a sighting,
+    oldest first
+    """
+    PostgresDB.execute(sql.SQL(SIGHTING_PHOTOS_SELECT_QUERY), (sighting_id,))
+    return [{"digest": digest, "email": email, "created_date": str(created_date)}
+            for digest, email, created_date in PostgresDB.fetch_all()]
@@ -10,15 +10,40 @@ from pydantic import BaseModel
 import psycopg2
 from psycopg2 import sql
 
-import bcrypt
-import jwt
-
-from app.resources.required_packages import PostgresDB, SECRET_KEY, ALGORITHM, salt
+from app.resources.required_packages import (
+    PostgresDB, PostgresDatabase, SESSION_WRITE_BEHIND)
+from app.resources.shards import SHARDS
 from app.resources.type.status import Status
+from app.services.jwt_keys import KEYRING
+from app.resources.db_utils.db_utils import format_datas_from_db
 from app.resources.db_utils.user_queries import (USER_SELECT_QUERY, USER_INSERT_QUERY,
-                                                 USER_UPDATE_QUERY, END_USER_SESSION_QUERY,
-                                                 ACTIVE_USER_SESSION_QUERY,
-                                                 IS_USER_SESSION_ACTIVE_QUERY)
+                                                 USER_UPDATE_QUERY, USER_LIST_COLUMNS,
+                                                 USER_LIST_FILTERS, USER_LIST_QUERY,
+                                                 USER_LIST_AFTER_CONDITION,
+                                                 USER_ESTIMATE_COUNT_QUERY,
+                                                 USER_REHASH_QUERY)
+from app.services.session_store import SESSION_STORE
+from app.services.outbox import record
+from app.services.email_filter import EMAIL_FILTER
+from app.services.breached_passwords import is_breached
+from app.services.passwords import hash_password, check_password, needs_rehash
+
+SESSION_DURATION = timedelta(days=1)
+USER_UPDATE_RETRIES = 3
+# Columns written by User.update, in the order of USER_UPDATE_QUERY
+UPDATABLE_FIELDS = ("host", "password", "first_name", "last_name", "lang", "status")
+
+
+class UpdateConflictError(Exception):
+    """
+    Raised when a user was changed by another update since it was read
+    """
+
+
+class BreachedPasswordError(ValueError):
+    """
+    Raised when a password is found in the breached password filter
+    """
 
 
 class User(BaseModel):
@@ -34,7 +59,6 @@ class User(BaseModel):
         lastName (str): The last name of the user.
         status (Enum): The status of the user.
         token (str): The token of the user.
-        session_active (int): 1 if the user is connected and 0 if not
     """
 
     email: str = ""
@@ -44,7 +68,6 @@ class User(BaseModel):
     last_name: str = ""
     lang: str = ""
     status: Enum = Status.DISABLED
-    session_active: int = 0
 
     def setattr(self, **kwargs):
         """
@@ -65,14 +88,15 @@ class User(BaseModel):
             user (dict): The user found. None if no user is found.
         """
         query = sql.SQL(USER_SELECT_QUERY)
-        PostgresDB.execute(query, (self.email,))
-        user_data = PostgresDB.fetch_one()
+        database = db_for(self.email)
+        database.execute(query, (self.email,))
+        user_data = database.fetch_one()
 
         if user_data is None:
             return None
 
         # Récupérez les noms de colonnes à partir de cursor.description
-        column_names = [desc[0] for desc in PostgresDB.cursor.description]
+        column_names = [desc[0] for desc in database.cursor.description]
 
         # Créez un dictionnaire en utilisant les noms de colonnes comme clés
         user_dict = {column_names[i]: user_data[i] for i in range(len(column_names))}
@@ -95,18 +119,22 @@ class User(BaseModel):
 
         Returns
             acknowledged (bool): True if the user is created, False otherwise.
+
+        Raises:
+            BreachedPasswordError: The password is found in a data breach.
         """
+        if self.password and is_breached(self.password):
+            raise BreachedPasswordError(self.email)
         query = sql.SQL(USER_INSERT_QUERY)
-        hashed_password = bcrypt.hashpw(
-            self.password.encode("utf-8"), salt.encode("utf-8")
-        )
+        hashed_password = hash_password(self.password)
         self.status = Status.PENDING
+        database = db_for(self.email)
         try:
-            PostgresDB.execute(
+            database.execute(
                 query,
                 (
                     self.email,
-                    str(hashed_password),
+                    hashed_password,
                     self.host,
                     self.first_name,
                     self.last_name,
@@ -116,7 +144,10 @@ class User(BaseModel):
                     self.status.value,
                 ),
             )
-            PostgresDB.commit()
+            record(database, "user.created", self.email,
+                   {"status": self.status.value, "host": self.host, "lang": self.lang})
+            database.commit()
+            EMAIL_FILTER.add(self.email)
 
             user_data = self.select()
             if not user_data:
@@ -128,19 +159,21 @@ class User(BaseModel):
             return user_data
 
         except psycopg2.IntegrityError as _e_:
-            PostgresDB.rollback()
+            database.rollback()
             if _e_.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
                 data = {"message": "User exists"}
                 return data
             raise
 
-    def generate_token(self, email: str, expiration_time: timedelta = None):
+    def generate_token(self, email: str, expiration_time: timedelta = None,
+                       sid: str = None):
         """
         Generate a token for the user.
 
         Attributes:
             - email (str): The email address of the user.
             - expiration_time (timedelta): The time before the token expires.
+            - sid (str): The session the token belongs to, if any.
 
         Returns:
             token (str): The token of the user.
@@ -151,12 +184,18 @@ class User(BaseModel):
             "iat": datetime.utcnow(),
             "exp": datetime.utcnow() + expiration_time,
         }
-        return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+        if sid:
+            payload["sid"] = sid
+        return KEYRING.sign(payload)
 
-    def authenticate_user(self):
+    def authenticate_user(self, device: str = None):
         """
         Authenticate the user.
 
+        Attributes:
+            - device (str): The device the user logs in from. A session is
+                            opened per device, a new one if not given.
+
         Returns:
             token (str): The token of the user.
         """
@@ -164,15 +203,14 @@ class User(BaseModel):
         # Check if user exists and is active
         if user:
             if (
-                not bcrypt.checkpw(
-                    bytes(self.password, "utf-8"),
-                    bytes(user["password"][2:-1], "utf-8"),
-                )
+                not check_password(self.password, user["password"])
             ) or user["status"] != Status.ACTIVE.value:
                 return False
+            if needs_rehash(user["password"]):
+                self.rehash_password(user["password"])
 
-            # Set the user connected in database
-            self.active_session()
+            # Open a session for the device
+            sid = self.active_session(device)
             return {
                 "email": user["email"],
                 "host": user["host"],
@@ -183,16 +221,54 @@ class User(BaseModel):
                 "updated_date": str(user["updated_date"]),
                 "status": user["status"],
                 "access_token": self.generate_token(
-                    user["email"], expiration_time=timedelta(days=1)
+                    user["email"], expiration_time=SESSION_DURATION, sid=sid
                 ),
                 "token_type": "Bearer",
             }
         return False
 
+    def rehash_password(self, stored: str) -> bool:
+        """
+        Replace the stored hash of the password just checked by a hash of
+        BCRYPT_COST. The hash is only replaced if the password did not
+        change meanwhile, the version is kept: the password is the same.
+
+        Returns:
+            rehashed (bool): True if the hash is replaced.
+        """
+        database = db_for(self.email)
+        try:
+            database.execute(sql.SQL(USER_REHASH_QUERY),
+                             (hash_password(self.password), self.email, stored))
+            rehashed = database.cursor.rowcount == 1
+            database.commit()
+        except psycopg2.Error:
+            # The login goes on with the former hash
+            database.rollback()
+            return False
+        return rehashed
+
     def update(self, updated_user_data: dict):
         """
         Update a user.
+
+        The row is only written if its version is still the one read. When
+        another update changed other fields meanwhile, the changes are
+        merged on the new row again, up to USER_UPDATE_RETRIES times.
+        A "version" in updated_user_data is the version the caller read:
+        it must still be current, without retry.
+
+        Returns:
+            user (dict): The updated user. None if no user is found.
+
+        Raises:
+            UpdateConflictError: A concurrent update changed the same fields,
+                                 or the version given is not current.
+            BreachedPasswordError: The new password is found in a data breach.
         """
+        if "password" in updated_user_data and is_breached(updated_user_data["password"]):
+            raise BreachedPasswordError(self.email)
+        expected_version = updated_user_data.pop("version", None)
         updated_user_data["updated_date"] = datetime.utcnow()
 
         query = sql.SQL(USER_UPDATE_QUERY)
@@ -200,56 +276,82 @@ class User(BaseModel):
             self.status = Status(updated_user_data["status"])
         self.setattr(**updated_user_data)
         if updated_user_data.get("password"):
-            updated_user_data["password"] = str(
-                bcrypt.hashpw(
-                    updated_user_data["password"].encode("utf-8"), salt.encode("utf-8")
-                )
-            )
+            updated_user_data["password"] = hash_password(updated_user_data["password"])
+        changes = {field: updated_user_data[field] for field in UPDATABLE_FIELDS
+                   if field in updated_user_data}
         user = self.select()
+        if user is None:
+            return None
+        if expected_version is not None and user.get("version", 0) != expected_version:
+            raise UpdateConflictError(self.email)
 
-        PostgresDB.execute(
-            query,
-            (
-                updated_user_data.get("host", user["host"]),
-                updated_user_data.get("password", user["password"]),
-                updated_user_data.get("first_name", user["first_name"]),
-                updated_user_data.get("last_name", user["last_name"]),
-                updated_user_data.get("lang", user["lang"]),
-                updated_user_data.get("status", user["status"]),
-                updated_user_data["updated_date"],
-                self.email,
-            ),
-        )
-        PostgresDB.commit()
+        database = db_for(self.email)
+        for _ in range(USER_UPDATE_RETRIES + 1):
+            database.execute(
+                query,
+                (
+                    *(changes.get(field, user[field]) for field in UPDATABLE_FIELDS),
+                    updated_user_data["updated_date"],
+                    self.email,
+                    user.get("version", 0),
+                ),
+            )
+            written = database.fetch_one()
+            if written is not None:
+                record(database, "user.updated", self.email,
+                       {"fields": sorted(changes), "version": written[0]})
+            database.commit()
+            if written is not None:
+                return self.select()
+
+            current = self.select()
+            if current is None:
+                return None
+            if expected_version is not None or any(
+                    current[field] != user[field] for field in changes):
+                raise UpdateConflictError(self.email)
+            user = current
 
-        return self.select()
+        raise UpdateConflictError(self.email)
 
-    def active_session(self):
+    def active_session(self, device: str = None, sync: bool = None):
         """
-        Set a user connected in database by
-        setting the column session_active to 1
+        Open a session of the user on device, replacing the previous
+        session of that device. Unless sync, the session may be written
+        behind, by default when SESSION_WRITE_BEHIND is set.
+
+        Returns:
+            sid (str): The id of the session.
+        """
+        return SESSION_STORE.create(
+            self.email, device or secrets.token_urlsafe(8), SESSION_DURATION,
+            sync=not SESSION_WRITE_BEHIND if sync is None else sync,
+        )
+
+    def end_session(self, sid: str = None, sync: bool = None):
+        """
+        End the session sid of the user, or all his sessions if sid is None.
+        Ending all the sessions is always written at once.
         """
-        query = sql.SQL(ACTIVE_USER_SESSION_QUERY)
-        PostgresDB.execute(query, (1, self.email,))
-        PostgresDB.commit()
+        if sid:
+            SESSION_STORE.end(sid, sync=not SESSION_WRITE_BEHIND if sync is None else sync)
+        else:
+            SESSION_STORE.end_all(self.email)
 
-    def end_session(self):
+    def touch_session(self, sid: str):
         """
-        Set a user disconnected in database by
-        setting the column session_active to 0
+        Record that the session sid is used, written behind
         """
-        query = sql.SQL(END_USER_SESSION_QUERY)
-        PostgresDB.execute(query, (0, self.email,))
-        PostgresDB.commit()
+        SESSION_STORE.touch(sid)
 
-    def is_session_active(self):
+    def is_session_active(self, sid: str = None):
         """
-        Return the session_active value
+        Return True if the session sid is active. Without sid, return
+        True if the user has at least one active session.
         """
-        query = sql.SQL(IS_USER_SESSION_ACTIVE_QUERY)
-        PostgresDB.execute(query, (self.email,))
-        user_session_active = PostgresDB.fetch_one()
-        return user_session_active[0]
+        if sid:
+            return SESSION_STORE.is_active(sid)
+        return SESSION_STORE.has_active(self.email)
 
 
 def generate_password(length=20):
@@ -259,3 +361,97 @@ def generate_password(length=20):
     characters = string.ascii_letters + string.digits + string.punctuation
     password = "".join(secrets.choice(characters) for _ in range(length))
     return password
+
+
+def _list_conditions(filters: dict):
+    """
+    Return the WHERE clause and params of the list filters that are set
+    """
+    conditions, params = [], []
+    for column in USER_LIST_FILTERS:
+        if filters.get(column) is not None:
+            conditions.append(sql.SQL("{} = %s").format(sql.Identifier(column)))
+            params.append(filters[column])
+    return conditions, params
+
+
+def _where(conditions: list):
+    """
+    Join conditions in a WHERE clause
+    """
+    if not conditions:
+        return sql.SQL("")
+    return sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions)
+
+
+def db_for(email: str) -> PostgresDatabase:
+    """
+    Return the database holding the user email
+    """
+    if SHARDS is None:
+        return PostgresDB
+    return SHARDS.db_for(email)
+
+
+def all_databases() -> list:
+    """
+    Return the databases holding users, one per shard
+    """
+    if SHARDS is None:
+        return [PostgresDB]
+    return SHARDS.all()
+
+
+def list_users(limit: int, after: tuple = None, **filters):
+    """
+    List users, newest first, by keyset pagination on (created_date, id, email).
+    With shards, every shard is read and the pages merged: ids are only
+    unique within a shard, the email breaks their ties.
+
+    Attributes:
+        - limit (int): The maximum number of users returned.
+        - after (tuple): (created_date, id, email) of the last user of the previous page.
+        - filters: status, lang and host, compared for equality when set.
+
+    Returns:
+        users (list): The users of the page, without their password.
+        next_after (tuple): (created_date, id, email) to read the next page, None on the
+            last page.
+    """
+    conditions, params = _list_conditions(filters)
+    if after is not None:
+        conditions.append(sql.SQL(USER_LIST_AFTER_CONDITION))
+        params.extend(after)
+    query = sql.SQL(USER_LIST_QUERY).format(
+        columns=sql.SQL(", ").join(sql.Identifier(column) for column in USER_LIST_COLUMNS),
+        where=_where(conditions),
+    )
+    users = []
+    for database in all_databases():
+        # One extra row tells whether there is a next page
+        database.execute(query, (*params, limit + 1))
+        users.extend(format_datas_from_db(database, database.fetch_all()))
+    if len(all_databases()) > 1:
+        users.sort(key=lambda user: (user["created_date"], user["id"], user["email"]),
+                   reverse=True)
+
+    next_after = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_after = (users[-1]["created_date"], users[-1]["id"], users[-1]["email"])
+    return users, next_after
+
+
+def estimate_user_count(**filters) -> int:
+    """
+    Return the number of users matching filters as estimated by the
+    planner statistics, without counting the rows.
+    """
+    conditions, params = _list_conditions(filters)
+    query = sql.SQL(USER_ESTIMATE_COUNT_QUERY).format(where=_where(conditions))
+    total = 0
+    for database in all_databases():
+        database.execute(query, tuple(params) or None)
+        plan = database.fetch_one()[0]
+        total += int(plan[0]["Plan"]["Plan Rows"])
+    return total
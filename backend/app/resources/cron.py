@@ -0,0 +1,95 @@
+"""
+Cron expressions of the recurring jobs.
+
+Five fields: minute, hour, day of month, month and day of week (0 or 7
+for Sunday). A field is "*", a value, a range "a-b", a step "*/n" or
+"a-b/n", or a list of those separated by commas. As in cron, when both
+the day of month and the day of week are restricted, a day matching
+either runs. Times are naive UTC datetimes, like the rest of the
+application.
+
+Attributes:
+    - CronSchedule (class): A parsed expression and its next run times.
+"""
+from datetime import datetime, timedelta
+
+# (lowest, highest) of each field
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+# Run times are searched up to this many years ahead, "0 0 30 2 *" never runs
+MAX_YEARS = 5
+
+
+def _parse_field(text: str, lowest: int, highest: int) -> set:
+    """
+    Return the values of a field
+    """
+    values = set()
+    for part in text.split(","):
+        span, _, step = part.partition("/")
+        if span == "*":
+            first, last = lowest, highest
+        elif "-" in span:
+            first, last = (int(bound) for bound in span.split("-", 1))
+        else:
+            first = last = int(span)
+        step = int(step) if step else 1
+        if not lowest <= first <= last <= highest or step < 1:
+            raise ValueError(f"Invalid cron field '{text}'")
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class CronSchedule:
+    """
+    Cron expression
+    """
+
+    def __init__(self, expression: str):
+        """
+        Attrs:
+            expression (str): The five fields, separated by spaces
+
+        Raises:
+            ValueError: The expression is not valid.
+        """
+        fields = expression.split()
+        if len(fields) != len(FIELDS):
+            raise ValueError(f"Invalid cron expression '{expression}'")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(field, *bounds) for field, bounds in zip(fields, FIELDS))
+        # Sunday is 0 and 7 in cron, 6 for datetime.weekday()
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        in_month = moment.day in self.days
+        in_week = moment.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, moment: datetime) -> datetime:
+        """
+        Return the first run time strictly after moment
+
+        Raises:
+            ValueError: The expression has no run time in MAX_YEARS years.
+        """
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment.replace(year=moment.year + MAX_YEARS, month=1, day=1)
+        # Skips whole months, days and hours that do not match
+        while candidate < limit:
+            if candidate.month not in self.months:
+                year, month = divmod(candidate.year * 12 + candidate.month, 12)
+                candidate = datetime(year, month + 1, 1)
+            elif not self._day_matches(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+            elif candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression '{self.expression}' never runs")
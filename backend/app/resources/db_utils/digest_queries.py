@@ -0,0 +1,86 @@
+"""
+Module providing queries to interact with the digest tables
+"""
+DIGEST_RUN_START_QUERY = """
+                        INSERT INTO digest_runs (run_date, started_date)
+                        VALUES (%s, %s)
+                        ON CONFLICT (run_date) DO NOTHING
+                    """
+
+# The checkpoint is locked by the chunk being queued: runs of the same day
+# queue their chunks one after the other
+DIGEST_RUN_LOCK_QUERY = """
+                        SELECT last_email, finished_date
+                        FROM digest_runs
+                        WHERE run_date = %s
+                        FOR UPDATE
+                    """
+
+DIGEST_RUN_ADVANCE_QUERY = """
+                        UPDATE digest_runs
+                        SET last_email = %s, queued = queued + %s
+                        WHERE run_date = %s
+                    """
+
+DIGEST_RUN_FINISH_QUERY = "UPDATE digest_runs SET finished_date = %s WHERE run_date = %s"
+
+# Composed with sql.SQL().format(): {bit}, the daily_task_report bit, a
+# literal so that its partial index serves the keyset pages
+DIGEST_RECIPIENTS_QUERY = """
+                        SELECT notification.user_mail, users.first_name
+                        FROM notification
+                        JOIN users ON users.email = notification.user_mail
+                        WHERE notification.preferences & {bit} <> 0
+                            AND notification.user_mail > %s
+                            AND users.status = %s
+                        ORDER BY notification.user_mail
+                        LIMIT %s
+                    """
+
+# Events of the users of a chunk, (first, last] email, over a day
+DIGEST_ACTIVITY_QUERY = """
+                        SELECT email, event, count(*)
+                        FROM outbox
+                        WHERE email > %s AND email <= %s
+                            AND created_date >= %s AND created_date < %s
+                        GROUP BY email, event
+                    """
+
+# VALUES %s filled by execute_values
+DIGEST_MAIL_INSERT_QUERY = """
+                        INSERT INTO digest_mail (run_date, email, subject, body, created_date)
+                        VALUES %s
+                        ON CONFLICT (run_date, email) DO NOTHING
+                    """
+
+# Claims the pending digests, hidden from the other deliveries until
+# locked_until. A failed digest is hidden until its retry.
+DIGEST_CLAIM_QUERY = """
+                        UPDATE digest_mail
+                        SET locked_until = %s, attempts = attempts + 1
+                        WHERE id IN (
+                            SELECT id
+                            FROM digest_mail
+                            WHERE sent_date IS NULL
+                                AND attempts < %s
+                                AND (locked_until IS NULL OR locked_until < %s)
+                            ORDER BY id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, email, subject, body
+                    """
+
+DIGEST_SENT_QUERY = """
+                        UPDATE digest_mail
+                        SET sent_date = %s, locked_until = NULL, last_error = NULL
+                        WHERE id = %s
+                    """
+
+DIGEST_FAILED_QUERY = """
+                        UPDATE digest_mail
+                        SET locked_until = %s, last_error = %s
+                        WHERE id = %s
+                    """
+
+DIGEST_PURGE_QUERY = "DELETE FROM digest_mail WHERE sent_date < %s"
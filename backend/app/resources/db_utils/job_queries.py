@@ -0,0 +1,73 @@
+"""
+Module providing queries to interact with the jobs tables
+"""
+JOB_INSERT_QUERY = """
+                        INSERT INTO jobs (name, payload, run_at, max_attempts, created_date)
+                        VALUES (%s, %s::jsonb, %s, %s, %s)
+                        RETURNING id
+                    """
+
+# Claims the due jobs that are not running, hidden from the other workers
+# until locked_until
+JOB_CLAIM_QUERY = """
+                        UPDATE jobs
+                        SET locked_until = %s, locked_by = %s, attempts = attempts + 1
+                        WHERE id IN (
+                            SELECT id
+                            FROM jobs
+                            WHERE run_at <= %s
+                                AND attempts < max_attempts
+                                AND (locked_until IS NULL OR locked_until < %s)
+                            ORDER BY run_at, id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, name, payload::text AS payload, run_at, attempts, max_attempts
+                    """
+
+# VALUES %s filled by execute_values, the jobs still running
+JOB_EXTEND_QUERY = """
+                        UPDATE jobs
+                        SET locked_until = running.locked_until
+                        FROM (VALUES %s) AS running (id, locked_until, locked_by)
+                        WHERE jobs.id = running.id AND jobs.locked_by = running.locked_by
+                    """
+
+# Only by the worker still holding the job
+JOB_DONE_QUERY = "DELETE FROM jobs WHERE id = %s AND locked_by = %s"
+
+JOB_FAILED_QUERY = """
+                        UPDATE jobs
+                        SET run_at = %s, locked_until = NULL, locked_by = NULL, last_error = %s
+                        WHERE id = %s AND locked_by = %s
+                    """
+
+# Jobs whose worker died during their last attempt: never claimed again,
+# they are failed once their lock expires
+JOB_LOST_QUERY = """
+                        UPDATE jobs
+                        SET locked_until = NULL, locked_by = NULL, last_error = %s
+                        WHERE locked_by IS NOT NULL
+                            AND locked_until < %s
+                            AND attempts >= max_attempts
+                    """
+
+JOB_SCHEDULE_UPSERT_QUERY = """
+                        INSERT INTO job_schedules (name, cron, next_run_at)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (name) DO UPDATE
+                        SET
+                            cron = EXCLUDED.cron,
+                            next_run_at = CASE WHEN job_schedules.cron = EXCLUDED.cron
+                                               THEN job_schedules.next_run_at
+                                               ELSE EXCLUDED.next_run_at END
+                    """
+
+JOB_SCHEDULES_DUE_QUERY = """
+                        SELECT name, cron, next_run_at
+                        FROM job_schedules
+                        WHERE next_run_at <= %s
+                        FOR UPDATE SKIP LOCKED
+                    """
+
+JOB_SCHEDULE_NEXT_QUERY = "UPDATE job_schedules SET next_run_at = %s WHERE name = %s"
@@ -0,0 +1,276 @@
+"""
+Versioned migrations of the database schema.
+
+Migrations are the SQL files of the migrations directory, named
+"<version>_<name>.sql" with a four digits version, applied in version order
+and recorded in the schema_migrations table. A file runs in one transaction
+unless its first line is "-- migrate: no-transaction": its statements then
+run one by one outside of any transaction, as CREATE INDEX CONCURRENTLY
+requires. A concurrent index build that fails leaves an INVALID index
+behind, drop it before running the migration again.
+
+The check command explains the lookups of the query modules (SELECT, UPDATE
+and DELETE queries) and reports those whose plan still reads a table by
+sequential scan. Everything runs on the primary, never on a read replica.
+
+Attributes:
+    - MIGRATIONS_DIR (str): The directory of the migration files.
+    - NO_TRANSACTION_HEADER (str): The first line of the migrations run outside a transaction.
+    - CHECKED_MODULES (tuple): The query modules verified by the check command.
+    - Migration (namedtuple): A migration file.
+    - load_migrations (function): Read the migrations of a directory.
+    - migrate (function): Apply the pending migrations.
+    - migration_status (function): List the migrations and whether they are applied.
+    - check_queries (function): Find the queries not served by an index.
+
+Usage:
+    python -m app.resources.db_utils.migrate up
+    python -m app.resources.db_utils.migrate status
+    python -m app.resources.db_utils.migrate check
+"""
+import argparse
+from collections import namedtuple
+from datetime import datetime
+import importlib
+import os
+import re
+import sys
+
+from psycopg2 import sql
+
+from app.resources.required_packages import PostgresDB, PostgresDatabase
+from app.resources.db_utils.migration_queries import (
+    MIGRATION_CREATE_TABLE_QUERY, MIGRATION_LOCK_QUERY, MIGRATION_UNLOCK_QUERY,
+    MIGRATION_APPLIED_QUERY, MIGRATION_INSERT_QUERY, CHECK_DISABLE_SEQSCAN_QUERY,
+    CHECK_GENERIC_PLAN_QUERY, CHECK_PREPARE_QUERY, CHECK_EXPLAIN_QUERY,
+    CHECK_DEALLOCATE_QUERY)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+NO_TRANSACTION_HEADER = "-- migrate: no-transaction"
+CHECKED_MODULES = (
+    "app.resources.db_utils.user_queries",
+    "app.resources.db_utils.session_queries",
+    "app.resources.db_utils.outbox_queries",
+    "app.resources.db_utils.digest_queries",
+    "app.resources.db_utils.job_queries",
+    "app.resources.db_utils.sighting_queries",
+)
+
+# Key of the advisory lock taken while migrating, so that two processes
+# starting together do not apply the same migration
+MIGRATION_LOCK_ID = 7_340_034
+# Values of the {} fields of the composed queries when they are checked
+CHECK_FORMATS = {"columns": "*", "where": "", "bit": "1"}
+
+FILE_NAME = re.compile(r"^(\d{4})_(\w+)\.sql$")
+CHECKED_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+# Templates of execute_values, joined on their VALUES list by primary key
+BULK_VALUES = "VALUES %s"
+
+Migration = namedtuple("Migration", ["version", "name", "path", "transactional"])
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR) -> list:
+    """
+    Return the migrations of directory sorted by version
+    """
+    migrations = {}
+    for file_name in sorted(os.listdir(directory)):
+        match = FILE_NAME.match(file_name)
+        if not match:
+            continue
+        version, name = match.groups()
+        if version in migrations:
+            raise ValueError(f"Duplicate migration version {version}.")
+        path = os.path.join(directory, file_name)
+        with open(path, "r", encoding="utf-8") as migration_file:
+            first_line = migration_file.readline().strip()
+        migrations[version] = Migration(version, name, path,
+                                        first_line != NO_TRANSACTION_HEADER)
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def split_statements(text: str) -> list:
+    """
+    Split a migration in statements, comments removed
+    """
+    lines = [line for line in text.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";")
+            if statement.strip()]
+
+
+def applied_versions(postgres_db: PostgresDatabase = PostgresDB) -> set:
+    """
+    Return the versions already applied
+    """
+    postgres_db.execute(sql.SQL(MIGRATION_CREATE_TABLE_QUERY))
+    postgres_db.execute(sql.SQL(MIGRATION_APPLIED_QUERY))
+    versions = {version for (version,) in postgres_db.fetch_all()}
+    postgres_db.commit()
+    return versions
+
+
+def _apply(postgres_db: PostgresDatabase, migration: Migration):
+    """
+    Run one migration and record it
+    """
+    with open(migration.path, "r", encoding="utf-8") as migration_file:
+        text = migration_file.read()
+
+    if migration.transactional:
+        postgres_db.execute(sql.SQL(text))
+    else:
+        postgres_db.commit()
+        postgres_db.connection.autocommit = True
+        try:
+            for statement in split_statements(text):
+                postgres_db.execute(sql.SQL(statement))
+        finally:
+            postgres_db.connection.autocommit = False
+
+    postgres_db.execute(sql.SQL(MIGRATION_INSERT_QUERY),
+                        (migration.version, migration.name, datetime.utcnow()))
+    postgres_db.commit()
+
+
+def migrate(postgres_db: PostgresDatabase = PostgresDB, directory: str = MIGRATIONS_DIR,
+            target: str = None) -> list:
+    """
+    Apply the pending migrations up to target, all of them by default.
+
+    Returns:
+        applied (list): The versions applied.
+    """
+    with postgres_db.primary():
+        postgres_db.execute(sql.SQL(MIGRATION_LOCK_QUERY), (MIGRATION_LOCK_ID,))
+        postgres_db.commit()
+        applied = []
+        try:
+            done = applied_versions(postgres_db)
+            for migration in load_migrations(directory):
+                if target is not None and migration.version > target:
+                    break
+                if migration.version in done:
+                    continue
+                try:
+                    _apply(postgres_db, migration)
+                except Exception:
+                    postgres_db.rollback()
+                    raise
+                applied.append(migration.version)
+        finally:
+            postgres_db.execute(sql.SQL(MIGRATION_UNLOCK_QUERY), (MIGRATION_LOCK_ID,))
+            postgres_db.commit()
+    return applied
+
+
+def migration_status(postgres_db: PostgresDatabase = PostgresDB,
+                     directory: str = MIGRATIONS_DIR) -> list:
+    """
+    Return (version, name, applied) for every migration
+    """
+    with postgres_db.primary():
+        done = applied_versions(postgres_db)
+    return [(migration.version, migration.name, migration.version in done)
+            for migration in load_migrations(directory)]
+
+
+def checked_queries(modules: tuple = CHECKED_MODULES) -> dict:
+    """
+    Return {name: query} for the lookups of the query modules, but the
+    execute_values templates that cannot be prepared
+    """
+    queries = {}
+    for module_name in modules:
+        module = importlib.import_module(module_name)
+        for name, query in vars(module).items():
+            if (name.endswith("_QUERY") and isinstance(query, str)
+                    and query.lstrip().upper().startswith(CHECKED_STATEMENTS)
+                    and BULK_VALUES not in query):
+                queries[f"{module_name.rsplit('.', 1)[-1]}.{name}"] = query
+    return queries
+
+
+def to_prepared(query: str):
+    """
+    Return query with $n parameters, and its number of parameters
+    """
+    if "{" in query:
+        query = query.format(**CHECK_FORMATS)
+    count = 0
+
+    def number(_match):
+        nonlocal count
+        count += 1
+        return f"${count}"
+    query = re.sub(r"%s", number, query).replace("%%", "%")
+    return query, count
+
+
+def find_seq_scans(plan: dict) -> list:
+    """
+    Return the tables read by sequential scan in a plan node and its children
+    """
+    tables = [plan["Relation Name"]] if plan.get("Node Type") == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        tables.extend(find_seq_scans(child))
+    return tables
+
+
+def explain(postgres_db: PostgresDatabase, query: str) -> dict:
+    """
+    Return the generic plan of query, sequential scans disabled
+    """
+    prepared, count = to_prepared(query)
+    params = ", ".join(["NULL"] * count)
+    explain_query = CHECK_EXPLAIN_QUERY.format(params=params)
+    if not count:
+        explain_query = explain_query.replace(" ()", "")
+    try:
+        postgres_db.execute(sql.SQL(CHECK_DISABLE_SEQSCAN_QUERY))
+        postgres_db.execute(sql.SQL(CHECK_GENERIC_PLAN_QUERY))
+        postgres_db.execute(sql.SQL(CHECK_PREPARE_QUERY.format(query=prepared)))
+        postgres_db.execute(sql.SQL(explain_query))
+        plan = postgres_db.fetch_one()[0][0]["Plan"]
+        postgres_db.execute(sql.SQL(CHECK_DEALLOCATE_QUERY))
+    finally:
+        # EXPLAIN does not run the query, nothing to keep
+        postgres_db.rollback()
+    return plan
+
+
+def check_queries(postgres_db: PostgresDatabase = PostgresDB,
+                  modules: tuple = CHECKED_MODULES) -> dict:
+    """
+    Return {name: tables} for the queries reading tables by sequential scan
+    """
+    failures = {}
+    with postgres_db.primary():
+        for name, query in checked_queries(modules).items():
+            tables = find_seq_scans(explain(postgres_db, query))
+            if tables:
+                failures[name] = tables
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the database schema.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    up = subparsers.add_parser("up", help="Apply the pending migrations.")
+    up.add_argument("--target", default=None, help="Last version to apply.")
+    subparsers.add_parser("status", help="List the migrations.")
+    subparsers.add_parser("check", help="Check that the queries use an index.")
+    args = parser.parse_args()
+
+    if args.command == "up":
+        for applied_version in migrate(target=args.target):
+            print(f"applied {applied_version}")
+    elif args.command == "status":
+        for version, name, is_applied in migration_status():
+            print(f"{version} {name} {'applied' if is_applied else 'pending'}")
+    else:
+        FAILURES = check_queries()
+        for query_name in checked_queries():
+            print(f"{'SEQ SCAN' if query_name in FAILURES else 'ok':8} {query_name}"
+                  + (f" ({', '.join(FAILURES[query_name])})" if query_name in FAILURES else ""))
+        sys.exit(1 if FAILURES else 0)
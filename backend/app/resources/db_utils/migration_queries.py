@@ -0,0 +1,33 @@
+"""
+Module providing queries to apply the schema migrations
+"""
+MIGRATION_CREATE_TABLE_QUERY = """
+                        CREATE TABLE IF NOT EXISTS schema_migrations (
+                                    version TEXT PRIMARY KEY,
+                                    name TEXT NOT NULL,
+                                    applied_at TIMESTAMP NOT NULL)
+                    """
+
+MIGRATION_LOCK_QUERY = "SELECT pg_advisory_lock(%s)"
+
+MIGRATION_UNLOCK_QUERY = "SELECT pg_advisory_unlock(%s)"
+
+MIGRATION_APPLIED_QUERY = "SELECT version FROM schema_migrations"
+
+MIGRATION_INSERT_QUERY = """
+                        INSERT INTO schema_migrations (version, name, applied_at)
+                        VALUES (%s, %s, %s)
+                    """
+
+# Plans are checked generic, as for prepared statements, and with
+# sequential scans disabled: a Seq Scan left in the plan means no index
+# can serve the query.
+CHECK_DISABLE_SEQSCAN_QUERY = "SET LOCAL enable_seqscan = off"
+
+CHECK_GENERIC_PLAN_QUERY = "SET LOCAL plan_cache_mode = force_generic_plan"
+
+CHECK_PREPARE_QUERY = "PREPARE migration_check AS {query}"
+
+CHECK_EXPLAIN_QUERY = "EXPLAIN (FORMAT JSON) EXECUTE migration_check ({params})"
+
+CHECK_DEALLOCATE_QUERY = "DEALLOCATE migration_check"
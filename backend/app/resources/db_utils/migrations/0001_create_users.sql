@@ -0,0 +1,16 @@
+-- Users, looked up by email without regard to case
+CREATE EXTENSION IF NOT EXISTS citext;
+
+CREATE TABLE IF NOT EXISTS users (
+    id BIGSERIAL PRIMARY KEY,
+    email CITEXT NOT NULL,
+    password TEXT NOT NULL,
+    host TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    lang TEXT,
+    created_date TIMESTAMP NOT NULL,
+    updated_date TIMESTAMP NOT NULL,
+    status SMALLINT NOT NULL,
+    CONSTRAINT users_email_key UNIQUE (email)
+);
@@ -0,0 +1,15 @@
+-- Notification settings, one row per user
+CREATE TABLE IF NOT EXISTS notification (
+    id BIGSERIAL PRIMARY KEY,
+    user_mail CITEXT NOT NULL,
+    daily_task_report BOOLEAN NOT NULL DEFAULT FALSE,
+    mention_in_comment BOOLEAN NOT NULL DEFAULT FALSE,
+    projet_due_date BOOLEAN NOT NULL DEFAULT FALSE,
+    projet_status_changed BOOLEAN NOT NULL DEFAULT FALSE,
+    questions_and_sections_assigned_as_author BOOLEAN NOT NULL DEFAULT FALSE,
+    questions_and_sections_assigned_as_reviewer BOOLEAN NOT NULL DEFAULT FALSE,
+    content_library_revision BOOLEAN NOT NULL DEFAULT FALSE,
+    group_of_questions_completed BOOLEAN NOT NULL DEFAULT FALSE,
+    task_assigned BOOLEAN NOT NULL DEFAULT FALSE,
+    CONSTRAINT notification_user_mail_key UNIQUE (user_mail)
+);
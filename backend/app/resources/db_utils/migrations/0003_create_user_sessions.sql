@@ -0,0 +1,12 @@
+-- Sessions, one per user and device. (email, device) also serves the
+-- lookups by email, expires_at the sweeps.
+CREATE TABLE IF NOT EXISTS user_sessions (
+    sid TEXT PRIMARY KEY,
+    email CITEXT NOT NULL,
+    device TEXT NOT NULL,
+    created_date TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    CONSTRAINT user_sessions_email_device_key UNIQUE (email, device)
+);
+
+CREATE INDEX IF NOT EXISTS user_sessions_expires_at_idx ON user_sessions (expires_at);
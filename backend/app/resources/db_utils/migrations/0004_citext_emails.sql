@@ -0,0 +1,6 @@
+-- Tables created by hand before the migrations stored emails as text.
+-- text and citext are binary compatible: the tables are not rewritten,
+-- only the indexes on the emails are rebuilt.
+ALTER TABLE users ALTER COLUMN email TYPE CITEXT;
+ALTER TABLE notification ALTER COLUMN user_mail TYPE CITEXT;
+ALTER TABLE user_sessions ALTER COLUMN email TYPE CITEXT;
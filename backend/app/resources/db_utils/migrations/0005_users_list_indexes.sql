@@ -0,0 +1,9 @@
+-- migrate: no-transaction
+-- Keyset pages of /user/list, newest first. The status index covers the
+-- listed columns so filtered pages are read by index only scans.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_created_date_id_idx
+    ON users (created_date DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_status_created_date_id_idx
+    ON users (status, created_date DESC, id DESC)
+    INCLUDE (email, host, first_name, last_name, lang, updated_date);
@@ -0,0 +1,2 @@
+-- Last use of a session, written behind by the session store
+ALTER TABLE user_sessions ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP;
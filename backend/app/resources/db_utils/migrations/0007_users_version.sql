@@ -0,0 +1,2 @@
+-- Version of the users rows, incremented by every update (compare-and-swap)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
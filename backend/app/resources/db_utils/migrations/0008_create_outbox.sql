@@ -0,0 +1,13 @@
+-- Changes of the users and of their sessions, written in the transaction of
+-- the change and published in id order by the outbox relay. The index
+-- serves the pending rows (published_date IS NULL) and the purge.
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event TEXT NOT NULL,
+    email CITEXT NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    created_date TIMESTAMP NOT NULL,
+    published_date TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS outbox_published_date_id_idx ON outbox (published_date, id);
@@ -0,0 +1,26 @@
+-- Notification settings in one bitmask, bit n being the nth flag of
+-- app.resources.type.notification.NotificationPreference. The booleans
+-- are folded into it, then dropped.
+ALTER TABLE notification ADD COLUMN IF NOT EXISTS preferences INTEGER NOT NULL DEFAULT 0;
+
+UPDATE notification
+SET preferences = daily_task_report::int
+    | (mention_in_comment::int << 1)
+    | (projet_due_date::int << 2)
+    | (projet_status_changed::int << 3)
+    | (questions_and_sections_assigned_as_author::int << 4)
+    | (questions_and_sections_assigned_as_reviewer::int << 5)
+    | (content_library_revision::int << 6)
+    | (group_of_questions_completed::int << 7)
+    | (task_assigned::int << 8);
+
+ALTER TABLE notification
+    DROP COLUMN daily_task_report,
+    DROP COLUMN mention_in_comment,
+    DROP COLUMN projet_due_date,
+    DROP COLUMN projet_status_changed,
+    DROP COLUMN questions_and_sections_assigned_as_author,
+    DROP COLUMN questions_and_sections_assigned_as_reviewer,
+    DROP COLUMN content_library_revision,
+    DROP COLUMN group_of_questions_completed,
+    DROP COLUMN task_assigned;
@@ -0,0 +1,29 @@
+-- migrate: no-transaction
+-- Subscribers of a notification, by keyset on user_mail: one partial
+-- index per bit, matching the predicate of NOTIF_SUBSCRIBERS_QUERY.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_daily_task_report_idx
+    ON notification (user_mail) WHERE preferences & 1 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_mention_in_comment_idx
+    ON notification (user_mail) WHERE preferences & 2 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_projet_due_date_idx
+    ON notification (user_mail) WHERE preferences & 4 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_projet_status_changed_idx
+    ON notification (user_mail) WHERE preferences & 8 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_questions_and_sections_assigned_as_author_idx
+    ON notification (user_mail) WHERE preferences & 16 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_questions_and_sections_assigned_as_reviewer_idx
+    ON notification (user_mail) WHERE preferences & 32 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_content_library_revision_idx
+    ON notification (user_mail) WHERE preferences & 64 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_group_of_questions_completed_idx
+    ON notification (user_mail) WHERE preferences & 128 <> 0;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notification_task_assigned_idx
+    ON notification (user_mail) WHERE preferences & 256 <> 0;
@@ -0,0 +1,24 @@
+-- Daily digests: the checkpoint of each day's run, and the rendered mails
+-- waiting for delivery. A run commits its mails with its checkpoint, so a
+-- restarted run goes on after the last recipient queued. The index serves
+-- the pending mails (sent_date IS NULL) and the purge.
+CREATE TABLE IF NOT EXISTS digest_runs (
+    run_date DATE PRIMARY KEY,
+    last_email CITEXT NOT NULL DEFAULT '',
+    queued INTEGER NOT NULL DEFAULT 0,
+    started_date TIMESTAMP NOT NULL,
+    finished_date TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS digest_mail (
+    id BIGSERIAL PRIMARY KEY,
+    run_date DATE NOT NULL,
+    email CITEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_date TIMESTAMP NOT NULL,
+    sent_date TIMESTAMP,
+    CONSTRAINT digest_mail_run_date_email_key UNIQUE (run_date, email)
+);
+
+CREATE INDEX IF NOT EXISTS digest_mail_sent_date_id_idx ON digest_mail (sent_date, id);
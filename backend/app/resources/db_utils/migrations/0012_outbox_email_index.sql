@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- Activity of a range of users over a day, read by the daily digests
+CREATE INDEX CONCURRENTLY IF NOT EXISTS outbox_email_created_date_idx
+    ON outbox (email, created_date);
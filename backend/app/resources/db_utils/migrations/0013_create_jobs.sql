@@ -0,0 +1,28 @@
+-- Jobs waiting to run, claimed by the workers with SKIP LOCKED. A claimed
+-- job is hidden until locked_until, extended while it runs: the job of a
+-- worker that died is claimed again once it passes. Jobs are deleted once
+-- done and kept after their last failed attempt. The partial index serves
+-- the claims of the jobs that may still run.
+CREATE TABLE IF NOT EXISTS jobs (
+    id BIGSERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    run_at TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    locked_until TIMESTAMP,
+    locked_by TEXT,
+    last_error TEXT,
+    created_date TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS jobs_run_at_id_idx ON jobs (run_at, id) WHERE attempts < max_attempts;
+
+-- Recurring jobs, enqueued by the worker that locks their row when due
+CREATE TABLE IF NOT EXISTS job_schedules (
+    name TEXT PRIMARY KEY,
+    cron TEXT NOT NULL,
+    next_run_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS job_schedules_next_run_at_idx ON job_schedules (next_run_at);
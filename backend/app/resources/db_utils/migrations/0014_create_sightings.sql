@@ -0,0 +1,12 @@
+-- Waste sightings reported by the users. Nearby and bounding box queries
+-- are served by the in-memory index of every worker, loaded by id pages.
+CREATE TABLE IF NOT EXISTS sightings (
+    id BIGSERIAL PRIMARY KEY,
+    email CITEXT NOT NULL,
+    latitude DOUBLE PRECISION NOT NULL CHECK (latitude BETWEEN -90 AND 90),
+    longitude DOUBLE PRECISION NOT NULL CHECK (longitude BETWEEN -180 AND 180),
+    description TEXT NOT NULL DEFAULT '',
+    status SMALLINT NOT NULL DEFAULT 1,
+    created_date TIMESTAMP NOT NULL,
+    updated_date TIMESTAMP NOT NULL
+);
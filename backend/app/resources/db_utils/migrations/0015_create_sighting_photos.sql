@@ -0,0 +1,9 @@
+-- Photos of the sightings. The files are stored on disk by the SHA-256
+-- digest of their bytes, the same photo once whatever its sightings.
+CREATE TABLE IF NOT EXISTS sighting_photos (
+    sighting_id BIGINT NOT NULL REFERENCES sightings (id) ON DELETE CASCADE,
+    digest CHAR(64) NOT NULL,
+    email CITEXT NOT NULL,
+    created_date TIMESTAMP NOT NULL,
+    PRIMARY KEY (sighting_id, digest)
+);
@@ -0,0 +1,2 @@
+-- Canonical report of a sighting reported again, NULL for the canonical ones
+ALTER TABLE sightings ADD COLUMN IF NOT EXISTS duplicate_of BIGINT REFERENCES sightings (id);
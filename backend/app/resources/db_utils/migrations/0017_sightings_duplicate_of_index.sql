@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- Duplicates of a sighting, counted when it is read
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sightings_duplicate_of_idx
+    ON sightings (duplicate_of) WHERE duplicate_of IS NOT NULL;
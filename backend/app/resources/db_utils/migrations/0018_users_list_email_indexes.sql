@@ -0,0 +1,13 @@
+-- migrate: no-transaction
+-- Keyset pages of /user/list end their order on the email: ids of
+-- different shards can be equal. The new indexes replace those of 0005.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_created_date_id_email_idx
+    ON users (created_date DESC, id DESC, email DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_status_created_date_id_email_idx
+    ON users (status, created_date DESC, id DESC, email DESC)
+    INCLUDE (host, first_name, last_name, lang, updated_date);
+
+DROP INDEX CONCURRENTLY IF EXISTS users_created_date_id_idx;
+
+DROP INDEX CONCURRENTLY IF EXISTS users_status_created_date_id_idx;
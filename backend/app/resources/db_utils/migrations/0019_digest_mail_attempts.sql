@@ -0,0 +1,7 @@
+-- Digests are claimed until locked_until and sent one by one: a failed
+-- send counts an attempt and keeps its error, the other digests of the
+-- batch are still marked sent.
+ALTER TABLE digest_mail
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS last_error TEXT;
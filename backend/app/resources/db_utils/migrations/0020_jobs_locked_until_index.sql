@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- Claimed jobs by the end of their lock: the last attempts of dead workers
+-- are failed once it passes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS jobs_locked_until_idx
+    ON jobs (locked_until) WHERE locked_by IS NOT NULL;
@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- Sightings changed while the push listener of a worker was disconnected,
+-- read again when it reconnects
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sightings_updated_date_idx
+    ON sightings (updated_date);
@@ -0,0 +1,3 @@
+-- Perceptual hash of the photos sent with a report, read back when a worker
+-- builds its duplicate buckets. NULL for the photos attached afterwards.
+ALTER TABLE sighting_photos ADD COLUMN IF NOT EXISTS phash BIGINT;
@@ -0,0 +1,44 @@
+"""
+Module providing queries to interact with the outbox table
+"""
+OUTBOX_INSERT_QUERY = """
+                        INSERT INTO outbox (event, email, payload, created_date)
+                        VALUES (%s, %s, %s::jsonb, %s)
+                    """
+
+# VALUES %s filled by execute_values
+OUTBOX_BULK_INSERT_QUERY = """
+                        INSERT INTO outbox (event, email, payload, created_date)
+                        VALUES %s
+                    """
+
+# Held until the end of the transaction: one relay at a time keeps the order
+OUTBOX_LOCK_QUERY = "SELECT pg_try_advisory_xact_lock(%s)"
+
+OUTBOX_PENDING_QUERY = """
+                        SELECT id, event, email, payload::text AS payload, created_date
+                        FROM outbox
+                        WHERE published_date IS NULL
+                        ORDER BY id
+                        LIMIT %s
+                    """
+
+# The last id published: the pending ids above it are published without gap
+OUTBOX_HIGH_WATER_QUERY = """
+                        SELECT id
+                        FROM outbox
+                        WHERE published_date IS NOT NULL
+                        ORDER BY id DESC
+                        LIMIT 1
+                    """
+
+OUTBOX_PUBLISHED_QUERY = """
+                        UPDATE outbox
+                        SET published_date = published.published_date
+                        FROM (VALUES %s) AS published (id, published_date)
+                        WHERE outbox.id = published.id
+                    """
+
+OUTBOX_NOTIFY_QUERY = "SELECT pg_notify(%s, %s)"
+
+OUTBOX_PURGE_QUERY = "DELETE FROM outbox WHERE published_date < %s"
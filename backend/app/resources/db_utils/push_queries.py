@@ -0,0 +1,8 @@
+"""
+Module providing queries to push messages between the workers
+"""
+# Sent at the commit of the transaction, payloads up to 8000 bytes
+PUSH_NOTIFY_QUERY = "SELECT pg_notify(%s, %s)"
+
+# Composed with sql.SQL().format(): {channel}, an identifier
+PUSH_LISTEN_QUERY = "LISTEN {channel}"
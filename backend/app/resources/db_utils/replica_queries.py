@@ -0,0 +1,14 @@
+"""
+Module providing queries to check the read replicas
+"""
+# Lag in seconds, 0 when the replica has replayed all it received, and
+# whether the server still is a replica
+REPLICA_LAG_QUERY = """
+                        SELECT
+                            CASE
+                                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE COALESCE(
+                                    EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                            END,
+                            pg_is_in_recovery()
+                    """
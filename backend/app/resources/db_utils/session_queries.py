@@ -0,0 +1,63 @@
+"""
+Module providing queries to interact with the user_sessions table
+"""
+SESSION_UPSERT_QUERY = """
+                        INSERT INTO user_sessions (
+                                    sid,
+                                    email,
+                                    device,
+                                    created_date,
+                                    expires_at)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (email, device) DO UPDATE
+                        SET
+                            sid = EXCLUDED.sid,
+                            created_date = EXCLUDED.created_date,
+                            expires_at = EXCLUDED.expires_at
+                    """
+
+IS_SESSION_ACTIVE_QUERY = "SELECT 1 FROM user_sessions WHERE sid = %s AND expires_at > %s"
+
+HAS_ACTIVE_SESSION_QUERY = """
+                        SELECT 1 FROM user_sessions
+                        WHERE email = %s AND expires_at > %s
+                        LIMIT 1
+                    """
+
+# The ended sessions are returned for their outbox events
+END_SESSION_QUERY = "DELETE FROM user_sessions WHERE sid = %s RETURNING sid, email, device"
+
+END_USER_SESSIONS_QUERY = """
+                        DELETE FROM user_sessions WHERE email = %s
+                        RETURNING sid, email, device
+                    """
+
+SWEEP_SESSIONS_QUERY = "DELETE FROM user_sessions WHERE expires_at <= %s"
+
+# Flushes of the write-behind buffer, VALUES %s filled by execute_values
+SESSION_BULK_UPSERT_QUERY = """
+                        INSERT INTO user_sessions (
+                                    sid,
+                                    email,
+                                    device,
+                                    created_date,
+                                    expires_at)
+                        VALUES %s
+                        ON CONFLICT (email, device) DO UPDATE
+                        SET
+                            sid = EXCLUDED.sid,
+                            created_date = EXCLUDED.created_date,
+                            expires_at = EXCLUDED.expires_at
+                    """
+
+END_SESSIONS_QUERY = """
+                        DELETE FROM user_sessions WHERE sid IN (VALUES %s)
+                        RETURNING sid, email, device
+                    """
+
+SESSIONS_SEEN_QUERY = """
+                        UPDATE user_sessions
+                        SET last_seen = seen.last_seen
+                        FROM (VALUES %s) AS seen (sid, last_seen)
+                        WHERE user_sessions.sid = seen.sid
+                    """
@@ -0,0 +1,29 @@
+"""
+Module providing queries to move users between shards
+"""
+SHARD_USERS_BATCH_QUERY = "SELECT * FROM users WHERE id > %s ORDER BY id LIMIT %s"
+
+SHARD_NOTIF_SELECT_QUERY = "SELECT * FROM notification WHERE user_mail = %s"
+
+# Composed with sql.SQL().format(): {columns}, {values} and {updates}.
+# Rows are copied again by every backfill, a newer copy is kept.
+SHARD_USER_COPY_QUERY = """
+                        INSERT INTO users ({columns})
+                        VALUES ({values})
+                        ON CONFLICT (email) DO UPDATE
+                        SET {updates}
+                        WHERE users.updated_date < EXCLUDED.updated_date
+                    """
+
+SHARD_NOTIF_COPY_QUERY = """
+                        INSERT INTO notification ({columns})
+                        VALUES ({values})
+                        ON CONFLICT (user_mail) DO UPDATE
+                        SET {updates}
+                    """
+
+SHARD_USER_EXISTS_QUERY = "SELECT 1 FROM users WHERE email = %s"
+
+SHARD_USER_DELETE_QUERY = "DELETE FROM users WHERE email = %s"
+
+SHARD_NOTIF_DELETE_QUERY = "DELETE FROM notification WHERE user_mail = %s"
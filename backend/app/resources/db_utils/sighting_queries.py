@@ -0,0 +1,68 @@
+"""
+Module providing queries to interact with the sightings table
+"""
+SIGHTING_INSERT_QUERY = """
+                        INSERT INTO sightings
+                        (email, latitude, longitude, description, status, created_date, updated_date,
+                            duplicate_of)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        RETURNING id
+                    """
+
+SIGHTING_SELECT_QUERY = """
+                        SELECT id, email, latitude, longitude, description, status,
+                            created_date, updated_date, duplicate_of,
+                            (SELECT count(*) FROM sightings AS duplicates
+                             WHERE duplicates.duplicate_of = sightings.id) AS duplicates
+                        FROM sightings
+                        WHERE id = %s
+                    """
+
+# Only an open sighting is resolved, once, with its open duplicates
+SIGHTING_RESOLVE_QUERY = """
+                        UPDATE sightings
+                        SET status = %s, updated_date = %s
+                        WHERE (id = %s OR duplicate_of = %s) AND status = %s
+                        RETURNING id, latitude, longitude, created_date, duplicate_of
+                    """
+
+# Keyset page of the sightings loaded in the index
+SIGHTINGS_BATCH_QUERY = """
+                        SELECT id, latitude, longitude, status, created_date, duplicate_of
+                        FROM sightings
+                        WHERE id > %s
+                        ORDER BY id
+                        LIMIT %s
+                    """
+
+# Sightings created or resolved since a date, missed while the push listener
+# was disconnected
+SIGHTINGS_UPDATED_QUERY = """
+                        SELECT id, latitude, longitude, status, created_date, duplicate_of
+                        FROM sightings
+                        WHERE updated_date >= %s
+                        ORDER BY id
+                    """
+
+# VALUES %s filled by execute_values. A photo sent again for the same
+# sighting is kept once.
+SIGHTING_PHOTO_INSERT_QUERY = """
+                        INSERT INTO sighting_photos (sighting_id, digest, email, created_date, phash)
+                        VALUES %s
+                        ON CONFLICT (sighting_id, digest) DO NOTHING
+                    """
+
+# Perceptual hashes of the report photos of an id range, for the duplicate
+# buckets
+SIGHTING_PHOTO_HASHES_QUERY = """
+                        SELECT sighting_id, phash
+                        FROM sighting_photos
+                        WHERE sighting_id >= %s AND sighting_id <= %s AND phash IS NOT NULL
+                    """
+
+SIGHTING_PHOTOS_SELECT_QUERY = """
+                        SELECT digest, email, created_date
+                        FROM sighting_photos
+                        WHERE sighting_id = %s
+                        ORDER BY created_date, digest
+                    """
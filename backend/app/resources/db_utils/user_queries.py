@@ -5,6 +5,8 @@ USER_SELECT_QUERY = "SELECT * FROM users WHERE email = %s"
 
 GET_USER_BY_ID_QUERY = "SELECT * FROM users WHERE id = %s"
 
+USER_EMAILS_BATCH_QUERY = "SELECT id, email FROM users WHERE id > %s ORDER BY id LIMIT %s"
+
 USER_INSERT_QUERY = """
                         INSERT INTO users (
                                     email,
@@ -19,6 +21,24 @@ USER_INSERT_QUERY = """
                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
                     """
 
+USER_BULK_INSERT_QUERY = """
+                        INSERT INTO users (
+                                    email,
+                                    password,
+                                    host,
+                                    first_name,
+                                    last_name,
+                                    lang,
+                                    created_date,
+                                    updated_date,
+                                    status)
+                        VALUES %s
+                        ON CONFLICT (email) DO NOTHING
+                        RETURNING email
+                    """
+
+# Compare-and-swap on version: no row is returned if another update
+# changed the user since it was read
 USER_UPDATE_QUERY = """
                         UPDATE users
                         SET
@@ -28,29 +48,57 @@ USER_UPDATE_QUERY = """
                             last_name = %s,
                             lang = %s,
                             status = %s,
-                            updated_date = %s
-                        WHERE email = %s
+                            updated_date = %s,
+                            version = version + 1
+                        WHERE email = %s AND version = %s
+                        RETURNING version
                     """
 
-ACTIVE_USER_SESSION_QUERY = "UPDATE users SET session_active = %s WHERE email = %s"
-
-END_USER_SESSION_QUERY = "UPDATE users SET session_active = %s WHERE email = %s"
+# Rehash at login: the password is unchanged, so is the version
+USER_REHASH_QUERY = "UPDATE users SET password = %s WHERE email = %s AND password = %s"
 
-IS_USER_SESSION_ACTIVE_QUERY = "SELECT session_active FROM users WHERE email = %s"
+NOTIF_SELECT_QUERY = "SELECT preferences FROM notification WHERE user_mail = %s"
 
-NOTIF_SELECT_QUERY = "SELECT * FROM notification WHERE user_mail = %s"
+NOTIF_INSERT_QUERY = """
+                        INSERT INTO notification (user_mail, preferences)
+                        VALUES (%s, %s)
+                        ON CONFLICT (user_mail) DO NOTHING
+                    """
 
+# Clears the bits of the first mask then sets those of the second, so
+# concurrent changes of other preferences are kept
 NOTIF_UPDATE_QUERY = """
                         UPDATE notification
-                        SET
-                            daily_task_report = %s,
-                            mention_in_comment = %s,
-                            projet_due_date = %s,
-                            projet_status_changed = %s,
-                            questions_and_sections_assigned_as_author = %s,
-                            questions_and_sections_assigned_as_reviewer = %s,
-                            content_library_revision = %s,
-                            group_of_questions_completed = %s,
-                            task_assigned = %s
+                        SET preferences = (preferences & ~%s::integer) | %s::integer
                         WHERE user_mail = %s
+                        RETURNING preferences
+                    """
+
+# Composed with sql.SQL().format(): {bit}, a literal so that the partial
+# index of the bit serves the predicate. Keyset pages on user_mail.
+NOTIF_SUBSCRIBERS_QUERY = """
+                        SELECT user_mail
+                        FROM notification
+                        WHERE preferences & {bit} <> 0 AND user_mail > %s
+                        ORDER BY user_mail
+                        LIMIT %s
                     """
+
+USER_LIST_COLUMNS = ("id", "email", "host", "first_name", "last_name", "lang", "status",
+                     "created_date", "updated_date")
+
+USER_LIST_FILTERS = ("status", "lang", "host")
+
+# Composed with sql.SQL().format(): {columns} and {where}, the filters joined by AND
+USER_LIST_QUERY = """
+                        SELECT {columns}
+                        FROM users
+                        {where}
+                        ORDER BY created_date DESC, id DESC, email DESC
+                        LIMIT %s
+                    """
+
+# The email breaks the ties of ids of different shards
+USER_LIST_AFTER_CONDITION = "(created_date, id, email) < (%s, %s, %s)"
+
+USER_ESTIMATE_COUNT_QUERY = "EXPLAIN (FORMAT JSON) SELECT 1 FROM users {where}"
@@ -3,19 +3,22 @@ Utilities function for users
 """
 from psycopg2 import sql
 from app.resources.db_utils.user_queries import GET_USER_BY_ID_QUERY
-from app.resources.required_packages import PostgresDB
 from app.resources.db_utils.db_utils import format_data_from_db
 
 
 def get_user_by_id(user_id: int):
     """
-    Function to get a user based on their id
+    Function to get a user based on their id. Ids are only unique within a
+    shard: with shards, the user of the first shard having this id is returned.
     """
-    query = sql.SQL(GET_USER_BY_ID_QUERY)
-    PostgresDB.execute(query, (user_id,))
-    data = PostgresDB.fetch_one()
+    # pylint: disable=import-outside-toplevel
+    from app.models.user import all_databases
 
-    if data is None:
-        return None
+    query = sql.SQL(GET_USER_BY_ID_QUERY)
+    for database in all_databases():
+        database.execute(query, (user_id,))
+        data = database.fetch_one()
+        if data is not None:
+            return format_data_from_db(database, data)
 
-    return format_data_from_db(PostgresDB, data)
+    return None
@@ -5,3 +5,4 @@ App dependencies
 from app.services.apphttpbearer import AppHttpBearer
 
 oauth2_scheme_session = AppHttpBearer(check_session=True)
+oauth2_scheme_admin = AppHttpBearer(check_session=True, check_admin=True)
@@ -7,14 +7,80 @@ Attributes:
     - client (MongoClient): The client for the MongoDB database.
     - db (Database): The database for the MongoDB database.
     - USERS (Collection): The collection for the users in the MongoDB database.
-    - salt (str): The salt used for hashing passwords.
+    - salt (str): The legacy global salt, giving the default BCRYPT_COST.
+    - BCRYPT_COST (int): The bcrypt work factor of new hashes, see app.services.passwords.
+    - DB_REPLICAS (list): The DSNs of the read replicas.
+    - REPLICA_MAX_LAG (float): The lag, in seconds, above which a replica is not read.
+    - REPLICA_CHECK_INTERVAL (int): The delay between two health checks of the replicas.
+    - READ_YOUR_WRITES_WINDOW (float): How long reads stay on the primary after a write.
+    - SHARD_MAP (str): The JSON shard map of the user storage, unsharded if empty.
+    - Replica (class): A read replica and its health.
+    - PostgresDatabase (class): The database, routing reads to the healthy replicas.
     - SECRET_KEY (str): The secret key used for generating tokens.
     - ALGORITHM (str): The algorithm used for generating tokens.
+    - TOKEN_CACHE_SIZE (int): The number of verified tokens kept in memory.
+    - JWT_KEYS_DIR (str): The directory of the signing keys for EdDSA/ES256.
+    - JWT_ACTIVE_KID (str): The kid of the key signing new tokens.
+    - JWKS_MAX_AGE (int): How long clients may cache the JWKS, in seconds.
+    - ADMIN_EMAILS (list): The emails of the users allowed on admin routes.
+    - SESSION_BACKEND (str): Where sessions are stored: memory, postgres or redis.
+    - SESSION_REDIS_URL (str): The URL of the Redis server for the redis backend.
+    - SESSION_SWEEP_INTERVAL (int): Minimum delay between two sweeps of expired sessions.
+    - SESSION_WRITE_BEHIND (bool): Buffer the session writes of login and logout.
+    - WRITE_BEHIND_INTERVAL (float): Minimum delay between two flushes of a write-behind buffer.
+    - WRITE_BEHIND_MAX_PENDING (int): The pending writes forcing a flush.
+    - OUTBOX_CHANNEL (str): The NOTIFY channel of the change events.
+    - OUTBOX_BATCH_SIZE (int): The events published together by the outbox relay.
+    - OUTBOX_POLL_INTERVAL (float): The delay between two reads of an empty outbox.
+    - OUTBOX_RETENTION_DAYS (int): How long published events are kept.
+    - OUTBOX_GAP_TIMEOUT (float): How long the relay waits for a missing id before skipping it.
+    - EMAIL_FILTER_ENABLED (bool): Skip the lookups of the new emails at registration.
+    - EMAIL_FILTER_CAPACITY (int): The emails the email filter holds at its error rate.
+    - EMAIL_FILTER_ERROR_RATE (float): The false positive rate of the email filter.
+    - EMAIL_FILTER_MAX_BYTES (int): The memory limit of the email filter, none if 0.
+    - BREACHED_PASSWORDS_FILE (str): The breached password filter file, no check if empty.
+    - NOTIF_CACHE_SIZE (int): The users whose notification preferences are kept in memory.
+    - NOTIF_CACHE_TTL (float): How long cached notification preferences are served, in seconds.
+    - DIGEST_CHUNK_SIZE (int): The recipients of the daily digest queued together.
+    - DIGEST_MAIL_BATCH_SIZE (int): The digests sent through one SMTP session.
+    - DIGEST_RETENTION_DAYS (int): How long sent digests are kept.
+    - DIGEST_MAX_ATTEMPTS (int): The sends of a digest before it is given up.
+    - PUSH_CHANNEL (str): The NOTIFY channel of the messages pushed to the connected users.
+    - PUSH_QUEUE_SIZE (int): The messages a connection may lag behind before it is closed.
+    - PUSH_LISTEN (bool): Listen to the push and change event channels in the API workers.
+    - JOBS_IN_PROCESS (bool): Run the jobs in the API process, rather than in worker.py.
+    - JOBS_CONCURRENCY (int): The jobs a worker runs at the same time.
+    - JOBS_POLL_INTERVAL (float): The delay between two claims of a worker without due jobs.
+    - JOBS_VISIBILITY_TIMEOUT (int): How long a claimed job is hidden from the other workers.
+    - JOBS_MAX_ATTEMPTS (int): The runs of a failing job before it is kept aside.
+    - SIGHTINGS_CELL_DEGREES (float): The side of the cells of the sightings index, in degrees.
+    - SIGHTINGS_MAX_ZOOM (int): The deepest map zoom level of the sighting clusters.
+    - PHOTOS_DIR (str): The directory of the sighting photos, by digest.
+    - PHOTO_MAX_BYTES (int): The largest photo accepted.
+    - PHOTO_WRITE_CONCURRENCY (int): The photo writes to disk in flight per worker.
+    - PHOTO_PROCESSES (int): The processes stripping and thumbnailing the photos.
+    - PHOTO_THUMBNAIL_SIZE (int): The longest side of the thumbnails, in pixels.
+    - SIGHTING_DUPLICATE_METERS (float): The distance of the reports of a same pile.
+    - SIGHTING_DUPLICATE_MINUTES (int): The delay between the reports of a same pile.
+    - SIGHTING_DUPLICATE_HAMMING (int): The differing bits of the photo hashes of a same pile.
     - SMTP_user (str): The email address used for sending emails.
     - SMTP_password (str): The password used for sending emails.
+    - BULK_IMPORT_BATCH_SIZE (int): The rows validated and inserted together by a bulk import.
+    - BULK_IMPORT_HASH_WORKERS (int): The threads hashing the passwords of a bulk import.
+    - BULK_MAIL_BATCH_SIZE (int): The mails sent through one SMTP session.
 """
+from contextlib import contextmanager
+from contextvars import ContextVar
+import re
+import threading
+import time
+
 import psycopg2
-from decouple import config
+import psycopg2.extras
+from psycopg2 import sql
+from decouple import config, Csv
+
+from app.resources.db_utils.replica_queries import REPLICA_LAG_QUERY
 
 DB_USER = config("DB_USER")
 DB_PASSWORD = config("DB_PASSWORD")
@@ -22,28 +88,212 @@ DB_HOST = config("DB_HOST")
 DB_PORT = config("DB_PORT")
 DB_NAME = config("DB_NAME")
 
+DB_REPLICAS = config("DB_REPLICAS", default="", cast=Csv())
+REPLICA_MAX_LAG = config("REPLICA_MAX_LAG", default=1.0, cast=float)
+REPLICA_CHECK_INTERVAL = config("REPLICA_CHECK_INTERVAL", default=10, cast=int)
+READ_YOUR_WRITES_WINDOW = config("READ_YOUR_WRITES_WINDOW", default=2.0, cast=float)
+SHARD_MAP = config("SHARD_MAP", default="")
+
+# Statements a replica can answer: plain SELECT, without row locks
+READ_QUERY = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+LOCKING_CLAUSE = re.compile(r"\bFOR\s+(UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)\b",
+                            re.IGNORECASE)
+FAILOVER_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# Read scopes kept on the primary after a write, pruned beyond this count
+MAX_STICKY_SCOPES = 10000
+
+_FORCE_PRIMARY = ContextVar("force_primary", default=False)
+# Who the statements of the current request run for, the email of its user
+_READ_SCOPE = ContextVar("read_scope", default=None)
+
+
+def set_read_scope(scope: str):
+    """
+    Run the statements of the current request for scope, the email of its
+    user: its reads stay on the primary after its own writes only
+    """
+    _READ_SCOPE.set(scope)
+
+
+class Replica:
+    """
+    Read replica, connected on its first health check
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.connection = None
+        self.cursor = None
+        self.healthy = False
+        self.lag = None
+
+    def check(self, max_lag: float = REPLICA_MAX_LAG):
+        """
+        Measure the lag of the replica, it is healthy if reachable, still a
+        replica and not lagging more than max_lag seconds
+        """
+        try:
+            if self.connection is None or self.connection.closed:
+                self.connection = psycopg2.connect(self.dsn)
+                # Reads do not hold a snapshot open between requests
+                self.connection.autocommit = True
+                self.cursor = self.connection.cursor()
+            self.lag, in_recovery = self._lag()
+            self.healthy = bool(in_recovery) and self.lag <= max_lag
+        except FAILOVER_ERRORS:
+            self.fail()
+
+    def _lag(self):
+        """Return (lag, in_recovery)"""
+        self.cursor.execute(sql.SQL(REPLICA_LAG_QUERY))
+        lag, in_recovery = self.cursor.fetchone()
+        return float(lag), in_recovery
+
+    def fail(self):
+        """
+        Take the replica out of rotation until its next health check
+        """
+        self.healthy = False
+        if self.connection is not None and not self.connection.closed:
+            self.connection.close()
+        self.connection = None
+        self.cursor = None
+
 
 class PostgresDatabase:
     """
     Posgress database class
+
+    Without replicas every statement runs on the primary. With replicas,
+    reads outside a write transaction go to a healthy replica, round robin,
+    and fall back to the primary when none is healthy or the replica fails.
+    After a write, the reads of the same read scope stay on the primary for
+    READ_YOUR_WRITES_WINDOW seconds, so a user reads what they wrote while
+    the others keep reading the replicas.
+
+    Every statement runs on a cursor of its own, and cursor is the cursor
+    of the last statement of the calling thread: concurrent requests never
+    fetch the rows of each other. The previous cursor of the thread is
+    closed by its next statement. in_write is kept per thread as well.
     """
 
     connection: psycopg2.extensions.connection
-    cursor: psycopg2.extensions.cursor
 
-    def __init__(self):
+    def __init__(self, replicas=(), dsn: str = None):
         """
         initialize the class method
+        Attrs:
+            replicas (list): DSNs of the read replicas
+            dsn (str): DSN of the primary, the DB_ settings by default
+        """
+        if dsn:
+            connection = psycopg2.connect(dsn)
+        else:
+            connection = psycopg2.connect(
+                host=DB_HOST,
+                port=DB_PORT,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                database=DB_NAME,
+            )
+        self._local = threading.local()
+        self.connection = connection
+        self.replicas = [Replica(dsn) for dsn in replicas]
+        # Read scope -> monotonic time its reads leave the primary
+        self.sticky_until = {}
+        self.checked_at = None
+        self._check_lock = threading.Lock()
+        self._next_replica = 0
+
+    @property
+    def cursor(self):
+        """
+        The cursor of the last statement of this thread, None before its
+        first statement
         """
+        return getattr(self._local, "cursor", None)
 
-        with psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-        ) as self.connection:
-            self.cursor = self.connection.cursor()
+    @cursor.setter
+    def cursor(self, cursor):
+        previous = getattr(self._local, "cursor", None)
+        if previous is not None and previous is not cursor:
+            try:
+                previous.close()
+            except psycopg2.InterfaceError:
+                # Its replica connection was closed by fail
+                pass
+        self._local.cursor = cursor
+
+    @property
+    def in_write(self) -> bool:
+        """
+        True while this thread has uncommitted writes on the primary
+        """
+        return getattr(self._local, "in_write", False)
+
+    @in_write.setter
+    def in_write(self, in_write: bool):
+        self._local.in_write = in_write
+
+    @contextmanager
+    def primary(self):
+        """
+        Run every statement of the block on the primary
+        """
+        token = _FORCE_PRIMARY.set(True)
+        try:
+            yield self
+        finally:
+            _FORCE_PRIMARY.reset(token)
+
+    def _text(self, query) -> str:
+        """Return the text of query"""
+        if isinstance(query, sql.SQL):
+            return query.string
+        if isinstance(query, sql.Composable):
+            return query.as_string(self.connection)
+        if isinstance(query, bytes):
+            return query.decode("utf-8")
+        return query
+
+    def is_read(self, query) -> bool:
+        """
+        Return True if query can run on a replica
+        """
+        text = self._text(query)
+        return bool(READ_QUERY.match(text)) and not LOCKING_CLAUSE.search(text)
+
+    def check_replicas(self):
+        """
+        Check the replicas if the last check is older than REPLICA_CHECK_INTERVAL
+        """
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < REPLICA_CHECK_INTERVAL:
+            return
+        # One thread checks, the others read with the previous state
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            for replica in self.replicas:
+                replica.check()
+            self.checked_at = time.monotonic()
+        finally:
+            self._check_lock.release()
+
+    def _replica_for(self, query):
+        """
+        Return the replica to run query on, None for the primary
+        """
+        if (not self.replicas or self.in_write or _FORCE_PRIMARY.get()
+                or time.monotonic() < self.sticky_until.get(_READ_SCOPE.get(), 0.0)
+                or not self.is_read(query)):
+            return None
+        self.check_replicas()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        self._next_replica = (self._next_replica + 1) % len(healthy)
+        return healthy[self._next_replica]
 
     def execute(self, query, params=None):
         """
@@ -52,10 +302,50 @@ class PostgresDatabase:
             query (str): query to execute
             params (str): query parameters
         """
-        if params is None:
-            self.cursor.execute(query)
-        else:
-            self.cursor.execute(query, params)
+        args = (query,) if params is None else (query, params)
+        replica = self._replica_for(query)
+        connection = None if replica is None else replica.connection
+        if connection is not None:
+            try:
+                cursor = connection.cursor()
+                self.cursor = cursor
+                cursor.execute(*args)
+                return
+            except FAILOVER_ERRORS:
+                replica.fail()
+
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(*args)
+        if self.replicas and not self.is_read(query):
+            self._wrote()
+
+    def _wrote(self):
+        """
+        Keep the reads of the read scope on the primary until the write is
+        committed and the replicas had time to replay it
+        """
+        self.in_write = True
+        now = time.monotonic()
+        if len(self.sticky_until) >= MAX_STICKY_SCOPES:
+            self.sticky_until = {scope: until for scope, until in list(self.sticky_until.items())
+                                 if until > now}
+        self.sticky_until[_READ_SCOPE.get()] = now + max(READ_YOUR_WRITES_WINDOW, REPLICA_MAX_LAG)
+
+    def execute_values(self, query, argslist, page_size=100, fetch=False):
+        """
+        Execute a query with a multi-row VALUES list
+        Attrs:
+            query (str): query with a single %s placeholder for the VALUES list
+            argslist (list): one params tuple per row
+            page_size (int): rows sent per statement
+            fetch (bool): return the rows of a RETURNING clause
+        """
+        self.cursor = self.connection.cursor()
+        if self.replicas:
+            self._wrote()
+        return psycopg2.extras.execute_values(
+            self.cursor, query, argslist, page_size=page_size, fetch=fetch
+        )
 
     def fetch_one(self):
         """
@@ -74,30 +364,87 @@ class PostgresDatabase:
         commit the transaction method
         """
         self.connection.commit()
+        self.in_write = False
 
     def rollback(self):
         """
         rollback the transaction method
         """
         self.connection.rollback()
+        self.in_write = False
 
     def close(self):
         """
         close the connection
         """
         self.connection.close()
+        for replica in self.replicas:
+            replica.fail()
 
 
-PostgresDB = PostgresDatabase()
+PostgresDB = PostgresDatabase(DB_REPLICAS)
 
 SERVER_URL = config("SERVER_URL")
 
-salt = config("salt")
+# Legacy global bcrypt salt, only its cost is read as default BCRYPT_COST
+salt = config("salt", default="")
+BCRYPT_COST = config("BCRYPT_COST", default=int(salt.split("$")[2]) if salt.count("$") >= 3 else 12,
+                     cast=int)
 SECRET_KEY = config("SECRET_KEY")
 ALGORITHM = config("ALGORITHM")
+TOKEN_CACHE_SIZE = config("TOKEN_CACHE_SIZE", default=10000, cast=int)
+JWT_KEYS_DIR = config("JWT_KEYS_DIR", default="")
+JWT_ACTIVE_KID = config("JWT_ACTIVE_KID", default="")
+JWKS_MAX_AGE = config("JWKS_MAX_AGE", default=3600, cast=int)
+ADMIN_EMAILS = config("ADMIN_EMAILS", default="", cast=Csv())
+
+SESSION_BACKEND = config("SESSION_BACKEND", default="postgres")
+SESSION_REDIS_URL = config("SESSION_REDIS_URL", default="redis://localhost:6379/0")
+SESSION_SWEEP_INTERVAL = config("SESSION_SWEEP_INTERVAL", default=300, cast=int)
+SESSION_WRITE_BEHIND = config("SESSION_WRITE_BEHIND", default=False, cast=bool)
+WRITE_BEHIND_INTERVAL = config("WRITE_BEHIND_INTERVAL", default=1.0, cast=float)
+WRITE_BEHIND_MAX_PENDING = config("WRITE_BEHIND_MAX_PENDING", default=1000, cast=int)
+OUTBOX_CHANNEL = config("OUTBOX_CHANNEL", default="user_changes")
+OUTBOX_BATCH_SIZE = config("OUTBOX_BATCH_SIZE", default=500, cast=int)
+OUTBOX_POLL_INTERVAL = config("OUTBOX_POLL_INTERVAL", default=1.0, cast=float)
+OUTBOX_RETENTION_DAYS = config("OUTBOX_RETENTION_DAYS", default=7, cast=int)
+OUTBOX_GAP_TIMEOUT = config("OUTBOX_GAP_TIMEOUT", default=10.0, cast=float)
+EMAIL_FILTER_ENABLED = config("EMAIL_FILTER_ENABLED", default=True, cast=bool)
+EMAIL_FILTER_CAPACITY = config("EMAIL_FILTER_CAPACITY", default=1_000_000, cast=int)
+EMAIL_FILTER_ERROR_RATE = config("EMAIL_FILTER_ERROR_RATE", default=0.01, cast=float)
+EMAIL_FILTER_MAX_BYTES = config("EMAIL_FILTER_MAX_BYTES", default=0, cast=int)
+BREACHED_PASSWORDS_FILE = config("BREACHED_PASSWORDS_FILE", default="")
+NOTIF_CACHE_SIZE = config("NOTIF_CACHE_SIZE", default=10000, cast=int)
+NOTIF_CACHE_TTL = config("NOTIF_CACHE_TTL", default=30.0, cast=float)
+DIGEST_CHUNK_SIZE = config("DIGEST_CHUNK_SIZE", default=500, cast=int)
+DIGEST_MAIL_BATCH_SIZE = config("DIGEST_MAIL_BATCH_SIZE", default=50, cast=int)
+DIGEST_RETENTION_DAYS = config("DIGEST_RETENTION_DAYS", default=7, cast=int)
+DIGEST_MAX_ATTEMPTS = config("DIGEST_MAX_ATTEMPTS", default=5, cast=int)
+PUSH_CHANNEL = config("PUSH_CHANNEL", default="user_notifications")
+PUSH_QUEUE_SIZE = config("PUSH_QUEUE_SIZE", default=100, cast=int)
+PUSH_LISTEN = config("PUSH_LISTEN", default=True, cast=bool)
+JOBS_IN_PROCESS = config("JOBS_IN_PROCESS", default=False, cast=bool)
+JOBS_CONCURRENCY = config("JOBS_CONCURRENCY", default=4, cast=int)
+JOBS_POLL_INTERVAL = config("JOBS_POLL_INTERVAL", default=1.0, cast=float)
+JOBS_VISIBILITY_TIMEOUT = config("JOBS_VISIBILITY_TIMEOUT", default=300, cast=int)
+JOBS_MAX_ATTEMPTS = config("JOBS_MAX_ATTEMPTS", default=5, cast=int)
+SIGHTINGS_CELL_DEGREES = config("SIGHTINGS_CELL_DEGREES", default=0.01, cast=float)
+SIGHTINGS_MAX_ZOOM = config("SIGHTINGS_MAX_ZOOM", default=16, cast=int)
+PHOTOS_DIR = config("PHOTOS_DIR", default="photos")
+PHOTO_MAX_BYTES = config("PHOTO_MAX_BYTES", default=10 * 1024 * 1024, cast=int)
+PHOTO_WRITE_CONCURRENCY = config("PHOTO_WRITE_CONCURRENCY", default=8, cast=int)
+PHOTO_PROCESSES = config("PHOTO_PROCESSES", default=2, cast=int)
+PHOTO_THUMBNAIL_SIZE = config("PHOTO_THUMBNAIL_SIZE", default=320, cast=int)
+SIGHTING_DUPLICATE_METERS = config("SIGHTING_DUPLICATE_METERS", default=50.0, cast=float)
+SIGHTING_DUPLICATE_MINUTES = config("SIGHTING_DUPLICATE_MINUTES", default=30, cast=int)
+SIGHTING_DUPLICATE_HAMMING = config("SIGHTING_DUPLICATE_HAMMING", default=10, cast=int)
 
 FROM_EMAIL = config("FROM_EMAIL")
 SMTP_SERVER = config("SMTP_SERVER")
 SMTP_PORT = config("SMTP_PORT")
 SMTP_USERNAME = config("SMTP_USERNAME")
 SMTP_PASSWORD = config("SMTP_PASSWORD")
+
+BULK_IMPORT_BATCH_SIZE = config("BULK_IMPORT_BATCH_SIZE", default=500, cast=int)
+BULK_IMPORT_HASH_WORKERS = config("BULK_IMPORT_HASH_WORKERS", default=4, cast=int)
+BULK_MAIL_BATCH_SIZE = config("BULK_MAIL_BATCH_SIZE", default=50, cast=int)
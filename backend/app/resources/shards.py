@@ -0,0 +1,267 @@
+"""
+Hash sharding of the user storage.
+
+Users are spread over several Postgres instances by their email: the
+normalized email is hashed into one of a fixed number of buckets, and the
+shard map assigns ranges of buckets to shards. The hash is stable across
+processes and versions, so a user always lives in the same bucket, and
+resharding moves whole buckets from a shard to another.
+
+A shard map is a JSON file:
+
+    {
+        "buckets": 1024,
+        "shards": {
+            "a": {"dsn": "host=db-a dbname=cleancomm", "buckets": [[0, 511]]},
+            "b": {"dsn": "host=db-b dbname=cleancomm", "replicas": ["host=db-b2 dbname=cleancomm"],
+                  "buckets": [[512, 1023]]}
+        }
+    }
+
+Each shard has its own PostgresDatabase, with its read replicas. The users,
+their notification settings and ids live in the shard of their email, ids are
+only unique within a shard.
+
+Resharding:
+    1. Write the new map and run backfill: the rows of the moving buckets are
+       copied to their new shard. It is safe to run again.
+    2. Deploy the new map, then run backfill again to copy the rows written
+       to the old shards meanwhile.
+    3. Run cleanup to delete the moved rows from the old shards.
+
+Attributes:
+    - normalize_email (function): The form of an email that is hashed.
+    - bucket_of (function): The bucket of an email.
+    - ShardMap (class): The buckets of every shard.
+    - ShardRouter (class): The databases of the shards.
+    - load_shard_map (function): Read a shard map file.
+    - backfill (function): Copy the rows of the moving buckets to their new shard.
+    - cleanup (function): Delete the moved rows from their old shard.
+    - SHARDS (ShardRouter): The shards of SHARD_MAP, None when unsharded.
+
+Usage:
+    python -m app.resources.shards backfill --from shards.json --to shards.new.json
+    python -m app.resources.shards cleanup --from shards.json --to shards.new.json
+"""
+import argparse
+import hashlib
+import json
+
+from psycopg2 import sql
+
+from app.resources.required_packages import PostgresDatabase, SHARD_MAP
+from app.resources.db_utils.db_utils import format_data_from_db, format_datas_from_db
+from app.resources.db_utils.shard_queries import (
+    SHARD_USERS_BATCH_QUERY, SHARD_NOTIF_SELECT_QUERY, SHARD_USER_COPY_QUERY,
+    SHARD_NOTIF_COPY_QUERY, SHARD_USER_EXISTS_QUERY, SHARD_USER_DELETE_QUERY,
+    SHARD_NOTIF_DELETE_QUERY)
+
+DEFAULT_BUCKETS = 1024
+BACKFILL_BATCH_SIZE = 500
+
+
+def normalize_email(email: str) -> str:
+    """
+    Return the form of email that is hashed, emails being case insensitive
+    """
+    return email.strip().lower()
+
+
+def bucket_of(email: str, buckets: int = DEFAULT_BUCKETS) -> int:
+    """
+    Return the bucket of email. Unlike hash(), blake2b does not change
+    between processes.
+    """
+    digest = hashlib.blake2b(normalize_email(email).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % buckets
+
+
+class ShardMap:
+    """
+    Buckets of every shard
+    """
+
+    def __init__(self, shards: dict, buckets: int = DEFAULT_BUCKETS):
+        """
+        Attrs:
+            shards (dict): {name: {"dsn", "replicas", "buckets": [[first, last], ...]}}
+            buckets (int): The number of buckets
+        """
+        self.shards = shards
+        self.buckets = buckets
+        owners = [None] * buckets
+        for name, shard in shards.items():
+            for first, last in shard["buckets"]:
+                for bucket in range(first, last + 1):
+                    if not 0 <= bucket < buckets:
+                        raise ValueError(f"Bucket {bucket} of shard {name} out of range.")
+                    if owners[bucket] is not None:
+                        raise ValueError(f"Bucket {bucket} in shards {owners[bucket]} and {name}.")
+                    owners[bucket] = name
+        missing = [bucket for bucket, owner in enumerate(owners) if owner is None]
+        if missing:
+            raise ValueError(f"Buckets without shard, from {missing[0]}.")
+        self.owners = owners
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """
+        Build a map from its JSON form
+        """
+        return cls(data["shards"], data.get("buckets", DEFAULT_BUCKETS))
+
+    def shard_of(self, email: str) -> str:
+        """
+        Return the name of the shard of email
+        """
+        return self.owners[bucket_of(email, self.buckets)]
+
+    def moves(self, new_map) -> dict:
+        """
+        Return {bucket: (old_shard, new_shard)} for the buckets changing shard
+        """
+        if new_map.buckets != self.buckets:
+            raise ValueError("Maps with different bucket counts.")
+        return {bucket: (old, new) for bucket, (old, new)
+                in enumerate(zip(self.owners, new_map.owners)) if old != new}
+
+
+class ShardRouter:
+    """
+    Databases of the shards of a map
+    """
+
+    def __init__(self, shard_map: ShardMap, databases: dict):
+        """
+        Attrs:
+            shard_map (ShardMap): The map of the shards
+            databases (dict): {name: PostgresDatabase} for every shard of the map
+        """
+        self.shard_map = shard_map
+        self.databases = databases
+
+    @classmethod
+    def connect(cls, shard_map: ShardMap):
+        """
+        Open the databases of the shards of shard_map
+        """
+        return cls(shard_map, {
+            name: PostgresDatabase(shard.get("replicas", ()), dsn=shard["dsn"])
+            for name, shard in shard_map.shards.items()
+        })
+
+    def db_for(self, email: str) -> PostgresDatabase:
+        """
+        Return the database of the shard of email
+        """
+        return self.databases[self.shard_map.shard_of(email)]
+
+    def all(self) -> list:
+        """
+        Return the database of every shard
+        """
+        return list(self.databases.values())
+
+
+def load_shard_map(path: str) -> ShardMap:
+    """
+    Read a shard map file
+    """
+    with open(path, "r", encoding="utf-8") as map_file:
+        return ShardMap.from_dict(json.load(map_file))
+
+
+def _copy_query(template: str, row: dict, skip: tuple):
+    """
+    Compose the upsert of row in a copy query template
+    """
+    columns = [column for column in row if column not in skip]
+    query = sql.SQL(template).format(
+        columns=sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+        values=sql.SQL(", ").join(sql.Placeholder() * len(columns)),
+        updates=sql.SQL(", ").join(
+            sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column)) for column in columns),
+    )
+    return query, tuple(row[column] for column in columns)
+
+
+def _moved_users(source: PostgresDatabase, source_name: str, new_map: ShardMap):
+    """
+    Yield, batch by batch, (user, new_shard) for the users of source
+    belonging to another shard
+    """
+    last_id = 0
+    while True:
+        source.execute(sql.SQL(SHARD_USERS_BATCH_QUERY), (last_id, BACKFILL_BATCH_SIZE))
+        users = format_datas_from_db(source, source.fetch_all())
+        if not users:
+            return
+        last_id = users[-1]["id"]
+        yield [(user, new_map.shard_of(user["email"])) for user in users
+               if new_map.shard_of(user["email"]) != source_name]
+
+
+def backfill(old: ShardRouter, new: ShardRouter) -> int:
+    """
+    Copy the users of old that new places in another shard, with their
+    notification settings. Returns the number of users copied.
+    """
+    copied = 0
+    for source_name, source in old.databases.items():
+        for batch in _moved_users(source, source_name, new.shard_map):
+            for user, target_name in batch:
+                target = new.databases[target_name]
+                source.execute(sql.SQL(SHARD_NOTIF_SELECT_QUERY), (user["email"],))
+                notification = source.fetch_one()
+
+                target.execute(*_copy_query(SHARD_USER_COPY_QUERY, user, ("id",)))
+                if notification:
+                    notification = format_data_from_db(source, notification)
+                    target.execute(*_copy_query(SHARD_NOTIF_COPY_QUERY, notification, ("id",)))
+                target.commit()
+                copied += 1
+    return copied
+
+
+def cleanup(old: ShardRouter, new: ShardRouter) -> int:
+    """
+    Delete from old the users new places in another shard, once their copy
+    exists. Returns the number of users deleted.
+    """
+    deleted = 0
+    for source_name, source in old.databases.items():
+        for batch in _moved_users(source, source_name, new.shard_map):
+            for user, target_name in batch:
+                target = new.databases[target_name]
+                target.execute(sql.SQL(SHARD_USER_EXISTS_QUERY), (user["email"],))
+                if target.fetch_one() is None:
+                    continue
+                source.execute(sql.SQL(SHARD_NOTIF_DELETE_QUERY), (user["email"],))
+                source.execute(sql.SQL(SHARD_USER_DELETE_QUERY), (user["email"],))
+                source.commit()
+                deleted += 1
+    return deleted
+
+
+SHARDS = ShardRouter.connect(load_shard_map(SHARD_MAP)) if SHARD_MAP else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move users between shards.")
+    parser.add_argument("command", choices=("backfill", "cleanup"))
+    parser.add_argument("--from", dest="old", required=True, help="The current shard map.")
+    parser.add_argument("--to", dest="new", required=True, help="The new shard map.")
+    args = parser.parse_args()
+
+    OLD_MAP, NEW_MAP = load_shard_map(args.old), load_shard_map(args.new)
+    for bucket_moved, (from_shard, to_shard) in sorted(OLD_MAP.moves(NEW_MAP).items())[:10]:
+        print(f"bucket {bucket_moved}: {from_shard} -> {to_shard}")
+    # A shard present in both maps is opened once, on its primary only
+    DATABASES = {name: PostgresDatabase(dsn=shard_config["dsn"]) for name, shard_config
+                 in {**OLD_MAP.shards, **NEW_MAP.shards}.items()}
+    OLD = ShardRouter(OLD_MAP, {name: DATABASES[name] for name in OLD_MAP.shards})
+    NEW = ShardRouter(NEW_MAP, {name: DATABASES[name] for name in NEW_MAP.shards})
+    if args.command == "backfill":
+        print(f"copied {backfill(OLD, NEW)} users")
+    else:
+        print(f"deleted {cleanup(OLD, NEW)} users")
@@ -0,0 +1,20 @@
+"""
+Contain NotificationPreference flag.
+"""
+from enum import IntFlag
+
+
+class NotificationPreference(IntFlag):
+    """
+    Notifications a user subscribes to, one bit each of the preferences
+    column of the notification table. Bits are stored: never renumber one.
+    """
+    DAILY_TASK_REPORT = 1 << 0
+    MENTION_IN_COMMENT = 1 << 1
+    PROJET_DUE_DATE = 1 << 2
+    PROJET_STATUS_CHANGED = 1 << 3
+    QUESTIONS_AND_SECTIONS_ASSIGNED_AS_AUTHOR = 1 << 4
+    QUESTIONS_AND_SECTIONS_ASSIGNED_AS_REVIEWER = 1 << 5
+    CONTENT_LIBRARY_REVISION = 1 << 6
+    GROUP_OF_QUESTIONS_COMPLETED = 1 << 7
+    TASK_ASSIGNED = 1 << 8
@@ -0,0 +1,6 @@
+"""
+Contain SightingStatus enum.
+"""
+from enum import Enum
+
+SightingStatus = Enum("SightingStatus", ["OPEN", "RESOLVED"])
@@ -1,5 +1,8 @@
 """Class AppHttpBearer is a helper to protect routes
 
+    Verified claims are kept in TOKEN_CACHE, keyed by a hash of the token,
+    until the token expires so a token seen again skips the signature check.
+
     Raises:
         HTTPException: jwt.ExpiredSignatureError, 401 Token expired
         HTTPException: jwt.InvalidTokenError, 401 invalid token
@@ -7,12 +10,39 @@
     Returns:
         JSONResponse: status_code 200 and message valid token
 """
+import hashlib
 from typing import Optional
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Request, HTTPException
 import jwt
-from app.resources.required_packages import ALGORITHM, SECRET_KEY
+from app.resources.cache import TTLCache
+from app.resources.required_packages import (
+    ALGORITHM, TOKEN_CACHE_SIZE, ADMIN_EMAILS, set_read_scope)
 from app.models.user import User
+from app.services.jwt_keys import KEYRING
+
+TOKEN_CACHE = TTLCache(maxsize=TOKEN_CACHE_SIZE)
+
+
+def decode_token(token: str) -> dict:
+    """
+    Verify a token and return its claims.
+
+    Claims of tokens already verified are served from TOKEN_CACHE until
+    the token "exp". Tokens without expiration are never cached.
+
+    Raises:
+        jwt.ExpiredSignatureError: The token has expired.
+        jwt.InvalidTokenError: The token is invalid.
+    """
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    claims = TOKEN_CACHE.get(key)
+    if claims is None:
+        claims = jwt.decode(token, KEYRING.verification_key(token),
+                            algorithms=[ALGORITHM])
+        if "exp" in claims:
+            TOKEN_CACHE.set(key, claims, claims["exp"])
+    return dict(claims)
 
 
 class AppHttpBearer(HTTPBearer):
@@ -21,26 +51,47 @@ class AppHttpBearer(HTTPBearer):
     The (check_session) property is set (True) when the oauth
     is for an endpoint that requires the user to be logged in
     and (False) for the others oauth.
+    The (check_admin) property is set (True) when the endpoint is
+    reserved to the users listed in ADMIN_EMAILS.
     """
 
-    def __init__(self, auto_error: bool = True, check_session: bool = False):
+    def __init__(self, auto_error: bool = True, check_session: bool = False,
+                 check_admin: bool = False):
         self.check_session = check_session
+        self.check_admin = check_admin
         super().__init__(auto_error=auto_error)
 
     async def __call__(
         self, request: Request
     ) -> Optional[HTTPAuthorizationCredentials]:
         res = await super().__call__(request)
+        return self.verify(res.credentials)
+
+    def verify(self, token: str) -> dict:
+        """
+        Return the claims of token once its session and rights are checked.
+        Connections that cannot send an Authorization header, such as
+        browser WebSockets, pass their token here.
+
+        Raises:
+            HTTPException: 401 if the token or its session is not valid,
+                           403 if admin rights are required.
+        """
         try:
-            decoded_token = jwt.decode(
-                res.credentials, SECRET_KEY, algorithms=[ALGORITHM]
-            )
+            decoded_token = decode_token(token)
+            # The request reads its own writes, not those of every user
+            set_read_scope(decoded_token["sub"])
             if self.check_session:
                 email = decoded_token["sub"]
                 user = User(email=email)
-                # If the user isn't connected, his token won't work
-                if user.is_session_active() == 0:
+                # If the session of the token is closed, the token won't work.
+                # Tokens issued without sid need any session of the user.
+                if not user.is_session_active(decoded_token.get("sid")):
                     raise HTTPException(401, "Token expired")
+                if decoded_token.get("sid"):
+                    user.touch_session(decoded_token["sid"])
+            if self.check_admin and decoded_token["sub"] not in ADMIN_EMAILS:
+                raise HTTPException(403, "Admin rights required")
             return decoded_token
         except jwt.ExpiredSignatureError as exc:
             # Token has expired
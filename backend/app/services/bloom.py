@@ -0,0 +1,105 @@
+"""
+Bloom filter of byte strings.
+
+A key sets `hashes` bits of a bit array, derived from one blake2b digest
+(double hashing). A key whose bits are not all set was never added: the
+filter has no false negatives, and false positives at the rate given by
+the number of bits, of hashes and of keys added.
+
+Attributes:
+    - optimal_size (function): The bits and hashes of a capacity and error rate.
+    - BloomFilter (class): The filter, on a bytearray or any writable buffer.
+"""
+import hashlib
+import math
+import threading
+
+MASK_64 = (1 << 64) - 1
+
+
+def optimal_size(capacity: int, error_rate: float, max_bytes: int = 0) -> tuple:
+    """
+    Return (bits, hashes) holding capacity keys at error_rate, the bits
+    limited to max_bytes when set
+    """
+    if capacity < 1 or not 0 < error_rate < 1:
+        raise ValueError("Capacity must be positive and the error rate in ]0, 1[.")
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    if max_bytes:
+        bits = min(bits, max_bytes * 8)
+    # Rounded to whole bytes, which are allocated anyway
+    bits = max(8, bits + -bits % 8)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """
+    Bloom filter on a bit array of `bits` bits
+    """
+
+    def __init__(self, bits: int, hashes: int, buffer=None):
+        """
+        Attrs:
+            bits (int): The size of the bit array, a multiple of 8
+            hashes (int): The bits set per key
+            buffer: The bit array, a new bytearray by default. A read-only
+                    buffer (bytes, read-only mmap) gives a read-only filter.
+        """
+        if bits % 8:
+            raise ValueError("The bits must be a multiple of 8.")
+        self.bits = bits
+        self.hashes = hashes
+        self.buffer = bytearray(bits // 8) if buffer is None else buffer
+        if len(self.buffer) < bits // 8:
+            raise ValueError("The buffer is smaller than the bits.")
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float, max_bytes: int = 0):
+        """
+        Build an empty filter holding capacity keys at error_rate
+        """
+        return cls(*optimal_size(capacity, error_rate, max_bytes))
+
+    @property
+    def size_bytes(self) -> int:
+        """
+        Return the memory of the bit array
+        """
+        return self.bits // 8
+
+    def _positions(self, key: bytes):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        # Odd, so the positions do not repeat for a power of two size
+        second = int.from_bytes(digest[8:], "little") | 1
+        for index in range(self.hashes):
+            yield ((first + index * second) & MASK_64) % self.bits
+
+    def add(self, key: bytes):
+        """
+        Add key to the filter
+        """
+        # Setting a bit rewrites its byte: concurrent adds would lose bits
+        with self._lock:
+            for position in self._positions(key):
+                self.buffer[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.buffer[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def fill_ratio(self) -> float:
+        """
+        Return the share of bits set
+        """
+        return int.from_bytes(self.buffer[:self.size_bytes], "little").bit_count() / self.bits
+
+    def error_rate(self) -> float:
+        """
+        Return the false positive rate of the filter, from its bits set
+        """
+        return self.fill_ratio() ** self.hashes
@@ -0,0 +1,155 @@
+"""
+Filter of the passwords found in data breaches.
+
+The filter is a Bloom filter of the SHA-1 digests of a breached password
+corpus, such as the Pwned Passwords "SHA1:count" lists, built offline into
+a file. The application maps the file read-only: the workers share its
+pages through the page cache, a check reads `hashes` bytes of it and costs
+no network call. A password in the corpus is always refused; one outside
+of it is refused at the error rate of the filter, and can be replaced.
+
+File layout, little endian: the magic "CCBPF001", the number of bits
+(uint64), of hashes (uint32) and of digests added (uint64), zeros up to
+HEADER_SIZE bytes, then the bit array.
+
+Attributes:
+    - HEADER_SIZE (int): The bytes before the bit array.
+    - password_key (function): The key of a password in the filter.
+    - parse_hash (function): The digest of a line of a hash list.
+    - build_filter (function): Write the filter file of a hash list.
+    - BreachedPasswords (class): A filter file, mapped read-only.
+    - is_breached (function): Whether a password is in the filter of BREACHED_PASSWORDS_FILE.
+
+Usage:
+    python -m app.services.breached_passwords build --hashes pwned-passwords-sha1.txt \
+        --out breached.bloom --error-rate 0.001
+"""
+import argparse
+import hashlib
+import mmap
+import struct
+
+from app.resources.required_packages import BREACHED_PASSWORDS_FILE
+from app.services import metrics
+from app.services.bloom import BloomFilter, optimal_size
+
+MAGIC = b"CCBPF001"
+HEADER = struct.Struct("<8sQIQ")
+HEADER_SIZE = 64
+DEFAULT_ERROR_RATE = 0.001
+
+CHECKS = metrics.counter(
+    "breached_password_checks_total",
+    "Passwords checked against the breached password filter, by answer (breached, ok).")
+
+
+def password_key(password: str) -> bytes:
+    """
+    Return the SHA-1 digest of password, as in the hash lists
+    """
+    return hashlib.sha1(password.encode("utf-8")).digest()
+
+
+def parse_hash(line: str):
+    """
+    Return the digest of a "SHA1[:count]" line, None if it holds none
+    """
+    digest = line.split(":", 1)[0].strip()
+    if len(digest) != 40:
+        return None
+    try:
+        return bytes.fromhex(digest)
+    except ValueError:
+        return None
+
+
+def _count_hashes(path: str) -> int:
+    with open(path, "r", encoding="ascii", errors="replace") as hash_file:
+        return sum(1 for line in hash_file if parse_hash(line) is not None)
+
+
+def build_filter(hashes_path: str, out_path: str, error_rate: float = DEFAULT_ERROR_RATE,
+                 capacity: int = None) -> int:
+    """
+    Write the filter file of the hash list at hashes_path and return the
+    number of digests added. The bit array is written through a map of
+    the file, so the filter does not need to fit in memory.
+    """
+    capacity = capacity or max(1, _count_hashes(hashes_path))
+    bits, hashes = optimal_size(capacity, error_rate)
+    with open(out_path, "w+b") as out_file:
+        out_file.truncate(HEADER_SIZE + bits // 8)
+        with mmap.mmap(out_file.fileno(), 0) as mapped:
+            view = memoryview(mapped)
+            bloom = BloomFilter(bits, hashes, view[HEADER_SIZE:])
+            with open(hashes_path, "r", encoding="ascii", errors="replace") as hash_file:
+                for line in hash_file:
+                    digest = parse_hash(line)
+                    if digest is not None:
+                        bloom.add(digest)
+            bloom.buffer.release()
+            view[:HEADER.size] = HEADER.pack(MAGIC, bits, hashes, bloom.count)
+            view.release()
+            mapped.flush()
+    return bloom.count
+
+
+class BreachedPasswords:
+    """
+    Filter file mapped read-only
+    """
+
+    def __init__(self, path: str):
+        """
+        Attrs:
+            path (str): The filter file written by build_filter
+        """
+        with open(path, "rb") as filter_file:
+            self._map = mmap.mmap(filter_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bits, hashes, count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or len(self._map) < HEADER_SIZE + bits // 8:
+            self._map.close()
+            raise ValueError(f"{path} is not a breached password filter.")
+        self.path = path
+        self.bloom = BloomFilter(bits, hashes,
+                                 memoryview(self._map)[HEADER_SIZE:HEADER_SIZE + bits // 8])
+        self.bloom.count = count
+
+    def __contains__(self, password: str) -> bool:
+        return password_key(password) in self.bloom
+
+
+BREACHED_PASSWORDS = BreachedPasswords(BREACHED_PASSWORDS_FILE) if BREACHED_PASSWORDS_FILE else None
+
+
+def is_breached(password: str) -> bool:
+    """
+    Return True if password is in the breached password filter, False
+    when no filter is configured
+    """
+    if BREACHED_PASSWORDS is None:
+        return False
+    breached = password in BREACHED_PASSWORDS
+    CHECKS.inc(answer="breached" if breached else "ok")
+    return breached
+
+
+metrics.gauge("breached_password_filter_bytes", "Size of the mapped breached password filter.",
+              lambda: BREACHED_PASSWORDS.bloom.size_bytes if BREACHED_PASSWORDS else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the breached password filter.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Write the filter of a SHA-1 hash list.")
+    build.add_argument("--hashes", required=True, help="Lines of SHA1 hex digests, :count allowed.")
+    build.add_argument("--out", required=True, help="The filter file to write.")
+    build.add_argument("--error-rate", type=float, default=DEFAULT_ERROR_RATE,
+                       help="The share of other passwords refused.")
+    build.add_argument("--capacity", type=int, default=None,
+                       help="The number of digests, counted from the list by default.")
+    args = parser.parse_args()
+
+    ADDED = build_filter(args.hashes, args.out, args.error_rate, args.capacity)
+    BITS, HASHES = optimal_size(args.capacity or max(1, ADDED), args.error_rate)
+    print(f"added {ADDED} digests, {BITS // 8} bytes, {HASHES} hashes")
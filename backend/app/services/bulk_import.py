@@ -0,0 +1,183 @@
+"""
+Bulk import of users from CSV or NDJSON.
+
+Records are read from the request body as it arrives, one per line, and
+imported by batches of BULK_IMPORT_BATCH_SIZE: the passwords of a batch are
+hashed in parallel and its users inserted by one multi-row statement.
+Invalid rows and existing emails are reported per line, they never abort
+the rest of the import. Imported users are pending and receive an invite
+with a link to set their password.
+
+Attributes:
+    - INVITE_DURATION (timedelta): The validity of the invite links.
+    - REQUIRED_FIELDS (tuple): The fields every record must provide.
+    - iter_records (function): Parse the records of a body stream.
+    - validate_record (function): Check a record and return the user row.
+    - import_batch (function): Insert a batch of records.
+    - send_invites (function): Send the invites by batches of mails.
+"""
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+
+from email_validator import validate_email, EmailNotValidError
+from psycopg2 import sql
+
+from app.models.user import User, db_for, generate_password
+from app.resources.db_utils.user_queries import USER_BULK_INSERT_QUERY
+from app.resources.required_packages import (
+    BULK_IMPORT_BATCH_SIZE, BULK_IMPORT_HASH_WORKERS,
+    BULK_MAIL_BATCH_SIZE)
+from app.resources.type.status import Status
+from app.services.breached_passwords import is_breached
+from app.services.email_filter import EMAIL_FILTER
+from app.services.outbox import outbox_row, record_many
+from app.services.passwords import hash_password
+from app.services.send_mail import send_recovery_mails
+
+INVITE_DURATION = timedelta(days=7)
+REQUIRED_FIELDS = ("email", "host", "first_name", "last_name", "lang")
+
+HASH_EXECUTOR = ThreadPoolExecutor(max_workers=BULK_IMPORT_HASH_WORKERS)
+
+
+async def iter_records(stream, body_format: str):
+    """
+    Yield (line_number, record, error) for every non empty line of stream.
+
+    - stream: async iterator of bytes chunks.
+    - body_format (str): "csv", with a header line, or "ndjson".
+    """
+    header = None
+    line_number = 0
+    buffer = b""
+
+    async def lines():
+        nonlocal buffer
+        async for chunk in stream:
+            buffer += chunk
+            *complete, buffer = buffer.split(b"\n")
+            for line in complete:
+                yield line
+        if buffer:
+            yield buffer
+
+    async for raw_line in lines():
+        line_number += 1
+        line = raw_line.decode("utf-8-sig" if line_number == 1 else "utf-8").strip()
+        if not line:
+            continue
+        try:
+            if body_format == "ndjson":
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Record must be an object.")
+            else:
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [value.strip() for value in values]
+                    continue
+                if len(values) != len(header):
+                    raise ValueError(f"Expected {len(header)} values, got {len(values)}.")
+                record = dict(zip(header, values))
+        except ValueError as exception:
+            yield line_number, None, str(exception)
+            continue
+        yield line_number, record, None
+
+
+def validate_record(record: dict, seen: set):
+    """
+    Return (row, None) for a valid record, (None, error) otherwise.
+    seen holds the emails already imported by the request.
+    """
+    missing = [field for field in REQUIRED_FIELDS if not str(record.get(field) or "").strip()]
+    if missing:
+        return None, f"Missing fields: {', '.join(missing)}."
+    try:
+        email = validate_email(str(record["email"]).strip(),
+                               check_deliverability=False).normalized
+    except EmailNotValidError:
+        return None, "Invalid email."
+    if email in seen:
+        return None, "Duplicate email in import."
+    seen.add(email)
+
+    row = {field: str(record[field]).strip() for field in REQUIRED_FIELDS}
+    row["email"] = email
+    password = str(record.get("password") or "")
+    if password and is_breached(password):
+        return None, "Password found in a data breach."
+    row["password"] = password or generate_password()
+    return row, None
+
+
+def import_batch(rows: list):
+    """
+    Insert the valid rows of a batch.
+
+    - rows (list): (line_number, row) for every valid record.
+
+    Returns:
+        created (list): The rows inserted.
+        errors (list): {"line", "email", "error"} for the rows not inserted.
+    """
+    hashed_passwords = list(HASH_EXECUTOR.map(hash_password,
+                                              [row["password"] for _, row in rows]))
+    now = datetime.utcnow()
+    values = [
+        (row["email"], hashed, row["host"], row["first_name"], row["last_name"],
+         row["lang"], now, now, Status.PENDING.value)
+        for (_, row), hashed in zip(rows, hashed_passwords)
+    ]
+    # One statement per shard, a failing shard does not abort the others
+    shards = {}
+    for (line, row), value in zip(rows, values):
+        database = db_for(row["email"])
+        shards.setdefault(id(database), (database, []))[1].append((line, row, value))
+
+    created, errors = [], []
+    for database, shard_rows in shards.values():
+        try:
+            inserted = database.execute_values(
+                sql.SQL(USER_BULK_INSERT_QUERY), [value for _, _, value in shard_rows],
+                page_size=BULK_IMPORT_BATCH_SIZE, fetch=True,
+            )
+            record_many(database, [
+                outbox_row("user.created", email, {"status": Status.PENDING.value})
+                for (email,) in inserted])
+            database.commit()
+        except Exception as exception:  # pylint: disable=broad-except
+            database.rollback()
+            errors.extend({"line": line, "email": row["email"], "error": str(exception)}
+                          for line, row, _ in shard_rows)
+            continue
+
+        inserted = {email for (email,) in inserted}
+        for email in inserted:
+            EMAIL_FILTER.add(email)
+        for line, row, _ in shard_rows:
+            if row["email"] in inserted:
+                created.append(row)
+            else:
+                errors.append({"line": line, "email": row["email"], "error": "User exists"})
+    return created, errors
+
+
+def send_invites(rows: list):
+    """
+    Send the invites of the created rows, BULK_MAIL_BATCH_SIZE mails at a time
+    """
+    for start in range(0, len(rows), BULK_MAIL_BATCH_SIZE):
+        invites = []
+        for row in rows[start:start + BULK_MAIL_BATCH_SIZE]:
+            user = User(email=row["email"], status=Status.PENDING)
+            invites.append({
+                "token": user.generate_token(row["email"], expiration_time=INVITE_DURATION),
+                "host": row["host"],
+                "email": row["email"],
+                "first_name": row["first_name"],
+                "lang": row["lang"],
+            })
+        send_recovery_mails(invites)
@@ -0,0 +1,315 @@
+"""
+Daily digest of the activity of the users subscribed to daily_task_report.
+
+A run reports one day. For every user database, the subscribers are read
+by keyset pages of DIGEST_CHUNK_SIZE on their email, served by the partial
+index of the daily_task_report bit. The events of the outbox of a whole
+page are counted by one grouped query, the digests of the page rendered
+together and queued in digest_mail, in the transaction advancing the
+checkpoint of the run in digest_runs. A run stopped halfway goes on after
+the last page queued, and a page queued twice is ignored: no digest is
+rendered or queued twice. Users without activity that day get no digest.
+
+Delivery claims the queued digests by batches of DIGEST_MAIL_BATCH_SIZE,
+hidden from the other deliveries for DIGEST_CLAIM_DURATION, and sends each
+batch through one SMTP session. Every digest is marked sent, or failed with
+its error, as soon as it is tried: a digest refused does not hold back the
+rest of its batch. Failed digests are tried again DIGEST_RETRY_DELAY later,
+by the next deliveries, DIGEST_MAX_ATTEMPTS times at most, then left in digest_mail with their last
+error. A delivery stopped between sending a digest and marking it sends
+that digest again once its claim expires.
+
+Attributes:
+    - EVENT_LABELS (dict): The events reported, and their labels.
+    - render_digests (function): The digest rows of a page of recipients.
+    - DigestEngine (class): Queue and deliver the digests.
+
+Usage:
+    python -m app.services.digest run [--date 2024-05-31]   # yesterday by default
+    python -m app.services.digest deliver
+    python -m app.services.digest purge
+"""
+import argparse
+from datetime import date, datetime, time, timedelta
+import html
+import logging
+import smtplib
+import sys
+
+from psycopg2 import sql
+
+from app.models.user import all_databases
+from app.resources.required_packages import (
+    PostgresDB, PostgresDatabase, DIGEST_CHUNK_SIZE, DIGEST_MAIL_BATCH_SIZE,
+    DIGEST_RETENTION_DAYS, DIGEST_MAX_ATTEMPTS, FROM_EMAIL)
+from app.resources.type.notification import NotificationPreference
+from app.resources.type.status import Status
+from app.resources.db_utils.digest_queries import (
+    DIGEST_RUN_START_QUERY, DIGEST_RUN_LOCK_QUERY, DIGEST_RUN_ADVANCE_QUERY,
+    DIGEST_RUN_FINISH_QUERY, DIGEST_RECIPIENTS_QUERY, DIGEST_ACTIVITY_QUERY,
+    DIGEST_MAIL_INSERT_QUERY, DIGEST_CLAIM_QUERY, DIGEST_SENT_QUERY, DIGEST_FAILED_QUERY,
+    DIGEST_PURGE_QUERY)
+from app.services.send_mail import MailError, build_html_message, smtp_session
+
+# Longer than the SMTP session of a batch
+DIGEST_CLAIM_DURATION = timedelta(minutes=10)
+# A failed digest is not tried again by the same delivery
+DIGEST_RETRY_DELAY = timedelta(minutes=15)
+
+LOGGER = logging.getLogger(__name__)
+
+# Singular and plural labels, in the order of the digest
+EVENT_LABELS = {
+    "session.created": ("sign-in", "sign-ins"),
+    "session.ended": ("sign-out", "sign-outs"),
+    "user.updated": ("profile update", "profile updates"),
+    "notification.updated": ("notification settings change", "notification settings changes"),
+    "sighting.created": ("waste report", "waste reports"),
+    "sighting.resolved": ("cleanup", "cleanups"),
+}
+
+DIGEST_SUBJECT = "Your daily report of {day}"
+DIGEST_TEMPLATE = """
+    <html>
+    <body>
+        <p>Hi {first_name},</p>
+        <p>Activity of your account on {day}:</p>
+        <ul>{items}</ul>
+    </body>
+    </html>
+    """
+DIGEST_ITEM = "<li>{count} {label}</li>"
+
+
+def render_digests(recipients: list, activity: dict, day: date) -> list:
+    """
+    Return the digest_mail rows of recipients, (email, first_name) pairs,
+    from their activity {email: {event: count}}. Recipients without
+    activity are skipped.
+    """
+    subject = DIGEST_SUBJECT.format(day=day.isoformat())
+    created = datetime.utcnow()
+    rows = []
+    for email, first_name in recipients:
+        counts = activity.get(email.lower())
+        if not counts:
+            continue
+        items = "".join(
+            DIGEST_ITEM.format(count=counts[event], label=labels[counts[event] != 1])
+            for event, labels in EVENT_LABELS.items() if counts.get(event))
+        body = DIGEST_TEMPLATE.format(first_name=html.escape(first_name or ""),
+                                      day=day.isoformat(), items=items)
+        rows.append((day, email, subject, body, created))
+    return rows
+
+
+class DigestEngine:
+    """
+    Queue and deliver the daily digests of the user databases
+    """
+
+    def __init__(self, databases: list = None, chunk_size: int = DIGEST_CHUNK_SIZE,
+                 batch_size: int = DIGEST_MAIL_BATCH_SIZE,
+                 max_attempts: int = DIGEST_MAX_ATTEMPTS):
+        """
+        Attrs:
+            databases (list): The user databases, every shard by default
+            chunk_size (int): The recipients queued per transaction
+            batch_size (int): The digests sent per SMTP session
+            max_attempts (int): The sends of a digest before it is given up
+        """
+        self.databases = databases if databases is not None else all_databases()
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.recipients_query = sql.SQL(DIGEST_RECIPIENTS_QUERY).format(
+            bit=sql.Literal(int(NotificationPreference.DAILY_TASK_REPORT)))
+
+    def _activity(self, postgres_db: PostgresDatabase, first: str, last: str,
+                  day: date) -> dict:
+        """
+        Return {email: {event: count}} of the users of (first, last] on day.
+        With shards, the session events are in the outbox of the main database.
+        """
+        since = datetime.combine(day, time.min)
+        activity = {}
+        for database in {id(postgres_db): postgres_db, id(PostgresDB): PostgresDB}.values():
+            database.execute(sql.SQL(DIGEST_ACTIVITY_QUERY),
+                             (first, last, since, since + timedelta(days=1)))
+            for email, event, count in database.fetch_all():
+                counts = activity.setdefault(email.lower(), {})
+                counts[event] = counts.get(event, 0) + count
+        return activity
+
+    def queue_chunk(self, postgres_db: PostgresDatabase, day: date):
+        """
+        Queue the digests of the next page of recipients of postgres_db and
+        advance the checkpoint of day. Returns the number of digests queued,
+        None once every recipient is done.
+        """
+        with postgres_db.primary():
+            try:
+                postgres_db.execute(sql.SQL(DIGEST_RUN_LOCK_QUERY), (day,))
+                last_email, finished = postgres_db.fetch_one()
+                if finished:
+                    postgres_db.rollback()
+                    return None
+                postgres_db.execute(self.recipients_query,
+                                    (last_email, Status.ACTIVE.value, self.chunk_size))
+                recipients = postgres_db.fetch_all()
+                if not recipients:
+                    postgres_db.execute(sql.SQL(DIGEST_RUN_FINISH_QUERY),
+                                        (datetime.utcnow(), day))
+                    postgres_db.commit()
+                    return None
+
+                activity = self._activity(postgres_db, last_email, recipients[-1][0], day)
+                rows = render_digests(recipients, activity, day)
+                if rows:
+                    postgres_db.execute_values(sql.SQL(DIGEST_MAIL_INSERT_QUERY), rows,
+                                               page_size=len(rows))
+                postgres_db.execute(sql.SQL(DIGEST_RUN_ADVANCE_QUERY),
+                                    (recipients[-1][0], len(rows), day))
+                postgres_db.commit()
+            except Exception:
+                postgres_db.rollback()
+                raise
+        return len(rows)
+
+    def queue(self, day: date) -> int:
+        """
+        Queue the digests of day, from the checkpoint of every database,
+        and return how many were queued
+        """
+        queued = 0
+        for database in self.databases:
+            with database.primary():
+                database.execute(sql.SQL(DIGEST_RUN_START_QUERY), (day, datetime.utcnow()))
+                database.commit()
+            while True:
+                chunk = self.queue_chunk(database, day)
+                if chunk is None:
+                    break
+                queued += chunk
+        return queued
+
+    def _claim(self, postgres_db: PostgresDatabase) -> list:
+        """
+        Claim the next batch of queued digests of postgres_db
+        """
+        now = datetime.utcnow()
+        with postgres_db.primary():
+            try:
+                postgres_db.execute(sql.SQL(DIGEST_CLAIM_QUERY), (
+                    now + DIGEST_CLAIM_DURATION, self.max_attempts, now, self.batch_size))
+                claimed = sorted(postgres_db.fetch_all())
+                postgres_db.commit()
+            except Exception:
+                postgres_db.rollback()
+                raise
+        return claimed
+
+    @staticmethod
+    def _mark(postgres_db: PostgresDatabase, query: str, params: tuple):
+        """
+        Record the outcome of a digest at once
+        """
+        with postgres_db.primary():
+            try:
+                postgres_db.execute(sql.SQL(query), params)
+                postgres_db.commit()
+            except Exception:
+                postgres_db.rollback()
+                raise
+
+    def deliver_batch(self, postgres_db: PostgresDatabase) -> tuple:
+        """
+        Send the next batch of queued digests of postgres_db, one by one,
+        and return (sent, failed)
+
+        Raises:
+            MailError: The mail server cannot be reached, the digests of the
+                batch not tried yet are failed with its error.
+        """
+        claimed = self._claim(postgres_db)
+        sent, failed = 0, 0
+        try:
+            with smtp_session() as server:
+                for digest_id, email, subject, body in claimed:
+                    try:
+                        server.sendmail(FROM_EMAIL, email,
+                                        build_html_message(email, subject, body).as_string())
+                    except (smtplib.SMTPException, OSError) as exception:
+                        LOGGER.warning("Digest %s to %s failed: %s", digest_id, email, exception)
+                        self._mark(postgres_db, DIGEST_FAILED_QUERY, (
+                            datetime.utcnow() + DIGEST_RETRY_DELAY, repr(exception), digest_id))
+                        failed += 1
+                    else:
+                        self._mark(postgres_db, DIGEST_SENT_QUERY, (datetime.utcnow(), digest_id))
+                        sent += 1
+        except MailError as exception:
+            for digest_id, *_ in claimed[sent + failed:]:
+                self._mark(postgres_db, DIGEST_FAILED_QUERY, (
+                    datetime.utcnow() + DIGEST_RETRY_DELAY, repr(exception), digest_id))
+            raise
+        return sent, failed
+
+    def deliver(self) -> int:
+        """
+        Send every queued digest and return how many were sent
+
+        Raises:
+            MailError: The mail server cannot be reached.
+        """
+        sent = 0
+        for database in self.databases:
+            while True:
+                batch_sent, batch_failed = self.deliver_batch(database)
+                sent += batch_sent
+                if batch_sent + batch_failed < self.batch_size:
+                    break
+        return sent
+
+    def run(self, day: date) -> tuple:
+        """
+        Queue then deliver the digests of day, return (queued, sent)
+        """
+        return self.queue(day), self.deliver()
+
+    def purge(self, retention: timedelta = timedelta(days=DIGEST_RETENTION_DAYS)) -> int:
+        """
+        Delete the digests sent more than retention ago and return how many
+        were deleted
+        """
+        deleted = 0
+        before = datetime.utcnow() - retention
+        for database in self.databases:
+            with database.primary():
+                database.execute(sql.SQL(DIGEST_PURGE_QUERY), (before,))
+                deleted += database.cursor.rowcount
+                database.commit()
+        return deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send the daily digests.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser("run", help="Queue and send the digests of a day.")
+    run.add_argument("--date", type=date.fromisoformat, default=None,
+                     help="The day reported, yesterday (UTC) by default.")
+    subparsers.add_parser("deliver", help="Send the queued digests.")
+    subparsers.add_parser("purge", help="Delete the old sent digests.")
+    args = parser.parse_args()
+
+    ENGINE = DigestEngine()
+    try:
+        if args.command == "run":
+            DAY = args.date or datetime.utcnow().date() - timedelta(days=1)
+            QUEUED, SENT = ENGINE.run(DAY)
+            print(f"queued {QUEUED} digests of {DAY}, sent {SENT}")
+        elif args.command == "deliver":
+            print(f"sent {ENGINE.deliver()} digests")
+        else:
+            print(f"deleted {ENGINE.purge()} digests")
+    except MailError as error:
+        sys.exit(f"mail server error, the digests stay queued: {error}")
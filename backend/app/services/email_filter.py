@@ -0,0 +1,118 @@
+"""
+Bloom filter of the registered emails.
+
+Registering an email starts with a lookup of the users table that misses
+for new emails. The filter answers most of those misses from memory: an
+email it does not contain was never registered, or registered by another
+worker since this one built its filter, and the unique constraint of the
+users table refuses it then. An email it may contain is looked up.
+
+The filter is built at startup by reading the emails of every shard by
+batches, and gets the users created by the process. Until it is built,
+every email is looked up. Its size follows EMAIL_FILTER_CAPACITY and
+EMAIL_FILTER_ERROR_RATE, limited to EMAIL_FILTER_MAX_BYTES.
+
+Attributes:
+    - EmailFilter (class): The filter and its lookups.
+    - EMAIL_FILTER (EmailFilter): The filter of the process.
+"""
+from psycopg2 import sql
+
+from app.resources.required_packages import (
+    EMAIL_FILTER_ENABLED, EMAIL_FILTER_CAPACITY, EMAIL_FILTER_ERROR_RATE,
+    EMAIL_FILTER_MAX_BYTES)
+from app.resources.shards import normalize_email
+from app.resources.db_utils.user_queries import USER_EMAILS_BATCH_QUERY
+from app.services import metrics
+from app.services.bloom import BloomFilter
+
+EMAIL_FILTER_BATCH_SIZE = 10_000
+
+CHECKS = metrics.counter(
+    "email_filter_checks_total",
+    "Emails checked before registration, by answer of the filter (miss, maybe, off).")
+FALSE_POSITIVES = metrics.counter(
+    "email_filter_false_positives_total",
+    "Emails the filter may contain that were not registered.")
+
+
+class EmailFilter:
+    """
+    Registered emails of every shard, in a Bloom filter
+    """
+
+    def __init__(self, capacity: int = EMAIL_FILTER_CAPACITY,
+                 error_rate: float = EMAIL_FILTER_ERROR_RATE,
+                 max_bytes: int = EMAIL_FILTER_MAX_BYTES, enabled: bool = EMAIL_FILTER_ENABLED):
+        self.enabled = enabled
+        self.error_rate = error_rate
+        self.bloom = BloomFilter.for_capacity(capacity, error_rate, max_bytes)
+        self.ready = False
+
+    def build(self, databases: list) -> int:
+        """
+        Add the emails of the users of databases and return how many were read
+        """
+        if not self.enabled:
+            return 0
+        read = 0
+        for database in databases:
+            last_id = 0
+            while True:
+                database.execute(sql.SQL(USER_EMAILS_BATCH_QUERY),
+                                 (last_id, EMAIL_FILTER_BATCH_SIZE))
+                rows = database.fetch_all()
+                if not rows:
+                    break
+                for _, email in rows:
+                    self.add(email)
+                read += len(rows)
+                last_id = rows[-1][0]
+        self.ready = True
+        return read
+
+    def add(self, email: str):
+        """
+        Add a registered email
+        """
+        if self.enabled:
+            self.bloom.add(normalize_email(email).encode("utf-8"))
+
+    def might_exist(self, email: str) -> bool:
+        """
+        Return False if email is surely not registered
+        """
+        if not (self.enabled and self.ready):
+            CHECKS.inc(answer="off")
+            return True
+        if normalize_email(email).encode("utf-8") in self.bloom:
+            CHECKS.inc(answer="maybe")
+            return True
+        CHECKS.inc(answer="miss")
+        return False
+
+    def exists(self, email: str, lookup):
+        """
+        Return the result of lookup() when email may be registered, None
+        when it surely is not
+        """
+        if not self.might_exist(email):
+            return None
+        found = lookup()
+        if not found and self.ready:
+            FALSE_POSITIVES.inc()
+        return found
+
+
+EMAIL_FILTER = EmailFilter()
+
+metrics.gauge("email_filter_bytes", "Memory of the bit array of the email filter.",
+              lambda: EMAIL_FILTER.bloom.size_bytes)
+metrics.gauge("email_filter_hashes", "Bits set per email in the email filter.",
+              lambda: EMAIL_FILTER.bloom.hashes)
+metrics.gauge("email_filter_emails", "Emails added to the email filter.",
+              lambda: EMAIL_FILTER.bloom.count)
+metrics.gauge("email_filter_target_error_rate", "Configured false positive rate.",
+              lambda: EMAIL_FILTER.error_rate)
+metrics.gauge("email_filter_error_rate", "False positive rate from the bits set.",
+              lambda: EMAIL_FILTER.bloom.error_rate())
@@ -0,0 +1,370 @@
+"""
+In-memory grid index of points on the globe.
+
+Points are kept in square cells of cell_degrees of latitude and longitude,
+by key. A bounding box query reads the cells the box covers, a radius
+query the cells of the box around its circle, then filters their points:
+the cost follows the points near the query, not the points indexed. When
+a box covers more cells than are occupied, the occupied cells are read
+instead. Boxes whose west edge is east of their east edge cross the
+antimeridian.
+
+GridAggregates keeps, for every zoom level of a map, the count and the
+sums of the positions of the points of each cell of a grid of
+CLUSTER_CELLS_PER_TILE cells per map tile side: a cluster is a cell, at
+the mean position of its points. Adding or removing a point updates one
+cell per zoom, and the clusters of a viewport read only its cells.
+
+SpaceTimeBuckets keeps the recent points in cells of its radius and windows
+of its delay: the points near a new one in space and time are in the 3 × 3
+cells around it, more towards the poles, of its window and the windows
+beside it. Finding them reads these buckets only, and the windows older
+than the delay are dropped as points come.
+
+Attributes:
+    - EARTH_RADIUS_KM (float): The mean radius of the Earth.
+    - CLUSTER_CELLS_PER_TILE (int): The cluster cells per side of a map tile.
+    - haversine_km (function): The great circle distance of two points.
+    - GeoIndex (class): The points and their cells.
+    - GridAggregates (class): The clusters of the points, per zoom.
+    - SpaceTimeBuckets (class): The recent points, by cell and time window.
+"""
+import math
+import threading
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+CLUSTER_CELLS_PER_TILE = 8
+
+
+def _grid_ranges(degrees: float, south: float, west: float, north: float,
+                 east: float) -> tuple:
+    """
+    Return the rows and the column ranges of the cells of degrees covering
+    a box, two column ranges for a box crossing the antimeridian
+    """
+    rows = range(_grid_index(south + 90, degrees, 180), _grid_index(north + 90, degrees, 180) + 1)
+    if west <= east:
+        return rows, [range(_grid_index(west + 180, degrees, 360),
+                            _grid_index(east + 180, degrees, 360) + 1)]
+    return rows, [range(_grid_index(west + 180, degrees, 360), math.ceil(360 / degrees)),
+                  range(0, _grid_index(east + 180, degrees, 360) + 1)]
+
+
+def _grid_index(offset: float, degrees: float, span: float) -> int:
+    """
+    Return the index of the cell of degrees holding offset, within span
+    """
+    return min(int(offset // degrees), math.ceil(span / degrees) - 1)
+
+
+def _covered(cells: dict, rows: range, column_ranges: list) -> list:
+    """
+    Return (cell, value) of the occupied cells among rows and column_ranges,
+    reading the occupied cells when they are fewer
+    """
+    if len(rows) * sum(map(len, column_ranges)) > len(cells):
+        return [(cell, value) for cell, value in cells.items()
+                if cell[0] in rows and any(cell[1] in columns for columns in column_ranges)]
+    return [((row, column), cells[(row, column)])
+            for row in rows for columns in column_ranges for column in columns
+            if (row, column) in cells]
+
+
+def _around(latitude: float, longitude: float, radius_km: float) -> tuple:
+    """
+    Return (south, west, north, east) of the box holding the circle of
+    radius_km around a point
+    """
+    latitude_span = radius_km / KM_PER_DEGREE
+    south, north = latitude - latitude_span, latitude + latitude_span
+    cos_latitude = math.cos(math.radians(min(abs(latitude) + latitude_span, 90.0)))
+    if south <= -90 or north >= 90 or radius_km >= cos_latitude * KM_PER_DEGREE * 180:
+        # The circle holds a pole or spans every longitude
+        return south, -180.0, north, 180.0
+    longitude_span = radius_km / (KM_PER_DEGREE * cos_latitude)
+    return (south, (longitude - longitude_span + 180) % 360 - 180,
+            north, (longitude + longitude_span + 180) % 360 - 180)
+
+
+def _clamped(south: float, west: float, north: float, east: float) -> tuple:
+    return max(south, -90.0), west, min(north, 90.0), east
+
+
+def haversine_km(latitude1: float, longitude1: float,
+                 latitude2: float, longitude2: float) -> float:
+    """
+    Return the great circle distance between two points, in km
+    """
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    half_dphi = (phi2 - phi1) / 2
+    half_dlambda = math.radians(longitude2 - longitude1) / 2
+    chord = (math.sin(half_dphi) ** 2
+             + math.cos(phi1) * math.cos(phi2) * math.sin(half_dlambda) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(chord)))
+
+
+class GeoIndex:
+    """
+    Points by key, in cells of cell_degrees. Safe from any thread.
+    """
+
+    def __init__(self, cell_degrees: float):
+        if not 0 < cell_degrees <= 90:
+            raise ValueError("The cells must be between 0 and 90 degrees.")
+        self.cell_degrees = cell_degrees
+        # (row, column) -> {key: (latitude, longitude, value)}
+        self._cells = {}
+        self._points = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def add(self, key, latitude: float, longitude: float, value=None):
+        """
+        Index value at a point under key, replacing the point of key
+
+        Raises:
+            ValueError: The point is not on the globe.
+        """
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError("Latitude must be in [-90, 90] and longitude in [-180, 180].")
+        cell = (_grid_index(latitude + 90, self.cell_degrees, 180),
+                _grid_index(longitude + 180, self.cell_degrees, 360))
+        with self._lock:
+            self._discard(key)
+            self._cells.setdefault(cell, {})[key] = (latitude, longitude, value)
+            self._points[key] = cell
+
+    def _discard(self, key) -> bool:
+        cell = self._points.pop(key, None)
+        if cell is None:
+            return False
+        points = self._cells[cell]
+        del points[key]
+        if not points:
+            del self._cells[cell]
+        return True
+
+    def remove(self, key) -> bool:
+        """
+        Remove the point of key and return whether it was indexed
+        """
+        with self._lock:
+            return self._discard(key)
+
+    def get(self, key):
+        """
+        Return (latitude, longitude, value) of key, None if not indexed
+        """
+        with self._lock:
+            cell = self._points.get(key)
+            return None if cell is None else self._cells[cell][key]
+
+    def in_bbox(self, south: float, west: float, north: float, east: float) -> list:
+        """
+        Return (key, latitude, longitude, value) of the points of a box, by key
+        """
+        south, north = max(south, -90.0), min(north, 90.0)
+        rows, column_ranges = _grid_ranges(self.cell_degrees, south, west, north, east)
+        with self._lock:
+            found = [(key, latitude, longitude, value)
+                     for _, points in _covered(self._cells, rows, column_ranges)
+                     for key, (latitude, longitude, value) in points.items()
+                     if south <= latitude <= north
+                     and (west <= longitude <= east if west <= east
+                          else longitude >= west or longitude <= east)]
+        return sorted(found, key=lambda point: point[0])
+
+    def nearby(self, latitude: float, longitude: float, radius_km: float) -> list:
+        """
+        Return (distance_km, key, latitude, longitude, value) of the points
+        within radius_km of a point, nearest first
+        """
+        found = []
+        for key, point_latitude, point_longitude, value in self.in_bbox(
+                *_around(latitude, longitude, radius_km)):
+            distance = haversine_km(latitude, longitude, point_latitude, point_longitude)
+            if distance <= radius_km:
+                found.append((distance, key, point_latitude, point_longitude, value))
+        found.sort(key=lambda point: (point[0], point[1]))
+        return found
+
+
+class GridAggregates:
+    """
+    Count and mean position of the points of every cell, per zoom level.
+    Keys are integers. Safe from any thread.
+    """
+
+    def __init__(self, max_zoom: int, cells_per_tile: int = CLUSTER_CELLS_PER_TILE):
+        """
+        Attrs:
+            max_zoom (int): The deepest zoom level aggregated
+            cells_per_tile (int): The cells per side of a map tile
+        """
+        self.max_zoom = max_zoom
+        # A map tile of zoom z spans 360 / 2 ** z degrees
+        self.cell_degrees = [360 / (2 ** zoom * cells_per_tile) for zoom in range(max_zoom + 1)]
+        # Per zoom, (row, column) -> [count, latitude sum, longitude sum, key sum]
+        self._zooms = [{} for _ in self.cell_degrees]
+        self._lock = threading.Lock()
+
+    def _update(self, key: int, latitude: float, longitude: float, sign: int):
+        with self._lock:
+            for degrees, cells in zip(self.cell_degrees, self._zooms):
+                cell = (_grid_index(latitude + 90, degrees, 180),
+                        _grid_index(longitude + 180, degrees, 360))
+                totals = cells.setdefault(cell, [0, 0.0, 0.0, 0])
+                totals[0] += sign
+                totals[1] += sign * latitude
+                totals[2] += sign * longitude
+                totals[3] += sign * key
+                if totals[0] <= 0:
+                    del cells[cell]
+
+    def add(self, key: int, latitude: float, longitude: float):
+        """
+        Count the point of key in its cell of every zoom
+        """
+        self._update(key, latitude, longitude, 1)
+
+    def remove(self, key: int, latitude: float, longitude: float):
+        """
+        Remove the point of key, added at the same position, from its cells
+        """
+        self._update(key, latitude, longitude, -1)
+
+    def cells(self, south: float, west: float, north: float, east: float, zoom: int) -> int:
+        """
+        Return the number of cells of zoom covering a box
+        """
+        rows, column_ranges = _grid_ranges(self.cell_degrees[zoom], max(south, -90.0),
+                                           west, min(north, 90.0), east)
+        return len(rows) * sum(map(len, column_ranges))
+
+    def clusters(self, south: float, west: float, north: float, east: float,
+                 zoom: int) -> list:
+        """
+        Return the clusters {"count", "latitude", "longitude"} of the cells
+        of zoom covering a box, with the "key" of the single points
+        """
+        degrees, cells = self.cell_degrees[zoom], self._zooms[zoom]
+        rows, column_ranges = _grid_ranges(degrees, max(south, -90.0), west,
+                                           min(north, 90.0), east)
+        with self._lock:
+            found = [(cell, tuple(totals)) for cell, totals in _covered(cells, rows, column_ranges)]
+        clusters = []
+        for _, (count, latitude_sum, longitude_sum, key_sum) in sorted(found):
+            cluster = {"count": count, "latitude": round(latitude_sum / count, 6),
+                       "longitude": round(longitude_sum / count, 6)}
+            if count == 1:
+                cluster["key"] = key_sum
+            clusters.append(cluster)
+        return clusters
+
+
+class SpaceTimeBuckets:
+    """
+    Points of the last window_seconds by cell of radius_km and time window,
+    with the hashes of their photos. Safe from any thread.
+    """
+
+    def __init__(self, radius_km: float, window_seconds: float, max_hamming: int = 0):
+        """
+        Attrs:
+            radius_km (float): The distance of the points found
+            window_seconds (float): The delay between the points found
+            max_hamming (int): The differing bits of the hashes of the points found
+        """
+        if radius_km <= 0 or window_seconds <= 0:
+            raise ValueError("The radius and the window must be positive.")
+        self.radius_km = radius_km
+        self.window_seconds = window_seconds
+        self.max_hamming = max_hamming
+        self.cell_degrees = min(radius_km / KM_PER_DEGREE, 90.0)
+        # window -> (row, column) -> {key: (latitude, longitude, seconds, hashes, value)}
+        self._windows = {}
+        self._points = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _matches(self, hashes: tuple, other: tuple) -> bool:
+        """
+        Return whether two points share a photo, true unless both have some
+        """
+        if not hashes or not other:
+            return True
+        return any(bin(first ^ second).count("1") <= self.max_hamming
+                   for first in hashes for second in other)
+
+    def find(self, latitude: float, longitude: float, seconds: float, hashes: tuple = ()):
+        """
+        Return (key, value) of the nearest point within radius_km and
+        window_seconds of a point, with a similar photo if both have hashes,
+        None if there is none
+        """
+        window = int(seconds // self.window_seconds)
+        rows, column_ranges = _grid_ranges(self.cell_degrees,
+                                           *_clamped(*_around(latitude, longitude, self.radius_km)))
+        found = []
+        with self._lock:
+            for near in (window - 1, window, window + 1):
+                cells = self._windows.get(near)
+                if not cells:
+                    continue
+                for _, points in _covered(cells, rows, column_ranges):
+                    for key, (point_latitude, point_longitude, point_seconds, point_hashes,
+                              value) in points.items():
+                        if (abs(point_seconds - seconds) <= self.window_seconds
+                                and self._matches(hashes, point_hashes)):
+                            found.append((point_latitude, point_longitude, key, value))
+        best = None
+        for point_latitude, point_longitude, key, value in found:
+            distance = haversine_km(latitude, longitude, point_latitude, point_longitude)
+            if distance <= self.radius_km and (best is None or (distance, key) < best[:2]):
+                best = (distance, key, value)
+        return None if best is None else best[1:]
+
+    def add(self, key, latitude: float, longitude: float, seconds: float,
+            hashes: tuple = (), value=None):
+        """
+        Keep a point of the time seconds under key, and drop the windows
+        too old to be found near it
+        """
+        window = int(seconds // self.window_seconds)
+        cell = (_grid_index(latitude + 90, self.cell_degrees, 180),
+                _grid_index(longitude + 180, self.cell_degrees, 360))
+        with self._lock:
+            newest = max(self._windows, default=window)
+            if window < newest - 1:
+                # Out of the reach of the points to come
+                return
+            self._discard(key)
+            self._windows.setdefault(window, {}).setdefault(cell, {})[key] = (
+                latitude, longitude, seconds, tuple(hashes), value)
+            self._points[key] = (window, cell)
+            for old in [old for old in self._windows if old < max(newest, window) - 1]:
+                for points in self._windows.pop(old).values():
+                    for old_key in points:
+                        del self._points[old_key]
+
+    def _discard(self, key) -> bool:
+        window, cell = self._points.pop(key, (None, None))
+        if window is None:
+            return False
+        points = self._windows[window][cell]
+        del points[key]
+        if not points:
+            del self._windows[window][cell]
+        return True
+
+    def remove(self, key) -> bool:
+        """
+        Remove the point of key and return whether it was kept
+        """
+        with self._lock:
+            return self._discard(key)
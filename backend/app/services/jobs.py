@@ -0,0 +1,373 @@
+"""
+Background jobs, run from a queue table of Postgres.
+
+Handlers are registered by name with the @job decorator, with a cron
+expression for the recurring ones. enqueue() writes a job in the
+transaction of its caller, so a job exists if and only if the change that
+asked for it is committed. Workers claim the due jobs by batches with
+FOR UPDATE SKIP LOCKED, so any number of workers share the queue without
+waiting for each other nor running a job twice, and run them on
+JOBS_CONCURRENCY threads.
+
+A claimed job is hidden from the other workers for JOBS_VISIBILITY_TIMEOUT
+seconds, extended by its worker while it runs: the jobs of a worker that
+died are claimed again once their timeout passes. A job can thus run more
+than once and handlers are idempotent. A failing job runs again after a
+backoff doubling from RETRY_DELAY, until its max_attempts, then is kept
+with its last error. A job whose worker died during its last attempt is
+kept the same way once its timeout passes, with LOST_JOB_ERROR.
+
+The worker locking a due schedule enqueues its job and advances its
+next_run_at in one transaction: a recurring job is enqueued once per run
+time, however many workers poll. Runs missed while no worker was up are
+enqueued once.
+
+Workers run in worker.py, next to the API of main.py, or in the API
+process with JOBS_IN_PROCESS.
+
+Attributes:
+    - Handler (class): A registered job function and its schedule.
+    - HANDLERS (dict): The handlers of the process, by name.
+    - job (function): Decorator registering a handler.
+    - enqueue (function): Add a job in the transaction of the caller.
+    - JobWorker (class): Claim and run the due jobs.
+
+Usage:
+    python -m app.services.jobs enqueue <name> [--payload '{"key": "value"}']
+    python worker.py
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+
+from psycopg2 import sql
+
+from app.resources.cron import CronSchedule
+from app.resources.required_packages import (
+    PostgresDB, PostgresDatabase, JOBS_CONCURRENCY, JOBS_POLL_INTERVAL,
+    JOBS_VISIBILITY_TIMEOUT, JOBS_MAX_ATTEMPTS)
+from app.resources.db_utils.job_queries import (
+    JOB_INSERT_QUERY, JOB_CLAIM_QUERY, JOB_EXTEND_QUERY, JOB_DONE_QUERY,
+    JOB_FAILED_QUERY, JOB_LOST_QUERY, JOB_SCHEDULE_UPSERT_QUERY, JOB_SCHEDULES_DUE_QUERY,
+    JOB_SCHEDULE_NEXT_QUERY)
+from app.services import metrics
+
+# Delay before the second attempt of a failing job, doubled at each attempt
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(hours=1)
+LOST_JOB_ERROR = "The worker stopped during the last attempt"
+
+LOGGER = logging.getLogger(__name__)
+
+DURATIONS = metrics.histogram(
+    "job_duration_seconds", "Run time of the jobs, by name.",
+    (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+WAITS = metrics.histogram(
+    "job_wait_seconds", "Delay between the run time of the jobs and their start, by name.",
+    (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+RUNS = metrics.counter(
+    "jobs_total", "Jobs run, by name and outcome: done, failed or unknown.")
+
+
+class Handler:
+    """
+    Job function, called with the payload of the job
+    """
+
+    def __init__(self, name: str, function, cron: str = None,
+                 max_attempts: int = JOBS_MAX_ATTEMPTS):
+        """
+        Attrs:
+            name (str): The name of the jobs
+            function (callable): Called with the payload dict of a job
+            cron (str): The schedule of the recurring job, if any
+            max_attempts (int): The runs of a failing job
+        """
+        self.name = name
+        self.function = function
+        self.schedule = CronSchedule(cron) if cron else None
+        self.max_attempts = max_attempts
+
+
+HANDLERS = {}
+
+
+def job(name: str, cron: str = None, max_attempts: int = JOBS_MAX_ATTEMPTS):
+    """
+    Register the decorated function as the handler of the jobs name
+
+    Raises:
+        ValueError: The cron expression is not valid.
+    """
+    def register(function):
+        HANDLERS[name] = Handler(name, function, cron, max_attempts)
+        return function
+    return register
+
+
+def enqueue(postgres_db: PostgresDatabase, name: str, payload: dict = None,
+            run_at: datetime = None, max_attempts: int = None) -> int:
+    """
+    Add a job in the current transaction of postgres_db and return its id.
+    The caller commits.
+    """
+    if max_attempts is None:
+        handler = HANDLERS.get(name)
+        max_attempts = handler.max_attempts if handler else JOBS_MAX_ATTEMPTS
+    now = datetime.utcnow()
+    postgres_db.execute(sql.SQL(JOB_INSERT_QUERY), (
+        name, json.dumps(payload or {}, default=str), run_at or now, max_attempts, now))
+    return postgres_db.fetch_one()[0]
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    """
+    Return the delay before the next run of a job failed attempts times
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def _timestamp(value) -> datetime:
+    """
+    Return value as a datetime
+    """
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+class JobWorker:
+    """
+    Worker claiming the due jobs and running them on a thread pool
+    """
+
+    def __init__(self, postgres_db: PostgresDatabase = None, handlers: dict = None,
+                 concurrency: int = JOBS_CONCURRENCY,
+                 visibility_timeout: float = JOBS_VISIBILITY_TIMEOUT,
+                 poll_interval: float = JOBS_POLL_INTERVAL):
+        """
+        Attrs:
+            postgres_db (PostgresDatabase): The database of the queue, a
+                connection of the worker by default, not shared with the requests
+            handlers (dict): The handlers run, HANDLERS by default
+            concurrency (int): The jobs run at the same time
+            visibility_timeout (float): Seconds a claimed job is hidden, extended while it runs
+            poll_interval (float): Seconds between two claims finding no job
+        """
+        self.db = postgres_db or PostgresDatabase()
+        self.handlers = HANDLERS if handlers is None else handlers
+        self.concurrency = concurrency
+        self.visibility_timeout = timedelta(seconds=visibility_timeout)
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+        self.stopped = threading.Event()
+        # The connection is shared by the polling thread and the job threads
+        self._lock = threading.Lock()
+        self._running = set()
+        self._extended_at = datetime.utcnow()
+        self._executor = None
+        self._thread = None
+
+    def _write(self, query, params=None, fetch: bool = False):
+        """
+        Run query in a transaction of its own, return its rows if fetch,
+        else its row count
+        """
+        with self._lock, self.db.primary():
+            try:
+                self.db.execute(query, params)
+                rows = self.db.fetch_all() if fetch else self.db.cursor.rowcount
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        return rows
+
+    def register_schedules(self, now: datetime = None):
+        """
+        Create the schedules of the recurring handlers. A schedule whose
+        expression changed runs next at its new time.
+        """
+        now = now or datetime.utcnow()
+        for handler in self.handlers.values():
+            if handler.schedule is not None:
+                self._write(sql.SQL(JOB_SCHEDULE_UPSERT_QUERY), (
+                    handler.name, handler.schedule.expression, handler.schedule.next_after(now)))
+
+    def enqueue_due(self, now: datetime = None) -> int:
+        """
+        Enqueue the runs of the due schedules and return how many were
+        enqueued. The schedules locked by another worker are left to it.
+        """
+        now = now or datetime.utcnow()
+        enqueued = 0
+        with self._lock, self.db.primary():
+            try:
+                self.db.execute(sql.SQL(JOB_SCHEDULES_DUE_QUERY), (now,))
+                for name, _, next_run_at in self.db.fetch_all():
+                    handler = self.handlers.get(name)
+                    if handler is None or handler.schedule is None:
+                        # Registered by a worker running other handlers
+                        continue
+                    enqueue(self.db, name, run_at=_timestamp(next_run_at))
+                    self.db.execute(sql.SQL(JOB_SCHEDULE_NEXT_QUERY),
+                                    (handler.schedule.next_after(now), name))
+                    enqueued += 1
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        return enqueued
+
+    def claim(self, limit: int, now: datetime = None) -> list:
+        """
+        Claim up to limit due jobs and return them as dicts
+        """
+        now = now or datetime.utcnow()
+        rows = self._write(sql.SQL(JOB_CLAIM_QUERY), (
+            now + self.visibility_timeout, self.name, now, now, limit), fetch=True)
+        jobs = [{"id": row[0], "name": row[1], "payload": json.loads(row[2]),
+                 "run_at": _timestamp(row[3]), "attempts": row[4], "max_attempts": row[5]}
+                for row in rows]
+        # RETURNING does not keep the order of the subquery
+        jobs.sort(key=lambda claimed: (claimed["run_at"], claimed["id"]))
+        with self._lock:
+            self._running.update(claimed["id"] for claimed in jobs)
+        return jobs
+
+    def fail_lost(self, now: datetime = None) -> int:
+        """
+        Fail the jobs whose last attempt outlived its visibility timeout,
+        and return how many were failed
+        """
+        now = now or datetime.utcnow()
+        failed = self._write(sql.SQL(JOB_LOST_QUERY), (LOST_JOB_ERROR, now))
+        if failed:
+            LOGGER.warning("%s jobs failed after their worker stopped", failed)
+        return failed
+
+    def extend(self, now: datetime = None) -> int:
+        """
+        Hide the running jobs for another visibility timeout and return
+        how many were extended
+        """
+        now = now or datetime.utcnow()
+        with self._lock, self.db.primary():
+            running = sorted(self._running)
+            self._extended_at = now
+            if not running:
+                return 0
+            locked_until = now + self.visibility_timeout
+            try:
+                self.db.execute_values(sql.SQL(JOB_EXTEND_QUERY),
+                                       [(job_id, locked_until, self.name) for job_id in running],
+                                       page_size=len(running))
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        return len(running)
+
+    def run_job(self, claimed: dict):
+        """
+        Run a claimed job: delete it once done, or schedule its next attempt
+        """
+        started = datetime.utcnow()
+        WAITS.observe(max((started - claimed["run_at"]).total_seconds(), 0),
+                      name=claimed["name"])
+        handler = self.handlers.get(claimed["name"])
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                outcome, error = "unknown", f"No handler for the job '{claimed['name']}'"
+            else:
+                try:
+                    handler.function(claimed["payload"])
+                    outcome, error = "done", None
+                except Exception as exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Job %s (%s) failed", claimed["id"], claimed["name"])
+                    outcome, error = "failed", repr(exception)
+            DURATIONS.observe(time.perf_counter() - start, name=claimed["name"])
+            RUNS.inc(name=claimed["name"], outcome=outcome)
+            if error is None:
+                updated = self._write(sql.SQL(JOB_DONE_QUERY), (claimed["id"], self.name))
+            else:
+                run_at = datetime.utcnow() + _retry_delay(claimed["attempts"])
+                updated = self._write(sql.SQL(JOB_FAILED_QUERY),
+                                      (run_at, error, claimed["id"], self.name))
+            if not updated:
+                LOGGER.warning("Job %s ran past its visibility timeout and was claimed again",
+                               claimed["id"])
+        finally:
+            with self._lock:
+                self._running.discard(claimed["id"])
+
+    def poll_once(self, now: datetime = None) -> int:
+        """
+        Enqueue the due schedules, extend the running jobs, fail the lost
+        ones, claim jobs for the free threads and return how many were claimed
+        """
+        now = now or datetime.utcnow()
+        self.enqueue_due(now)
+        if now - self._extended_at >= self.visibility_timeout / 3:
+            self.extend(now)
+            self.fail_lost(now)
+        with self._lock:
+            free = self.concurrency - len(self._running)
+        if free <= 0:
+            return 0
+        claimed = self.claim(free, now)
+        for job_to_run in claimed:
+            self._executor.submit(self.run_job, job_to_run)
+        return len(claimed)
+
+    def run(self):
+        """
+        Poll until stopped, without waiting while jobs are claimed
+        """
+        while not self.stopped.is_set():
+            try:
+                claimed = self.poll_once()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Job worker failed, retrying in %s seconds", self.poll_interval)
+                claimed = 0
+            if not claimed:
+                self.stopped.wait(self.poll_interval)
+
+    def start(self):
+        """
+        Register the schedules and poll in a thread of the worker
+        """
+        self.register_schedules()
+        self.stopped.clear()
+        self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix="job")
+        self._thread = threading.Thread(target=self.run, name="job-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop claiming jobs and wait for the running ones
+        """
+        self.stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the background jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add = subparsers.add_parser("enqueue", help="Add a job, run as soon as a worker is free.")
+    add.add_argument("name", help="The name of the job.")
+    add.add_argument("--payload", type=json.loads, default=None, help="The JSON payload.")
+    args = parser.parse_args()
+
+    JOB_ID = enqueue(PostgresDB, args.name, args.payload)
+    PostgresDB.commit()
+    print(f"enqueued job {JOB_ID}")
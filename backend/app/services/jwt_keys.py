@@ -0,0 +1,214 @@
+"""
+Keys used to sign and verify the tokens of the application.
+
+With ALGORITHM set to HS256 the shared SECRET_KEY is used as before. With
+EdDSA or ES256 the private keys are read from JWT_KEYS_DIR, one PEM file per
+key named "<kid>.pem". Tokens are signed by the key JWT_ACTIVE_KID and carry
+its kid in their header, while every key of the directory stays valid for
+verification and is published on the JWKS endpoint. A retired key can be
+kept as a public key only ("<kid>.pem" holding a PUBLIC KEY).
+
+Rotation:
+    1. Generate a new key in JWT_KEYS_DIR, it is published but not used.
+    2. Once the JWKS cache max-age has passed, set JWT_ACTIVE_KID to the new kid.
+    3. Once the longest token lifetime has passed, remove the old key.
+
+The directory is read again when a token carries an unknown kid, at most
+every KEY_RELOAD_INTERVAL seconds: the keys added for a rotation are
+accepted without a restart.
+
+Attributes:
+    - ASYMMETRIC_ALGORITHMS (tuple): The supported asymmetric algorithms.
+    - KeyRing (class): Signing and verification keys.
+    - KEYRING (KeyRing): The key ring configured for the application.
+    - generate_key (function): Create a new private key in a keys directory.
+
+Usage:
+    python -m app.services.jwt_keys generate --dir keys --algorithm EdDSA
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+from app.resources.required_packages import (
+    ALGORITHM, SECRET_KEY, JWT_KEYS_DIR, JWT_ACTIVE_KID)
+
+ASYMMETRIC_ALGORITHMS = ("EdDSA", "ES256")
+# Tokens with unknown kids read the keys directory at most this often
+KEY_RELOAD_INTERVAL = 30.0
+
+
+def key_id(public_key) -> str:
+    """
+    Derive a stable kid from a public key
+    """
+    der = public_key.public_bytes(
+        serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    digest = hashlib.sha256(der).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")[:16]
+
+
+class KeyRing:
+    """
+    Signing and verification keys of the application.
+
+    Attributes:
+        algorithm (str): The algorithm used to sign tokens.
+        active_kid (str): The kid of the signing key, None for HS256.
+        jwks (dict): The public keys as a JSON Web Key Set.
+        jwks_json (bytes): The serialized JWKS, built once.
+    """
+
+    def __init__(self, algorithm: str, secret_key: str = "",
+                 keys_dir: str = "", active_kid: str = ""):
+        self.algorithm = algorithm
+        self._alg = jwt.get_algorithm_by_name(algorithm)
+        self._keys_dir = keys_dir
+        self._configured_kid = active_kid
+        self._lock = threading.Lock()
+        self._loaded_at = 0.0
+        self.active_kid = None
+
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            self._signing_key = self._alg.prepare_key(secret_key)
+            self._verify_keys = {None: self._signing_key}
+            self._publish({"keys": []})
+        else:
+            if not keys_dir:
+                raise ValueError(f"Set JWT_KEYS_DIR to the directory of the {algorithm} keys")
+            if not os.path.isdir(keys_dir):
+                raise ValueError(f"JWT_KEYS_DIR '{keys_dir}' is not a directory")
+            self.reload()
+
+    def _publish(self, jwks: dict):
+        self.jwks = jwks
+        self.jwks_json = json.dumps(jwks, separators=(",", ":")).encode("utf-8")
+        self.jwks_etag = '"' + hashlib.sha256(self.jwks_json).hexdigest()[:32] + '"'
+
+    def reload(self):
+        """
+        Read the keys directory again. The active key stays the configured
+        one, or the current one when none is configured.
+
+        Raises:
+            ValueError: The active key has no private key in the directory.
+        """
+        with self._lock:
+            verify_keys, jwks = {}, {"keys": []}
+            private_keys = self._load(self._keys_dir, verify_keys, jwks)
+            active_kid = self._configured_kid or self.active_kid
+            if not active_kid and len(private_keys) == 1:
+                active_kid = next(iter(private_keys))
+            if active_kid not in private_keys:
+                raise ValueError(
+                    f"JWT_ACTIVE_KID '{active_kid}' has no private key in '{self._keys_dir}'"
+                )
+            self._verify_keys = verify_keys
+            self.active_kid = active_kid
+            self._signing_key = private_keys[active_kid]
+            self._publish(jwks)
+            self._loaded_at = time.monotonic()
+
+    def _load(self, keys_dir: str, verify_keys: dict, jwks: dict) -> dict:
+        """
+        Load every PEM key of keys_dir in verify_keys and jwks, return the
+        private ones by kid
+        """
+        private_keys = {}
+        for filename in sorted(os.listdir(keys_dir)):
+            if not filename.endswith(".pem"):
+                continue
+            kid = filename[: -len(".pem")]
+            with open(os.path.join(keys_dir, filename), "rb") as key_file:
+                data = key_file.read()
+            if b"PRIVATE KEY" in data:
+                private_key = serialization.load_pem_private_key(data, password=None)
+                private_keys[kid] = self._alg.prepare_key(private_key)
+                public_key = private_key.public_key()
+            else:
+                public_key = serialization.load_pem_public_key(data)
+            verify_keys[kid] = self._alg.prepare_key(public_key)
+
+            jwk = self._alg.to_jwk(public_key, as_dict=True)
+            jwk.update({"kid": kid, "use": "sig", "alg": self.algorithm})
+            jwks["keys"].append(jwk)
+        return private_keys
+
+    def sign(self, payload: dict) -> str:
+        """
+        Sign the payload with the active key
+        """
+        headers = {"kid": self.active_kid} if self.active_kid else None
+        return jwt.encode(payload, self._signing_key,
+                          algorithm=self.algorithm, headers=headers)
+
+    def verification_key(self, token: str):
+        """
+        Return the prepared key matching the kid of the token, reading the
+        keys directory again for an unknown kid.
+
+        Raises:
+            jwt.InvalidTokenError: The kid is unknown.
+        """
+        if self.active_kid is None:
+            return self._verify_keys[None]
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid not in self._verify_keys and \
+                time.monotonic() - self._loaded_at >= KEY_RELOAD_INTERVAL:
+            try:
+                self.reload()
+            except (OSError, ValueError):
+                # The keys in use stay valid until the directory is fixed
+                self._loaded_at = time.monotonic()
+        try:
+            return self._verify_keys[kid]
+        except KeyError as exc:
+            raise jwt.InvalidTokenError("Unknown kid") from exc
+
+
+def generate_key(keys_dir: str, algorithm: str) -> str:
+    """
+    Create a new private key in keys_dir and return its kid.
+    """
+    if algorithm == "EdDSA":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == "ES256":
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"Unsupported algorithm '{algorithm}'")
+
+    kid = key_id(private_key.public_key())
+    os.makedirs(keys_dir, exist_ok=True)
+    path = os.path.join(keys_dir, f"{kid}.pem")
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as key_file:
+        key_file.write(private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+    return kid
+
+
+KEYRING = KeyRing(ALGORITHM, secret_key=SECRET_KEY,
+                  keys_dir=JWT_KEYS_DIR, active_kid=JWT_ACTIVE_KID)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the JWT signing keys.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate = subparsers.add_parser("generate", help="Generate a new signing key.")
+    generate.add_argument("--dir", default=JWT_KEYS_DIR or "keys")
+    generate.add_argument("--algorithm", choices=ASYMMETRIC_ALGORITHMS,
+                          default=ALGORITHM if ALGORITHM in ASYMMETRIC_ALGORITHMS
+                          else "EdDSA")
+    args = parser.parse_args()
+    print(generate_key(args.dir, args.algorithm))
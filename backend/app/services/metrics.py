@@ -0,0 +1,202 @@
+"""
+Metrics of the process, in the Prometheus text format.
+
+Counters are incremented by the code they count, gauges read their value
+from a function when the metrics are scraped. Values are per worker
+process: the scraper sums or averages them over the workers.
+
+Attributes:
+    - Counter (class): A value that only goes up, by labels.
+    - Gauge (class): A value read when scraped.
+    - Histogram (class): Observed values counted by bucket, by labels.
+    - Registry (class): The metrics of the process.
+    - REGISTRY (Registry): The registry served on /metrics.
+    - counter (function): Register a counter.
+    - gauge (function): Register a gauge.
+    - histogram (function): Register a histogram.
+"""
+import threading
+
+
+def _labels(labels: tuple) -> str:
+    """
+    Return the Prometheus form of sorted (name, value) labels
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """
+    Value that only goes up, one per set of labels
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Add amount to the value of labels
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """
+        Return the value of labels
+        """
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> list:
+        """
+        Return (labels, value) of every set of labels
+        """
+        return list(self._values.items())
+
+    def series(self) -> list:
+        """
+        Return (name, labels, value) of every sample
+        """
+        return [(self.name, labels, value) for labels, value in self.samples()]
+
+
+class Gauge:
+    """
+    Value read from a function when scraped
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def value(self) -> float:
+        """
+        Return the current value
+        """
+        return self.function()
+
+    def samples(self) -> list:
+        """
+        Return the current value, without labels
+        """
+        return [((), self.value())]
+
+    def series(self) -> list:
+        """
+        Return (name, labels, value) of the current value
+        """
+        return [(self.name, (), self.value())]
+
+
+class Histogram:
+    """
+    Observed values counted by upper bound, with their sum and count, one
+    set per labels
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """
+        Count value in the buckets of labels
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ((0,) * len(self.buckets), 0, 0))
+            counts = tuple(bucket_count + (value <= bound)
+                           for bound, bucket_count in zip(self.buckets, counts))
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels) -> int:
+        """
+        Return the number of values observed with labels
+        """
+        return self._values.get(tuple(sorted(labels.items())), ((), 0, 0))[2]
+
+    def total(self, **labels) -> float:
+        """
+        Return the sum of the values observed with labels
+        """
+        return self._values.get(tuple(sorted(labels.items())), ((), 0, 0))[1]
+
+    def series(self) -> list:
+        """
+        Return the cumulative buckets, sum and count of every set of labels
+        """
+        series = []
+        for labels, (counts, total, count) in list(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                series.append((f"{self.name}_bucket", labels + (("le", f"{bound:g}"),),
+                               bucket_count))
+            series.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), count))
+            series.append((f"{self.name}_sum", labels, total))
+            series.append((f"{self.name}_count", labels, count))
+        return series
+
+
+class Registry:
+    """
+    Metrics of the process, by name
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """
+        Add metric, or return the metric already registered with its name
+        """
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        """
+        Return every metric in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.series():
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str) -> Counter:
+    """
+    Register a counter in REGISTRY
+    """
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name: str, documentation: str, function) -> Gauge:
+    """
+    Register a gauge in REGISTRY reading function
+    """
+    return REGISTRY.register(Gauge(name, documentation, function))
+
+
+def histogram(name: str, documentation: str, buckets: tuple) -> Histogram:
+    """
+    Register a histogram in REGISTRY, counting values up to each bucket
+    """
+    return REGISTRY.register(Histogram(name, documentation, buckets))
@@ -0,0 +1,287 @@
+"""
+Transactional outbox of the user changes.
+
+Creating or updating a user, opening or ending a session writes an outbox
+row in the transaction of the change, so an event exists if and only if its
+change is committed. The relay reads the pending rows in id order, by
+batches, hands them to the subscribers of its process, sends them on the
+OUTBOX_CHANNEL channel with NOTIFY and marks them published, all in one
+transaction: the notifications are only sent if the batch is marked.
+
+Events are {"id", "event", "email", "payload", "created_date"}, with event
+one of EVENTS. Ids are ordered within a database: the changes of a user
+take its row lock before writing their event, so they are published in
+order. Ids are taken when the events are written, not when they are
+committed: an id missing above the last one published may belong to a
+transaction still running. The relay stops before it, and only skips it
+as rolled back once it is missing for OUTBOX_GAP_TIMEOUT seconds.
+Delivery is at least once, a batch whose subscriber fails is published
+again by the next run: consumers skip the ids they have seen. With
+shards, every shard has its own outbox and ids.
+
+Attributes:
+    - EVENTS (tuple): The names of the change events.
+    - outbox_row (function): The row of an event, for record_many.
+    - record (function): Write an event in the transaction of a change.
+    - record_many (function): Write several events in one statement.
+    - subscribe (function): Receive the published events in the relay process.
+    - unsubscribe (function): Stop receiving the events.
+    - OutboxRelay (class): Publish the pending events.
+
+Usage:
+    python -m app.services.outbox run [--subscriber module:callable ...]
+    python -m app.services.outbox purge
+"""
+import argparse
+from datetime import datetime, timedelta
+import importlib
+import json
+import logging
+import threading
+import time
+
+from psycopg2 import sql
+
+from app.resources.required_packages import (
+    PostgresDB, PostgresDatabase, OUTBOX_CHANNEL, OUTBOX_BATCH_SIZE,
+    OUTBOX_POLL_INTERVAL, OUTBOX_RETENTION_DAYS, OUTBOX_GAP_TIMEOUT)
+from app.resources.shards import SHARDS
+from app.resources.db_utils.db_utils import format_datas_from_db
+from app.resources.db_utils.outbox_queries import (
+    OUTBOX_INSERT_QUERY, OUTBOX_BULK_INSERT_QUERY, OUTBOX_LOCK_QUERY,
+    OUTBOX_PENDING_QUERY, OUTBOX_HIGH_WATER_QUERY, OUTBOX_PUBLISHED_QUERY, OUTBOX_NOTIFY_QUERY,
+    OUTBOX_PURGE_QUERY)
+
+EVENTS = ("user.created", "user.updated", "session.created", "session.ended",
+          "notification.updated", "sighting.created", "sighting.resolved")
+
+# Key of the advisory lock held by the relay publishing a batch
+OUTBOX_LOCK_ID = 7_340_035
+
+LOGGER = logging.getLogger(__name__)
+_SUBSCRIBERS = []
+
+
+def outbox_row(event: str, email: str, payload: dict = None) -> tuple:
+    """
+    Return the outbox row of an event
+    """
+    if event not in EVENTS:
+        raise ValueError(f"Unknown event '{event}'")
+    return (event, email, json.dumps(payload or {}, default=str), datetime.utcnow())
+
+
+def record(postgres_db: PostgresDatabase, event: str, email: str, payload: dict = None):
+    """
+    Write an event in the current transaction of postgres_db, committed
+    with the change it describes
+    """
+    postgres_db.execute(sql.SQL(OUTBOX_INSERT_QUERY), outbox_row(event, email, payload))
+
+
+def record_many(postgres_db: PostgresDatabase, rows: list):
+    """
+    Write the outbox rows in one statement of the current transaction
+    """
+    if rows:
+        postgres_db.execute_values(sql.SQL(OUTBOX_BULK_INSERT_QUERY), rows,
+                                   page_size=len(rows))
+
+
+def subscribe(callback, events: tuple = None):
+    """
+    Call callback with the list of every published batch, limited to
+    events when given. Returns callback, so it can decorate a function.
+    """
+    _SUBSCRIBERS.append((callback, set(events) if events else None))
+    return callback
+
+
+def unsubscribe(callback):
+    """
+    Stop calling callback
+    """
+    _SUBSCRIBERS[:] = [(subscriber, events) for subscriber, events in _SUBSCRIBERS
+                       if subscriber is not callback]
+
+
+def _deliver(events: list):
+    """
+    Hand a batch to the subscribers, in order
+    """
+    for callback, names in list(_SUBSCRIBERS):
+        selected = events if names is None else [
+            event for event in events if event["event"] in names]
+        if selected:
+            callback(selected)
+
+
+def _to_event(row: dict) -> dict:
+    """
+    Return the event of an outbox row
+    """
+    return {
+        "id": row["id"],
+        "event": row["event"],
+        "email": row["email"],
+        "payload": json.loads(row["payload"]),
+        "created_date": str(row["created_date"]),
+    }
+
+
+def _outbox_databases() -> list:
+    """
+    Return the databases holding an outbox: the shards and the main
+    database of the sessions
+    """
+    databases = {id(PostgresDB): PostgresDB}
+    for database in SHARDS.all() if SHARDS is not None else ():
+        databases.setdefault(id(database), database)
+    return list(databases.values())
+
+
+class OutboxRelay:
+    """
+    Publisher of the pending events of the outboxes
+    """
+
+    def __init__(self, databases: list = None, batch_size: int = OUTBOX_BATCH_SIZE,
+                 channel: str = OUTBOX_CHANNEL, gap_timeout: float = OUTBOX_GAP_TIMEOUT):
+        """
+        Attrs:
+            databases (list): The databases to relay, every outbox by default
+            batch_size (int): The events published together
+            channel (str): The NOTIFY channel, None to only deliver in process
+            gap_timeout (float): Seconds a missing id is waited for
+        """
+        self.databases = databases if databases is not None else _outbox_databases()
+        self.batch_size = batch_size
+        self.channel = channel
+        self.gap_timeout = gap_timeout
+        # {(id of the database, first missing id): monotonic time it was first missed}
+        self._gaps = {}
+
+    def _ready(self, postgres_db: PostgresDatabase, events: list) -> list:
+        """
+        Return the events to publish: those following the last id published
+        without gap, or after a gap missing for gap_timeout
+        """
+        postgres_db.execute(sql.SQL(OUTBOX_HIGH_WATER_QUERY))
+        row = postgres_db.fetch_one()
+        expected = row[0] + 1 if row is not None else events[0]["id"]
+        now = time.monotonic()
+        ready = []
+        for event in events:
+            if event["id"] > expected:
+                missed = self._gaps.setdefault((id(postgres_db), expected), now)
+                if now - missed < self.gap_timeout:
+                    break
+                LOGGER.warning("Outbox ids %d to %d skipped, missing for %s seconds",
+                               expected, event["id"] - 1, self.gap_timeout)
+            elif event["id"] < expected:
+                LOGGER.warning("Outbox id %d published after a later id", event["id"])
+            ready.append(event)
+            expected = max(expected, event["id"] + 1)
+        self._gaps = {gap: missed for gap, missed in self._gaps.items()
+                      if gap[0] != id(postgres_db) or gap[1] >= expected}
+        return ready
+
+    def publish(self, postgres_db: PostgresDatabase) -> int:
+        """
+        Publish the next batch of postgres_db and return its number of
+        events. Another relay publishing meanwhile, or a missing id waited
+        for, makes it return 0.
+        """
+        with postgres_db.primary():
+            try:
+                postgres_db.execute(sql.SQL(OUTBOX_LOCK_QUERY), (OUTBOX_LOCK_ID,))
+                if not postgres_db.fetch_one()[0]:
+                    postgres_db.rollback()
+                    return 0
+                postgres_db.execute(sql.SQL(OUTBOX_PENDING_QUERY), (self.batch_size,))
+                events = [_to_event(row) for row in
+                          format_datas_from_db(postgres_db, postgres_db.fetch_all())]
+                if events:
+                    events = self._ready(postgres_db, events)
+                if not events:
+                    postgres_db.rollback()
+                    return 0
+
+                _deliver(events)
+                if self.channel:
+                    for event in events:
+                        postgres_db.execute(sql.SQL(OUTBOX_NOTIFY_QUERY),
+                                            (self.channel, json.dumps(event)))
+                published = datetime.utcnow()
+                postgres_db.execute_values(
+                    sql.SQL(OUTBOX_PUBLISHED_QUERY),
+                    [(event["id"], published) for event in events], page_size=len(events))
+                postgres_db.commit()
+            except Exception:
+                postgres_db.rollback()
+                raise
+        return len(events)
+
+    def run_once(self) -> int:
+        """
+        Publish a batch of every outbox and return the number of events
+        """
+        return sum(self.publish(database) for database in self.databases)
+
+    def run(self, interval: float = OUTBOX_POLL_INTERVAL, stop: threading.Event = None):
+        """
+        Publish until stop is set, without waiting while batches are full
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                published = self.run_once()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Outbox relay failed, retrying in %s seconds", interval)
+                published = 0
+            if published < self.batch_size:
+                stop.wait(interval)
+
+    def purge(self, retention: timedelta = timedelta(days=OUTBOX_RETENTION_DAYS)) -> int:
+        """
+        Delete the events published more than retention ago and return
+        how many were deleted
+        """
+        deleted = 0
+        before = datetime.utcnow() - retention
+        for database in self.databases:
+            with database.primary():
+                database.execute(sql.SQL(OUTBOX_PURGE_QUERY), (before,))
+                deleted += database.cursor.rowcount
+                database.commit()
+        return deleted
+
+
+def _load_callable(path: str):
+    """
+    Import "module:callable"
+    """
+    module_name, _, name = path.partition(":")
+    return getattr(importlib.import_module(module_name), name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish the change events of the outbox.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser("run", help="Publish the events until interrupted.")
+    run.add_argument("--subscriber", action="append", default=[],
+                     help="module:callable receiving every batch of events.")
+    subparsers.add_parser("purge", help="Delete the old published events.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    RELAY = OutboxRelay()
+    if args.command == "run":
+        for subscriber_path in args.subscriber:
+            subscribe(_load_callable(subscriber_path))
+        try:
+            RELAY.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(f"deleted {RELAY.purge()} events")
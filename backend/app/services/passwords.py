@@ -0,0 +1,123 @@
+"""
+Password hashing with bcrypt.
+
+Every hash has its own random salt, and the work factor BCRYPT_COST. The
+cost is chosen for the hardware with the calibrate command: the highest
+cost hashing within the latency target. A login whose stored hash has
+another cost rehashes the password with BCRYPT_COST, so the hashes follow
+the configured cost without resetting any password. Hashes are stored as
+the str() of the bcrypt bytes, "b'$2b$12$...'".
+
+Attributes:
+    - MIN_COST (int): The lowest cost bcrypt accepts.
+    - hash_password (function): Hash a password with a new salt.
+    - check_password (function): Compare a password with its stored hash.
+    - hash_cost (function): The cost of a stored hash.
+    - needs_rehash (function): Whether a stored hash has another cost.
+    - calibrate (function): The highest cost hashing within a latency target.
+
+Usage:
+    python -m app.services.passwords calibrate --target-ms 250
+"""
+import argparse
+import re
+import time
+
+import bcrypt
+
+from app.resources.required_packages import BCRYPT_COST
+
+MIN_COST = 4
+MAX_COST = 31
+DEFAULT_MIN_COST = 10
+DEFAULT_TARGET_MS = 250
+CALIBRATION_PASSWORD = b"calibration password"
+
+STORED_HASH = re.compile(r"^b'(\$2[abxy]?\$(\d{2})\$.{53})'$")
+
+
+def _stored_bytes(stored: str) -> bytes:
+    """
+    Return the bcrypt hash of a stored "b'...'" hash
+    """
+    return bytes(stored[2:-1], "utf-8")
+
+
+def hash_password(password: str, cost: int = None) -> str:
+    """
+    Return the stored form of the hash of password, with a new salt and
+    cost, BCRYPT_COST by default
+    """
+    salt = bcrypt.gensalt(rounds=cost or BCRYPT_COST)
+    return str(bcrypt.hashpw(password.encode("utf-8"), salt))
+
+
+def check_password(password: str, stored: str) -> bool:
+    """
+    Return True if password matches the stored hash
+    """
+    return bool(bcrypt.checkpw(bytes(password, "utf-8"), _stored_bytes(stored)))
+
+
+def hash_cost(stored: str):
+    """
+    Return the cost of a stored hash, None if it is not a bcrypt hash
+    """
+    match = STORED_HASH.match(stored or "")
+    return int(match.group(2)) if match else None
+
+
+def needs_rehash(stored: str, cost: int = None) -> bool:
+    """
+    Return True if the stored hash is a bcrypt hash of another cost than
+    cost, BCRYPT_COST by default
+    """
+    current = hash_cost(stored)
+    return current is not None and current != (cost or BCRYPT_COST)
+
+
+def measure(cost: int, rounds: int = 3) -> float:
+    """
+    Return the fastest of rounds hashes at cost, in milliseconds
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        bcrypt.hashpw(CALIBRATION_PASSWORD, bcrypt.gensalt(rounds=cost))
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def calibrate(target_ms: float = DEFAULT_TARGET_MS, min_cost: int = DEFAULT_MIN_COST,
+              rounds: int = 3):
+    """
+    Return the highest cost, at least min_cost, whose hash takes at most
+    target_ms on this host, and {cost: milliseconds} of the costs measured.
+    Each cost doubles the time, the measures stop at the first one over
+    the target.
+    """
+    timings = {}
+    chosen = min_cost
+    for cost in range(MIN_COST, MAX_COST + 1):
+        timings[cost] = measure(cost, rounds)
+        if timings[cost] > target_ms:
+            break
+        chosen = max(chosen, cost)
+    return chosen, timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the bcrypt cost.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibration = subparsers.add_parser(
+        "calibrate", help="Find the highest cost hashing within a latency target.")
+    calibration.add_argument("--target-ms", type=float, default=DEFAULT_TARGET_MS,
+                             help="The longest hash time accepted, in milliseconds.")
+    calibration.add_argument("--min-cost", type=int, default=DEFAULT_MIN_COST,
+                             help="The lowest cost returned, whatever the hardware.")
+    args = parser.parse_args()
+
+    COST, TIMINGS = calibrate(args.target_ms, args.min_cost)
+    for measured_cost, milliseconds in TIMINGS.items():
+        print(f"cost {measured_cost:2}: {milliseconds:8.1f} ms")
+    print(f"BCRYPT_COST={COST}")
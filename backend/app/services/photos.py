@@ -0,0 +1,353 @@
+"""
+Photos of the sightings, stored on disk by content.
+
+An upload is a multipart body read as it arrives: the data of its file
+parts is hashed and written to a temporary file of PHOTOS_DIR by chunks of
+PHOTO_WRITE_BUFFER, never held whole in memory. The writes run in threads,
+at most PHOTO_WRITE_CONCURRENCY at a time per worker: while an upload waits
+for a write it reads no more of its body, so a slow disk slows the
+clients down instead of filling the memory.
+
+A photo is named by the SHA-256 digest of its bytes. A photo already stored
+is dropped at once. A new one is stripped of its EXIF metadata, the
+location of the reporter included, and thumbnailed in a pool of
+PHOTO_PROCESSES processes, off the threads of the API. An upload refused
+halfway removes the photos it stored before.
+
+Files are {PHOTOS_DIR}/{digest[:2]}/{digest}.jpg and {digest}.thumb.jpg.
+
+Attributes:
+    - UploadError (class): The upload is refused, with its HTTP status.
+    - StoredPhoto (namedtuple): A photo of an upload, by digest.
+    - process_photo (function): Strip and thumbnail a photo, in the pool.
+    - receive_photos (function): Store the photos of a multipart body.
+    - photo_path (function): The file of a stored photo or its thumbnail.
+    - perceptual_hash (function): The difference hash of a stored photo.
+    - shutdown (function): Stop the processes of the pool.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+import anyio
+from multipart.multipart import MultipartParser, parse_options_header
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from app.resources.required_packages import (
+    PHOTOS_DIR, PHOTO_MAX_BYTES, PHOTO_WRITE_CONCURRENCY, PHOTO_PROCESSES,
+    PHOTO_THUMBNAIL_SIZE)
+from app.services import metrics
+
+PHOTO_WRITE_BUFFER = 256 * 1024
+PHOTO_MAX_FILES = 5
+# Larger images are refused from their header, before being decoded
+PHOTO_MAX_PIXELS = 50_000_000
+JPEG_QUALITY = 85
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+StoredPhoto = namedtuple("StoredPhoto", ["digest", "size", "created"])
+
+UPLOADED = metrics.counter(
+    "photo_uploads_total", "Photos uploaded, by outcome: stored, duplicate or refused.")
+
+_WRITE_LIMITER = None
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload is refused, with the HTTP status to answer
+    """
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def photo_path(digest: str, thumbnail: bool = False, directory: str = None) -> str:
+    """
+    Return the file of the photo digest, or of its thumbnail, in directory
+    or PHOTOS_DIR
+    """
+    suffix = ".thumb.jpg" if thumbnail else ".jpg"
+    return os.path.join(directory or PHOTOS_DIR, digest[:2], digest + suffix)
+
+
+def perceptual_hash(digest: str) -> int:
+    """
+    Return the 64 bit difference hash of a stored photo, read from its
+    thumbnail: photos of the same scene differ by a few bits
+
+    Raises:
+        FileNotFoundError: No photo has this digest.
+    """
+    with Image.open(photo_path(digest, thumbnail=True)) as thumbnail:
+        pixels = thumbnail.convert("L").resize((9, 8)).tobytes()
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            bits = bits << 1 | (left < pixels[row * 9 + column + 1])
+    return bits
+
+
+def process_photo(source: str, photo: str, thumbnail: str,
+                  thumbnail_size: int = PHOTO_THUMBNAIL_SIZE):
+    """
+    Write the photo of source without its metadata, turned as it was shot,
+    and its thumbnail. Runs in the process pool.
+
+    Raises:
+        ValueError: source is not an image, or too large.
+    """
+    Image.MAX_IMAGE_PIXELS = PHOTO_MAX_PIXELS
+    try:
+        with Image.open(source) as original:
+            # PIL only refuses twice MAX_IMAGE_PIXELS, the header gives the size
+            width, height = original.size
+            if width * height > PHOTO_MAX_PIXELS:
+                raise ValueError(f"Images are limited to {PHOTO_MAX_PIXELS} pixels")
+            image = ImageOps.exif_transpose(original).convert("RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as exception:
+        raise ValueError(f"Not a supported image: {exception}") from exception
+    # Saved without the exif and info of the original
+    _save(image, photo)
+    image.thumbnail((thumbnail_size, thumbnail_size))
+    _save(image, thumbnail)
+
+
+def _save(image, path: str):
+    """
+    Write image as a JPEG at path, visible only once complete
+    """
+    partial = f"{path}.{os.getpid()}.partial"
+    image.save(partial, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(partial, path)
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(PHOTO_PROCESSES)
+        return _POOL
+
+
+def shutdown():
+    """
+    Stop the processes of the pool, on shutdown
+    """
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown()
+            _POOL = None
+
+
+def _write_limiter() -> anyio.CapacityLimiter:
+    # Created in the event loop of the worker
+    global _WRITE_LIMITER  # pylint: disable=global-statement
+    if _WRITE_LIMITER is None:
+        _WRITE_LIMITER = anyio.CapacityLimiter(PHOTO_WRITE_CONCURRENCY)
+    return _WRITE_LIMITER
+
+
+class _PendingPhoto:
+    """
+    File part being received in a temporary file, hashed as it is written
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(os.path.join(directory, "tmp"), exist_ok=True)
+        descriptor, self.path = tempfile.mkstemp(dir=os.path.join(directory, "tmp"),
+                                                 prefix="upload-")
+        self.file = os.fdopen(descriptor, "wb")
+        self.hash = hashlib.sha256()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.buffer = bytearray()
+
+    def _write(self, data: bytes):
+        self.hash.update(data)
+        self.file.write(data)
+
+    async def write(self, data: bytes):
+        """
+        Add data, written to disk by buffers of PHOTO_WRITE_BUFFER
+
+        Raises:
+            UploadError: The photo is larger than max_bytes.
+        """
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadError(413, f"Photos are limited to {self.max_bytes} bytes.")
+        self.buffer += data
+        if len(self.buffer) >= PHOTO_WRITE_BUFFER:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write the buffer in a thread, waiting for a free writer
+        """
+        if self.buffer:
+            data, self.buffer = bytes(self.buffer), bytearray()
+            await anyio.to_thread.run_sync(self._write, data, limiter=_write_limiter())
+
+    async def close(self) -> str:
+        """
+        Write the rest and return the digest of the photo
+        """
+        await self.flush()
+        await anyio.to_thread.run_sync(self.file.close)
+        return self.hash.hexdigest()
+
+    def discard(self):
+        """
+        Remove the temporary file
+        """
+        self.file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class _Parts:
+    """
+    Callbacks of the multipart parser, queueing the events of the file parts
+    """
+
+    def __init__(self):
+        self.events = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._is_file = False
+
+    def on_part_begin(self):
+        self._disposition, self._is_file = b"", False
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name, self._header_value = b"", b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        # Form fields are ignored, only files are received
+        self._is_file = b"filename" in options
+        if self._is_file:
+            self.events.append(("begin", None))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._is_file:
+            self.events.append(("data", data[start:end]))
+
+    def on_part_end(self):
+        if self._is_file:
+            self.events.append(("end", None))
+
+    def callbacks(self) -> dict:
+        """
+        Return the callbacks of MultipartParser
+        """
+        return {name: getattr(self, name) for name in (
+            "on_part_begin", "on_header_field", "on_header_value", "on_header_end",
+            "on_headers_finished", "on_part_data", "on_part_end")}
+
+
+def _remove(digest: str, directory: str):
+    """
+    Remove a stored photo and its thumbnail
+    """
+    for thumbnail in (False, True):
+        try:
+            os.unlink(photo_path(digest, thumbnail=thumbnail, directory=directory))
+        except FileNotFoundError:
+            pass
+
+
+async def _store(pending: _PendingPhoto, directory: str) -> StoredPhoto:
+    """
+    Keep a received photo under its digest, processed in the pool unless
+    it is already stored
+    """
+    digest = await pending.close()
+    path = photo_path(digest, directory=directory)
+    if os.path.exists(path):
+        pending.discard()
+        UPLOADED.inc(outcome="duplicate")
+        return StoredPhoto(digest, pending.size, False)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            _pool(), process_photo, pending.path, path,
+            photo_path(digest, thumbnail=True, directory=directory))
+    except ValueError as exception:
+        UPLOADED.inc(outcome="refused")
+        raise UploadError(415, "Send JPEG, PNG or WebP photos.") from exception
+    finally:
+        pending.discard()
+    UPLOADED.inc(outcome="stored")
+    return StoredPhoto(digest, pending.size, True)
+
+
+async def receive_photos(content_type: str, stream, directory: str = None,
+                         max_bytes: int = PHOTO_MAX_BYTES,
+                         max_files: int = PHOTO_MAX_FILES) -> list:
+    """
+    Store the photos of the file parts of a multipart/form-data body, read
+    from the async iterator stream, and return their StoredPhoto
+
+    Raises:
+        UploadError: The body is not multipart, has no photo or too many, or
+            a photo is too large or not an image. The photos stored by the
+            upload are removed.
+    """
+    directory = directory or PHOTOS_DIR
+    media_type, options = parse_options_header(content_type or "")
+    if media_type != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadError(415, "Send the photos as multipart/form-data.")
+    parts = _Parts()
+    parser = MultipartParser(options[b"boundary"], parts.callbacks())
+    received, pending, photos = [], None, []
+    try:
+        async for chunk in stream:
+            parser.write(chunk)
+            for event, data in parts.events:
+                if event == "begin":
+                    if len(photos) + len(received) >= max_files:
+                        raise UploadError(400, f"Send at most {max_files} photos.")
+                    pending = _PendingPhoto(directory, max_bytes)
+                    received.append(pending)
+                elif event == "data":
+                    await pending.write(data)
+                else:
+                    received.remove(pending)
+                    photos.append(await _store(pending, directory))
+                    pending = None
+            parts.events.clear()
+        parser.finalize()
+    except BaseException:
+        # Photos stored before by another upload are kept
+        for photo in photos:
+            if photo.created:
+                _remove(photo.digest, directory)
+        raise
+    finally:
+        for unfinished in received:
+            unfinished.discard()
+    if not photos:
+        raise UploadError(400, "Send at least one photo.")
+    return photos
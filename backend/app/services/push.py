@@ -0,0 +1,285 @@
+"""
+Messages pushed to the connected users.
+
+Each API worker keeps a Broker of its open connections, by email. A
+connection reads its messages from a queue of PUSH_QUEUE_SIZE: a consumer
+that falls that far behind is evicted, its queue dropped and its
+connection closed, so a slow client never holds the memory of the worker
+nor delays the others. Clients reconnect and read the current state.
+
+Messages reach every worker through Postgres LISTEN/NOTIFY. The
+PushListener thread of a worker listens on PUSH_CHANNEL, where push() sends
+{"email", "event", "payload"} messages, and on the OUTBOX_CHANNEL of the
+change events published by the outbox relay, forwarding PUSHED_EVENTS.
+A notification.updated event also drops the cached preferences of the
+user, so every worker reads the change, and the sighting events update the
+sightings index of the worker. The listening event is set once the
+channels are listened to. On every connection, the sightings changed
+since the listener last received are indexed again: their events were
+missed. Before the index is built, this is left to the build.
+
+Attributes:
+    - PUSHED_EVENTS (tuple): The change events forwarded to the connections.
+    - EVICTED (object): The last message of an evicted connection.
+    - Subscription (class): The queue of a connection.
+    - Broker (class): The connections of the worker and their queues.
+    - BROKER (Broker): The broker of the worker.
+    - push (function): Send a message to the connections of a user, on every worker.
+    - PushListener (class): The thread forwarding the notifications to a broker.
+"""
+import asyncio
+from datetime import datetime
+import json
+import logging
+import select
+import threading
+
+import psycopg2
+from psycopg2 import sql
+
+from app.models.notification import PREFERENCES_CACHE
+from app.models.sighting import apply_event as apply_sighting_event, sync_index
+from app.resources.required_packages import (
+    PostgresDatabase, OUTBOX_CHANNEL, PUSH_CHANNEL, PUSH_QUEUE_SIZE)
+from app.resources.shards import SHARDS, normalize_email
+from app.resources.db_utils.push_queries import PUSH_NOTIFY_QUERY, PUSH_LISTEN_QUERY
+from app.services import metrics
+
+PUSHED_EVENTS = ("user.updated", "session.ended", "notification.updated")
+EVICTED = object()
+LISTEN_TIMEOUT = 5.0
+RECONNECT_DELAY = 5.0
+
+LOGGER = logging.getLogger(__name__)
+
+MESSAGES = metrics.counter(
+    "push_messages_total", "Messages queued to the connections, by event.")
+EVICTIONS = metrics.counter(
+    "push_evictions_total", "Connections closed for lagging PUSH_QUEUE_SIZE messages behind.")
+
+
+class Subscription:
+    """
+    Queue of the messages of one connection, read in its event loop
+    """
+
+    def __init__(self, email: str, sid: str = None, maxsize: int = PUSH_QUEUE_SIZE):
+        self.email = normalize_email(email)
+        self.sid = sid
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.evicted = False
+
+    def offer(self, message: dict):
+        """
+        Queue message, or evict the connection if its queue is full. Runs
+        in the event loop of the connection.
+        """
+        if self.evicted:
+            return
+        try:
+            self.queue.put_nowait(message)
+            MESSAGES.inc(event=message.get("event"))
+        except asyncio.QueueFull:
+            self.evicted = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(EVICTED)
+            EVICTIONS.inc()
+
+    async def get(self):
+        """
+        Return the next message, EVICTED once the connection is evicted
+        """
+        return await self.queue.get()
+
+
+class Broker:
+    """
+    Open connections of the worker, by email
+    """
+
+    def __init__(self, queue_size: int = PUSH_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, email: str, sid: str = None) -> Subscription:
+        """
+        Open the queue of a connection of email, from its event loop
+        """
+        subscription = Subscription(email, sid, self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(subscription.email, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Drop the queue of a closed connection
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.email, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.email, None)
+
+    def publish(self, email: str, message: dict) -> int:
+        """
+        Queue message to the connections of email and return their number.
+        Safe from any thread: the queues are fed in their event loops.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(normalize_email(email), ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+            except RuntimeError:
+                # The loop of the connection is closed
+                self.unsubscribe(subscription)
+        return len(subscriptions)
+
+    @property
+    def connections(self) -> int:
+        """
+        Return the number of open connections
+        """
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+BROKER = Broker()
+
+metrics.gauge("push_connections", "Connections open on /ws/notifications.",
+              lambda: BROKER.connections)
+
+
+def push(postgres_db: PostgresDatabase, email: str, event: str, payload: dict = None):
+    """
+    Send event to the connections of email on every worker, at the commit
+    of the current transaction of postgres_db
+    """
+    message = json.dumps({"email": email, "event": event, "payload": payload or {}},
+                         default=str)
+    postgres_db.execute(sql.SQL(PUSH_NOTIFY_QUERY), (PUSH_CHANNEL, message))
+
+
+def _listen_dsns() -> list:
+    """
+    Return the DSNs of the databases notifying: the main database, None,
+    and the shards, whose outboxes notify the change events
+    """
+    dsns = [None]
+    if SHARDS is not None:
+        for shard in SHARDS.shard_map.shards.values():
+            if shard["dsn"] not in dsns:
+                dsns.append(shard["dsn"])
+    return dsns
+
+
+class PushListener(threading.Thread):
+    """
+    Thread listening to the push and change event channels, forwarding the
+    messages to a broker
+    """
+
+    def __init__(self, broker: Broker = BROKER, dsns: list = None,
+                 channels: tuple = (PUSH_CHANNEL, OUTBOX_CHANNEL)):
+        """
+        Attrs:
+            broker (Broker): The broker receiving the messages
+            dsns (list): The databases to listen to, None for the main one
+            channels (tuple): The channels listened to
+        """
+        super().__init__(name="push-listener", daemon=True)
+        self.broker = broker
+        self.dsns = dsns if dsns is not None else _listen_dsns()
+        self.channels = channels
+        self.stopped = threading.Event()
+        self.listening = threading.Event()
+        # Every notification committed before was received
+        self._received_at = None
+
+    def dispatch(self, channel: str, payload: str) -> int:
+        """
+        Forward the notification payload of channel and return the number
+        of connections it is queued to
+        """
+        try:
+            message = json.loads(payload)
+            email, event = message["email"], message["event"]
+        except (ValueError, TypeError, KeyError):
+            LOGGER.warning("Ignored a malformed notification on %s", channel)
+            return 0
+        if channel == OUTBOX_CHANNEL:
+            if event == "notification.updated":
+                PREFERENCES_CACHE.pop(normalize_email(email))
+            elif event.startswith("sighting."):
+                apply_sighting_event(event, message.get("payload", {}))
+            if event not in PUSHED_EVENTS:
+                return 0
+        return self.broker.publish(email, {
+            "event": event,
+            "payload": message.get("payload", {}),
+            **({"id": message["id"]} if "id" in message else {}),
+        })
+
+    def _connect(self) -> list:
+        """
+        Open the listening connections, outside of any transaction
+        """
+        connections = []
+        for dsn in self.dsns:
+            connection = PostgresDatabase(dsn=dsn).connection
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                for channel in self.channels:
+                    cursor.execute(sql.SQL(PUSH_LISTEN_QUERY).format(
+                        channel=sql.Identifier(channel)))
+            connections.append(connection)
+        return connections
+
+    def listen_once(self, connections: list, timeout: float = LISTEN_TIMEOUT) -> int:
+        """
+        Wait up to timeout for notifications, forward them and return how
+        many were received
+        """
+        ready, _, _ = select.select(connections, [], [], timeout)
+        received = 0
+        for connection in ready:
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                self.dispatch(notify.channel, notify.payload)
+                received += 1
+        return received
+
+    def run(self):
+        """
+        Listen until stopped, connecting again after a failure. The
+        sightings changed since the last notifications received are indexed
+        once listening again.
+        """
+        self._received_at = datetime.utcnow()
+        while not self.stopped.is_set():
+            connections = []
+            try:
+                connections = self._connect()
+                self.listening.set()
+                sync_index(self._received_at)
+                while not self.stopped.is_set():
+                    listened_at = datetime.utcnow()
+                    self.listen_once(connections)
+                    self._received_at = listened_at
+            except (psycopg2.Error, OSError):
+                LOGGER.exception("Push listener failed, reconnecting in %s seconds",
+                                 RECONNECT_DELAY)
+                self.stopped.wait(RECONNECT_DELAY)
+            finally:
+                for connection in connections:
+                    connection.close()
+
+    def stop(self):
+        """
+        Stop listening, within LISTEN_TIMEOUT
+        """
+        self.stopped.set()
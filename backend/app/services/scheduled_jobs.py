@@ -0,0 +1,55 @@
+"""
+Recurring jobs of the application, registered when imported by the
+processes running the jobs. Times are UTC.
+
+Attributes:
+    - sweep_sessions (function): Remove the expired sessions, every 5 minutes.
+    - send_digests (function): Queue and send the digests of the previous day.
+    - purge_digests (function): Delete the old sent digests, daily.
+    - purge_outbox (function): Delete the old published events, daily.
+"""
+from datetime import date, datetime, timedelta
+import logging
+
+from app.services.digest import DigestEngine
+from app.services.jobs import job
+from app.services.outbox import OutboxRelay
+from app.services.session_store import SESSION_STORE
+
+LOGGER = logging.getLogger(__name__)
+
+
+@job("sessions.sweep", cron="*/5 * * * *")
+def sweep_sessions(_payload: dict):
+    """
+    Remove the expired sessions
+    """
+    LOGGER.info("Swept %s expired sessions", SESSION_STORE.sweep())
+
+
+@job("digest.run", cron="0 6 * * *")
+def send_digests(payload: dict):
+    """
+    Queue and send the digests of payload["date"], yesterday by default.
+    A run already finished queues nothing again.
+    """
+    day = (date.fromisoformat(payload["date"]) if "date" in payload
+           else datetime.utcnow().date() - timedelta(days=1))
+    queued, sent = DigestEngine().run(day)
+    LOGGER.info("Queued %s digests of %s, sent %s", queued, day, sent)
+
+
+@job("digest.purge", cron="30 3 * * *")
+def purge_digests(_payload: dict):
+    """
+    Delete the digests sent before the retention
+    """
+    LOGGER.info("Deleted %s sent digests", DigestEngine().purge())
+
+
+@job("outbox.purge", cron="45 3 * * *")
+def purge_outbox(_payload: dict):
+    """
+    Delete the events published before the retention
+    """
+    LOGGER.info("Deleted %s published events", OutboxRelay().purge())
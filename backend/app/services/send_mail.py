@@ -4,7 +4,14 @@ This file contains the function to send an email to the user.
 Attributes:
     - recipient (str): The email address used for sending emails.
     - template_data (dict): contains the reset link
+    - MailError (class): The mail server cannot be reached or refused the emails.
+    - build_html_message (function): build an HTML email.
+    - smtp_session (function): open an authenticated SMTP session.
+    - send_mails (function): send several emails through one SMTP session.
+    - send_messages (function): send several built emails through one SMTP session.
+    - send_recovery_mails (function): send the reset links of several users.
 """
+from contextlib import contextmanager
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -12,16 +19,29 @@ from fastapi import HTTPException
 from app.resources.required_packages import (
     FROM_EMAIL, SMTP_PASSWORD, SMTP_PORT, SMTP_SERVER, SMTP_USERNAME)
 
-def send_mail(recipient: str, template_data: dict):
+
+class MailError(Exception):
     """
-    Function to send an email using SMTP.
+    Raised when the mail server cannot be reached or refuses the emails
+    """
+
+
+def build_html_message(recipient: str, subject: str, html: str) -> MIMEMultipart:
+    """
+    Build an email of recipient with an HTML body.
     """
-    # Create the email message
     msg = MIMEMultipart('alternative')
-    msg['Subject'] = "Password Reset"
+    msg['Subject'] = subject
     msg['From'] = FROM_EMAIL
     msg['To'] = recipient
+    msg.attach(MIMEText(html, 'html'))
+    return msg
 
+
+def build_message(recipient: str, template_data: dict) -> MIMEMultipart:
+    """
+    Build the password reset email of recipient.
+    """
     # Create the body of the message (HTML)
     html = f"""
     <html>
@@ -32,8 +52,14 @@ def send_mail(recipient: str, template_data: dict):
     </body>
     </html>
     """
-    part = MIMEText(html, 'html')
-    msg.attach(part)
+    return build_html_message(recipient, "Password Reset", html)
+
+
+def send_mail(recipient: str, template_data: dict):
+    """
+    Function to send an email using SMTP.
+    """
+    msg = build_message(recipient, template_data)
 
     try:
         # Connect to the server
@@ -49,6 +75,45 @@ def send_mail(recipient: str, template_data: dict):
             status_code=500, detail=error_message
         ) from original_exception
 
+def send_mails(messages: list):
+    """
+    Send (recipient, template_data) messages through one SMTP session.
+
+    Raises:
+        MailError: The server cannot be reached or refused an email.
+    """
+    return send_messages([build_message(recipient, template_data)
+                          for recipient, template_data in messages])
+
+@contextmanager
+def smtp_session():
+    """
+    Open an authenticated SMTP session.
+
+    Raises:
+        MailError: The server cannot be reached, or an email sent in the
+            session is refused.
+    """
+    try:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+            server.starttls()
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
+            yield server
+    except (smtplib.SMTPException, OSError) as original_exception:
+        raise MailError(str(original_exception)) from original_exception
+
+def send_messages(messages: list):
+    """
+    Send built messages through one SMTP session.
+
+    Raises:
+        MailError: The server cannot be reached or refused an email.
+    """
+    with smtp_session() as server:
+        for msg in messages:
+            server.sendmail(FROM_EMAIL, msg['To'], msg.as_string())
+    return 200
+
 def send_recovery_mail(token, host, email: str, first_name: str, lang: str):
     """
     Create a reset link and send it to the user.
@@ -66,3 +131,21 @@ def send_recovery_mail(token, host, email: str, first_name: str, lang: str):
     print(reset_link)
     # send_mail(recipient, template_data)
     return 200
+
+def send_recovery_mails(recoveries: list):
+    """
+    Create the reset links of several users and send them together.
+
+    - recoveries (list): dicts with the send_recovery_mail arguments.
+    """
+    messages = []
+    for recovery in recoveries:
+        reset_link = f"{recovery['host']}/reset-password/{recovery['token']}"
+        messages.append((recovery["email"], {
+            "link": reset_link,
+            "first_name": recovery["first_name"],
+            "lang": recovery["lang"],
+        }))
+    if not messages:
+        return 200
+    return send_mails(messages)
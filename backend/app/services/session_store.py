@@ -0,0 +1,375 @@
+"""
+Stores of the user sessions.
+
+A user has one session per device. Logging in again on the same device
+replaces its session, logging in on another device adds one. Sessions
+expire on their own and are swept at most every SESSION_SWEEP_INTERVAL seconds.
+Writes that are not critical can be written behind, see PostgresSessionStore.
+
+Attributes:
+    - SessionStore (class): The interface of the session stores.
+    - MemorySessionStore (class): Sessions kept in the process, for tests and a single worker.
+    - PostgresSessionStore (class): Sessions kept in the user_sessions table.
+    - RedisSessionStore (class): Sessions kept in a server speaking the Redis protocol.
+    - get_session_store (function): Build the store of a backend.
+    - SESSION_STORE (SessionStore): The store configured by SESSION_BACKEND.
+"""
+from datetime import datetime, timedelta
+import itertools
+import secrets
+import threading
+import time
+
+from psycopg2 import sql
+
+from app.resources.required_packages import (
+    PostgresDB, PostgresDatabase, SESSION_BACKEND, SESSION_REDIS_URL,
+    SESSION_SWEEP_INTERVAL)
+from app.resources.db_utils.session_queries import (
+    SESSION_UPSERT_QUERY, IS_SESSION_ACTIVE_QUERY, HAS_ACTIVE_SESSION_QUERY,
+    END_SESSION_QUERY, END_USER_SESSIONS_QUERY, SWEEP_SESSIONS_QUERY,
+    SESSION_BULK_UPSERT_QUERY, END_SESSIONS_QUERY, SESSIONS_SEEN_QUERY)
+from app.services.outbox import outbox_row, record, record_many
+from app.services.write_behind import WriteBehindBuffer
+
+
+def _ended_events(rows) -> list:
+    """
+    Return the outbox rows of the (sid, email, device) of ended sessions
+    """
+    return [outbox_row("session.ended", email, {"sid": sid, "device": device})
+            for sid, email, device in rows]
+
+
+class SessionStore:
+    """
+    Interface of the session stores.
+    """
+
+    sweep_interval: float = SESSION_SWEEP_INTERVAL
+    _last_sweep: float = 0.0
+
+    def create(self, email: str, device: str, ttl: timedelta, sync: bool = True) -> str:
+        """
+        Open a session of email on device for ttl and return its id.
+        Unless sync, the store may write it behind.
+        """
+        sid = secrets.token_urlsafe(24)
+        if sync:
+            self._create(sid, email, device, ttl)
+        else:
+            self._create_later(sid, email, device, ttl)
+        self.maybe_sweep()
+        return sid
+
+    def maybe_sweep(self):
+        """
+        Sweep expired sessions if the last sweep is older than sweep_interval
+        """
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            self.sweep()
+
+    def _create(self, sid: str, email: str, device: str, ttl: timedelta):
+        raise NotImplementedError
+
+    def _create_later(self, sid: str, email: str, device: str, ttl: timedelta):
+        # Stores without write-behind buffer write at once
+        self._create(sid, email, device, ttl)
+
+    def is_active(self, sid: str) -> bool:
+        """
+        Return True if the session sid exists and has not expired
+        """
+        raise NotImplementedError
+
+    def has_active(self, email: str) -> bool:
+        """
+        Return True if email has at least one live session
+        """
+        raise NotImplementedError
+
+    def end(self, sid: str, sync: bool = True):
+        """
+        End the session sid. Unless sync, the store may write it behind.
+        """
+        if sync:
+            self._end(sid)
+        else:
+            self._end_later(sid)
+
+    def _end(self, sid: str):
+        raise NotImplementedError
+
+    def _end_later(self, sid: str):
+        self._end(sid)
+
+    def touch(self, sid: str):
+        """
+        Record that the session sid is used now. Stores that do not keep
+        the last use of the sessions ignore it.
+        """
+
+    def end_all(self, email: str):
+        """
+        End every session of email
+        """
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """
+        Remove expired sessions and return how many were removed
+        """
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions kept in a dictionary of the process.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def _create(self, sid, email, device, ttl):
+        expires_at = time.time() + ttl.total_seconds()
+        with self._lock:
+            devices = self._by_user.setdefault(email, {})
+            previous = devices.get(device)
+            if previous is not None:
+                self._sessions.pop(previous, None)
+            devices[device] = sid
+            self._sessions[sid] = (email, device, expires_at)
+
+    def is_active(self, sid):
+        session = self._sessions.get(sid)
+        return session is not None and session[2] > time.time()
+
+    def has_active(self, email):
+        with self._lock:
+            sids = list(self._by_user.get(email, {}).values())
+        return any(self.is_active(sid) for sid in sids)
+
+    def _end(self, sid):
+        with self._lock:
+            self._remove(sid)
+
+    def end_all(self, email):
+        with self._lock:
+            for sid in self._by_user.pop(email, {}).values():
+                self._sessions.pop(sid, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, session in self._sessions.items() if session[2] <= now]
+            for sid in expired:
+                self._remove(sid)
+        return len(expired)
+
+    def _remove(self, sid):
+        session = self._sessions.pop(sid, None)
+        if session is None:
+            return
+        email, device, _ = session
+        devices = self._by_user.get(email, {})
+        if devices.get(device) == sid:
+            del devices[device]
+        if not devices:
+            self._by_user.pop(email, None)
+
+
+class PostgresSessionStore(SessionStore):
+    """
+    Sessions kept in the user_sessions table, away from the users rows.
+
+    Writes that are not sync, and the last use of the sessions, go through a
+    write-behind buffer: they are coalesced per device, or per session, and
+    flushed in batched statements. Until then, the sessions they create or
+    end are answered from the process. Sessions created and ended write
+    their outbox events in the same transaction, expired sessions do not.
+    Flushes may run in the thread of the WriteBehindFlusher: they write
+    through flush_db, a connection of the store by default.
+    """
+
+    def __init__(self, postgres_db: PostgresDatabase = PostgresDB,
+                 flush_db: PostgresDatabase = None):
+        self.db = postgres_db
+        self.flush_db = flush_db
+        self.writes = WriteBehindBuffer(self._flush)
+        # {sid: (email, expires_at)} of the sessions with a pending write,
+        # expires_at None once ended
+        self._local = {}
+
+    def _end_sessions(self, query: str, params: tuple):
+        """Delete sessions with the outbox events of the sessions deleted"""
+        self.db.execute(sql.SQL(query), params)
+        record_many(self.db, _ended_events(self.db.fetch_all()))
+        self.db.commit()
+
+    def _exists(self, query: str, params: tuple) -> bool:
+        self.db.execute(sql.SQL(query), params)
+        return self.db.fetch_one() is not None
+
+    def _create(self, sid, email, device, ttl):
+        now = datetime.utcnow()
+        self.db.execute(sql.SQL(SESSION_UPSERT_QUERY), (sid, email, device, now, now + ttl))
+        record(self.db, "session.created", email,
+               {"sid": sid, "device": device, "expires_at": now + ttl})
+        self.db.commit()
+
+    def _create_later(self, sid, email, device, ttl):
+        now = datetime.utcnow()
+        previous = self.writes.get(("create", email, device))
+        if previous is not None:
+            # Replaced before being written
+            self._local[previous[0]] = (email, None)
+        self._local[sid] = (email, now + ttl)
+        self.writes.put(("create", email, device), (sid, email, device, now, now + ttl))
+
+    def is_active(self, sid):
+        local = self._local.get(sid)
+        if local is not None:
+            return local[1] is not None and local[1] > datetime.utcnow()
+        return self._exists(IS_SESSION_ACTIVE_QUERY, (sid, datetime.utcnow()))
+
+    def has_active(self, email):
+        now = datetime.utcnow()
+        if any(local_email == email and expires_at is not None and expires_at > now
+               for local_email, expires_at in list(self._local.values())):
+            return True
+        return self._exists(HAS_ACTIVE_SESSION_QUERY, (email, now))
+
+    def _end(self, sid):
+        self._end_sessions(END_SESSION_QUERY, (sid,))
+
+    def _end_later(self, sid):
+        email = self._local.get(sid, (None, None))[0]
+        self._local[sid] = (email, None)
+        self.writes.put(("end", sid), (sid,))
+
+    def end_all(self, email):
+        # Sessions still in the buffer are never written
+        for _, (sid, *_) in self.writes.discard(
+                lambda key, _value: key[0] == "create" and key[1] == email):
+            self._local.pop(sid, None)
+        self._end_sessions(END_USER_SESSIONS_QUERY, (email,))
+
+    def touch(self, sid):
+        self.writes.put(("seen", sid), (sid, datetime.utcnow()))
+
+    def _flush(self, items: list):
+        """
+        Write the buffered writes, runs of the same kind in one statement,
+        and the outbox events of the sessions created and ended
+        """
+        queries = {"create": SESSION_BULK_UPSERT_QUERY, "end": END_SESSIONS_QUERY,
+                   "seen": SESSIONS_SEEN_QUERY}
+        if self.flush_db is None:
+            # Opened on the first flush, not shared with the requests
+            self.flush_db = PostgresDatabase()
+        events = []
+        try:
+            for kind, run in itertools.groupby(items, key=lambda item: item[0][0]):
+                values = [value for _, value in run]
+                rows = self.flush_db.execute_values(sql.SQL(queries[kind]), values,
+                                                    page_size=len(values), fetch=kind == "end")
+                if kind == "create":
+                    events.extend(
+                        outbox_row("session.created", email,
+                                   {"sid": sid, "device": device, "expires_at": expires_at})
+                        for sid, email, device, _, expires_at in values)
+                elif kind == "end":
+                    events.extend(_ended_events(rows))
+            record_many(self.flush_db, events)
+            self.flush_db.commit()
+        except Exception:
+            self.flush_db.rollback()
+            raise
+        # Written sessions are read from the table again
+        pending = {value[0] for value in self.writes.values()}
+        for _, value in items:
+            if value[0] not in pending:
+                self._local.pop(value[0], None)
+
+    def sweep(self):
+        self.db.execute(sql.SQL(SWEEP_SESSIONS_QUERY), (datetime.utcnow(),))
+        removed = self.db.cursor.rowcount
+        self.db.commit()
+        return removed
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions kept in a server speaking the Redis protocol.
+
+    "session:<sid>" holds the email and device of a session and expires with it.
+    "user_sessions:<email>" maps each device of a user to its session id,
+    entries of expired sessions are removed by sweep.
+    """
+
+    def __init__(self, client=None, url: str = SESSION_REDIS_URL):
+        if client is None:
+            import redis  # pylint: disable=import-outside-toplevel
+
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+
+    def _create(self, sid, email, device, ttl):
+        user_key = f"user_sessions:{email}"
+        previous = self.client.hget(user_key, device)
+        pipe = self.client.pipeline()
+        if previous:
+            pipe.delete(f"session:{previous}")
+        pipe.hset(f"session:{sid}", mapping={"email": email, "device": device})
+        pipe.expire(f"session:{sid}", ttl)
+        pipe.hset(user_key, device, sid)
+        pipe.execute()
+
+    def is_active(self, sid):
+        return bool(self.client.exists(f"session:{sid}"))
+
+    def has_active(self, email):
+        sids = self.client.hvals(f"user_sessions:{email}")
+        return any(self.is_active(sid) for sid in sids)
+
+    def _end(self, sid):
+        session = self.client.hgetall(f"session:{sid}")
+        pipe = self.client.pipeline()
+        pipe.delete(f"session:{sid}")
+        if session:
+            pipe.hdel(f"user_sessions:{session['email']}", session["device"])
+        pipe.execute()
+
+    def end_all(self, email):
+        user_key = f"user_sessions:{email}"
+        sids = self.client.hvals(user_key)
+        self.client.delete(user_key, *[f"session:{sid}" for sid in sids])
+
+    def sweep(self):
+        # Sessions expire on the server, only the device indexes are cleaned
+        removed = 0
+        for user_key in self.client.scan_iter(match="user_sessions:*"):
+            for device, sid in self.client.hgetall(user_key).items():
+                if not self.is_active(sid):
+                    removed += self.client.hdel(user_key, device)
+        return removed
+
+
+def get_session_store(backend: str) -> SessionStore:
+    """
+    Build the session store of backend ("memory", "postgres" or "redis")
+    """
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "postgres":
+        return PostgresSessionStore()
+    if backend == "redis":
+        return RedisSessionStore()
+    raise ValueError(f"Unknown session backend '{backend}'")
+
+
+SESSION_STORE = get_session_store(SESSION_BACKEND)
@@ -0,0 +1,171 @@
+"""
+Write-behind buffer of low-value writes.
+
+Writes are put under a key and coalesced: a write replaces the pending write
+of its key, so a burst of updates of the same row costs one row write. The
+pending writes are flushed together, in the order their keys were last
+written, once WRITE_BEHIND_INTERVAL seconds have passed since the previous
+flush, when WRITE_BEHIND_MAX_PENDING keys are pending, and on shutdown.
+Flushes run in the requests writing to the buffer and in the thread of the
+WriteBehindFlusher, so a write left alone is still written in about
+WRITE_BEHIND_INTERVAL seconds. The flush callable of a buffer writing to
+the database uses a connection of its own, not the one of the requests.
+
+Attributes:
+    - WriteBehindBuffer (class): The buffer of the writes of a store.
+    - WriteBehindFlusher (class): Thread flushing the buffers that are due.
+    - flush_due (function): Flush the buffers whose interval has passed.
+    - flush_all (function): Flush every buffer, on shutdown.
+"""
+import logging
+import threading
+import time
+import weakref
+
+from app.resources.required_packages import WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_PENDING
+
+_BUFFERS = weakref.WeakSet()
+LOGGER = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Pending writes by key, flushed by a callable receiving the list of
+    (key, value) in write order
+    """
+
+    def __init__(self, flush, interval: float = WRITE_BEHIND_INTERVAL,
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING):
+        self._flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        _BUFFERS.add(self)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, value):
+        """
+        Replace the pending write of key, then flush if due
+        """
+        with self._lock:
+            # Moved last: the flush keeps the order of the latest writes
+            self._pending.pop(key, None)
+            self._pending[key] = value
+        self.maybe_flush()
+
+    def get(self, key, default=None):
+        """
+        Return the pending write of key
+        """
+        return self._pending.get(key, default)
+
+    def values(self) -> list:
+        """
+        Return the pending writes
+        """
+        return list(self._pending.values())
+
+    def discard(self, predicate) -> list:
+        """
+        Drop the pending writes whose (key, value) match predicate and return them
+        """
+        with self._lock:
+            dropped = [(key, value) for key, value in self._pending.items()
+                       if predicate(key, value)]
+            for key, _ in dropped:
+                del self._pending[key]
+        return dropped
+
+    def maybe_flush(self):
+        """
+        Flush if the interval has passed or too many writes are pending
+        """
+        if not self._pending:
+            return
+        if (len(self._pending) >= self.max_pending
+                or time.monotonic() - self._last_flush >= self.interval):
+            # The request writing to the buffer does not fail for older writes
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Write-behind flush failed, %d writes pending", len(self))
+
+    def flush(self) -> int:
+        """
+        Write the pending writes and return how many were written. If the
+        flush fails, the writes not replaced meanwhile are pending again.
+        """
+        # A single flush at a time keeps the writes in order
+        with self._flush_lock:
+            with self._lock:
+                items = list(self._pending.items())
+                self._pending = {}
+            self._last_flush = time.monotonic()
+            if not items:
+                return 0
+            try:
+                self._flush(items)
+            except Exception:
+                with self._lock:
+                    self._pending = {**dict(items), **self._pending}
+                raise
+        return len(items)
+
+
+def flush_due():
+    """
+    Flush the buffers whose interval has passed
+    """
+    for buffer in list(_BUFFERS):
+        buffer.maybe_flush()
+
+
+class WriteBehindFlusher:
+    """
+    Thread flushing the due buffers, without waiting for their next write
+    """
+
+    def __init__(self, interval: float = WRITE_BEHIND_INTERVAL):
+        """
+        Attrs:
+            interval (float): The interval of the buffers, checked twice per interval
+        """
+        self.interval = interval
+        self.stopped = threading.Event()
+        self._thread = None
+
+    def run(self):
+        """
+        Flush the due buffers until stopped
+        """
+        while not self.stopped.wait(self.interval / 2):
+            flush_due()
+
+    def start(self):
+        """
+        Flush in a thread of the worker
+        """
+        self.stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop flushing, the pending writes are left to flush_all
+        """
+        self.stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def flush_all():
+    """
+    Flush every buffer, on shutdown
+    """
+    for buffer in list(_BUFFERS):
+        buffer.flush()
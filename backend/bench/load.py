@@ -0,0 +1,276 @@
+"""
+HTTP load test of the authentication API.
+
+Drives main.app in process (or a running server with --url) with a number of
+concurrent clients and reports, per endpoint, the requests per second and
+the p50/p95/p99 latencies. Results are saved as JSON and can be compared
+with a previous run to fail on regressions.
+
+The database is either the Postgres server configured in .env (--db postgres)
+or an in-memory SQLite stand-in (--db fake, the default). Mails are not sent.
+
+Usage:
+    python -m bench.load --concurrency 16 --requests 200 --output run.json
+    python -m bench.load --baseline main.json --max-regression 0.15
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+
+ENDPOINTS = ("register", "login", "update", "protected")
+PASSWORD = "bench-password"
+
+
+def percentile(sorted_values: list, rank: float) -> float:
+    """
+    Nearest rank percentile of already sorted values
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(rank * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    """
+    Build the statistics of one endpoint, latencies in milliseconds
+    """
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+    }
+
+
+def load_app(db_backend: str):
+    """
+    Import main.app on top of the chosen database
+    """
+    if db_backend == "fake":
+        import fake_postgres  # pylint: disable=import-outside-toplevel
+
+        fake_postgres.install()
+
+    # pylint: disable=import-outside-toplevel
+    from fastapi import Depends
+    import main
+    from app.controllers import auth
+    from app.resources.dependencies import oauth2_scheme_session
+
+    # Mails are not part of the measure
+    auth.send_recovery_mail = lambda **kwargs: 200
+
+    @main.app.get("/bench/protected", dependencies=[Depends(oauth2_scheme_session)])
+    def protected():
+        return {"message": "ok"}
+
+    return main.app
+
+
+def seed_users(count: int, run_id: str) -> list:
+    """
+    Create active users able to log in and return their emails
+    """
+    # pylint: disable=import-outside-toplevel
+    from app.models.user import User
+    from app.resources.type.status import Status
+
+    emails = []
+    for index in range(count):
+        email = f"bench-{run_id}-{index}@cleancomm.com"
+        user = User(email=email, password=PASSWORD, host="http://bench",
+                    first_name="Bench", last_name=str(index), lang="en")
+        if not user.select():
+            user.create()
+        user.update({"password": PASSWORD, "status": Status.ACTIVE.value})
+        emails.append(email)
+    return emails
+
+
+class LoadTest:
+    """
+    Run the scenarios of the API against a client.
+
+    Attributes:
+        client (httpx.AsyncClient): The client of the API.
+        concurrency (int): The number of requests in flight.
+        requests (int): The number of requests sent per endpoint.
+        emails (list): The emails of the seeded users.
+    """
+
+    def __init__(self, client, concurrency: int, requests: int, emails: list, run_id: str):
+        self.client = client
+        self.concurrency = concurrency
+        self.requests = requests
+        self.emails = emails
+        self.run_id = run_id
+        self.tokens = []
+
+    async def _run(self, send) -> dict:
+        """
+        Call send(index) self.requests times with self.concurrency workers
+        """
+        latencies, errors = [], 0
+        pending = iter(range(self.requests))
+
+        async def worker():
+            nonlocal errors
+            for index in pending:
+                start = time.perf_counter()
+                response = await send(index)
+                duration = (time.perf_counter() - start) * 1000
+                if response.status_code == 200:
+                    latencies.append(duration)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return summarize(latencies, errors, time.perf_counter() - start)
+
+    def _email(self, index: int) -> str:
+        return self.emails[index % len(self.emails)]
+
+    async def register(self, index: int):
+        """POST /user/register with a new email"""
+        data = {"email": f"bench-{self.run_id}-new-{index}@cleancomm.com",
+                "host": "http://bench", "first_name": "Bench",
+                "last_name": str(index), "lang": "en"}
+        return await self.client.post("/user/register", json={"data": data})
+
+    async def login(self, index: int):
+        """POST /user/login, keep the tokens for the protected routes"""
+        response = await self.client.post(
+            "/user/login",
+            data={"username": self._email(index), "password": PASSWORD,
+                  "client_id": f"bench-device-{index}"},
+        )
+        if response.status_code == 200 and len(self.tokens) < len(self.emails):
+            self.tokens.append(response.json()["access_token"])
+        return response
+
+    def _headers(self, index: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[index % len(self.tokens)]}"}
+
+    async def update(self, index: int):
+        """POST /user/update on the profile of a logged in user"""
+        return await self.client.post("/user/update",
+                                      json={"data": {"first_name": f"Bench{index}"}},
+                                      headers=self._headers(index))
+
+    async def protected(self, index: int):
+        """GET a route that only checks the token and its session"""
+        return await self.client.get("/bench/protected", headers=self._headers(index))
+
+    async def run(self, endpoints) -> dict:
+        """
+        Run the endpoints in order, logging in first when the protected
+        routes run without a login measure
+        """
+        results = {}
+        for endpoint in ENDPOINTS:
+            if endpoint not in endpoints:
+                continue
+            if endpoint in ("update", "protected") and not self.tokens:
+                await self._run(self.login)
+            results[endpoint] = await self._run(getattr(self, endpoint))
+        return results
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """
+    Return the regressions of results against baseline beyond max_regression
+    """
+    regressions = []
+    for endpoint, current in results.items():
+        previous = baseline.get("results", {}).get(endpoint)
+        if not previous:
+            continue
+        if previous["rps"] and current["rps"] < previous["rps"] * (1 - max_regression):
+            regressions.append(f"{endpoint}: rps {previous['rps']} -> {current['rps']}")
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if previous[key] and current[key] > previous[key] * (1 + max_regression):
+                regressions.append(f"{endpoint}: {key} {previous[key]} -> {current[key]}")
+    return regressions
+
+
+async def main(args) -> dict:
+    """
+    Run the load test and return the report
+    """
+    run_id = uuid.uuid4().hex[:8]
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+        emails = args.emails.split(",") if args.emails else []
+    else:
+        app = load_app(args.db)
+        emails = seed_users(args.users, run_id)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                   base_url="http://bench", timeout=60)
+
+    async with client:
+        load_test = LoadTest(client, args.concurrency, args.requests, emails, run_id)
+        results = await load_test.run(args.endpoints)
+
+    return {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "db": "server" if args.url else args.db,
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "users": len(emails),
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(description="Load test of the authentication API.")
+    parser.add_argument("--db", choices=("fake", "postgres"), default="fake",
+                        help="Database used by the in process app.")
+    parser.add_argument("--url", default="",
+                        help="Target a running server instead of the in process app.")
+    parser.add_argument("--emails", default="",
+                        help="With --url, comma separated active users with the bench password.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="Requests sent per endpoint.")
+    parser.add_argument("--users", type=int, default=10, help="Users seeded for login.")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--output", default="", help="Save the report as JSON.")
+    parser.add_argument("--baseline", default="", help="Report of a previous run.")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Allowed relative regression against the baseline.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    REPORT = asyncio.run(main(ARGS))
+    print(json.dumps(REPORT, indent=2))
+    if ARGS.output:
+        with open(ARGS.output, "w", encoding="utf-8") as output_file:
+            json.dump(REPORT, output_file, indent=2)
+    if ARGS.baseline:
+        with open(ARGS.baseline, "r", encoding="utf-8") as baseline_file:
+            REGRESSIONS = compare(REPORT["results"], json.load(baseline_file),
+                                  ARGS.max_regression)
+        for regression in REGRESSIONS:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if REGRESSIONS else 0)
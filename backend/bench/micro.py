@@ -0,0 +1,207 @@
+"""
+Microbenchmarks of the functions called on every request.
+
+Each case runs against synthetic cursors of varied row counts and column
+widths, without database. Time is reported per call (best and median of
+the repeats) along with the memory allocated by one call: the peak traced
+by tracemalloc and what is still retained afterwards.
+
+Usage:
+    python -m bench.micro --output micro.json
+    python -m bench.micro --filter format_datas --baseline micro.json --max-regression 0.2
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+
+import fake_postgres
+
+ROW_COUNTS = (1, 100, 10000)
+COLUMN_WIDTHS = (10, 50)
+USER_COLUMNS = ("id", "email", "password", "host", "first_name", "last_name",
+                "lang", "created_date", "updated_date", "status")
+
+
+class SyntheticCursor:
+    """
+    Cursor returning width columns for rows rows
+    """
+
+    def __init__(self, rows: int, width: int):
+        extra = [f"extra_{index}" for index in range(max(0, width - len(USER_COLUMNS)))]
+        columns = (list(USER_COLUMNS) + extra)[:width]
+        self.description = [(column,) for column in columns]
+        row = (1, "bench@cleancomm.com", "b'hash'", "http://bench", "Bench", "User",
+               "en", datetime(2024, 1, 1), datetime(2024, 1, 1), 1)
+        row = (row + tuple(f"value_{index}" for index in range(len(extra))))[:width]
+        self.rows = [row] * rows
+
+
+class SyntheticDatabase:
+    """
+    PostgresDatabase answering every query with the rows of a SyntheticCursor
+    """
+
+    def __init__(self, rows: int, width: int):
+        self.cursor = SyntheticCursor(rows, width)
+
+    def execute(self, query, params=None):
+        """Queries are ignored"""
+
+    def fetch_one(self):
+        """Return the first row"""
+        return self.cursor.rows[0]
+
+    def fetch_all(self):
+        """Return every row"""
+        return self.cursor.rows
+
+
+def cases():
+    """
+    Yield (name, function) for every benchmark case
+    """
+    # pylint: disable=import-outside-toplevel
+    from app.models import user as user_module
+    from app.models.user import User, generate_password
+    from app.resources.db_utils.db_utils import format_data_from_db, format_datas_from_db
+    from app.resources.type.status import Status
+    from app.services.apphttpbearer import TOKEN_CACHE, decode_token
+
+    for width in COLUMN_WIDTHS:
+        database = SyntheticDatabase(1, width)
+        row = database.fetch_one()
+        yield (f"format_data_from_db[cols={width}]",
+               lambda database=database, row=row: format_data_from_db(database, row))
+
+        for rows in ROW_COUNTS:
+            database = SyntheticDatabase(rows, width)
+            data = database.fetch_all()
+            yield (f"format_datas_from_db[rows={rows},cols={width}]",
+                   lambda database=database, data=data: format_datas_from_db(database, data))
+
+    for width in COLUMN_WIDTHS:
+        database = SyntheticDatabase(1, max(width, len(USER_COLUMNS)))
+
+        def select(database=database):
+            user_module.PostgresDB = database
+            return User(email="bench@cleancomm.com").select()
+        yield f"User.select[cols={max(width, len(USER_COLUMNS))}]", select
+
+    user = User(email="bench@cleancomm.com", status=Status.ACTIVE)
+    yield ("User.generate_token",
+           lambda: user.generate_token(user.email, expiration_time=timedelta(days=1)))
+
+    token = user.generate_token(user.email, expiration_time=timedelta(days=1))
+
+    def decode_uncached():
+        TOKEN_CACHE.clear()
+        return decode_token(token)
+    yield "AppHttpBearer.decode[uncached]", decode_uncached
+    yield "AppHttpBearer.decode[cached]", lambda: decode_token(token)
+
+    fields = {"id": 1, "email": "bench@cleancomm.com", "host": "http://bench",
+              "first_name": "Bench", "last_name": "User", "lang": "en",
+              "created_date": None, "updated_date": None}
+    yield "User.setattr", lambda: User().setattr(**dict(fields))
+
+    for length in (20, 64):
+        yield (f"generate_password[length={length}]",
+               lambda length=length: generate_password(length))
+
+
+def measure(function, repeat: int) -> dict:
+    """
+    Time one call of function and trace the memory it allocates
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    per_call = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+
+    function()
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = function()
+        current, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "number": number,
+        "best_us": round(min(per_call) * 1e6, 3),
+        "median_us": round(statistics.median(per_call) * 1e6, 3),
+        "peak_bytes": peak - start,
+        "retained_bytes": current - start,
+    }
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """
+    Return the cases slower or allocating more than baseline beyond max_regression
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+        for key in ("median_us", "peak_bytes"):
+            if previous[key] and current[key] > previous[key] * (1 + max_regression):
+                regressions.append(f"{name}: {key} {previous[key]} -> {current[key]}")
+    return regressions
+
+
+def main(args) -> dict:
+    """
+    Run the selected cases and return the report
+    """
+    fake_postgres.install()
+    results = {}
+    for name, function in cases():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(function, args.repeat)
+        print(f"{name:45} {results[name]['median_us']:>12} us "
+              f"{results[name]['peak_bytes']:>12} B", file=sys.stderr)
+    return {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the hot functions.")
+    parser.add_argument("--filter", default="", help="Run only the cases containing this text.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="", help="Save the report as JSON.")
+    parser.add_argument("--baseline", default="", help="Report of a previous run.")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Allowed relative regression against the baseline.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    REPORT = main(ARGS)
+    if ARGS.output:
+        with open(ARGS.output, "w", encoding="utf-8") as output_file:
+            json.dump(REPORT, output_file, indent=2)
+    if ARGS.baseline:
+        with open(ARGS.baseline, "r", encoding="utf-8") as baseline_file:
+            REGRESSIONS = compare(REPORT["results"], json.load(baseline_file),
+                                  ARGS.max_regression)
+        for regression in REGRESSIONS:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if REGRESSIONS else 0)
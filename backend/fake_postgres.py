@@ -0,0 +1,378 @@
+"""
+In-memory stand-in for the Postgres server, backed by SQLite.
+
+The fake sits under psycopg2: the application keeps using the real
+PostgresDatabase class, whose connection is a FakeConnection running the
+statements of the db_utils queries on an in-memory SQLite engine. Every
+FakeConnection has its own database, so tests are isolated. The tests and
+the benchmarks both use it.
+
+Attributes:
+    - SCHEMA (str): The tables of the application, in SQLite syntax. The
+      CITEXT emails of the migrations are compared with NOCASE.
+    - FakeConnection (class): A psycopg2 like connection on SQLite, keeping
+      the pg_notify notifications it sends.
+    - FakeCursor (class): A psycopg2 like cursor translating the queries.
+    - fake_database (function): Build a PostgresDatabase on a FakeConnection.
+    - patch_modules (function): Make the application use a fake database.
+    - install (function): Make psycopg2.connect return a FakeConnection.
+"""
+from datetime import datetime
+import re
+import sqlite3
+import sys
+
+import psycopg2
+import psycopg2.errorcodes
+from psycopg2 import sql
+
+SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL UNIQUE COLLATE NOCASE,
+    password TEXT NOT NULL,
+    host TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    lang TEXT,
+    created_date TIMESTAMP NOT NULL,
+    updated_date TIMESTAMP NOT NULL,
+    status INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE notification (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_mail TEXT NOT NULL UNIQUE COLLATE NOCASE,
+    preferences INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE user_sessions (
+    sid TEXT PRIMARY KEY,
+    email TEXT NOT NULL COLLATE NOCASE,
+    device TEXT NOT NULL,
+    created_date TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    last_seen TIMESTAMP,
+    UNIQUE (email, device)
+);
+
+CREATE TABLE outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    email TEXT NOT NULL COLLATE NOCASE,
+    payload TEXT NOT NULL DEFAULT '{}',
+    created_date TIMESTAMP NOT NULL,
+    published_date TIMESTAMP
+);
+
+CREATE TABLE digest_runs (
+    run_date DATE PRIMARY KEY,
+    last_email TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    queued INTEGER NOT NULL DEFAULT 0,
+    started_date TIMESTAMP NOT NULL,
+    finished_date TIMESTAMP
+);
+
+CREATE TABLE digest_mail (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_date DATE NOT NULL,
+    email TEXT NOT NULL COLLATE NOCASE,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_date TIMESTAMP NOT NULL,
+    sent_date TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    locked_until TIMESTAMP,
+    last_error TEXT,
+    UNIQUE (run_date, email)
+);
+
+CREATE TABLE jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '{}',
+    run_at TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    locked_until TIMESTAMP,
+    locked_by TEXT,
+    last_error TEXT,
+    created_date TIMESTAMP NOT NULL
+);
+
+CREATE TABLE sightings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL COLLATE NOCASE,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    status INTEGER NOT NULL DEFAULT 1,
+    created_date TIMESTAMP NOT NULL,
+    updated_date TIMESTAMP NOT NULL,
+    duplicate_of INTEGER REFERENCES sightings (id)
+);
+
+CREATE TABLE sighting_photos (
+    sighting_id INTEGER NOT NULL REFERENCES sightings (id),
+    digest TEXT NOT NULL,
+    email TEXT NOT NULL COLLATE NOCASE,
+    created_date TIMESTAMP NOT NULL,
+    phash INTEGER,
+    PRIMARY KEY (sighting_id, digest)
+);
+
+CREATE TABLE job_schedules (
+    name TEXT PRIMARY KEY,
+    cron TEXT NOT NULL,
+    next_run_at TIMESTAMP NOT NULL
+);
+"""
+
+# Postgres syntax rewritten for SQLite, applied in order
+REWRITES = (
+    (re.compile(r"::\w+"), ""),
+    # Column names of a VALUES list: (VALUES ...) AS v (a, b)
+    (re.compile(r"\(VALUES (.*)\) AS (\w+) ?\(([\w, ]+)\)", re.DOTALL),
+     lambda match: "(SELECT " + ", ".join(
+         f"column{index} AS {name.strip()}"
+         for index, name in enumerate(match.group(3).split(","), 1))
+     + f" FROM (VALUES {match.group(1)})) AS {match.group(2)}"),
+    # SQLite serializes the writers, row locks are not needed
+    (re.compile(r"\s+FOR\s+(UPDATE|NO\s+KEY\s+UPDATE|SHARE|KEY\s+SHARE)"
+                r"(\s+(SKIP\s+LOCKED|NOWAIT))?", re.IGNORECASE), ""),
+)
+
+# Placeholders, only read when the query has params
+PARAM_REWRITES = (
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"%%"), "%"),
+)
+
+# EXPLAIN (FORMAT JSON) answers the exact row count as the planner estimate
+EXPLAIN_JSON = re.compile(r"^\s*EXPLAIN \(FORMAT JSON\)\s+(.*)$", re.DOTALL)
+
+PGCODES = (
+    ("UNIQUE constraint failed", psycopg2.errorcodes.UNIQUE_VIOLATION),
+    ("NOT NULL constraint failed", psycopg2.errorcodes.NOT_NULL_VIOLATION),
+    ("CHECK constraint failed", psycopg2.errorcodes.CHECK_VIOLATION),
+)
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "microseconds"))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class FakeIntegrityError(psycopg2.IntegrityError):
+    """
+    IntegrityError carrying the pgcode Postgres would have sent
+    """
+
+    def __init__(self, message: str, pgcode: str = None):
+        super().__init__(message)
+        self._pgcode = pgcode
+
+    @property
+    def pgcode(self):
+        return self._pgcode
+
+
+def render(query) -> str:
+    """
+    Return the text of a query given as str, bytes or psycopg2.sql object.
+    Composed queries are rendered here as as_string() needs a real connection.
+    """
+    if isinstance(query, sql.Composed):
+        return "".join(render(part) for part in query.seq)
+    if isinstance(query, sql.Identifier):
+        return ".".join('"' + name.replace('"', '""') + '"' for name in query.strings)
+    if isinstance(query, sql.Placeholder):
+        return "%s" if query.name is None else f"%({query.name})s"
+    if isinstance(query, sql.Literal):
+        return quote(query.wrapped)
+    if isinstance(query, sql.SQL):
+        return query.string
+    if isinstance(query, bytes):
+        return query.decode("utf-8")
+    return query
+
+
+def translate(query, with_params: bool = True) -> str:
+    """
+    Return the SQLite text of a query given as str, bytes or psycopg2.sql object.
+    As psycopg2 does, placeholders are only read when params are given.
+    """
+    text = render(query)
+    for pattern, replacement in REWRITES + (PARAM_REWRITES if with_params else ()):
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def quote(value) -> str:
+    """
+    Return value as a SQLite literal
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, datetime):
+        value = value.isoformat(" ", "microseconds")
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class FakeCursor:
+    """
+    psycopg2 like cursor running translated queries on SQLite
+    """
+
+    def __init__(self, connection, cursor: sqlite3.Cursor):
+        self.connection = connection
+        self._cursor = cursor
+        self._plan = None
+
+    @property
+    def description(self):
+        """Columns of the last query, None if it returned no rows"""
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        """Rows changed by the last query"""
+        return self._cursor.rowcount
+
+    def execute(self, query, params=None):
+        """Run query with params"""
+        text = translate(query, params is not None)
+        self._plan = None
+        explain = EXPLAIN_JSON.match(text)
+        if explain:
+            text = f"SELECT COUNT(*) FROM ({explain.group(1)})"
+        try:
+            self._cursor.execute(text, tuple(params or ()))
+            if explain:
+                self._plan = [([{"Plan": {"Plan Rows": self._cursor.fetchone()[0]}}],)]
+        except sqlite3.IntegrityError as exc:
+            message = str(exc)
+            pgcode = next((code for text, code in PGCODES if message.startswith(text)), None)
+            raise FakeIntegrityError(message, pgcode) from exc
+        except sqlite3.Error as exc:
+            raise psycopg2.DatabaseError(str(exc)) from exc
+
+    def mogrify(self, query, params) -> bytes:
+        """Return query with params inlined, used by psycopg2.extras"""
+        return (render(query) % tuple(quote(value) for value in params)).encode("utf-8")
+
+    def executemany(self, query, params_list):
+        """Run query once per params"""
+        for params in params_list:
+            self.execute(query, params)
+
+    def fetchone(self):
+        """Return the next row"""
+        if self._plan is not None:
+            return self._plan.pop(0) if self._plan else None
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        """Return the next size rows"""
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    def fetchall(self):
+        """Return the remaining rows"""
+        return self._cursor.fetchall()
+
+    def close(self):
+        """Close the cursor"""
+        self._cursor.close()
+
+
+class FakeConnection:
+    """
+    psycopg2 like connection on a private in-memory SQLite database
+    """
+
+    encoding = "UTF8"
+
+    def __init__(self, schema: str = SCHEMA):
+        self._connection = sqlite3.connect(
+            ":memory:", detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False
+        )
+        self._connection.executescript(schema)
+        # Postgres functions: a single client holds every lock, the
+        # notifications are kept to be read by the tests
+        self.notifications = []
+        self._connection.create_function("pg_try_advisory_xact_lock", 1, lambda key: 1)
+        self._connection.create_function(
+            "pg_notify", 2, lambda channel, payload: self.notifications.append((channel, payload)))
+        self.closed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def cursor(self, *args, **kwargs):
+        """Open a cursor"""
+        return FakeCursor(self, self._connection.cursor())
+
+    def commit(self):
+        """Commit the transaction"""
+        self._connection.commit()
+
+    def rollback(self):
+        """Roll back the transaction"""
+        self._connection.rollback()
+
+    def close(self):
+        """Close the database"""
+        self._connection.close()
+        self.closed = 1
+
+
+def fake_database():
+    """
+    Build a PostgresDatabase whose connection is a new FakeConnection
+    """
+    connect = psycopg2.connect
+    psycopg2.connect = lambda *args, **kwargs: FakeConnection()
+    try:
+        # pylint: disable=import-outside-toplevel
+        from app.resources.required_packages import PostgresDatabase
+
+        return PostgresDatabase()
+    finally:
+        psycopg2.connect = connect
+
+
+def patch_modules(monkeypatch, database):
+    """
+    Replace the PostgresDB singleton by database in every loaded app module
+    """
+    # pylint: disable=import-outside-toplevel
+    from app.resources import required_packages
+    from app.services import session_store
+
+    original = required_packages.PostgresDB
+    for name, module in list(sys.modules.items()):
+        if name.startswith("app.") and getattr(module, "PostgresDB", None) is original:
+            monkeypatch.setattr(module, "PostgresDB", database)
+    if isinstance(session_store.SESSION_STORE, session_store.PostgresSessionStore):
+        monkeypatch.setattr(session_store.SESSION_STORE, "db", database)
+        monkeypatch.setattr(session_store.SESSION_STORE, "flush_db", database)
+
+
+def install():
+    """
+    Make psycopg2.connect return one shared FakeConnection. Must run
+    before the application is imported.
+    """
+    connection = FakeConnection()
+    psycopg2.connect = lambda *args, **kwargs: connection
+    return connection
@@ -4,14 +4,57 @@
 CleanComm Project by Guy Ahonakpon GBAGUIDI
 """
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.controllers import auth
+from app.controllers import (
+    auth, metrics, notifications, sightings, users, websocket, well_known)
+from app.models.sighting import build_index as build_sighting_index
+from app.models.user import all_databases
+from app.resources.required_packages import JOBS_IN_PROCESS, PUSH_LISTEN
+from app.services.email_filter import EMAIL_FILTER
+from app.services.jobs import JobWorker
+from app.services import photos
+from app.services.push import LISTEN_TIMEOUT, PushListener
+from app.services import scheduled_jobs  # pylint: disable=unused-import
+from app.services.write_behind import WriteBehindFlusher, flush_all
 
 from logger import uvicorn_access_logger, uvicorn_errors_logger
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    Build the email filter, listen to the pushed messages then build the
+    sightings index, so that no sighting event is missed in between, flush
+    the write-behind buffers and run the jobs if JOBS_IN_PROCESS on startup,
+    write the buffered writes and stop the photo processes on shutdown
+    """
+    EMAIL_FILTER.build(all_databases())
+    listener = PushListener() if PUSH_LISTEN else None
+    if listener is not None:
+        listener.start()
+        # Not listening yet: the listener indexes the events missed once it is
+        listener.listening.wait(LISTEN_TIMEOUT)
+    build_sighting_index()
+    flusher = WriteBehindFlusher()
+    flusher.start()
+    worker = JobWorker() if JOBS_IN_PROCESS else None
+    if worker is not None:
+        worker.start()
+    yield
+    if worker is not None:
+        worker.stop()
+    if listener is not None:
+        listener.stop()
+    flusher.stop()
+    flush_all()
+    photos.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,6 +65,12 @@ app.add_middleware(
 )
 
 app.include_router(auth.AUTH)
+app.include_router(users.USERS)
+app.include_router(notifications.NOTIFICATIONS)
+app.include_router(sightings.SIGHTINGS)
+app.include_router(websocket.WEBSOCKET)
+app.include_router(well_known.WELL_KNOWN)
+app.include_router(metrics.METRICS)
 
 
 @app.get("/")
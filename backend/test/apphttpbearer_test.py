@@ -0,0 +1,110 @@
+"""
+Test of the AppHttpBearer token verification
+"""
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+SECRET_KEY = "secret-key"
+ALGORITHM = "HS256"
+TEST_EMAIL = "cleancomm@gmail.com"
+
+
+def make_token(expiration_time=timedelta(minutes=5)):
+    """Build a token signed with the test key"""
+    payload = {"sub": TEST_EMAIL, "status": 1, "iat": datetime.utcnow()}
+    if expiration_time is not None:
+        payload["exp"] = datetime.utcnow() + expiration_time
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+
+@pytest.fixture
+def token_cache():
+    """Empty the verified token cache around each test"""
+    from app.services.apphttpbearer import TOKEN_CACHE
+
+    TOKEN_CACHE.clear()
+    yield TOKEN_CACHE
+    TOKEN_CACHE.clear()
+
+
+def test_decode_token_is_cached(mocker, token_cache):
+    """
+    A token seen twice is verified only once.
+    """
+    from app.services import apphttpbearer
+
+    token = make_token()
+    spy = mocker.spy(apphttpbearer.jwt, "decode")
+
+    first = apphttpbearer.decode_token(token)
+    second = apphttpbearer.decode_token(token)
+
+    assert first == second
+    assert first["sub"] == TEST_EMAIL
+    assert spy.call_count == 1
+    assert len(token_cache) == 1
+
+
+def test_decode_token_returns_copy(token_cache):
+    """
+    Mutating returned claims does not alter the cached ones.
+    """
+    from app.services.apphttpbearer import decode_token
+
+    token = make_token()
+    decode_token(token)["sub"] = "other@cleancomm.com"
+    assert decode_token(token)["sub"] == TEST_EMAIL
+
+
+def test_decode_token_without_exp_not_cached(token_cache):
+    """
+    Tokens without expiration are verified every time.
+    """
+    from app.services.apphttpbearer import decode_token
+
+    decode_token(make_token(expiration_time=None))
+    assert len(token_cache) == 0
+
+
+def test_decode_token_expired_entry(mocker, token_cache):
+    """
+    A cached token is verified again once its exp has passed.
+    """
+    from app.services import apphttpbearer
+
+    token = make_token()
+    apphttpbearer.decode_token(token)
+    spy = mocker.spy(apphttpbearer.jwt, "decode")
+    mocker.patch("app.resources.cache.time.time", return_value=2**40)
+    apphttpbearer.decode_token(token)
+    assert spy.call_count == 1
+
+
+def test_decode_token_invalid(token_cache):
+    """
+    Invalid tokens raise and are not cached.
+    """
+    from app.services.apphttpbearer import decode_token
+
+    token = jwt.encode({"sub": TEST_EMAIL}, "wrong-key", algorithm=ALGORITHM)
+    with pytest.raises(jwt.InvalidTokenError):
+        decode_token(token)
+    assert len(token_cache) == 0
+
+
+def test_ttl_cache_is_bounded():
+    """
+    The least recently used entry is evicted when the cache is full.
+    """
+    from app.resources.cache import TTLCache
+
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1, 2**40)
+    cache.set("b", 2, 2**40)
+    cache.get("a")
+    cache.set("c", 3, 2**40)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
@@ -558,3 +558,19 @@ def test_update_profile_with_invalid_email(client, mock_user):
         "Incorrect code, error: " f'{response.json()["detail"]}'
     )
     assert response.json()["detail"] == "Invalid email.", INCORRECT_MESSAGE
+
+def test_update_profile_conflict(client, mock_user):
+    """
+    Test the update profile route when the user was modified meanwhile.
+    """
+    from app.models.user import UpdateConflictError
+
+    mock_user.update.side_effect = UpdateConflictError(AUTH.username)
+
+    response = client.post(
+        "/user/update",
+        json={"data": {"lang": "en", "version": 3}},
+        headers={"Authorization": f"Bearer {VALID_TOKEN}"},
+    )
+    assert response.status_code == 409, INVALID_CODE_MESSAGE
+    assert response.json()["detail"] == "User was modified meanwhile, read it again."
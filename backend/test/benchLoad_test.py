@@ -0,0 +1,31 @@
+"""
+Test of the load test report helpers
+"""
+
+
+def test_summarize():
+    """
+    Percentiles use the nearest rank and errors count as requests.
+    """
+    from bench.load import summarize
+
+    result = summarize([float(value) for value in range(100, 0, -1)], errors=2, elapsed=2.0)
+    assert result["requests"] == 102
+    assert result["rps"] == 51.0
+    assert result["p50_ms"] == 50.0
+    assert result["p95_ms"] == 95.0
+    assert result["p99_ms"] == 99.0
+
+
+def test_compare_detects_regressions():
+    """
+    Only changes beyond the allowed regression are reported.
+    """
+    from bench.load import compare
+
+    baseline = {"results": {"login": {"rps": 100.0, "p50_ms": 10.0,
+                                      "p95_ms": 20.0, "p99_ms": 30.0}}}
+    current = {"login": {"rps": 95.0, "p50_ms": 10.5, "p95_ms": 26.0, "p99_ms": 30.0},
+               "register": {"rps": 1.0, "p50_ms": 1.0, "p95_ms": 1.0, "p99_ms": 1.0}}
+
+    assert compare(current, baseline, max_regression=0.10) == ["login: p95_ms 20.0 -> 26.0"]
@@ -0,0 +1,29 @@
+"""
+Test of the microbenchmark helpers
+"""
+
+
+def test_synthetic_cursor_shape():
+    """
+    Synthetic cursors have the requested rows and columns.
+    """
+    from bench.micro import SyntheticDatabase
+    from app.resources.db_utils.db_utils import format_datas_from_db
+
+    database = SyntheticDatabase(rows=3, width=12)
+    rows = format_datas_from_db(database, database.fetch_all())
+    assert len(rows) == 3
+    assert len(rows[0]) == 12
+    assert rows[0]["email"] == "bench@cleancomm.com"
+
+
+def test_measure_reports_time_and_memory():
+    """
+    measure reports the time per call and the memory allocated.
+    """
+    from bench.micro import measure
+
+    result = measure(lambda: [0] * 10000, repeat=2)
+    assert result["best_us"] <= result["median_us"]
+    assert result["peak_bytes"] >= 80000
+    assert result["retained_bytes"] < result["peak_bytes"]
@@ -0,0 +1,51 @@
+"""
+This file contains the tests for the Bloom filter.
+"""
+import pytest
+
+
+def test_optimal_size():
+    """
+    The size follows the capacity and error rate, within the memory limit.
+    """
+    from app.services.bloom import optimal_size
+
+    bits, hashes = optimal_size(1_000_000, 0.01)
+    assert 9_585_000 <= bits <= 9_586_000 and bits % 8 == 0
+    assert hashes == 7
+    assert optimal_size(1_000_000, 0.01, max_bytes=1024) == (8192, 1)
+    with pytest.raises(ValueError):
+        optimal_size(10, 1.5)
+
+
+def test_no_false_negatives_and_error_rate():
+    """
+    Added keys are always found, others rarely at the configured rate.
+    """
+    from app.services.bloom import BloomFilter
+
+    bloom = BloomFilter.for_capacity(5000, 0.01)
+    for index in range(5000):
+        bloom.add(f"user{index}@cleancomm.com".encode())
+
+    assert all(f"user{index}@cleancomm.com".encode() in bloom for index in range(5000))
+    false_positives = sum(f"other{index}@cleancomm.com".encode() in bloom
+                          for index in range(20000))
+    assert false_positives / 20000 < 0.02
+    assert 0.005 < bloom.error_rate() < 0.02
+    assert bloom.count == 5000
+
+
+def test_read_only_buffer():
+    """
+    A filter on the bytes of another answers the same.
+    """
+    from app.services.bloom import BloomFilter
+
+    bloom = BloomFilter(1024, 3)
+    bloom.add(b"key")
+    copy = BloomFilter(1024, 3, bytes(bloom.buffer))
+
+    assert b"key" in copy and b"other" not in copy
+    with pytest.raises(TypeError):
+        copy.add(b"other")
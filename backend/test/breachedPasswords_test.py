@@ -0,0 +1,134 @@
+"""
+This file contains the tests for the breached password filter.
+"""
+from datetime import timedelta
+import hashlib
+import runpy
+import sys
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+BREACHED = ["123456", "password", "qwerty", "iloveyou"]
+FAST_COST = 4
+
+
+@pytest.fixture
+def hash_list(tmp_path):
+    """
+    A hash list in the Pwned Passwords format, with a line to skip
+    """
+    path = tmp_path / "hashes.txt"
+    lines = [f"{hashlib.sha1(password.encode()).hexdigest().upper()}:{index + 1}"
+             for index, password in enumerate(BREACHED)]
+    path.write_text("\n".join(lines[:2] + ["not a hash"] + lines[2:]) + "\n", encoding="ascii")
+    return path
+
+
+@pytest.fixture
+def breached(hash_list, tmp_path, mocker):
+    """
+    The filter of the hash list, used by the application
+    """
+    from app.services import breached_passwords
+
+    path = tmp_path / "breached.bloom"
+    assert breached_passwords.build_filter(str(hash_list), str(path), error_rate=0.001) == 4
+    passwords = breached_passwords.BreachedPasswords(str(path))
+    mocker.patch.object(breached_passwords, "BREACHED_PASSWORDS", passwords)
+    return passwords
+
+
+def test_build_and_check(breached):
+    """
+    Every password of the list is found, others are not.
+    """
+    from app.services.breached_passwords import is_breached, CHECKS
+
+    flagged = CHECKS.value(answer="breached")
+    assert all(is_breached(password) for password in BREACHED)
+    assert not any(is_breached(f"correct horse battery staple {index}") for index in range(200))
+    assert CHECKS.value(answer="breached") == flagged + len(BREACHED)
+    assert breached.bloom.count == 4
+
+
+def test_filter_is_read_only(breached):
+    """
+    The mapped filter cannot be written.
+    """
+    with pytest.raises(TypeError):
+        breached.bloom.add(b"x" * 20)
+
+
+def test_invalid_file(tmp_path):
+    """
+    Files without the filter header are refused.
+    """
+    from app.services.breached_passwords import BreachedPasswords
+
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0" * 128)
+    with pytest.raises(ValueError):
+        BreachedPasswords(str(path))
+
+
+def test_no_filter_accepts_everything():
+    """
+    Without BREACHED_PASSWORDS_FILE, passwords are not checked.
+    """
+    from app.services.breached_passwords import is_breached
+
+    assert not is_breached("123456")
+
+
+@pytest.mark.filterwarnings("ignore:.*found in sys.modules:RuntimeWarning")
+def test_build_command(hash_list, tmp_path, mocker, capsys):
+    """
+    The build command writes a filter the application can map.
+    """
+    from app.services.breached_passwords import BreachedPasswords
+
+    path = tmp_path / "cli.bloom"
+    mocker.patch.object(sys, "argv", ["breached_passwords", "build",
+                                      "--hashes", str(hash_list), "--out", str(path)])
+    runpy.run_module("app.services.breached_passwords", run_name="__main__")
+
+    assert capsys.readouterr().out.startswith("added 4 digests")
+    assert "qwerty" in BreachedPasswords(str(path))
+
+
+def test_reset_refuses_breached_password(breached, fake_db, mocker):
+    """
+    A breached password is refused by /user/reset, another one accepted.
+    """
+    from app.controllers import auth
+    from app.models.user import User
+
+    mocker.patch("app.services.passwords.BCRYPT_COST", FAST_COST)
+    user = User(email="ada@cleancomm.com", password="first one", host="https://host")
+    user.create()
+    token = user.generate_token("ada@cleancomm.com", expiration_time=timedelta(minutes=15))
+    app = FastAPI()
+    app.include_router(auth.AUTH)
+    client = TestClient(app)
+
+    response = client.post("/user/reset", json={"data": {"password": "iloveyou"}},
+                           headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == auth.BREACHED_PASSWORD_MESSAGE
+
+    response = client.post("/user/reset", json={"data": {"password": "a long passphrase"}},
+                           headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+
+def test_create_refuses_breached_password(breached, fake_db):
+    """
+    Users are not created with a breached password.
+    """
+    from app.models.user import User, BreachedPasswordError
+
+    with pytest.raises(BreachedPasswordError):
+        User(email="bob@cleancomm.com", password="password").create()
+    assert User(email="bob@cleancomm.com").select() is None
@@ -34,3 +34,22 @@ def connect(mocker):
     import psycopg2
     mocker.patch.object(psycopg2, "connect")
     yield
+
+
+@pytest.fixture
+def fake_db(monkeypatch, connect):
+    """
+    Run the application on an in-memory fake of the Postgres server.
+    """
+    from fake_postgres import fake_database, patch_modules
+    import app.controllers.auth  # pylint: disable=unused-import
+    import app.controllers.sightings  # pylint: disable=unused-import
+
+    from app.services.write_behind import flush_all
+
+    database = fake_database()
+    patch_modules(monkeypatch, database)
+    yield database
+    # The writes left behind by the test go to its database, not the next one
+    flush_all()
+    database.close()
@@ -0,0 +1,217 @@
+"""
+This file contains the tests for the daily digests.
+"""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+DAY = date(2024, 5, 31)
+NOON = datetime(2024, 5, 31, 12)
+DAILY_TASK_REPORT = 1
+TASK_ASSIGNED = 256
+
+
+@pytest.fixture
+def engine(fake_db):
+    """
+    Engine of the fake database, two recipients per chunk and per mail batch
+    """
+    from app.services.digest import DigestEngine
+
+    return DigestEngine([fake_db], chunk_size=2, batch_size=2)
+
+
+@pytest.fixture
+def smtp(mocker):
+    """
+    Mock of the SMTP server
+    """
+    return mocker.patch("app.services.send_mail.smtplib.SMTP").return_value.__enter__.return_value
+
+
+def add_user(fake_db, email, preferences, status=1, events=()):
+    """Insert a user, its preferences and its events of the day"""
+    fake_db.execute(
+        "INSERT INTO users (email, password, first_name, created_date, updated_date, status) "
+        "VALUES (%s, %s, %s, %s, %s, %s)",
+        (email, "hash", email.split("@")[0].title(), NOON, NOON, status))
+    fake_db.execute("INSERT INTO notification (user_mail, preferences) VALUES (%s, %s)",
+                    (email, preferences))
+    for event, created_date in events:
+        fake_db.execute("INSERT INTO outbox (event, email, created_date) VALUES (%s, %s, %s)",
+                        (event, email, created_date))
+    fake_db.commit()
+
+
+@pytest.fixture
+def subscribers(fake_db):
+    """
+    Subscribers with activity on DAY, and users that get no digest
+    """
+    signed_in = [("session.created", NOON), ("session.created", NOON + timedelta(hours=1))]
+    add_user(fake_db, "ada@cleancomm.com", DAILY_TASK_REPORT,
+             events=signed_in + [("user.updated", NOON)])
+    add_user(fake_db, "bob@cleancomm.com", DAILY_TASK_REPORT | TASK_ASSIGNED,
+             events=[("session.ended", NOON)])
+    add_user(fake_db, "carl@cleancomm.com", DAILY_TASK_REPORT,
+             events=[("session.created", NOON - timedelta(days=1))])
+    add_user(fake_db, "dora@cleancomm.com", TASK_ASSIGNED, events=signed_in)
+    add_user(fake_db, "eve@cleancomm.com", DAILY_TASK_REPORT, status=3, events=signed_in)
+    add_user(fake_db, "fred@cleancomm.com", DAILY_TASK_REPORT, events=signed_in)
+    return ["ada@cleancomm.com", "bob@cleancomm.com", "fred@cleancomm.com"]
+
+
+def queued(fake_db):
+    """Emails of the queued digests, and whether they were sent"""
+    fake_db.execute("SELECT email, sent_date IS NOT NULL FROM digest_mail ORDER BY email")
+    return fake_db.fetch_all()
+
+
+def test_render_digests():
+    """
+    Digests count the events of the day, recipients without any are skipped.
+    """
+    from app.services.digest import render_digests
+
+    rows = render_digests(
+        [("ada@cleancomm.com", "<Ada>"), ("bob@cleancomm.com", "Bob")],
+        {"ada@cleancomm.com": {"session.created": 2, "user.updated": 1, "other": 4}}, DAY)
+
+    assert len(rows) == 1
+    run_date, email, subject, body, _ = rows[0]
+    assert (run_date, email, subject) == (DAY, "ada@cleancomm.com",
+                                          "Your daily report of 2024-05-31")
+    assert "Hi &lt;Ada&gt;," in body
+    assert "<li>2 sign-ins</li><li>1 profile update</li></ul>" in body
+
+
+def test_queue_and_deliver(engine, fake_db, subscribers, smtp):
+    """
+    Active subscribers with activity get one digest, sent by batches.
+    """
+    assert engine.queue(DAY) == 3
+    assert queued(fake_db) == [(email, 0) for email in subscribers]
+    fake_db.execute("SELECT last_email, queued, finished_date IS NOT NULL FROM digest_runs")
+    assert fake_db.fetch_one() == ("fred@cleancomm.com", 3, 1)
+
+    assert engine.deliver() == 3
+    assert queued(fake_db) == [(email, 1) for email in subscribers]
+    assert [call.args[1] for call in smtp.sendmail.call_args_list] == subscribers
+    assert smtp.login.call_count == 2
+
+    # A finished run queues nothing again
+    assert engine.queue(DAY) == 0
+    assert engine.deliver() == 0
+
+
+def test_queue_resumes_from_checkpoint(engine, fake_db, subscribers, mocker):
+    """
+    A run stopped halfway goes on after the last chunk queued.
+    """
+    from app.services import digest
+
+    calls = []
+    original = digest.render_digests
+
+    def stop_after_first_chunk(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("stopped")
+        return original(*args)
+
+    mocker.patch.object(digest, "render_digests", stop_after_first_chunk)
+    with pytest.raises(RuntimeError):
+        engine.queue(DAY)
+    assert queued(fake_db) == [(email, 0) for email in subscribers[:2]]
+
+    assert engine.queue(DAY) == 1
+    assert queued(fake_db) == [(email, 0) for email in subscribers]
+    # The first chunk is not rendered again
+    assert [recipients[0][0] for recipients, _, _ in calls] == [
+        "ada@cleancomm.com", "carl@cleancomm.com", "carl@cleancomm.com"]
+
+
+def attempts(fake_db):
+    """Emails of the digests not sent, with their attempts and whether they failed"""
+    fake_db.execute("SELECT email, attempts, last_error IS NOT NULL FROM digest_mail "
+                    "WHERE sent_date IS NULL ORDER BY email")
+    return fake_db.fetch_all()
+
+
+def retry_now(fake_db):
+    """Make the failed digests due, as after DIGEST_RETRY_DELAY"""
+    fake_db.execute("UPDATE digest_mail SET locked_until = NULL")
+    fake_db.commit()
+
+
+def test_failed_delivery_keeps_digests(engine, fake_db, subscribers, smtp):
+    """
+    Digests whose sending fails stay queued with their attempts.
+    """
+    engine.queue(DAY)
+    smtp.sendmail.side_effect = OSError("connection lost")
+
+    assert engine.deliver() == 0
+    assert attempts(fake_db) == [(email, 1, 1) for email in subscribers]
+
+    smtp.sendmail.side_effect = None
+    # Not tried again before the retry delay
+    assert engine.deliver() == 0
+    retry_now(fake_db)
+    assert engine.deliver() == 3
+    assert attempts(fake_db) == []
+
+
+def test_refused_digest_does_not_block_batch(engine, fake_db, subscribers, smtp):
+    """
+    A refused digest is retried up to max_attempts, the others of its batch
+    are sent.
+    """
+    import smtplib
+
+    engine.queue(DAY)
+    engine.max_attempts = 2
+
+    def refuse_bob(_sender, recipient, _message):
+        if recipient == "bob@cleancomm.com":
+            raise smtplib.SMTPRecipientsRefused({recipient: (550, b"No such user")})
+
+    smtp.sendmail.side_effect = refuse_bob
+    assert engine.deliver() == 2
+    assert attempts(fake_db) == [("bob@cleancomm.com", 1, 1)]
+    retry_now(fake_db)
+    assert engine.deliver() == 0
+    assert attempts(fake_db) == [("bob@cleancomm.com", 2, 1)]
+    # Given up after max_attempts
+    retry_now(fake_db)
+    assert engine.deliver() == 0
+    assert attempts(fake_db) == [("bob@cleancomm.com", 2, 1)]
+
+
+def test_unreachable_mail_server(engine, fake_db, subscribers, mocker):
+    """
+    A mail server that cannot be reached raises MailError, the digests stay
+    queued.
+    """
+    from app.services.send_mail import MailError
+
+    engine.queue(DAY)
+    mocker.patch("app.services.send_mail.smtplib.SMTP", side_effect=OSError("refused"))
+
+    with pytest.raises(MailError):
+        engine.deliver()
+    assert attempts(fake_db) == [(email, 1, 1) for email in subscribers[:2]] + [
+        (subscribers[2], 0, 0)]
+
+
+def test_purge_sent_digests(engine, fake_db, subscribers, smtp):
+    """
+    Only the digests sent before the retention are deleted.
+    """
+    engine.run(DAY)
+    fake_db.execute("UPDATE digest_mail SET sent_date = %s WHERE email = %s",
+                    (datetime.utcnow() - timedelta(days=8), subscribers[0]))
+    fake_db.commit()
+
+    assert engine.purge(timedelta(days=7)) == 1
+    assert queued(fake_db) == [(email, 1) for email in subscribers[1:]]
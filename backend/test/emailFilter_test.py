@@ -0,0 +1,140 @@
+"""
+This file contains the tests for the email filter of the registration.
+"""
+from datetime import datetime
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+FAST_COST = 4
+
+
+@pytest.fixture
+def email_filter(fake_db, mocker):
+    """
+    A small filter built from the fake database, used by the application
+    """
+    from app.resources.db_utils.user_queries import USER_INSERT_QUERY
+    from app.services.email_filter import EmailFilter
+
+    for index in range(3):
+        fake_db.execute(USER_INSERT_QUERY, (
+            f"user{index}@cleancomm.com", "b'hash'", "https://host", "First", "Last", "fr",
+            datetime.utcnow(), datetime.utcnow(), 1))
+    fake_db.commit()
+
+    email_filter = EmailFilter(capacity=1000, error_rate=0.01, enabled=True)
+    assert email_filter.build([fake_db]) == 3
+    for module in ("app.services.email_filter", "app.models.user", "app.controllers.auth"):
+        mocker.patch(f"{module}.EMAIL_FILTER", email_filter)
+    mocker.patch("app.services.passwords.BCRYPT_COST", FAST_COST)
+    mocker.patch("app.controllers.auth.send_recovery_mail")
+    return email_filter
+
+
+@pytest.fixture
+def client():
+    """
+    Client of the registration and metrics routes
+    """
+    from app.controllers import auth, metrics
+
+    app = FastAPI()
+    app.include_router(auth.AUTH)
+    app.include_router(metrics.METRICS)
+    return TestClient(app)
+
+
+def register(client, email):
+    """Register email through the API"""
+    return client.post("/user/register", json={"data": {
+        "email": email, "host": "https://host", "first_name": "Ada",
+        "last_name": "Lovelace", "lang": "en"}})
+
+
+def test_build_and_lookups(email_filter):
+    """
+    Registered emails may exist whatever their case, others are misses.
+    """
+    assert email_filter.might_exist("USER1@cleancomm.com")
+    assert not email_filter.might_exist("new@cleancomm.com")
+
+    email_filter.add("new@cleancomm.com")
+    assert email_filter.might_exist("new@cleancomm.com")
+
+
+def test_filter_off_until_built():
+    """
+    Every email is looked up until the filter is built or when disabled.
+    """
+    from app.services.email_filter import EmailFilter
+
+    assert EmailFilter(capacity=10).might_exist("new@cleancomm.com")
+    disabled = EmailFilter(capacity=10, enabled=False)
+    assert disabled.build([]) == 0
+    assert disabled.might_exist("new@cleancomm.com")
+
+
+def test_register_new_email_skips_lookup(client, email_filter, mocker):
+    """
+    A new email is created without the lookup, then added to the filter.
+    """
+    from app.models.user import User
+
+    select = mocker.spy(User, "select")
+    response = register(client, "ada@cleancomm.com")
+
+    assert response.status_code == 200
+    assert response.json()["email"] == "ada@cleancomm.com"
+    # Only the reads of the created user remain
+    assert select.call_count == 2
+    assert email_filter.might_exist("ada@cleancomm.com")
+
+
+def test_register_existing_email(client, email_filter, mocker):
+    """
+    An existing email is looked up and not created again.
+    """
+    from app.models.user import User
+
+    create = mocker.spy(User, "create")
+    response = register(client, "user0@cleancomm.com")
+
+    assert response.status_code == 200
+    assert create.call_count == 0
+
+
+def test_register_missed_existing_email(client, email_filter, fake_db):
+    """
+    An email registered by another worker is refused by the unique constraint.
+    """
+    from app.resources.db_utils.user_queries import USER_INSERT_QUERY
+
+    fake_db.execute(USER_INSERT_QUERY, (
+        "other@cleancomm.com", "b'hash'", "https://host", "Other", "Worker", "de",
+        datetime.utcnow(), datetime.utcnow(), 1))
+    fake_db.commit()
+
+    response = register(client, "other@cleancomm.com")
+    assert response.status_code == 200
+    assert response.json()["first_name"] == "Other"
+
+
+def test_metrics(client, email_filter):
+    """
+    The filter size, rates and checks are exposed on /metrics.
+    """
+    from app.services.email_filter import CHECKS
+
+    misses = CHECKS.value(answer="miss")
+    register(client, "ada@cleancomm.com")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE email_filter_checks_total counter" in lines
+    assert f'email_filter_checks_total{{answer="miss"}} {misses + 1:g}' in lines
+    assert "email_filter_target_error_rate 0.01" in lines
+    assert any(line.startswith("email_filter_bytes ") for line in lines)
@@ -0,0 +1,252 @@
+"""
+This file contains the tests for the background jobs and their schedules.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+NOW = datetime(2024, 5, 31, 12, 0, 30)
+
+
+@pytest.mark.parametrize("expression, moment, expected", [
+    ("*/5 * * * *", datetime(2024, 5, 31, 12, 3, 59), datetime(2024, 5, 31, 12, 5)),
+    ("*/5 * * * *", datetime(2024, 5, 31, 12, 5), datetime(2024, 5, 31, 12, 10)),
+    ("0 6 * * *", datetime(2024, 5, 31, 7), datetime(2024, 6, 1, 6)),
+    ("30 2 1 1,7 *", datetime(2024, 5, 31), datetime(2024, 7, 1, 2, 30)),
+    ("0 9 * * 1-5", datetime(2024, 6, 1, 10), datetime(2024, 6, 3, 9)),
+    ("0 0 * * 7", datetime(2024, 5, 31), datetime(2024, 6, 2)),
+    # Day of month or day of week when both are restricted
+    ("0 0 13 * 5", datetime(2024, 6, 1), datetime(2024, 6, 7)),
+    ("0 0 29 2 *", datetime(2024, 3, 1), datetime(2028, 2, 29)),
+])
+def test_cron_next_after(expression, moment, expected):
+    """
+    Run times are the first matching minute strictly after the moment.
+    """
+    from app.resources.cron import CronSchedule
+
+    assert CronSchedule(expression).next_after(moment) == expected
+
+
+@pytest.mark.parametrize("expression", [
+    "* * * *", "60 * * * *", "*/0 * * * *", "5-1 * * * *", "a * * * *"])
+def test_cron_invalid(expression):
+    """
+    Malformed expressions and values out of range are refused.
+    """
+    from app.resources.cron import CronSchedule
+
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_cron_never_runs():
+    """
+    An expression without run time is refused when searched.
+    """
+    from app.resources.cron import CronSchedule
+
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 30 2 *").next_after(NOW)
+
+
+def test_histogram_render():
+    """
+    Histograms render cumulative buckets, their sum and count.
+    """
+    from app.services.metrics import Histogram, Registry
+
+    registry = Registry()
+    latency = registry.register(Histogram("latency_seconds", "Latency.", (1, 0.5)))
+    for value in (0.2, 0.7, 3):
+        latency.observe(value, name="a")
+
+    assert latency.count(name="a") == 3 and latency.total(name="a") == pytest.approx(3.9)
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{name="a",le="0.5"} 1',
+        'latency_seconds_bucket{name="a",le="1"} 2',
+        'latency_seconds_bucket{name="a",le="+Inf"} 3',
+        'latency_seconds_sum{name="a"} 3.9',
+        'latency_seconds_count{name="a"} 3',
+    ]
+
+
+@pytest.fixture
+def handlers():
+    """
+    Handlers recording their payloads, one failing and one recurring
+    """
+    from app.services.jobs import Handler
+
+    calls = []
+
+    def fail(payload):
+        raise RuntimeError(payload["reason"])
+
+    return calls, {
+        "record": Handler("record", calls.append),
+        "fail": Handler("fail", fail, max_attempts=2),
+        "sweep": Handler("sweep", calls.append, cron="*/5 * * * *"),
+    }
+
+
+@pytest.fixture
+def worker(fake_db, handlers):
+    """
+    Worker of the fake database, with a visibility timeout of a minute
+    """
+    from app.services.jobs import JobWorker
+
+    return JobWorker(fake_db, handlers[1], concurrency=2, visibility_timeout=60)
+
+
+def add_job(fake_db, name, payload=None, run_at=NOW, max_attempts=None):
+    """Enqueue and commit a job"""
+    from app.services.jobs import enqueue
+
+    job_id = enqueue(fake_db, name, payload, run_at, max_attempts)
+    fake_db.commit()
+    return job_id
+
+
+def jobs(fake_db):
+    """Rows of the jobs table"""
+    fake_db.execute("SELECT name, attempts, locked_by IS NOT NULL, last_error FROM jobs "
+                    "ORDER BY id")
+    return fake_db.fetch_all()
+
+
+def test_claim_and_run(worker, fake_db, handlers):
+    """
+    Due jobs are claimed in run time order up to the limit, done jobs deleted.
+    """
+    from app.services import jobs as jobs_module
+
+    add_job(fake_db, "record", {"n": 2}, NOW - timedelta(seconds=5))
+    add_job(fake_db, "record", {"n": 1}, NOW - timedelta(seconds=10))
+    add_job(fake_db, "record", {"n": 3}, NOW + timedelta(minutes=1))
+    add_job(fake_db, "record", {"n": 4}, NOW)
+
+    claimed = worker.claim(2, NOW)
+    assert [job["payload"] for job in claimed] == [{"n": 1}, {"n": 2}]
+    assert claimed[0]["attempts"] == 1 and claimed[0]["run_at"] == NOW - timedelta(seconds=10)
+    # Claimed jobs are hidden, the job not due is not claimed
+    assert [job["payload"] for job in worker.claim(5, NOW)] == [{"n": 4}]
+    assert worker.claim(5, NOW) == []
+
+    done = jobs_module.RUNS.value(name="record", outcome="done")
+    for job in claimed:
+        worker.run_job(job)
+    assert handlers[0] == [{"n": 1}, {"n": 2}]
+    assert jobs(fake_db) == [("record", 0, 0, None), ("record", 1, 1, None)]
+    assert jobs_module.RUNS.value(name="record", outcome="done") == done + 2
+    assert jobs_module.DURATIONS.count(name="record") >= 2
+
+
+def test_failed_job_retries(worker, fake_db):
+    """
+    A failing job runs again after its backoff, until its max attempts.
+    """
+    add_job(fake_db, "fail", {"reason": "boom"}, max_attempts=2)
+
+    worker.run_job(worker.claim(1, NOW)[0])
+    assert jobs(fake_db) == [("fail", 1, 0, "RuntimeError('boom')")]
+    assert worker.claim(1, NOW) == []
+
+    later = datetime.utcnow() + timedelta(minutes=1)
+    worker.run_job(worker.claim(1, later)[0])
+    assert jobs(fake_db) == [("fail", 2, 0, "RuntimeError('boom')")]
+    # Kept with its error once out of attempts
+    assert worker.claim(1, later + timedelta(days=1)) == []
+
+
+def test_unknown_job_fails(worker, fake_db):
+    """
+    Jobs without handler in the worker fail, as long as no worker knows them.
+    """
+    add_job(fake_db, "missing", max_attempts=1)
+
+    worker.run_job(worker.claim(1, NOW)[0])
+    assert jobs(fake_db) == [("missing", 1, 0, "No handler for the job 'missing'")]
+
+
+def test_visibility_timeout(worker, fake_db, handlers):
+    """
+    The job of a dead worker is claimed again after the timeout, unless
+    extended; the late worker does not delete the job claimed again.
+    """
+    from app.services.jobs import JobWorker
+
+    other = JobWorker(fake_db, handlers[1], visibility_timeout=60)
+    add_job(fake_db, "record", {"n": 1})
+    add_job(fake_db, "record", {"n": 2})
+    first, second = worker.claim(2, NOW)
+
+    assert worker.extend(NOW + timedelta(seconds=50)) == 2
+    assert other.claim(2, NOW + timedelta(seconds=90)) == []
+    worker.run_job(second)
+
+    reclaimed = other.claim(2, NOW + timedelta(seconds=200))
+    assert [(job["id"], job["attempts"]) for job in reclaimed] == [(first["id"], 2)]
+    worker.run_job(first)
+    assert jobs(fake_db) == [("record", 2, 1, None)]
+    other.run_job(reclaimed[0])
+    assert jobs(fake_db) == []
+
+
+def test_lost_last_attempt_fails(worker, fake_db, handlers):
+    """
+    A job whose worker died during its last attempt is failed once its
+    timeout passes, not left locked.
+    """
+    from app.services.jobs import LOST_JOB_ERROR
+
+    add_job(fake_db, "record", {"n": 1}, max_attempts=1)
+    add_job(fake_db, "record", {"n": 2}, max_attempts=2)
+    worker.claim(2, NOW)
+
+    assert worker.fail_lost(NOW + timedelta(seconds=30)) == 0
+    assert worker.fail_lost(NOW + timedelta(seconds=90)) == 1
+    assert jobs(fake_db) == [("record", 1, 0, LOST_JOB_ERROR), ("record", 1, 1, None)]
+    # The job with attempts left runs again
+    assert [job["payload"] for job in worker.claim(2, NOW + timedelta(seconds=90))] == [{"n": 2}]
+
+
+def test_schedules_enqueue_once(worker, fake_db, handlers):
+    """
+    A due schedule is enqueued once per run time, and advanced.
+    """
+    from app.services.jobs import JobWorker
+
+    worker.register_schedules(NOW)
+    # A second worker registering does not move the next run
+    JobWorker(fake_db, handlers[1]).register_schedules(NOW + timedelta(minutes=3))
+    fake_db.execute("SELECT name, cron, next_run_at FROM job_schedules")
+    assert fake_db.fetch_all() == [("sweep", "*/5 * * * *", datetime(2024, 5, 31, 12, 5))]
+
+    assert worker.enqueue_due(NOW) == 0
+    assert worker.enqueue_due(NOW + timedelta(minutes=7)) == 1
+    assert worker.enqueue_due(NOW + timedelta(minutes=8)) == 0
+    fake_db.execute("SELECT run_at FROM jobs")
+    assert fake_db.fetch_all() == [(datetime(2024, 5, 31, 12, 5),)]
+    fake_db.execute("SELECT next_run_at FROM job_schedules")
+    assert fake_db.fetch_one() == (datetime(2024, 5, 31, 12, 10),)
+
+
+def test_worker_thread(worker, fake_db, handlers):
+    """
+    A started worker runs the enqueued jobs on its threads.
+    """
+    worker.poll_interval = 0.01
+    add_job(fake_db, "record", {"n": 1}, datetime.utcnow())
+    worker.start()
+    try:
+        for _ in range(500):
+            if handlers[0]:
+                break
+            worker.stopped.wait(0.01)
+    finally:
+        worker.stop()
+
+    assert handlers[0] == [{"n": 1}]
+    assert jobs(fake_db) == []
@@ -0,0 +1,155 @@
+"""
+Test of the JWT key ring and the JWKS route
+"""
+from datetime import datetime, timedelta
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import jwt
+import pytest
+
+TEST_EMAIL = "cleancomm@gmail.com"
+
+
+def payload():
+    """A valid token payload"""
+    return {
+        "sub": TEST_EMAIL,
+        "iat": datetime.utcnow(),
+        "exp": datetime.utcnow() + timedelta(minutes=5),
+    }
+
+
+def decode(keyring, token):
+    """Verify a token the way AppHttpBearer does"""
+    return jwt.decode(token, keyring.verification_key(token),
+                      algorithms=[keyring.algorithm])
+
+
+@pytest.mark.parametrize("algorithm", ["EdDSA", "ES256"])
+def test_keyring_sign_and_verify(tmp_path, algorithm):
+    """
+    Tokens carry the kid of the active key and verify with it.
+    """
+    from app.services.jwt_keys import KeyRing, generate_key
+
+    kid = generate_key(str(tmp_path), algorithm)
+    keyring = KeyRing(algorithm, keys_dir=str(tmp_path))
+
+    token = keyring.sign(payload())
+    assert jwt.get_unverified_header(token)["kid"] == kid
+    assert decode(keyring, token)["sub"] == TEST_EMAIL
+
+    assert [key["kid"] for key in keyring.jwks["keys"]] == [kid]
+    assert "d" not in keyring.jwks["keys"][0]
+
+
+def test_keyring_rotation(tmp_path):
+    """
+    Tokens signed by the previous key stay valid after the rotation.
+    """
+    from app.services.jwt_keys import KeyRing, generate_key
+
+    old_kid = generate_key(str(tmp_path), "EdDSA")
+    old_token = KeyRing("EdDSA", keys_dir=str(tmp_path)).sign(payload())
+
+    new_kid = generate_key(str(tmp_path), "EdDSA")
+    keyring = KeyRing("EdDSA", keys_dir=str(tmp_path), active_kid=new_kid)
+
+    assert decode(keyring, old_token)["sub"] == TEST_EMAIL
+    assert jwt.get_unverified_header(keyring.sign(payload()))["kid"] == new_kid
+    assert {key["kid"] for key in keyring.jwks["keys"]} == {old_kid, new_kid}
+
+
+def test_keyring_requires_active_kid(tmp_path):
+    """
+    The active key must be chosen when several keys are present.
+    """
+    from app.services.jwt_keys import KeyRing, generate_key
+
+    generate_key(str(tmp_path), "EdDSA")
+    generate_key(str(tmp_path), "EdDSA")
+    with pytest.raises(ValueError):
+        KeyRing("EdDSA", keys_dir=str(tmp_path))
+
+
+def test_keyring_unknown_kid(tmp_path):
+    """
+    Tokens signed by a key absent from the ring are rejected.
+    """
+    from app.services.jwt_keys import KeyRing, generate_key
+
+    generate_key(str(tmp_path / "other"), "EdDSA")
+    other = KeyRing("EdDSA", keys_dir=str(tmp_path / "other"))
+    generate_key(str(tmp_path / "ring"), "EdDSA")
+    keyring = KeyRing("EdDSA", keys_dir=str(tmp_path / "ring"))
+
+    with pytest.raises(jwt.InvalidTokenError):
+        decode(keyring, other.sign(payload()))
+
+
+def test_keyring_symmetric():
+    """
+    HS256 tokens keep using the shared secret without kid.
+    """
+    from app.services.jwt_keys import KeyRing
+
+    keyring = KeyRing("HS256", secret_key="secret-key")
+    token = keyring.sign(payload())
+    assert "kid" not in jwt.get_unverified_header(token)
+    assert jwt.decode(token, "secret-key", algorithms=["HS256"])["sub"] == TEST_EMAIL
+    assert keyring.jwks == {"keys": []}
+
+
+def test_jwks_route():
+    """
+    The JWKS route is cacheable and answers 304 for a known ETag.
+    """
+    from app.controllers import well_known
+
+    app = FastAPI()
+    app.include_router(well_known.WELL_KNOWN)
+    client = TestClient(app)
+
+    response = client.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    assert response.json() == {"keys": []}
+    assert "max-age" in response.headers["cache-control"]
+
+    response = client.get("/.well-known/jwks.json",
+                          headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+def test_keyring_reloads_on_unknown_kid(tmp_path, monkeypatch):
+    """
+    Keys added to the directory are read when a token carries their kid,
+    at most every KEY_RELOAD_INTERVAL.
+    """
+    from app.services import jwt_keys
+    from app.services.jwt_keys import KeyRing, generate_key
+
+    generate_key(str(tmp_path), "EdDSA")
+    keyring = KeyRing("EdDSA", keys_dir=str(tmp_path))
+    new_kid = generate_key(str(tmp_path), "EdDSA")
+    token = KeyRing("EdDSA", keys_dir=str(tmp_path), active_kid=new_kid).sign(payload())
+
+    with pytest.raises(jwt.InvalidTokenError):
+        decode(keyring, token)
+    monkeypatch.setattr(jwt_keys, "KEY_RELOAD_INTERVAL", 0)
+    assert decode(keyring, token)["sub"] == TEST_EMAIL
+    assert new_kid in {key["kid"] for key in keyring.jwks["keys"]}
+    # The signing key does not change without JWT_ACTIVE_KID
+    assert jwt.get_unverified_header(keyring.sign(payload()))["kid"] != new_kid
+
+
+def test_keyring_requires_keys_dir(tmp_path):
+    """
+    Asymmetric algorithms need an existing keys directory.
+    """
+    from app.services.jwt_keys import KeyRing
+
+    with pytest.raises(ValueError, match="JWT_KEYS_DIR"):
+        KeyRing("EdDSA", keys_dir="")
+    with pytest.raises(ValueError, match="not a directory"):
+        KeyRing("ES256", keys_dir=str(tmp_path / "missing"))
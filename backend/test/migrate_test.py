@@ -0,0 +1,175 @@
+"""
+Test of the schema migrations
+"""
+import pytest
+
+# Rows of EXPLAIN (FORMAT JSON)
+PLAN_INDEX = ([{"Plan": {"Node Type": "Limit", "Plans": [
+    {"Node Type": "Index Scan", "Relation Name": "users"}]}}],)
+PLAN_SEQ_SCAN = ([{"Plan": {"Node Type": "Sort", "Plans": [
+    {"Node Type": "Seq Scan", "Relation Name": "notification"}]}}],)
+
+
+@pytest.fixture
+def mock_db(mocker):
+    """
+    Fixture of a database recording the queries
+    """
+    database = mocker.MagicMock()
+    database.connection.autocommit = False
+    return database
+
+
+def executed(database):
+    """Return the text of the executed queries"""
+    return [call.args[0].string for call in database.execute.call_args_list]
+
+
+def test_load_migrations():
+    """
+    The shipped migrations are ordered, only the concurrent indexes run
+    outside a transaction.
+    """
+    from app.resources.db_utils.migrate import load_migrations
+
+    migrations = load_migrations()
+
+    assert [migration.version for migration in migrations] == sorted(
+        migration.version for migration in migrations)
+    assert migrations[0].name == "create_users"
+    for migration in migrations:
+        with open(migration.path, "r", encoding="utf-8") as migration_file:
+            concurrent = "CONCURRENTLY" in migration_file.read()
+        assert migration.transactional is not concurrent
+
+
+def test_load_migrations_duplicate_version(tmp_path):
+    """
+    Two files of the same version are refused.
+    """
+    from app.resources.db_utils.migrate import load_migrations
+
+    (tmp_path / "0001_first.sql").write_text("SELECT 1;")
+    (tmp_path / "0001_second.sql").write_text("SELECT 2;")
+    (tmp_path / "notes.txt").write_text("ignored")
+
+    with pytest.raises(ValueError):
+        load_migrations(str(tmp_path))
+
+
+def test_split_statements():
+    """
+    Statements are split and comments dropped.
+    """
+    from app.resources.db_utils.migrate import split_statements
+
+    text = "-- migrate: no-transaction\nCREATE INDEX a ON t (x);\n-- b\n\nCREATE INDEX b\n ON t (y);\n"
+    assert split_statements(text) == ["CREATE INDEX a ON t (x)", "CREATE INDEX b\n ON t (y)"]
+
+
+def test_migrate_applies_pending(mock_db, tmp_path, mocker):
+    """
+    Only pending migrations run, the no-transaction ones in autocommit.
+    """
+    from app.resources.db_utils import migrate as migrate_module
+
+    (tmp_path / "0001_tables.sql").write_text("CREATE TABLE t (x INT);")
+    (tmp_path / "0002_more.sql").write_text("ALTER TABLE t ADD y INT;")
+    (tmp_path / "0003_index.sql").write_text(
+        "-- migrate: no-transaction\nCREATE INDEX CONCURRENTLY a ON t (x);\n"
+        "CREATE INDEX CONCURRENTLY b ON t (y);\n")
+    (tmp_path / "0004_later.sql").write_text("ALTER TABLE t ADD z INT;")
+    mock_db.fetch_all.return_value = [("0001",)]
+    autocommit = []
+    mock_db.execute.side_effect = lambda *args: autocommit.append(
+        mock_db.connection.autocommit)
+
+    applied = migrate_module.migrate(mock_db, str(tmp_path), target="0003")
+
+    assert applied == ["0002", "0003"]
+    queries = executed(mock_db)
+    assert "ALTER TABLE t ADD y INT;" in queries
+    assert "ALTER TABLE t ADD z INT;" not in queries
+    index = queries.index("CREATE INDEX CONCURRENTLY a ON t (x)")
+    assert queries[index + 1] == "CREATE INDEX CONCURRENTLY b ON t (y)"
+    assert autocommit[index] and autocommit[index + 1]
+    assert not mock_db.connection.autocommit
+    assert "pg_advisory_unlock" in queries[-1]
+
+
+def test_migrate_failure_rolls_back(mock_db, tmp_path):
+    """
+    A failing migration is rolled back, not recorded, and the lock released.
+    """
+    from app.resources.db_utils.migrate import migrate
+
+    (tmp_path / "0001_broken.sql").write_text("CREATE TABLE;")
+    mock_db.fetch_all.return_value = []
+
+    def execute(query, params=None):
+        if query.string == "CREATE TABLE;":
+            raise RuntimeError("syntax error")
+    mock_db.execute.side_effect = execute
+
+    with pytest.raises(RuntimeError):
+        migrate(mock_db, str(tmp_path))
+
+    mock_db.rollback.assert_called()
+    assert not any("INSERT INTO schema_migrations" in query for query in executed(mock_db))
+    assert "pg_advisory_unlock" in executed(mock_db)[-1]
+
+
+def test_to_prepared():
+    """
+    Placeholders become numbered parameters, composed queries are formatted.
+    """
+    from app.resources.db_utils.migrate import to_prepared
+    from app.resources.db_utils.user_queries import USER_LIST_QUERY
+
+    assert to_prepared("SELECT 1 FROM t WHERE a = %s AND b LIKE '%%x' AND c = %s") == (
+        "SELECT 1 FROM t WHERE a = $1 AND b LIKE '%x' AND c = $2", 2)
+    query, count = to_prepared(USER_LIST_QUERY)
+    assert "SELECT *" in query and "LIMIT $1" in query and count == 1
+
+
+def test_checked_queries():
+    """
+    The lookups of the query modules are checked, not the inserts.
+    """
+    from app.resources.db_utils.migrate import checked_queries
+
+    queries = checked_queries()
+
+    assert "user_queries.USER_SELECT_QUERY" in queries
+    assert "user_queries.NOTIF_UPDATE_QUERY" in queries
+    assert "user_queries.NOTIF_SUBSCRIBERS_QUERY" in queries
+    assert "user_queries.NOTIF_INSERT_QUERY" not in queries
+    assert "digest_queries.DIGEST_ACTIVITY_QUERY" in queries
+    assert "digest_queries.DIGEST_MAIL_INSERT_QUERY" not in queries
+    assert "session_queries.SWEEP_SESSIONS_QUERY" in queries
+    assert "user_queries.USER_INSERT_QUERY" not in queries
+    assert "user_queries.USER_ESTIMATE_COUNT_QUERY" not in queries
+    assert "outbox_queries.OUTBOX_PENDING_QUERY" in queries
+    assert "session_queries.SESSIONS_SEEN_QUERY" not in queries
+
+
+def test_check_queries_reports_seq_scans(mock_db):
+    """
+    Queries whose plan reads a table sequentially are reported.
+    """
+    from app.resources.db_utils.migrate import check_queries
+
+    mock_db.fetch_one.side_effect = lambda: (PLAN_SEQ_SCAN
+                                             if "notification" in prepared[-1] else PLAN_INDEX)
+    prepared = []
+    mock_db.execute.side_effect = lambda query, params=None: (
+        prepared.append(query.string) if query.string.startswith("PREPARE") else None)
+
+    failures = check_queries(mock_db)
+
+    assert failures == {"user_queries.NOTIF_SELECT_QUERY": ["notification"],
+                        "user_queries.NOTIF_UPDATE_QUERY": ["notification"],
+                        "user_queries.NOTIF_SUBSCRIBERS_QUERY": ["notification"],
+                        "digest_queries.DIGEST_RECIPIENTS_QUERY": ["notification"]}
+    assert all("$" in query or "%s" not in query for query in prepared)
+    assert mock_db.rollback.call_count == len(prepared)
@@ -0,0 +1,156 @@
+"""
+This file contains the tests for the notification preferences.
+"""
+from datetime import timedelta
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+EMAIL = "ada@cleancomm.com"
+
+
+@pytest.fixture
+def preferences_cache(mocker):
+    """
+    An empty cache of the preferences
+    """
+    from app.resources.cache import TTLCache
+
+    return mocker.patch("app.models.notification.PREFERENCES_CACHE", TTLCache(maxsize=100))
+
+
+@pytest.fixture
+def client():
+    """
+    Client of the notification routes
+    """
+    from app.controllers import notifications
+
+    app = FastAPI()
+    app.include_router(notifications.NOTIFICATIONS)
+    return TestClient(app)
+
+
+@pytest.fixture
+def headers(fake_db, preferences_cache):
+    """
+    Authorization header of a connected user
+    """
+    from app.models.user import User
+
+    user = User(email=EMAIL)
+    sid = user.active_session("tests")
+    token = user.generate_token(EMAIL, expiration_time=timedelta(hours=1), sid=sid)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_mask_round_trip():
+    """
+    Names map to their bits, unknown names and non booleans are refused.
+    """
+    from app.models.notification import to_mask, to_dict
+    from app.resources.type.notification import NotificationPreference
+
+    set_bits, clear_bits = to_mask({"task_assigned": True, "daily_task_report": False})
+    assert set_bits == NotificationPreference.TASK_ASSIGNED == 256
+    assert clear_bits == NotificationPreference.DAILY_TASK_REPORT == 1
+    assert to_dict(set_bits) == {name: name == "task_assigned" for name in to_dict(0)}
+    assert len(to_dict(0)) == 9
+
+    for changes in ({"unknown": True}, {"task_assigned": 1}):
+        with pytest.raises(ValueError):
+            to_mask(changes)
+
+
+def test_update_keeps_other_preferences(fake_db, preferences_cache):
+    """
+    The first change creates the row, the next ones keep the bits not named.
+    """
+    from app.models.notification import get_preferences, update_preferences
+    from app.resources.type.notification import NotificationPreference as Pref
+
+    assert get_preferences(EMAIL) == 0
+    assert update_preferences(EMAIL, {"task_assigned": True, "mention_in_comment": True}) == (
+        Pref.TASK_ASSIGNED | Pref.MENTION_IN_COMMENT)
+    assert update_preferences(EMAIL, {"mention_in_comment": False,
+                                      "daily_task_report": True}) == (
+        Pref.TASK_ASSIGNED | Pref.DAILY_TASK_REPORT)
+
+    fake_db.execute("SELECT preferences FROM notification WHERE user_mail = %s", (EMAIL,))
+    assert fake_db.fetch_one() == (257,)
+    fake_db.execute("SELECT event, payload FROM outbox WHERE email = %s ORDER BY id", (EMAIL,))
+    events = fake_db.fetch_all()
+    assert [event for event, _ in events] == ["notification.updated"] * 2
+    assert json.loads(events[-1][1]) == {"preferences": 257,
+                                         "changed": ["daily_task_report", "mention_in_comment"]}
+
+
+def test_reads_are_cached(fake_db, preferences_cache, mocker):
+    """
+    Reads are served from the cache, refreshed by the writes.
+    """
+    from app.models.notification import get_preferences, update_preferences
+
+    update_preferences("ADA@cleancomm.com", {"projet_due_date": True})
+    execute = mocker.spy(fake_db, "execute")
+
+    assert get_preferences(EMAIL) == 4
+    assert execute.call_count == 0
+
+    preferences_cache.clear()
+    assert get_preferences(EMAIL) == 4
+    assert execute.call_count == 1
+
+
+def test_iter_subscribers(fake_db, preferences_cache):
+    """
+    Subscribers of a preference are read by keyset pages.
+    """
+    from app.models.notification import iter_subscribers, update_preferences
+    from app.resources.type.notification import NotificationPreference
+
+    emails = [f"user{index}@cleancomm.com" for index in range(7)]
+    for index, email in enumerate(emails):
+        update_preferences(email, {"task_assigned": index % 2 == 0, "daily_task_report": True})
+
+    assert list(iter_subscribers(NotificationPreference.TASK_ASSIGNED, batch_size=2)) == (
+        emails[::2])
+    assert list(iter_subscribers(NotificationPreference.DAILY_TASK_REPORT)) == emails
+    assert list(iter_subscribers(NotificationPreference.PROJET_DUE_DATE)) == []
+
+
+# Test for route /user/notifications ===========================================
+def test_get_and_patch_notifications(client, headers):
+    """
+    The preferences of the connected user are read and changed.
+    """
+    response = client.get("/user/notifications", headers=headers)
+    assert response.status_code == 200
+    assert not any(response.json().values())
+
+    response = client.patch("/user/notifications", headers=headers,
+                            json={"data": {"content_library_revision": True}})
+    assert response.status_code == 200
+    assert response.json()["content_library_revision"] is True
+
+    response = client.get("/user/notifications", headers=headers)
+    assert [name for name, wanted in response.json().items() if wanted] == [
+        "content_library_revision"]
+
+
+@pytest.mark.parametrize("data", [{}, {"unknown": True}, {"task_assigned": "yes"}, ["x"]])
+def test_patch_notifications_invalid(client, headers, data):
+    """
+    Empty bodies, unknown names and non booleans are refused.
+    """
+    response = client.patch("/user/notifications", headers=headers, json={"data": data})
+    assert response.status_code == 400
+
+
+def test_notifications_need_session(client, fake_db):
+    """
+    The routes need a token.
+    """
+    assert client.get("/user/notifications").status_code == 403
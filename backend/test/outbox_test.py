@@ -0,0 +1,167 @@
+"""
+This file contains the tests for the outbox of the user changes.
+"""
+from datetime import timedelta
+import json
+
+import pytest
+
+TEST_EMAIL = "john@doe.com"
+FAST_COST = 4
+TTL = timedelta(hours=1)
+
+
+@pytest.fixture
+def relay(fake_db, mocker):
+    """
+    Relay of the fake database, with a subscriber collecting the batches
+    """
+    from app.services import outbox
+
+    mocker.patch("app.services.passwords.BCRYPT_COST", FAST_COST)
+    mocker.patch.object(outbox, "_SUBSCRIBERS", [])
+    batches = []
+    outbox.subscribe(batches.append)
+    relay = outbox.OutboxRelay([fake_db], batch_size=2)
+    relay.batches = batches
+    return relay
+
+
+def create_user():
+    """Create the test user through the model"""
+    from app.models.user import User
+
+    return User(email=TEST_EMAIL, password="password", host="https://host",
+                first_name="John", last_name="Doe", lang="fr").create()
+
+
+def pending(fake_db):
+    """Ids of the events not published yet"""
+    fake_db.execute("SELECT id FROM outbox WHERE published_date IS NULL ORDER BY id")
+    return [row[0] for row in fake_db.fetch_all()]
+
+
+def test_user_changes_published_in_order(relay, fake_db):
+    """
+    Every change writes an event, published once, by batches, in order.
+    """
+    from app.models.user import User
+
+    create_user()
+    User(email=TEST_EMAIL).update({"lang": "en"})
+    User(email=TEST_EMAIL).update({"first_name": "Johnny", "password": "new"})
+
+    assert relay.run_once() == 2
+    assert relay.run_once() == 1
+    assert relay.run_once() == 0
+    events = [event for batch in relay.batches for event in batch]
+    assert [event["event"] for event in events] == ["user.created", "user.updated", "user.updated"]
+    assert [event["id"] for event in events] == sorted(event["id"] for event in events)
+    assert events[1]["payload"] == {"fields": ["lang"], "version": 1}
+    assert events[2]["payload"] == {"fields": ["first_name", "password"], "version": 2}
+
+    notified = [json.loads(payload) for _, payload in fake_db.connection.notifications]
+    assert [event["id"] for event in notified] == [event["id"] for event in events]
+    assert {channel for channel, _ in fake_db.connection.notifications} == {"user_changes"}
+    assert pending(fake_db) == []
+
+
+def test_failed_change_writes_no_event(relay, fake_db):
+    """
+    A change rolled back takes its event with it.
+    """
+    create_user()
+    assert create_user() == {"message": "User exists"}
+
+    assert len(pending(fake_db)) == 1
+
+
+def test_failing_subscriber_republishes(relay, fake_db, mocker):
+    """
+    A batch is only marked published once every subscriber took it.
+    """
+    from app.services import outbox
+
+    create_user()
+    failing = mocker.Mock(side_effect=[RuntimeError("down"), None])
+    outbox.subscribe(failing, events=("user.created",))
+
+    with pytest.raises(RuntimeError):
+        relay.run_once()
+    assert len(pending(fake_db)) == 1
+    assert fake_db.connection.notifications == []
+
+    assert relay.run_once() == 1
+    assert failing.call_count == 2
+    assert pending(fake_db) == []
+
+
+def test_session_events(relay, fake_db):
+    """
+    Sessions opened and ended write their events, written behind or not.
+    """
+    from app.services.session_store import PostgresSessionStore
+
+    store = PostgresSessionStore(fake_db, fake_db)
+    phone = store.create(TEST_EMAIL, "phone", TTL)
+    laptop = store.create(TEST_EMAIL, "laptop", TTL, sync=False)
+    store.end(phone)
+    assert len(pending(fake_db)) == 2
+
+    store.end(laptop, sync=False)
+    store.writes.flush()
+    relay.batch_size = 10
+    relay.run_once()
+
+    events = [(event["event"], event["payload"]["sid"]) for event in relay.batches[0]]
+    assert events == [("session.created", phone), ("session.ended", phone),
+                      ("session.created", laptop), ("session.ended", laptop)]
+
+
+def test_purge_published_events(relay, fake_db):
+    """
+    Only the events published before the retention are deleted.
+    """
+    create_user()
+    assert relay.purge(timedelta(0)) == 0
+    relay.run_once()
+
+    assert relay.purge(timedelta(days=1)) == 0
+    assert relay.purge(timedelta(seconds=-1)) == 1
+    fake_db.execute("SELECT COUNT(*) FROM outbox")
+    assert fake_db.fetch_one()[0] == 0
+
+
+def insert_event(fake_db, event_id):
+    """Commit an event with the given id, as a transaction holding it would"""
+    fake_db.execute("INSERT INTO outbox (id, event, email, payload, created_date) "
+                    "VALUES (%s, 'user.updated', %s, '{}', CURRENT_TIMESTAMP)",
+                    (event_id, TEST_EMAIL))
+    fake_db.commit()
+
+
+def test_relay_waits_for_missing_ids(relay, fake_db):
+    """
+    An id missing above the last one published holds the next events back
+    until it is committed, or skipped after the gap timeout.
+    """
+    relay.batch_size = 10
+    relay.gap_timeout = 3600
+    create_user()
+    assert relay.run_once() == 1
+    # The id 2 is taken by a transaction not committed yet
+    insert_event(fake_db, 3)
+    assert relay.run_once() == 0
+
+    insert_event(fake_db, 2)
+    assert relay.run_once() == 2
+    ids = [event["id"] for batch in relay.batches for event in batch]
+    assert ids == [1, 2, 3]
+
+    # The id 4 was rolled back
+    insert_event(fake_db, 5)
+    assert relay.run_once() == 0
+    relay.gap_timeout = 0
+    assert relay.run_once() == 1
+    assert relay.batches[-1][0]["id"] == 5
+    assert pending(fake_db) == []
@@ -0,0 +1,97 @@
+"""
+This file contains the tests for the password hashing.
+"""
+import pytest
+
+TEST_EMAIL = "john@doe.com"
+TEST_PASSWORD = "a long passphrase"
+
+
+@pytest.fixture
+def fast_cost(mocker):
+    """
+    Hash with the lowest cost
+    """
+    return mocker.patch("app.services.passwords.BCRYPT_COST", 4)
+
+
+def test_hashes_have_their_own_salt(fast_cost):
+    """
+    Hashing twice gives two hashes, both checked, with the configured cost.
+    """
+    from app.services.passwords import hash_password, check_password, hash_cost
+
+    first, second = hash_password(TEST_PASSWORD), hash_password(TEST_PASSWORD)
+
+    assert first != second
+    assert first.startswith("b'$2b$04$")
+    assert check_password(TEST_PASSWORD, first) and check_password(TEST_PASSWORD, second)
+    assert not check_password("another one", first)
+    assert hash_cost(first) == 4
+    assert hash_cost(hash_password(TEST_PASSWORD, cost=5)) == 5
+
+
+def test_needs_rehash(fast_cost):
+    """
+    Only bcrypt hashes of another cost are rehashed.
+    """
+    from app.services.passwords import hash_password, needs_rehash
+
+    assert not needs_rehash(hash_password(TEST_PASSWORD))
+    assert needs_rehash(hash_password(TEST_PASSWORD, cost=5))
+    assert not needs_rehash("hashed_password")
+
+
+def test_calibrate(mocker):
+    """
+    The highest cost within the target is chosen, never below the minimum.
+    """
+    from app.services import passwords
+
+    # 1 ms at cost 4, doubling with every cost
+    measure = mocker.patch.object(passwords, "measure",
+                                  side_effect=lambda cost, rounds: 2 ** (cost - 4))
+
+    cost, timings = passwords.calibrate(target_ms=300, min_cost=10)
+    assert cost == 12
+    assert list(timings) == list(range(4, 14))
+    assert measure.call_count == 10
+
+    assert passwords.calibrate(target_ms=10, min_cost=10)[0] == 10
+
+
+def test_login_rehashes_to_configured_cost(fake_db, mocker):
+    """
+    A login with a hash of another cost stores a hash of the configured cost.
+    """
+    from app.models.user import User, Status
+    from app.services.passwords import hash_cost
+
+    mocker.patch("app.services.passwords.BCRYPT_COST", 4)
+    User(email=TEST_EMAIL, password=TEST_PASSWORD).create()
+    User(email=TEST_EMAIL).update({"status": Status.ACTIVE.value})
+    version = User(email=TEST_EMAIL).select()["version"]
+
+    mocker.patch("app.services.passwords.BCRYPT_COST", 5)
+    assert User(email=TEST_EMAIL, password=TEST_PASSWORD).authenticate_user("phone")
+
+    stored = User(email=TEST_EMAIL).select()
+    assert hash_cost(stored["password"]) == 5
+    assert stored["version"] == version
+    assert User(email=TEST_EMAIL, password=TEST_PASSWORD).authenticate_user("phone")
+    assert User(email=TEST_EMAIL).select()["password"] == stored["password"]
+
+
+def test_rehash_keeps_changed_password(fake_db, mocker):
+    """
+    A password changed since it was checked is not overwritten.
+    """
+    from app.models.user import User
+
+    mocker.patch("app.services.passwords.BCRYPT_COST", 4)
+    User(email=TEST_EMAIL, password=TEST_PASSWORD).create()
+    checked = User(email=TEST_EMAIL).select()["password"]
+    User(email=TEST_EMAIL).update({"password": "the new one"})
+
+    assert not User(email=TEST_EMAIL, password=TEST_PASSWORD).rehash_password(checked)
+    assert User(email=TEST_EMAIL).select()["password"] != checked
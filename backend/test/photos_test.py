@@ -0,0 +1,246 @@
+"""
+This file contains the tests for the photos of the sightings.
+"""
+from datetime import timedelta
+import hashlib
+import io
+import os
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+import pytest
+
+EMAIL = "ada@cleancomm.com"
+PARIS = (48.8656, 2.3212)
+# EXIF tags of the orientation and GPS directory
+ORIENTATION, GPS_INFO = 0x0112, 0x8825
+
+
+def jpeg(width=640, height=480, color=(20, 120, 40), exif=True) -> bytes:
+    """A JPEG with its orientation and location"""
+    image = Image.new("RGB", (width, height), color)
+    buffer = io.BytesIO()
+    if exif:
+        tags = Image.Exif()
+        tags[ORIENTATION] = 6
+        tags[GPS_INFO] = {1: "N", 2: (48.0, 51.0, 56.0)}
+        image.save(buffer, "JPEG", exif=tags)
+    else:
+        image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def photos(tmp_path, monkeypatch):
+    """
+    Photos stored in a temporary directory, processed in the pool
+    """
+    from app.services import photos as service
+
+    monkeypatch.setattr(service, "PHOTOS_DIR", str(tmp_path))
+    yield service
+    service.shutdown()
+
+
+def gradient(reverse=False) -> bytes:
+    """A JPEG darkening from left to right, or the reverse"""
+    image = Image.new("L", (256, 64))
+    image.putdata([255 - column if reverse else column
+                   for _ in range(64) for column in range(256)])
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(fake_db, photos, monkeypatch):
+    """
+    Client of the sightings routes, with a connected user and a sighting
+    """
+    from app.controllers import sightings
+    from app.models import sighting
+    from app.models.sighting import create_sighting
+    from app.models.user import User
+    from app.services.geo_index import GeoIndex, GridAggregates, SpaceTimeBuckets
+
+    monkeypatch.setattr(sighting, "SIGHTING_INDEX", GeoIndex(0.01))
+    monkeypatch.setattr(sighting, "SIGHTING_CLUSTERS", GridAggregates(16))
+    monkeypatch.setattr(sighting, "SIGHTING_DUPLICATES", SpaceTimeBuckets(0.05, 1800, 10))
+    monkeypatch.setattr(sighting, "_built", False)
+    user = User(email=EMAIL)
+    sid = user.active_session("tests")
+    token = user.generate_token(EMAIL, expiration_time=timedelta(hours=1), sid=sid)
+    create_sighting(EMAIL, *PARIS, "Bags by the fountain")
+    app = FastAPI()
+    app.include_router(sightings.SIGHTINGS)
+    client = TestClient(app)
+    client.headers["Authorization"] = f"Bearer {token}"
+    return client
+
+
+def test_process_photo_strips_metadata(tmp_path):
+    """
+    Photos are turned as shot, saved without EXIF, and thumbnailed.
+    """
+    from app.services.photos import process_photo
+
+    source = tmp_path / "source.jpg"
+    source.write_bytes(jpeg())
+    process_photo(str(source), str(tmp_path / "photo.jpg"), str(tmp_path / "thumb.jpg"), 100)
+
+    with Image.open(tmp_path / "photo.jpg") as photo:
+        assert photo.size == (480, 640)
+        assert not photo.getexif() and "exif" not in photo.info
+    with Image.open(tmp_path / "thumb.jpg") as thumbnail:
+        assert thumbnail.size == (75, 100)
+
+    (tmp_path / "text.jpg").write_bytes(b"not an image")
+    with pytest.raises(ValueError):
+        process_photo(str(tmp_path / "text.jpg"), str(tmp_path / "a.jpg"),
+                      str(tmp_path / "b.jpg"))
+
+
+@pytest.mark.filterwarnings("ignore::PIL.Image.DecompressionBombWarning")
+def test_process_photo_limits_pixels(tmp_path, monkeypatch):
+    """
+    Images above PHOTO_MAX_PIXELS are refused, not only above twice the
+    limit of PIL.
+    """
+    from app.services import photos as service
+
+    source = tmp_path / "source.jpg"
+    source.write_bytes(jpeg(exif=False))
+    monkeypatch.setattr(service, "PHOTO_MAX_PIXELS", 640 * 480 - 1)
+    with pytest.raises(ValueError, match="pixels"):
+        service.process_photo(str(source), str(tmp_path / "a.jpg"), str(tmp_path / "b.jpg"))
+    assert not (tmp_path / "a.jpg").exists()
+
+
+def test_upload_photos(client, photos, tmp_path):
+    """
+    Photos are stored by digest, the same photo once.
+    """
+    body = jpeg()
+    digest = hashlib.sha256(body).hexdigest()
+    response = client.post("/sightings/1/photos", files=[
+        ("photo", ("a.jpg", body, "image/jpeg")),
+        ("photo", ("b.jpg", jpeg(color=(200, 0, 0), exif=False), "image/jpeg"))],
+        data={"caption": "ignored"})
+
+    assert response.status_code == 201
+    uploaded = response.json()["photos"]
+    assert uploaded[0] == {"digest": digest, "url": f"/sightings/photos/{digest}",
+                           "thumbnail_url": f"/sightings/photos/{digest}/thumbnail"}
+    assert os.path.exists(photos.photo_path(digest))
+    assert os.path.exists(photos.photo_path(digest, thumbnail=True))
+    # No temporary file is left
+    assert os.listdir(tmp_path / "tmp") == []
+
+    again = client.post("/sightings/1/photos", files={"photo": ("c.jpg", body, "image/jpeg")})
+    assert again.status_code == 201 and again.json()["photos"][0]["digest"] == digest
+    listed = client.get("/sightings/1/photos").json()["photos"]
+    # Photos of the same upload are listed by digest
+    assert [photo["digest"] for photo in listed] == sorted(photo["digest"] for photo in uploaded)
+    assert listed[0]["email"] == EMAIL
+
+    served = client.get(f"/sightings/photos/{digest}")
+    assert served.status_code == 200 and served.headers["content-type"] == "image/jpeg"
+    with Image.open(io.BytesIO(served.content)) as photo:
+        assert not photo.getexif()
+    assert client.get(f"/sightings/photos/{digest}/thumbnail").status_code == 200
+    assert client.get(f"/sightings/photos/{'0' * 64}").status_code == 404
+    assert client.get("/sightings/photos/..%2F..%2Fmain.py").status_code == 404
+
+
+def test_upload_errors(client, photos, tmp_path, monkeypatch):
+    """
+    Uploads that are not photos, too large or too many are refused and
+    leave no file behind.
+    """
+    files = {"photo": ("a.jpg", jpeg(), "image/jpeg")}
+    assert client.post("/sightings/9/photos", files=files).status_code == 404
+    assert client.post("/sightings/1/photos", content=jpeg(),
+                       headers={"Content-Type": "image/jpeg"}).status_code == 415
+    assert client.post("/sightings/1/photos", data={"caption": "no photo"},
+                       files={"empty": ("", b"", "text/plain")}).status_code == 400
+    assert client.post("/sightings/1/photos", files={
+        "photo": ("a.txt", b"not an image", "text/plain")}).status_code == 415
+
+    monkeypatch.setattr(photos, "PHOTO_WRITE_BUFFER", 1024)
+    response = client.post("/sightings/1/photos", files={
+        "photo": ("big.jpg", os.urandom(photos.PHOTO_MAX_BYTES + 1), "image/jpeg")})
+    assert response.status_code == 413
+    response = client.post("/sightings/1/photos", files=[
+        ("photo", (f"{index}.jpg", jpeg(exif=False), "image/jpeg"))
+        for index in range(photos.PHOTO_MAX_FILES + 1)])
+    assert response.status_code == 400
+
+    assert os.listdir(tmp_path / "tmp") == []
+    assert client.get("/sightings/1/photos").json() == {"photos": []}
+
+
+def test_refused_upload_removes_its_photos(client, photos):
+    """
+    An upload refused halfway removes the photos it stored, not those
+    stored before.
+    """
+    kept, new = jpeg(exif=False), jpeg(color=(0, 0, 200), exif=False)
+    assert client.post("/sightings/1/photos", files={
+        "photo": ("kept.jpg", kept, "image/jpeg")}).status_code == 201
+
+    response = client.post("/sightings/1/photos", files=[
+        ("photo", ("kept.jpg", kept, "image/jpeg")),
+        ("photo", ("new.jpg", new, "image/jpeg")),
+        ("photo", ("a.txt", b"not an image", "text/plain"))])
+    assert response.status_code == 415
+    assert os.path.exists(photos.photo_path(hashlib.sha256(kept).hexdigest()))
+    new_digest = hashlib.sha256(new).hexdigest()
+    assert not os.path.exists(photos.photo_path(new_digest))
+    assert not os.path.exists(photos.photo_path(new_digest, thumbnail=True))
+
+
+def test_report_with_photos(client):
+    """
+    Photos sent with a report are attached to it, and reports of the same
+    place with different photos are not duplicates.
+    """
+    uploaded = client.post("/sightings/photos", files=[
+        ("photo", ("a.jpg", gradient(), "image/jpeg")),
+        ("photo", ("b.jpg", gradient(reverse=True), "image/jpeg"))])
+    assert uploaded.status_code == 201
+    first, second = (photo["digest"] for photo in uploaded.json()["photos"])
+
+    def report(*digests):
+        return client.post("/sightings", json={"data": {
+            "latitude": PARIS[0], "longitude": PARIS[1], "photos": list(digests)}})
+
+    with_photo = report(first)
+    assert with_photo.status_code == 201 and with_photo.json()["duplicate_of"] == 1
+    assert [photo["digest"] for photo in client.get("/sightings/2/photos").json()["photos"]] == [
+        first]
+    # The sighting 1 has no photo, the sighting 2 has another one
+    assert report(second).json()["duplicate_of"] == 1
+    assert client.post("/sightings/1/resolve").status_code == 200
+    assert report(first).json()["duplicate_of"] is None
+    assert report(second).json()["duplicate_of"] is None
+    # Linked to the canonical report through a duplicate with both photos
+    assert report(first, second).json()["duplicate_of"] == 4
+
+    assert report("0" * 64).status_code == 400
+    assert report("not a digest").status_code == 400
+
+
+def test_photos_need_a_session(fake_db, photos):
+    """
+    Uploads need a session, photos are read without one.
+    """
+    from app.controllers import sightings
+
+    app = FastAPI()
+    app.include_router(sightings.SIGHTINGS)
+    client = TestClient(app)
+
+    response = client.post("/sightings/1/photos", files={"photo": ("a.jpg", jpeg(), "image/jpeg")})
+    assert response.status_code in (401, 403)
+    assert client.get(f"/sightings/photos/{'0' * 64}").status_code == 404
@@ -0,0 +1,198 @@
+"""
+This file contains the tests for the messages pushed to the connected users.
+"""
+import asyncio
+from datetime import timedelta
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+import pytest
+
+EMAIL = "ada@cleancomm.com"
+
+
+@pytest.fixture
+def broker(mocker):
+    """
+    An empty broker, used by the WebSocket route
+    """
+    from app.services.push import Broker
+
+    broker = Broker(queue_size=2)
+    mocker.patch("app.controllers.websocket.BROKER", broker)
+    return broker
+
+
+@pytest.fixture
+def client():
+    """
+    Client of the WebSocket routes
+    """
+    from app.controllers import websocket
+
+    app = FastAPI()
+    app.include_router(websocket.WEBSOCKET)
+    return TestClient(app)
+
+
+@pytest.fixture
+def session(fake_db):
+    """
+    Session id and token of a connected user
+    """
+    from app.models.user import User
+
+    user = User(email=EMAIL)
+    sid = user.active_session("tests")
+    return sid, user.generate_token(EMAIL, expiration_time=timedelta(hours=1), sid=sid)
+
+
+def test_broker_queues_and_evicts(broker):
+    """
+    Messages reach the connections of their user, a full queue evicts its connection.
+    """
+    from app.services.push import EVICTED
+
+    async def scenario():
+        first = broker.subscribe("ADA@cleancomm.com")
+        other = broker.subscribe("bob@cleancomm.com")
+        assert broker.connections == 2
+
+        assert broker.publish(EMAIL, {"event": "a"}) == 1
+        await asyncio.sleep(0)
+        assert await first.get() == {"event": "a"}
+        assert other.queue.empty()
+
+        for index in range(3):
+            broker.publish(EMAIL, {"event": index})
+        await asyncio.sleep(0)
+        assert first.evicted and await first.get() is EVICTED
+        assert first.queue.empty()
+
+        broker.unsubscribe(first)
+        assert broker.publish(EMAIL, {"event": "b"}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_listener_dispatch(broker, mocker):
+    """
+    Push messages and the pushed change events are forwarded, the others dropped.
+    """
+    from app.services.push import PushListener
+
+    publish = mocker.patch.object(broker, "publish", return_value=1)
+    cache = mocker.patch("app.services.push.PREFERENCES_CACHE")
+    listener = PushListener(broker, dsns=[])
+
+    assert listener.dispatch("user_notifications", json.dumps(
+        {"email": EMAIL, "event": "task.assigned", "payload": {"task": 3}})) == 1
+    assert listener.dispatch("user_changes", json.dumps(
+        {"id": 7, "email": EMAIL, "event": "notification.updated", "payload": {}})) == 1
+    assert listener.dispatch("user_changes", json.dumps(
+        {"id": 8, "email": EMAIL, "event": "session.created", "payload": {}})) == 0
+    assert listener.dispatch("user_notifications", "not json") == 0
+
+    assert [call.args for call in publish.call_args_list] == [
+        (EMAIL, {"event": "task.assigned", "payload": {"task": 3}}),
+        (EMAIL, {"event": "notification.updated", "payload": {}, "id": 7}),
+    ]
+    cache.pop.assert_called_once_with(EMAIL)
+
+
+def test_listener_syncs_on_connect(mocker):
+    """
+    The sightings index is synced every time the listener connects, from
+    the last notifications received.
+    """
+    import psycopg2
+    from app.services import push
+
+    listener = push.PushListener(mocker.MagicMock(), dsns=[])
+    sync = mocker.patch.object(push, "sync_index")
+    mocker.patch.object(push, "RECONNECT_DELAY", 0)
+    mocker.patch.object(listener, "_connect", return_value=[])
+    listens = []
+
+    def listen_once(_connections):
+        listens.append(len(sync.call_args_list))
+        if len(listens) == 2:
+            raise psycopg2.OperationalError("connection lost")
+        if len(listens) == 3:
+            listener.stopped.set()
+        return 0
+
+    mocker.patch.object(listener, "listen_once", side_effect=listen_once)
+    listener.run()
+
+    assert listener.listening.is_set()
+    # Synced before listening, and again after the connection was lost
+    assert listens == [1, 1, 2]
+    first, second = (call.args[0] for call in sync.call_args_list)
+    assert second > first
+
+
+def test_push_notifies_at_commit(fake_db):
+    """
+    push() sends its message on the push channel.
+    """
+    from app.services.push import push
+
+    push(fake_db, EMAIL, "mention", {"comment": 12})
+    fake_db.commit()
+
+    channel, payload = fake_db.connection.notifications[-1]
+    assert channel == "user_notifications"
+    assert json.loads(payload) == {"email": EMAIL, "event": "mention",
+                                   "payload": {"comment": 12}}
+
+
+# Test for route /ws/notifications =============================================
+def test_socket_receives_messages(client, broker, session):
+    """
+    Messages of the user are pushed, the session end closes its connection.
+    """
+    sid, token = session
+    with client.websocket_connect("/ws/notifications",
+                                  headers={"Authorization": f"Bearer {token}"}) as socket:
+        assert broker.connections == 1
+        broker.publish(EMAIL, {"event": "mention", "payload": {"comment": 12}})
+        assert socket.receive_json() == {"event": "mention", "payload": {"comment": 12}}
+
+        broker.publish(EMAIL, {"event": "session.ended", "payload": {"sid": sid}})
+        assert socket.receive_json()["event"] == "session.ended"
+        with pytest.raises(WebSocketDisconnect) as closed:
+            socket.receive_json()
+        assert closed.value.code == 1008
+    assert broker.connections == 0
+
+
+def test_socket_token_subprotocol(client, broker, session):
+    """
+    Browsers offer their token as a subprotocol, the URL never carries it.
+    """
+    _, token = session
+    with client.websocket_connect("/ws/notifications",
+                                  subprotocols=["bearer", token]) as socket:
+        assert socket.accepted_subprotocol == "bearer"
+        assert broker.connections == 1
+
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with client.websocket_connect(f"/ws/notifications?access_token={token}"):
+            pass
+    assert closed.value.code == 1008
+
+
+@pytest.mark.parametrize("token", [None, "invalid"])
+def test_socket_refused(client, broker, fake_db, token):
+    """
+    Connections without a valid token are closed before the handshake.
+    """
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with client.websocket_connect("/ws/notifications", headers=headers):
+            pass
+    assert closed.value.code == 1008
+    assert broker.connections == 0
@@ -1,85 +1,237 @@
 """
 Test required_packages.py
 """
+import contextvars
+from datetime import datetime
+import threading
+
+import psycopg2
 import pytest
 
+INSERT_QUERY = """
+    INSERT INTO users (email, password, created_date, updated_date, status)
+    VALUES (%s, %s, %s, %s, %s)
+"""
+
 
-@pytest.fixture
-def mock_postgres_db(mocker):
-    """mock"""
-    from app.resources.required_packages import PostgresDatabase
-    db = mocker.patch("app.resources.required_packages.PostgresDatabase", new_calable=PostgresDatabase())
-
-    mock_connection = mocker.MagicMock()
-    mock_cursor = mocker.MagicMock()
-    mock_connection.cursor.return_value = mock_cursor
-    db.connection = mock_connection
-    db.cursor = mocker.MagicMock()
-    db.execute = mocker.MagicMock()
-    db.cursor.execute = db.execute
-    db.fetch_one = mocker.MagicMock()
-    db.cursor.fetchone = db.fetch_one
-    db.fetchall = mocker.MagicMock()
-    db.cursor.fetchall = db.fetch_all
-    db.commit = mocker.MagicMock()
-    db.rollback = mocker.MagicMock()
-    db.close = mocker.MagicMock()
-    return db
-
-
-def test_execute(mocker, mock_postgres_db):
+def insert(db, email):
+    """Insert a minimal user"""
+    db.execute(INSERT_QUERY, (email, "hash", datetime.utcnow(), datetime.utcnow(), 1))
+
+
+def test_execute(fake_db):
     """
     Test execute method
     """
     query = "SELECT * FROM users"
-    mock_postgres_db.execute(query)
+    fake_db.execute(query)
+    assert [desc[0] for desc in fake_db.cursor.description][:2] == ["id", "email"]
 
-    mock_postgres_db.execute.assert_called_once_with(query)
-    mock_postgres_db.cursor.execute.assert_called_once_with(query)
 
-def test_fetch_one(mocker, mock_postgres_db):
+def test_fetch_one(fake_db):
     """
     Test fetch_one method
     """
-    query = "SELECT * FROM users"
-    mock_postgres_db.execute(query)
-    mock_postgres_db.cursor.fetchone.return_value = ('John', 'Doe')
-    result = mock_postgres_db.fetch_one()
-    mock_postgres_db.cursor.execute.assert_called_once_with(query)
-    mock_postgres_db.cursor.fetchone.assert_called_once_with()
-    assert result == ('John', 'Doe')
+    insert(fake_db, "john@doe.com")
+    fake_db.execute("SELECT email, status FROM users WHERE email = %s", ("john@doe.com",))
+    result = fake_db.fetch_one()
+    assert result == ("john@doe.com", 1)
 
 
-def test_fetch_all(mocker, mock_postgres_db):
+def test_fetch_all(fake_db):
     """
     Test fetch_all method
     """
-    query = "SELECT * FROM users LIMIT 10"
-    mock_postgres_db.execute(query)
-    mock_postgres_db.fetch_all.return_value = [('Alice', 'Smith'), ('Bob', 'Johnson')]
-    result = mock_postgres_db.fetch_all()
-    mock_postgres_db.cursor.execute.assert_called_once_with(query)
-    mock_postgres_db.cursor.fetchall.assert_called_once_with()
-    assert result == [('Alice', 'Smith'), ('Bob', 'Johnson')]
+    insert(fake_db, "alice@smith.com")
+    insert(fake_db, "bob@johnson.com")
+    fake_db.execute("SELECT email FROM users ORDER BY id LIMIT 10")
+    result = fake_db.fetch_all()
+    assert result == [("alice@smith.com",), ("bob@johnson.com",)]
 
 
-def test_commit(mocker, mock_postgres_db):
+def test_commit(fake_db):
     """
     Test commit method
     """
-    mock_postgres_db.commit()
-    mock_postgres_db.commit.assert_called_once_with()
+    insert(fake_db, "john@doe.com")
+    fake_db.commit()
+    fake_db.rollback()
+    fake_db.execute("SELECT count(*) FROM users")
+    assert fake_db.fetch_one() == (1,)
 
 
-def test_rollback(mocker, mock_postgres_db):
+def test_rollback(fake_db):
     """
     Test rollback method
     """
-    mock_postgres_db.rollback()
-    mock_postgres_db.rollback.assert_called_once_with()
+    insert(fake_db, "john@doe.com")
+    fake_db.rollback()
+    fake_db.execute("SELECT count(*) FROM users")
+    assert fake_db.fetch_one() == (0,)
+
+
+def test_integrity_error(fake_db):
+    """
+    Constraint violations raise psycopg2.IntegrityError with their pgcode
+    """
+    import psycopg2.errorcodes
+
+    insert(fake_db, "john@doe.com")
+    with pytest.raises(psycopg2.IntegrityError) as error:
+        insert(fake_db, "john@doe.com")
+    assert error.value.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION
 
-def test_close(mocker, mock_postgres_db):
+
+def test_close(fake_db):
     """Test close method"""
 
-    mock_postgres_db.close()
-    mock_postgres_db.close.assert_called_once_with()
\ No newline at end of file
+    fake_db.close()
+    assert fake_db.connection.closed
+
+
+@pytest.fixture
+def replicated_db(mocker):
+    """
+    Fake primary with one fake replica, lagging 0.1s
+    """
+    from fake_postgres import FakeConnection, fake_database
+    from app.resources.required_packages import Replica
+
+    mocker.patch.object(Replica, "_lag", return_value=(0.1, True))
+    database = fake_database()
+    replica = Replica("dbname=replica")
+    replica.connection = FakeConnection()
+    replica.cursor = replica.connection.cursor()
+    database.replicas = [replica]
+    # The replica has a user the primary does not, to tell them apart
+    insert(replica.cursor, "replica@cleancomm.com")
+    yield database
+    database.close()
+
+
+def read_emails(db):
+    """Return the emails of the users table the read was routed to"""
+    db.execute("SELECT email FROM users ORDER BY id")
+    return [email for (email,) in db.fetch_all()]
+
+
+def test_reads_go_to_replica(replicated_db):
+    """
+    Reads run on a healthy replica
+    """
+    assert read_emails(replicated_db) == ["replica@cleancomm.com"]
+    assert replicated_db.replicas[0].lag == 0.1
+
+
+def test_read_your_writes(replicated_db, mocker):
+    """
+    After a write, reads stay on the primary for the window
+    """
+    from app.resources import required_packages
+
+    insert(replicated_db, "john@doe.com")
+    assert read_emails(replicated_db) == ["john@doe.com"]
+    replicated_db.commit()
+    assert read_emails(replicated_db) == ["john@doe.com"]
+
+    now = required_packages.time.monotonic()
+    mocker.patch.object(required_packages.time, "monotonic",
+                        return_value=now + required_packages.READ_YOUR_WRITES_WINDOW + 1)
+    assert read_emails(replicated_db) == ["replica@cleancomm.com"]
+
+
+def test_read_your_writes_per_scope(replicated_db):
+    """
+    A write keeps on the primary the reads of its own scope only
+    """
+    from app.resources.required_packages import set_read_scope
+
+    def as_user(email, action):
+        def scoped():
+            set_read_scope(email)
+            return action()
+        return contextvars.copy_context().run(scoped)
+
+    as_user("ada@cleancomm.com", lambda: insert(replicated_db, "ada@cleancomm.com"))
+    replicated_db.commit()
+    assert as_user("ada@cleancomm.com", lambda: read_emails(replicated_db)) == [
+        "ada@cleancomm.com"]
+    assert as_user("bob@cleancomm.com", lambda: read_emails(replicated_db)) == [
+        "replica@cleancomm.com"]
+
+
+def test_cursor_per_thread(replicated_db):
+    """
+    Every statement runs on a cursor of its own, seen by its thread only,
+    and the previous cursor of the thread is closed
+    """
+    read_emails(replicated_db)
+    replica_cursor = replicated_db.cursor
+    assert replica_cursor.connection is replicated_db.replicas[0].connection
+    assert replica_cursor is not replicated_db.replicas[0].cursor
+
+    def write_then_wait(started, resume, seen):
+        insert(replicated_db, "thread@cleancomm.com")
+        started.set()
+        resume.wait()
+        seen.append((replicated_db.in_write, replicated_db.fetch_one()))
+
+    started, resume, seen = threading.Event(), threading.Event(), []
+    thread = threading.Thread(target=write_then_wait, args=(started, resume, seen))
+    thread.start()
+    started.wait()
+    # The write of the other thread keeps only its own reads on the primary
+    assert not replicated_db.in_write
+    assert read_emails(replicated_db) == ["replica@cleancomm.com"]
+    with pytest.raises(Exception):
+        replica_cursor.fetchall()
+    resume.set()
+    thread.join()
+    assert seen == [(True, None)]
+    assert replicated_db.cursor is not replica_cursor
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT email FROM users WHERE email = %s FOR UPDATE",
+    "UPDATE users SET lang = 'fr' WHERE email = %s",
+])
+def test_writes_and_locks_go_to_primary(replicated_db, query):
+    """
+    Writes and locking reads never run on a replica
+    """
+    assert not replicated_db.is_read(query)
+    replicated_db.execute(query, ("replica@cleancomm.com",))
+    assert replicated_db.cursor.connection is replicated_db.connection
+
+
+def test_lagging_replica_is_skipped(replicated_db, mocker):
+    """
+    A replica lagging more than REPLICA_MAX_LAG is not read
+    """
+    from app.resources.required_packages import Replica
+
+    mocker.patch.object(Replica, "_lag", return_value=(60.0, True))
+    assert read_emails(replicated_db) == []
+    assert not replicated_db.replicas[0].healthy
+
+
+def test_failover_to_primary(replicated_db, mocker):
+    """
+    A replica failing a read is taken out and the read retried on the primary
+    """
+    replica = replicated_db.replicas[0]
+    read_emails(replicated_db)
+    mocker.patch.object(replica.connection, "cursor", side_effect=psycopg2.OperationalError)
+
+    assert read_emails(replicated_db) == []
+    assert not replica.healthy
+    assert replica.connection is None
+
+
+def test_primary_block(replicated_db):
+    """
+    Inside primary(), reads run on the primary
+    """
+    with replicated_db.primary():
+        assert read_emails(replicated_db) == []
+    assert read_emails(replicated_db) == ["replica@cleancomm.com"]
@@ -69,3 +69,22 @@ def test_send_recovery_mail(mocker):
         )
         == 200
     )
+
+
+
+def test_send_recovery_mails(mocker, capsys):
+    """
+    The reset links of an import are mailed in one SMTP session, not printed
+    """
+    from app.services.send_mail import send_recovery_mails
+
+    server = mocker.patch("app.services.send_mail.smtplib.SMTP").return_value.__enter__.return_value
+    recoveries = [{"token": f"token-{index}", "host": "https://host-test-frontend.com",
+                   "email": f"user{index}@example.com", "first_name": "Toto", "lang": "fr"}
+                  for index in range(3)]
+
+    assert send_recovery_mails(recoveries) == 200
+    assert [call.args[1] for call in server.sendmail.call_args_list] == [
+        "user0@example.com", "user1@example.com", "user2@example.com"]
+    assert "reset-password/token-1" in server.sendmail.call_args_list[1].args[2]
+    assert "token-" not in capsys.readouterr().out
@@ -0,0 +1,318 @@
+"""
+Test of the session stores
+"""
+from datetime import timedelta
+import time
+from unittest.mock import MagicMock
+
+import jwt
+import pytest
+
+TEST_EMAIL = "cleancomm@gmail.com"
+TTL = timedelta(hours=1)
+
+
+class FakeRedis:
+    """
+    Minimal client speaking the commands used by RedisSessionStore
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.hashes.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.hashes
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field) if self._alive(key) else None
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {})) if self._alive(key) else {}
+
+    def hvals(self, key):
+        return list(self.hgetall(key).values())
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        values = self.hashes.setdefault(key, {})
+        if mapping:
+            values.update(mapping)
+        if field is not None:
+            values[field] = value
+
+    def hdel(self, key, *fields):
+        values = self.hashes.get(key, {})
+        return sum(values.pop(field, None) is not None for field in fields)
+
+    def expire(self, key, ttl):
+        self.expires[key] = time.time() + ttl.total_seconds()
+
+    def exists(self, key):
+        return int(self._alive(key))
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.expires.pop(key, None)
+
+    def scan_iter(self, match):
+        prefix = match.rstrip("*")
+        return [key for key in list(self.hashes) if key.startswith(prefix)]
+
+
+class FakePipeline:
+    """
+    Queue commands and run them on execute
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.client, name), args, kwargs))
+        return queue
+
+    def execute(self):
+        return [command(*args, **kwargs) for command, args, kwargs in self.commands]
+
+
+@pytest.fixture(params=["memory", "redis", "postgres"])
+def store(request):
+    """Session stores that keep state"""
+    from app.services.session_store import (
+        MemorySessionStore, RedisSessionStore, PostgresSessionStore)
+
+    if request.param == "memory":
+        return MemorySessionStore()
+    if request.param == "postgres":
+        database = request.getfixturevalue("fake_db")
+        return PostgresSessionStore(database, database)
+    return RedisSessionStore(client=FakeRedis())
+
+
+@pytest.fixture
+def behind_store(fake_db, mocker):
+    """Postgres store flushing only when asked"""
+    from app.services.session_store import PostgresSessionStore
+
+    store = PostgresSessionStore(fake_db, fake_db)
+    store.writes.interval = 3600
+    mocker.spy(fake_db, "execute_values")
+    return store
+
+
+def stored_sids(database):
+    """Return the sids of the user_sessions table"""
+    database.execute("SELECT sid FROM user_sessions ORDER BY sid")
+    return [sid for (sid,) in database.fetch_all()]
+
+
+def test_sessions_per_device(store):
+    """
+    Logging in on a second device keeps the first session.
+    """
+    phone = store.create(TEST_EMAIL, "phone", TTL)
+    laptop = store.create(TEST_EMAIL, "laptop", TTL)
+
+    assert store.is_active(phone)
+    assert store.is_active(laptop)
+    assert store.has_active(TEST_EMAIL)
+
+
+def test_session_replaced_on_same_device(store):
+    """
+    Logging in again on a device replaces its session.
+    """
+    first = store.create(TEST_EMAIL, "phone", TTL)
+    second = store.create(TEST_EMAIL, "phone", TTL)
+
+    assert not store.is_active(first)
+    assert store.is_active(second)
+
+
+def test_end_session(store):
+    """
+    Ending a session leaves the other devices connected.
+    """
+    phone = store.create(TEST_EMAIL, "phone", TTL)
+    laptop = store.create(TEST_EMAIL, "laptop", TTL)
+
+    store.end(phone)
+    assert not store.is_active(phone)
+    assert store.is_active(laptop)
+
+    store.end_all(TEST_EMAIL)
+    assert not store.is_active(laptop)
+    assert not store.has_active(TEST_EMAIL)
+
+
+def test_session_expiry_and_sweep(store):
+    """
+    Expired sessions are inactive and removed by sweep.
+    """
+    live = store.create(TEST_EMAIL, "laptop", TTL)
+    expired = store.create(TEST_EMAIL, "phone", timedelta(seconds=-1))
+
+    assert not store.is_active(expired)
+    assert store.sweep() == 1
+    assert store.is_active(live)
+
+
+def test_postgres_store_queries():
+    """
+    The postgres store reads and writes the user_sessions table only.
+    """
+    from app.services.session_store import PostgresSessionStore
+
+    postgres_db = MagicMock()
+    store = PostgresSessionStore(postgres_db)
+
+    sid = store.create(TEST_EMAIL, "phone", TTL)
+    query, params = postgres_db.execute.call_args_list[0].args
+    assert "user_sessions" in query.string
+    assert params[:3] == (sid, TEST_EMAIL, "phone")
+    postgres_db.commit.assert_called()
+
+    postgres_db.fetch_one.return_value = None
+    assert store.is_active(sid) is False
+    postgres_db.fetch_one.return_value = (1,)
+    assert store.is_active(sid) is True
+
+
+def test_login_token_carries_session(mocker):
+    """
+    The token returned at login identifies its session.
+    """
+    from app.models.user import User, Status
+    from app.services.session_store import MemorySessionStore
+    import bcrypt
+
+    store = MemorySessionStore()
+    mocker.patch("app.models.user.SESSION_STORE", store)
+    mocker.patch.object(bcrypt, "checkpw", return_value=True)
+    mocker.patch.object(User, "select", return_value={
+        "email": TEST_EMAIL, "password": "b'hashed'", "host": "", "first_name": "",
+        "last_name": "", "lang": "fr", "created_date": "", "updated_date": "",
+        "status": Status.ACTIVE.value,
+    })
+
+    user = User(email=TEST_EMAIL, password="password")
+    token = user.authenticate_user(device="phone")["access_token"]
+    sid = jwt.decode(token, options={"verify_signature": False})["sid"]
+
+    assert user.is_session_active(sid)
+    user.end_session(sid)
+    assert not user.is_session_active(sid)
+
+
+def test_write_behind_coalesces_logins(behind_store, fake_db):
+    """
+    Logins written behind on a device are coalesced in one row write.
+    """
+    sids = [behind_store.create(TEST_EMAIL, "phone", TTL, sync=False) for _ in range(3)]
+    laptop = behind_store.create(TEST_EMAIL, "laptop", TTL, sync=False)
+
+    assert stored_sids(fake_db) == []
+    assert [behind_store.is_active(sid) for sid in sids] == [False, False, True]
+    assert behind_store.has_active(TEST_EMAIL)
+
+    assert behind_store.writes.flush() == 2
+    session_writes = [call for call in fake_db.execute_values.call_args_list
+                      if "user_sessions" in call.args[0].string]
+    assert len(session_writes) == 1
+    assert stored_sids(fake_db) == sorted([sids[-1], laptop])
+    assert behind_store.is_active(sids[-1]) and not behind_store.is_active(sids[0])
+
+
+def test_write_behind_keeps_order(behind_store, fake_db):
+    """
+    Ends written behind follow the creates, ending everything is at once.
+    """
+    phone = behind_store.create(TEST_EMAIL, "phone", TTL)
+    behind_store.end(phone, sync=False)
+    laptop = behind_store.create(TEST_EMAIL, "laptop", TTL, sync=False)
+    behind_store.end(laptop, sync=False)
+
+    assert not behind_store.is_active(phone) and not behind_store.is_active(laptop)
+    assert stored_sids(fake_db) == [phone]
+    behind_store.writes.flush()
+    assert stored_sids(fake_db) == []
+
+    tablet = behind_store.create(TEST_EMAIL, "tablet", TTL, sync=False)
+    behind_store.end_all(TEST_EMAIL)
+    assert not behind_store.is_active(tablet)
+    assert len(behind_store.writes) == 0
+
+
+def test_touch_writes_last_seen_behind(behind_store, fake_db):
+    """
+    The last use of a session is coalesced and written by the next flush.
+    """
+    sid = behind_store.create(TEST_EMAIL, "phone", TTL)
+    for _ in range(5):
+        behind_store.touch(sid)
+
+    fake_db.execute("SELECT last_seen FROM user_sessions WHERE sid = %s", (sid,))
+    assert fake_db.fetch_one() == (None,)
+    assert behind_store.writes.flush() == 1
+    fake_db.execute("SELECT last_seen FROM user_sessions WHERE sid = %s", (sid,))
+    assert fake_db.fetch_one()[0] is not None
+
+
+def test_write_behind_buffer_flushes(mocker):
+    """
+    The buffer flushes when due or full, and keeps the writes of a failed flush.
+    """
+    from app.services.write_behind import WriteBehindBuffer, flush_all
+
+    flushed = []
+    buffer = WriteBehindBuffer(flushed.append, interval=3600, max_pending=3)
+    buffer.put("a", 1)
+    buffer.put("b", 2)
+    buffer.put("a", 3)
+    assert flushed == []
+    buffer.put("c", 4)
+    assert flushed == [[("b", 2), ("a", 3), ("c", 4)]]
+
+    buffer.put("d", 5)
+    flush_all()
+    assert flushed[-1] == [("d", 5)]
+
+    failing = WriteBehindBuffer(mocker.Mock(side_effect=RuntimeError), interval=0)
+    failing.put("e", 6)
+    assert failing.get("e") == 6
+    with pytest.raises(RuntimeError):
+        failing.flush()
+    assert failing.values() == [6]
+
+
+def test_write_behind_flusher(behind_store, fake_db):
+    """
+    Writes left alone are flushed by the flusher thread, through the
+    connection of the flushes.
+    """
+    from app.services.write_behind import WriteBehindFlusher
+
+    behind_store.writes.interval = 0.05
+    sid = behind_store.create(TEST_EMAIL, "phone", TTL, sync=False)
+    assert stored_sids(fake_db) == []
+
+    flusher = WriteBehindFlusher(interval=0.05)
+    flusher.start()
+    try:
+        for _ in range(100):
+            if stored_sids(fake_db):
+                break
+            time.sleep(0.02)
+    finally:
+        flusher.stop()
+    assert stored_sids(fake_db) == [sid]
+    assert len(behind_store.writes) == 0
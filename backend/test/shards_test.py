@@ -0,0 +1,188 @@
+"""
+Test of the hash sharding of users
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from fake_postgres import fake_database
+
+NOTIF_INSERT_QUERY = "INSERT INTO notification (user_mail, preferences) VALUES (%s, %s)"
+TASK_ASSIGNED = 256
+
+
+def two_shards(buckets=16):
+    """Return a map giving half of the buckets to a and half to b"""
+    from app.resources.shards import ShardMap
+
+    return ShardMap({"a": {"dsn": "a", "buckets": [[0, buckets // 2 - 1]]},
+                     "b": {"dsn": "b", "buckets": [[buckets // 2, buckets - 1]]}}, buckets)
+
+
+@pytest.fixture
+def shard_dbs(connect):
+    """
+    Three local Postgres stand-ins
+    """
+    databases = {name: fake_database() for name in ("a", "b", "c")}
+    yield databases
+    for database in databases.values():
+        database.close()
+
+
+@pytest.fixture
+def sharded(shard_dbs, mocker):
+    """
+    Users sharded between a and b
+    """
+    from app.models import user as user_module
+    from app.resources.shards import ShardRouter
+
+    router = ShardRouter(two_shards(), {"a": shard_dbs["a"], "b": shard_dbs["b"]})
+    mocker.patch.object(user_module, "SHARDS", router)
+    mocker.patch("app.services.passwords.BCRYPT_COST", 4)
+    return router
+
+
+def emails_of(database):
+    """Return the emails stored in database"""
+    database.execute("SELECT email FROM users ORDER BY email")
+    return [email for (email,) in database.fetch_all()]
+
+
+def create_users(count):
+    """Create count users a minute apart, return their emails"""
+    from app.models.user import User
+
+    emails = []
+    for index in range(count):
+        user = User(email=f"user{index}@cleancomm.com", password="password", host="h",
+                    first_name="F", last_name="L", lang="en")
+        user.create()
+        emails.append(user.email)
+    return emails
+
+
+def test_bucket_of_is_stable():
+    """
+    Buckets do not depend on the process nor the case of the email
+    """
+    from app.resources.shards import bucket_of
+
+    assert bucket_of("john@doe.com") == bucket_of("  John@Doe.COM ")
+    assert bucket_of("john@doe.com", 1024) == 695
+    assert len({bucket_of(f"user{index}@cleancomm.com", 16) for index in range(200)}) == 16
+
+
+@pytest.mark.parametrize("buckets", [
+    {"a": [[0, 7]], "b": [[7, 15]]},
+    {"a": [[0, 6]], "b": [[8, 15]]},
+    {"a": [[0, 7]], "b": [[8, 16]]},
+])
+def test_shard_map_must_cover_buckets_once(buckets):
+    """
+    Maps with overlapping, missing or out of range buckets are refused
+    """
+    from app.resources.shards import ShardMap
+
+    with pytest.raises(ValueError):
+        ShardMap({name: {"dsn": name, "buckets": ranges} for name, ranges in buckets.items()}, 16)
+
+
+def test_users_are_routed_to_their_shard(sharded, shard_dbs):
+    """
+    Users are created in and read from the shard of their email only
+    """
+    from app.models.user import User
+
+    emails = create_users(10)
+
+    for name in ("a", "b"):
+        expected = sorted(email for email in emails if sharded.shard_map.shard_of(email) == name)
+        assert emails_of(shard_dbs[name]) == expected
+        assert expected
+    assert User(email="USER3@cleancomm.com").select()["email"] == "user3@cleancomm.com"
+    assert User(email="user3@cleancomm.com").update({"lang": "fr"})["lang"] == "fr"
+
+
+def test_list_users_merges_shards(sharded, mocker):
+    """
+    Pages are merged from every shard, newest first
+    """
+    from app.models import user as user_module
+
+    start = datetime(2024, 1, 1)
+    for index in range(7):
+        mocker.patch.object(user_module, "datetime", mocker.Mock(
+            utcnow=mocker.Mock(return_value=start + timedelta(minutes=index))))
+        user_module.User(email=f"user{index}@cleancomm.com", password="p").create()
+
+    emails, after = [], None
+    while True:
+        users, after = user_module.list_users(3, after)
+        emails.extend(user["email"] for user in users)
+        if after is None:
+            break
+    assert emails == [f"user{index}@cleancomm.com" for index in range(6, -1, -1)]
+    assert user_module.estimate_user_count() == 7
+
+
+def test_list_users_ties_across_shards(sharded, mocker):
+    """
+    Users of different shards with the same created_date and id are all
+    listed once
+    """
+    from app.models import user as user_module
+
+    mocker.patch.object(user_module, "datetime", mocker.Mock(
+        utcnow=mocker.Mock(return_value=datetime(2024, 1, 1))))
+    emails = create_users(8)
+    # Every shard numbers its users from 1
+    assert {sharded.shard_map.shard_of(email) for email in emails} == {"a", "b"}
+
+    listed, after = [], None
+    while True:
+        users, after = user_module.list_users(3, after)
+        listed.extend(user["email"] for user in users)
+        if after is None:
+            break
+    assert sorted(listed) == sorted(emails)
+
+
+def test_backfill_and_cleanup(shard_dbs):
+    """
+    Moving buckets copies the users and their settings, then deletes the old rows
+    """
+    from app.resources.shards import ShardMap, ShardRouter, backfill, cleanup
+
+    old = ShardRouter(ShardMap({"a": {"dsn": "a", "buckets": [[0, 15]]}}, 16),
+                      {"a": shard_dbs["a"]})
+    new = ShardRouter(ShardMap({"a": {"dsn": "a", "buckets": [[0, 7]]},
+                                "c": {"dsn": "c", "buckets": [[8, 15]]}}, 16),
+                      {"a": shard_dbs["a"], "c": shard_dbs["c"]})
+    now = datetime.utcnow()
+    emails = [f"user{index}@cleancomm.com" for index in range(12)]
+    for email in emails:
+        shard_dbs["a"].execute(
+            "INSERT INTO users (email, password, created_date, updated_date, status) "
+            "VALUES (%s, %s, %s, %s, %s)", (email, "hash", now, now, 1))
+        shard_dbs["a"].execute(NOTIF_INSERT_QUERY, (email, TASK_ASSIGNED))
+    shard_dbs["a"].commit()
+    moved = sorted(email for email in emails if new.shard_map.shard_of(email) == "c")
+
+    assert backfill(old, new) == len(moved)
+    assert emails_of(shard_dbs["c"]) == moved
+    shard_dbs["c"].execute("SELECT count(*) FROM notification WHERE preferences & 256 <> 0")
+    assert shard_dbs["c"].fetch_one() == (len(moved),)
+
+    # Writes on the old shard are copied again, newest row wins
+    shard_dbs["a"].execute("UPDATE users SET lang = 'fr', updated_date = %s WHERE email = %s",
+                           (now + timedelta(seconds=1), moved[0]))
+    shard_dbs["a"].commit()
+    assert backfill(old, new) == len(moved)
+    shard_dbs["c"].execute("SELECT lang FROM users WHERE email = %s", (moved[0],))
+    assert shard_dbs["c"].fetch_one() == ("fr",)
+
+    assert cleanup(old, new) == len(moved)
+    assert emails_of(shard_dbs["a"]) == sorted(set(emails) - set(moved))
+    assert emails_of(shard_dbs["c"]) == moved
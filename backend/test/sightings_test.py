@@ -0,0 +1,438 @@
+"""
+This file contains the tests for the waste sightings and their index.
+"""
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+EMAIL = "ada@cleancomm.com"
+# Place de la Concorde, and points at about 1 km and 5 km
+PARIS = (48.8656, 2.3212)
+NEAR = (48.8746, 2.3212)
+FAR = (48.9106, 2.3212)
+
+
+def test_haversine_km():
+    """
+    Distances follow the great circles.
+    """
+    from app.services.geo_index import haversine_km
+
+    assert haversine_km(*PARIS, *PARIS) == 0
+    assert haversine_km(*PARIS, *NEAR) == pytest.approx(1.0, abs=0.01)
+    assert haversine_km(0, 179.5, 0, -179.5) == pytest.approx(111.2, abs=0.1)
+
+
+def test_geo_index_queries():
+    """
+    Box and radius queries return the points of their cells, across the
+    antimeridian and around the poles.
+    """
+    from app.services.geo_index import GeoIndex
+
+    index = GeoIndex(0.01)
+    points = {1: PARIS, 2: NEAR, 3: FAR, 4: (0, 179.99), 5: (0, -179.99), 6: (89.999, 0),
+              7: (89.999, 180)}
+    for key, (latitude, longitude) in points.items():
+        index.add(key, latitude, longitude, {"key": key})
+
+    assert [point[0] for point in index.in_bbox(48.8, 2.3, 48.88, 2.4)] == [1, 2]
+    assert [point[0] for point in index.in_bbox(-1, 179, 1, -179)] == [4, 5]
+    assert [(round(distance, 2), key) for distance, key, *_ in index.nearby(*PARIS, 2)] == [
+        (0, 1), (1.0, 2)]
+    assert [key for _, key, *_ in index.nearby(0, 180, 5)] == [4, 5]
+    assert [key for _, key, *_ in index.nearby(90, 0, 1)] == [6, 7]
+
+    # Moved and removed points leave their cell
+    index.add(1, *FAR, {"key": 1})
+    assert [key for _, key, *_ in index.nearby(*FAR, 0.5)] == [1, 3]
+    assert index.remove(3) and not index.remove(3)
+    assert index.get(3) is None and len(index) == 6
+
+    with pytest.raises(ValueError):
+        index.add(8, 91, 0)
+
+
+def test_grid_aggregates():
+    """
+    Clusters are the cells of the zoom, at the mean of their points, with
+    the key of the single points.
+    """
+    from app.services.geo_index import GridAggregates
+
+    grid = GridAggregates(12)
+    for key, point in ((1, PARIS), (2, NEAR), (3, FAR), (4, (0, 179.9)), (5, (0, -179.9))):
+        grid.add(key, *point)
+
+    assert grid.clusters(48, 2, 49, 3, 0) == [
+        {"count": 3, "latitude": 48.883600, "longitude": 2.3212}]
+    assert grid.clusters(48, 2, 49, 3, 12) == [
+        {"count": 1, "latitude": PARIS[0], "longitude": PARIS[1], "key": 1},
+        {"count": 1, "latitude": NEAR[0], "longitude": NEAR[1], "key": 2},
+        {"count": 1, "latitude": FAR[0], "longitude": FAR[1], "key": 3}]
+    assert [cluster["key"] for cluster in grid.clusters(-1, 179, 1, -179, 8)] == [5, 4]
+    assert grid.cells(48, 2, 49, 3, 0) == 1 and grid.cells(-90, -180, 90, 180, 0) == 4 * 8
+
+    grid.remove(1, *PARIS)
+    grid.remove(3, *FAR)
+    assert grid.clusters(48, 2, 49, 3, 0) == [
+        {"count": 1, "latitude": NEAR[0], "longitude": NEAR[1], "key": 2}]
+    grid.remove(2, *NEAR)
+    assert grid.clusters(48, 2, 49, 3, 0) == []
+
+
+def test_space_time_buckets():
+    """
+    Points are found near in space and time, with a similar hash when both
+    have some, and the old windows are dropped.
+    """
+    from app.services.geo_index import SpaceTimeBuckets
+
+    buckets = SpaceTimeBuckets(0.05, 1800, 4)
+    buckets.add(1, *PARIS, 1000, (0b1111,), "a")
+    buckets.add(2, 48.8659, 2.3212, 1200, (), "b")
+    buckets.add(3, 0, 179.9999, 1000, (), "c")
+
+    # Points at about 10 m and 20 m, nearest first
+    assert buckets.find(48.8658, 2.3212, 2500) == (2, "b")
+    assert buckets.find(48.8655, 2.3212, 2500) == (1, "a")
+    assert buckets.find(48.8655, 2.3212, 2500, (0b0111,)) == (1, "a")
+    assert buckets.find(48.8655, 2.3212, 2500, (0xff00,)) == (2, "b")
+    assert buckets.find(*NEAR, 1000) is None
+    assert buckets.find(*PARIS, 3100) is None
+    assert buckets.find(0, -179.9999, 1000) == (3, "c")
+    assert buckets.remove(3) and not buckets.remove(3)
+    assert buckets.find(0, -179.9999, 1000) is None
+
+    # Windows too old for the new points are dropped
+    buckets.add(4, *FAR, 5400)
+    assert len(buckets) == 1 and buckets.find(*PARIS, 1000) is None
+    buckets.add(5, *PARIS, 1000)
+    assert len(buckets) == 1
+
+
+@pytest.fixture
+def index(monkeypatch):
+    """
+    Empty sightings index, built on the first query
+    """
+    from app.models import sighting
+    from app.services.geo_index import GeoIndex, GridAggregates, SpaceTimeBuckets
+
+    monkeypatch.setattr(sighting, "SIGHTING_INDEX", GeoIndex(0.01))
+    monkeypatch.setattr(sighting, "SIGHTING_CLUSTERS", GridAggregates(16))
+    monkeypatch.setattr(sighting, "SIGHTING_DUPLICATES", SpaceTimeBuckets(0.05, 1800, 10))
+    monkeypatch.setattr(sighting, "_built", False)
+    monkeypatch.setattr(sighting, "_last_id", 0)
+    return sighting
+
+
+@pytest.fixture
+def client():
+    """
+    Client of the sightings routes
+    """
+    from app.controllers import sightings
+
+    app = FastAPI()
+    app.include_router(sightings.SIGHTINGS)
+    return TestClient(app)
+
+
+@pytest.fixture
+def headers(fake_db):
+    """
+    Authorization header of a connected user
+    """
+    from app.models.user import User
+
+    user = User(email=EMAIL)
+    sid = user.active_session("tests")
+    token = user.generate_token(EMAIL, expiration_time=timedelta(hours=1), sid=sid)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def add_row(fake_db, latitude, longitude):
+    """Insert a sighting reported by another worker"""
+    now = datetime(2024, 5, 31, 12)
+    fake_db.execute(
+        "INSERT INTO sightings (email, latitude, longitude, status, created_date, updated_date) "
+        "VALUES (%s, %s, %s, 1, %s, %s)", ("bob@cleancomm.com", latitude, longitude, now, now))
+    fake_db.commit()
+
+
+def test_create_sighting(fake_db, index):
+    """
+    A sighting is stored with its outbox event and indexed at once.
+    """
+    created = index.create_sighting(EMAIL, *PARIS, "Bags by the fountain")
+
+    assert created["id"] == 1 and created["status"] == "OPEN"
+    assert index.SIGHTING_INDEX.get(1)[:2] == PARIS
+    fake_db.execute("SELECT event, email, payload FROM outbox")
+    event, email, payload = fake_db.fetch_one()
+    assert (event, email) == ("sighting.created", EMAIL)
+    assert json.loads(payload)["latitude"] == PARIS[0]
+    assert index.get_sighting(1)["description"] == "Bags by the fountain"
+    assert index.get_sighting(2) is None
+
+    with pytest.raises(ValueError):
+        index.create_sighting(EMAIL, 0, 181)
+
+
+def test_index_built_once(fake_db, index, monkeypatch):
+    """
+    The index is loaded by pages on the first query, then kept in memory.
+    """
+    monkeypatch.setattr(index, "SIGHTINGS_BATCH_SIZE", 2)
+    for point in (PARIS, NEAR, FAR):
+        add_row(fake_db, *point)
+
+    assert [found["id"] for found in index.sightings_nearby(*PARIS, 2, 10)] == [1, 2]
+    add_row(fake_db, *PARIS)
+    # Rows of other workers arrive by their events
+    assert [found["id"] for found in index.sightings_nearby(*PARIS, 2, 10)] == [1, 2]
+    index.apply_event("sighting.created", {"id": 4, "latitude": PARIS[0], "longitude": PARIS[1],
+                                           "status": 1, "created_date": "2024-05-31 12:00:00"})
+    assert [found["id"] for found in index.sightings_nearby(*PARIS, 2, 10)] == [1, 4, 2]
+    assert index.build_index() == 4
+
+
+def test_sync_index(fake_db, index):
+    """
+    The sightings created or resolved while the events were missed are
+    indexed by the sync, once the index is built.
+    """
+    add_row(fake_db, *PARIS)
+    assert index.sync_index(datetime(2024, 6, 1)) == 0
+    index.build_index()
+    add_row(fake_db, *NEAR)
+    fake_db.execute("UPDATE sightings SET status = 2, updated_date = %s WHERE id = 1",
+                    (datetime(2024, 6, 1, 12),))
+    fake_db.commit()
+
+    assert index.sync_index(datetime(2024, 6, 1, 12, 0, 30)) == 2
+    assert index.SIGHTING_INDEX.get(2)[:2] == NEAR
+    assert index.SIGHTING_INDEX.get(1)[2]["status"] == "RESOLVED"
+    assert index.sync_index(datetime(2024, 6, 1, 13)) == 0
+
+
+def test_resolve_updates_clusters(fake_db, index):
+    """
+    Resolved sightings leave the clusters once, and stay resolved.
+    """
+    for point in (PARIS, NEAR, FAR):
+        index.create_sighting(EMAIL, *point)
+    assert index.sighting_clusters(48, 2, 49, 3, 4, 64) == [
+        {"count": 3, "latitude": 48.8836, "longitude": 2.3212}]
+
+    resolved = index.resolve_sighting("bob@cleancomm.com", 1)
+    assert resolved["status"] == "RESOLVED"
+    assert index.resolve_sighting("bob@cleancomm.com", 1) == resolved
+    assert index.resolve_sighting("bob@cleancomm.com", 9) is None
+    assert index.sighting_clusters(48, 2, 49, 3, 4, 64) == [
+        {"count": 2, "latitude": 48.8926, "longitude": 2.3212}]
+
+    fake_db.execute("SELECT event, email FROM outbox WHERE event = 'sighting.resolved'")
+    assert fake_db.fetch_all() == [("sighting.resolved", "bob@cleancomm.com")]
+    # A created event delivered late does not open it again
+    index.apply_event("sighting.created", {"id": 1, "latitude": PARIS[0], "longitude": PARIS[1],
+                                           "status": 1, "created_date": "2024-05-31 12:00:00"})
+    assert index.SIGHTING_INDEX.get(1)[2]["status"] == "RESOLVED"
+    assert index.sighting_clusters(48, 2, 49, 3, 4, 64)[0]["count"] == 2
+    # Deeper zoom levels are served by the deepest one kept
+    assert index.sighting_clusters(48.86, 2.3, 48.88, 2.33, 30, 10 ** 4) == [
+        {"count": 1, "latitude": NEAR[0], "longitude": NEAR[1], "id": 2}]
+
+    with pytest.raises(ValueError):
+        index.sighting_clusters(-90, -180, 90, 180, 16, 4096)
+
+
+def test_listener_indexes_sightings(fake_db, index, mocker):
+    """
+    Published sighting events reach the index of every worker.
+    """
+    from app.services.push import PushListener
+
+    listener = PushListener(mocker.MagicMock(), dsns=[])
+    listener.dispatch("user_changes", json.dumps({
+        "id": 9, "email": EMAIL, "event": "sighting.created",
+        "payload": {"id": 3, "latitude": NEAR[0], "longitude": NEAR[1], "status": 1,
+                    "created_date": "2024-05-31 12:00:00"}}))
+
+    assert index.SIGHTING_INDEX.get(3)[:2] == NEAR
+    listener.broker.publish.assert_not_called()
+
+
+# Test for routes /sightings ===================================================
+def test_report_and_query(client, headers, index):
+    """
+    Reported sightings are found around their point and in their box.
+    """
+    for point in (PARIS, NEAR, FAR):
+        response = client.post("/sightings", headers=headers, json={
+            "data": {"latitude": point[0], "longitude": point[1]}})
+        assert response.status_code == 201
+
+    response = client.get("/sightings/nearby", headers=headers,
+                          params={"lat": PARIS[0], "lon": PARIS[1], "radius_km": 2})
+    assert response.status_code == 200
+    assert [(found["id"], found["distance_km"]) for found in response.json()["sightings"]] == [
+        (1, 0), (2, pytest.approx(1.0, abs=0.01))]
+
+    response = client.get("/sightings", headers=headers,
+                          params={"bbox": "2.3,48.86,2.4,48.95", "limit": 2})
+    assert [found["id"] for found in response.json()["sightings"]] == [1, 2]
+
+    response = client.get("/sightings/3", headers=headers)
+    assert response.status_code == 200 and response.json()["email"] == EMAIL
+    assert client.get("/sightings/4", headers=headers).status_code == 404
+
+
+def test_clusters_and_resolve(client, headers, index):
+    """
+    The clusters of a viewport follow the reports and their resolution.
+    """
+    for point in (PARIS, NEAR):
+        client.post("/sightings", headers=headers, json={
+            "data": {"latitude": point[0], "longitude": point[1]}})
+    params = {"bbox": "2,48,3,49", "zoom": 6}
+
+    response = client.get("/sightings/clusters", headers=headers, params=params)
+    assert response.status_code == 200
+    assert [cluster["count"] for cluster in response.json()["clusters"]] == [2]
+
+    response = client.post("/sightings/1/resolve", headers=headers)
+    assert response.status_code == 200 and response.json()["status"] == "RESOLVED"
+    response = client.get("/sightings/clusters", headers=headers, params=params)
+    assert response.json()["clusters"] == [
+        {"count": 1, "latitude": NEAR[0], "longitude": NEAR[1], "id": 2}]
+
+    assert client.post("/sightings/3/resolve", headers=headers).status_code == 404
+    response = client.get("/sightings/clusters", headers=headers,
+                          params={"bbox": "-180,-90,180,90", "zoom": 12})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("data", [
+    {"latitude": 91, "longitude": 0},
+    {"latitude": "48.8", "longitude": 2.3},
+    {"latitude": True, "longitude": 2.3},
+    {"longitude": 2.3},
+    {"latitude": 48.8, "longitude": 2.3, "description": 12},
+    [48.8, 2.3],
+])
+def test_report_invalid(client, headers, index, data):
+    """
+    Positions off the globe and malformed reports are refused.
+    """
+    response = client.post("/sightings", headers=headers, json={"data": data})
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("params", [
+    {"bbox": "2.3,48.9,2.4"},
+    {"bbox": "2.3,48.9,2.4,48.8"},
+    {"bbox": "west,48.8,2.4,48.9"},
+])
+def test_invalid_bbox(client, headers, index, params):
+    """
+    Boxes must be west,south,east,north in degrees.
+    """
+    assert client.get("/sightings", headers=headers, params=params).status_code == 400
+
+
+def test_requires_session(client, fake_db, index):
+    """
+    Sightings are only served to connected users.
+    """
+    assert client.get("/sightings/nearby", params={"lat": 0, "lon": 0}).status_code == 403
+
+
+def test_duplicate_reports(fake_db, index):
+    """
+    Reports of the same pile are linked to the first, left out of the
+    clusters and resolved with it.
+    """
+    first = index.create_sighting(EMAIL, *PARIS)
+    # About 20 m away, then 40 m from the second one but 20 m from the first
+    second = index.create_sighting("bob@cleancomm.com", 48.8658, 2.3212)
+    third = index.create_sighting("bob@cleancomm.com", 48.8654, 2.3212)
+    other = index.create_sighting(EMAIL, *NEAR)
+
+    assert first["duplicate_of"] is None and other["duplicate_of"] is None
+    assert second["duplicate_of"] == third["duplicate_of"] == first["id"]
+    assert [cluster["count"] for cluster in index.sighting_clusters(48, 2, 49, 3, 4, 64)] == [2]
+    assert index.get_sighting(first["id"])["duplicates"] == 2
+    fake_db.execute("SELECT payload FROM outbox WHERE event = 'sighting.created'")
+    assert json.loads(fake_db.fetch_all()[1][0])["duplicate_of"] == first["id"]
+
+    assert index.resolve_sighting(EMAIL, first["id"])["status"] == "RESOLVED"
+    assert index.get_sighting(third["id"])["status"] == "RESOLVED"
+    fake_db.execute("SELECT count(*) FROM outbox WHERE event = 'sighting.resolved'")
+    assert fake_db.fetch_one()[0] == 3
+    # The pile is back: a new report is a new sighting
+    assert index.create_sighting(EMAIL, *PARIS)["duplicate_of"] is None
+
+    # Other workers link the duplicates of their reports
+    index.apply_event("sighting.created", {
+        "id": 9, "latitude": NEAR[0], "longitude": NEAR[1], "status": 1,
+        "created_date": str(datetime.utcnow()), "duplicate_of": other["id"], "hashes": []})
+    assert index.SIGHTING_INDEX.get(9)[2]["duplicate_of"] == other["id"]
+    assert [cluster["count"] for cluster in index.sighting_clusters(48, 2, 49, 3, 4, 64)] == [2]
+
+
+def test_duplicate_hashes_survive_rebuild(fake_db, index, monkeypatch):
+    """
+    The hashes of the report photos are stored and read back when the
+    index is built again.
+    """
+    from app.services.geo_index import GeoIndex, GridAggregates, SpaceTimeBuckets
+
+    # Above the largest signed BIGINT
+    phash = 0xF0F0F0F0F0F0F0F0
+    index.create_sighting(EMAIL, *PARIS, photos=["a" * 64], hashes=(phash,))
+    index.add_photos(EMAIL, 1, ["b" * 64])
+    monkeypatch.setattr(index, "SIGHTING_INDEX", GeoIndex(0.01))
+    monkeypatch.setattr(index, "SIGHTING_CLUSTERS", GridAggregates(16))
+    monkeypatch.setattr(index, "SIGHTING_DUPLICATES", SpaceTimeBuckets(0.05, 1800, 10))
+    monkeypatch.setattr(index, "_built", False)
+
+    assert index.build_index() == 1
+    other = index.create_sighting(EMAIL, *PARIS, photos=["c" * 64], hashes=(~phash & 2 ** 64 - 1,))
+    assert other["duplicate_of"] is None
+    same = index.create_sighting(EMAIL, *PARIS, photos=["d" * 64], hashes=(phash ^ 1,))
+    assert same["duplicate_of"] == 1
+    with pytest.raises(ValueError):
+        index.create_sighting(EMAIL, *PARIS, photos=["e" * 64])
+
+
+def test_concurrent_reports_one_canonical(fake_db, index, monkeypatch):
+    """
+    Reports of the same place sent together to a worker are checked one at
+    a time: only the first stays canonical.
+    """
+    canonical = index._canonical  # pylint: disable=protected-access
+
+    def slow_canonical(*args):
+        found = canonical(*args)
+        time.sleep(0.05)
+        return found
+
+    index.build_index()
+    monkeypatch.setattr(index, "_canonical", slow_canonical)
+    created = []
+    threads = [threading.Thread(target=lambda: created.append(index.create_sighting(EMAIL, *PARIS)))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [sighting["duplicate_of"] for sighting in created] == [None, 1, 1]
@@ -6,7 +6,6 @@ from datetime import datetime, timedelta
 import jwt
 import bcrypt
 import pytest
-from unittest.mock import MagicMock
 import psycopg2
 
 TEST_EMAIL = "cleancomm@gmail.com"
@@ -19,37 +18,14 @@ SECRET_KEY = "secret-key"
 ALGORITHM = "HS256"
 FAKE_EMAIL = "fake@cleancomm.com"
 
-class MockPostgresDatabase:
-
-    def __init__(self):
-        self.cursor = MagicMock()
-
-    def execute(self, query, params=None):
-        print(params)
-        self.cursor.execute.assert_called_with(query, params)
-        if params[0] == "duplicate email":
-            raise psycopg2.IntegrityError(pgcode="23505")
-
-    def fetch_one(self):
-        return self.cursor.fetchone.return_value
-
-    def fetch_all(self):
-        return self.cursor.fetchall.return_value
-
-    def commit(self):
-        self.cursor.commit.assert_called()
-
-    def rollback(self):
-        self.cursor.rollback.assert_called()
-
 @pytest.fixture
 def mock_salt(mocker):
     """
-    Fixture to mock salt
+    Fixture to mock the bcrypt cost
     Args:
         mocker (MockFixture): use to mock object, function ...
     """
-    mocker.patch('app.models.user.salt', "$2b$12$dMDN8PpZYSUQmCh.dM3euO")
+    mocker.patch('app.services.passwords.BCRYPT_COST', 12)
 
 
 @pytest.fixture
@@ -57,9 +33,7 @@ def mock_db(mocker):
     """
     mock the DB class instance
     """
-    mock_postgres_db = MockPostgresDatabase()
-    mocker.patch("app.models.user.PostgresDB")
-    return mocker.patch("app.models.user.PostgresDB", return_value=mock_postgres_db)
+    return mocker.patch("app.models.user.PostgresDB")
 
 @pytest.fixture
 def mock_user_select(mocker):
@@ -540,4 +514,130 @@ def test_setattr_without_kwargs(mock_user_select, expected_result):
     expected_result is None
     user.setattr(**expected_result) is None
     mock_user_select.return_value == None
-    user.select() == None
\ No newline at end of file
+    user.select() == None
+
+
+# Tests on the fake database ===================================================
+def create_user(email=TEST_EMAIL, password=TEST_PASSWORD):
+    """Create a user through the model"""
+    from app.models.user import User
+
+    user = User(email=email, password=password, host=TEST_HOST,
+                first_name=TEST_FIRSTNAME, last_name=TEST_LASTNAME, lang="fr")
+    return user.create()
+
+
+def test_create_and_select_with_fake_db(fake_db):
+    """
+    A created user is found by select with its stored columns
+    """
+    from app.models.user import User, Status
+
+    created = create_user()
+    assert created["email"] == TEST_EMAIL
+    assert "password" not in created
+
+    user = User(email=TEST_EMAIL)
+    selected = user.select()
+    assert selected["first_name"] == TEST_FIRSTNAME
+    assert selected["status"] == Status.PENDING.value
+    assert isinstance(selected["created_date"], datetime)
+    assert user.last_name == TEST_LASTNAME
+
+
+def test_create_duplicate_with_fake_db(fake_db):
+    """
+    Creating an existing email reports it instead of raising
+    """
+    create_user()
+    assert create_user() == {"message": "User exists"}
+
+
+def test_update_and_authenticate_with_fake_db(fake_db):
+    """
+    An activated user with a new password can log in with it only
+    """
+    from app.models.user import User, Status
+
+    create_user()
+    updated = User(email=TEST_EMAIL).update(
+        {"password": TEST_NEW_PASSWORD, "status": Status.ACTIVE.value}
+    )
+    assert updated["status"] == Status.ACTIVE.value
+
+    assert User(email=TEST_EMAIL, password=TEST_PASSWORD).authenticate_user() is False
+    login = User(email=TEST_EMAIL, password=TEST_NEW_PASSWORD).authenticate_user("phone")
+    sid = jwt.decode(login["access_token"], SECRET_KEY, algorithms=[ALGORITHM])["sid"]
+    assert User(email=TEST_EMAIL).is_session_active(sid)
+
+
+def concurrent_write(mocker, fake_db, **changes):
+    """Apply changes to the user right after the update reads it"""
+    from app.models.user import User
+
+    select = User.select
+
+    def select_then_write(user):
+        row = select(user)
+        if not select_then_write.done:
+            select_then_write.done = True
+            assignments = ", ".join(f"{column} = %s" for column in changes)
+            fake_db.execute(f"UPDATE users SET {assignments}, version = version + 1 "
+                            "WHERE email = %s", (*changes.values(), user.email))
+            fake_db.commit()
+        return row
+    select_then_write.done = False
+    mocker.patch.object(User, "select", select_then_write)
+
+
+def test_update_increments_version_with_fake_db(fake_db):
+    """
+    Every update bumps the version of the user
+    """
+    from app.models.user import User
+
+    create_user()
+    assert User(email=TEST_EMAIL).select()["version"] == 0
+    assert User(email=TEST_EMAIL).update({"lang": "en"})["version"] == 1
+    assert User(email=TEST_EMAIL).update({"lang": "fr", "version": 1})["version"] == 2
+
+
+def test_update_merges_concurrent_change_with_fake_db(fake_db, mocker):
+    """
+    A concurrent update of other fields is kept and the update retried
+    """
+    from app.models.user import User
+
+    create_user()
+    concurrent_write(mocker, fake_db, first_name="Ada")
+    updated = User(email=TEST_EMAIL).update({"lang": "en"})
+
+    assert updated["first_name"] == "Ada"
+    assert updated["lang"] == "en"
+    assert updated["version"] == 2
+
+
+def test_update_conflict_with_fake_db(fake_db, mocker):
+    """
+    A concurrent update of the same field is not overwritten
+    """
+    from app.models.user import User, UpdateConflictError
+
+    create_user()
+    concurrent_write(mocker, fake_db, lang="de")
+    with pytest.raises(UpdateConflictError):
+        User(email=TEST_EMAIL).update({"lang": "en"})
+
+    assert User(email=TEST_EMAIL).select()["lang"] == "de"
+
+
+def test_update_stale_version_with_fake_db(fake_db):
+    """
+    An update from an outdated read is refused
+    """
+    from app.models.user import User, UpdateConflictError
+
+    create_user()
+    User(email=TEST_EMAIL).update({"first_name": "Ada"})
+    with pytest.raises(UpdateConflictError):
+        User(email=TEST_EMAIL).update({"lang": "en", "version": 0})
@@ -0,0 +1,185 @@
+"""
+This file contains the tests for the users administration routes.
+"""
+from datetime import datetime, timedelta
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+ADMIN_EMAIL = "admin@cleancomm.com"
+FAST_COST = 4
+CSV_HEADER = "email,host,first_name,last_name,lang,password"
+
+
+@pytest.fixture
+def client():
+    """
+    Fixture for the test client.
+    """
+    from app.controllers import users
+
+    app = FastAPI()
+    app.include_router(users.USERS)
+    return TestClient(app)
+
+
+@pytest.fixture
+def admin_headers(fake_db, mocker):
+    """
+    Authorization header of a connected admin
+    """
+    from app.models.user import User
+
+    mocker.patch("app.services.apphttpbearer.ADMIN_EMAILS", [ADMIN_EMAIL])
+    mocker.patch("app.services.passwords.BCRYPT_COST", FAST_COST)
+    user = User(email=ADMIN_EMAIL)
+    sid = user.active_session("tests")
+    token = user.generate_token(ADMIN_EMAIL, expiration_time=timedelta(hours=1), sid=sid)
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def mock_invites(mocker):
+    """
+    Mock of the invites mails
+    """
+    return mocker.patch("app.services.bulk_import.send_recovery_mails")
+
+
+# Test for route /user/bulk-import =============================================
+def test_bulk_import_csv(client, admin_headers, mock_invites):
+    """
+    Valid rows are created and invited, the others reported by line.
+    """
+    from app.models.user import User, Status
+
+    body = "\n".join([
+        CSV_HEADER,
+        "ada@cleancomm.com,https://host,Ada,Lovelace,en,secret",
+        "not-an-email,https://host,Bad,Email,en,",
+        "bob@cleancomm.com,https://host,Bob,,fr,",
+        "grace@cleancomm.com,https://host,Grace,Hopper,en,",
+        "grace@cleancomm.com,https://host,Grace,Again,en,",
+        "too,few",
+    ])
+    response = client.post("/user/bulk-import", content=body,
+                           headers={**admin_headers, "Content-Type": "text/csv"})
+
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+    assert [(error["line"], error["error"]) for error in response.json()["errors"]] == [
+        (3, "Invalid email."),
+        (4, "Missing fields: last_name."),
+        (6, "Duplicate email in import."),
+        (7, "Expected 6 values, got 2."),
+    ]
+
+    ada = User(email="ada@cleancomm.com").select()
+    assert ada["status"] == Status.PENDING.value
+    assert ada["password"].startswith("b'$2b$04$")
+    assert User(email="grace@cleancomm.com").select() is not None
+
+    invited = [invite["email"] for call in mock_invites.call_args_list
+               for invite in call.args[0]]
+    assert invited == ["ada@cleancomm.com", "grace@cleancomm.com"]
+
+
+def test_bulk_import_ndjson_existing_user(client, admin_headers, mock_invites):
+    """
+    Existing emails are reported without aborting the batch.
+    """
+    record = {"email": "ada@cleancomm.com", "host": "https://host",
+              "first_name": "Ada", "last_name": "Lovelace", "lang": "en"}
+    first = client.post("/user/bulk-import", content=json.dumps(record),
+                        headers={**admin_headers, "Content-Type": "application/x-ndjson"})
+    assert first.json() == {"created": 1, "errors": []}
+
+    other = dict(record, email="bob@cleancomm.com")
+    body = "\n".join([json.dumps(record), "[1, 2]", json.dumps(other)])
+    second = client.post("/user/bulk-import", content=body,
+                         headers={**admin_headers, "Content-Type": "application/x-ndjson"})
+    assert second.json()["created"] == 1
+    assert [(error["line"], error["error"]) for error in second.json()["errors"]] == [
+        (1, "User exists"),
+        (2, "Record must be an object."),
+    ]
+
+
+def test_bulk_import_unsupported_format(client, admin_headers):
+    """
+    Bodies other than CSV or NDJSON are refused.
+    """
+    response = client.post("/user/bulk-import", json={"data": []}, headers=admin_headers)
+    assert response.status_code == 415
+
+
+def test_bulk_import_requires_admin(client, admin_headers, mocker):
+    """
+    Connected users that are not admins are refused.
+    """
+    mocker.patch("app.services.apphttpbearer.ADMIN_EMAILS", [])
+    response = client.post("/user/bulk-import", content=CSV_HEADER,
+                           headers={**admin_headers, "Content-Type": "text/csv"})
+    assert response.status_code == 403
+
+
+@pytest.fixture
+def listed_users(fake_db):
+    """
+    Seven users created a day apart, the admin aside
+    """
+    from app.resources.db_utils.user_queries import USER_INSERT_QUERY
+
+    for index in range(7):
+        created = datetime(2024, 1, 1) + timedelta(days=index)
+        fake_db.execute(USER_INSERT_QUERY, (
+            f"user{index}@cleancomm.com", "b'hash'", "https://host" if index % 2 else "https://other",
+            "First", "Last", "fr" if index < 3 else "en", created, created,
+            1 if index % 2 else 2,
+        ))
+    fake_db.commit()
+
+
+# Test for route /user/list ====================================================
+def test_list_users_pages(client, admin_headers, listed_users):
+    """
+    Pages follow each other newest first, without overlap.
+    """
+    emails, cursor = [], None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/user/list", params=params, headers=admin_headers).json()
+        assert len(page["users"]) <= 3
+        assert "password" not in page["users"][0]
+        emails.extend(user["email"] for user in page["users"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert emails == [f"user{index}@cleancomm.com" for index in range(6, -1, -1)]
+    assert page["estimated_total"] == 7
+
+
+def test_list_users_filters(client, admin_headers, listed_users):
+    """
+    Filters are combined and applied to the estimate.
+    """
+    response = client.get("/user/list", headers=admin_headers,
+                          params={"status": "active", "lang": "en", "host": "https://host"})
+
+    assert response.status_code == 200
+    assert [user["email"] for user in response.json()["users"]] == [
+        "user5@cleancomm.com", "user3@cleancomm.com"]
+    assert response.json()["next_cursor"] is None
+    assert response.json()["estimated_total"] == 2
+
+
+@pytest.mark.parametrize("params", [{"cursor": "not-a-cursor"}, {"status": "unknown"}])
+def test_list_users_invalid_params(client, admin_headers, params):
+    """
+    Invalid cursors and statuses are refused.
+    """
+    response = client.get("/user/list", params=params, headers=admin_headers)
+    assert response.status_code == 400
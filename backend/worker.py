@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+(C)Copyright 2024, PROJECT
+CleanComm Project by Guy Ahonakpon GBAGUIDI
+
+Worker running the background jobs, next to the API of main.py:
+    python worker.py
+"""
+import logging
+import signal
+import threading
+
+import app.services.scheduled_jobs  # pylint: disable=unused-import
+from app.services.jobs import JobWorker
+from app.services.write_behind import flush_all
+
+
+def main():
+    """
+    Run the jobs until SIGINT or SIGTERM, then wait for the running ones
+    """
+    logging.basicConfig(level=logging.INFO)
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopped.set())
+    worker = JobWorker()
+    worker.start()
+    stopped.wait()
+    worker.stop()
+    flush_all()
+
+
+if __name__ == "__main__":
+    main()